@@ -0,0 +1,435 @@
+"""Benchmark and load test the recreation server on synthetic photos.
+
+Generates a synthetic photo CSV, builds the global quadtree with
+``recmodel_server.construct_userday_quadtree``, serves a ``RecModel`` on a
+local Pyro daemon and replays concurrent client requests with AOIs of
+varying polygon counts.  Reports the quadtree build time and size, request
+latency overall and per server phase, throughput, and the peak resident
+memory of this process and its children.
+
+Example:
+
+    python benchmark_recmodel_server.py --workspace bench \\
+        --n-photos 2000000 --skew 0.8 --polygon-counts 1 100 1000 \\
+        --n-clients 4 --n-requests 8 --report-path bench/report.json
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+import numpy
+import psutil
+import Pyro4
+from osgeo import ogr
+from osgeo import osr
+
+from natcap.invest.recreation import recmodel_client
+from natcap.invest.recreation import recmodel_server
+
+Pyro4.config.SERIALIZER = 'marshal'
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s')
+LOGGER = logging.getLogger('benchmark_recmodel_server.py')
+# the server logs every request in detail
+logging.getLogger('natcap.invest.recreation').setLevel(logging.WARNING)
+
+_PHOTO_CSV_HEADER = b'id,owner,datetaken,latitude,longitude,accuracy\n'
+_PHOTOS_PER_BLOCK = 2 ** 18
+_MIN_YEAR = 2005
+_MAX_YEAR = 2014
+# seconds between job status polls, short so latency is measured closely
+_POLL_INTERVAL = 0.05
+# degrees of latitude and longitude covered by each AOI
+_AOI_WIDTH = 2.0
+
+
+def generate_photo_csv(
+        csv_path, n_photos, bounding_box, skew, n_clusters, n_users, seed):
+    """Write a synthetic photo CSV in the recreation server's format.
+
+    Args:
+        csv_path (string): path to the CSV to create.
+        n_photos (int): number of photo records to write.
+        bounding_box (list): [lng_min, lat_min, lng_max, lat_max] the photos
+            are placed in.
+        skew (float): fraction of the photos drawn from clusters, the rest
+            are uniform over ``bounding_box``.  1.0 puts every photo in a
+            cluster.
+        n_clusters (int): number of normally distributed photo clusters.
+        n_users (int): number of distinct photo owners.
+        seed (int): seed of the random generator.
+
+    Returns:
+        numpy array of the (lng, lat) cluster centers.
+    """
+    rng = numpy.random.RandomState(seed)
+    lng_min, lat_min, lng_max, lat_max = bounding_box
+    cluster_centers = numpy.column_stack((
+        rng.uniform(lng_min, lng_max, n_clusters),
+        rng.uniform(lat_min, lat_max, n_clusters)))
+    cluster_sigma = rng.uniform(0.05, 1.0, n_clusters)
+    n_days = (
+        datetime.date(_MAX_YEAR, 12, 31) -
+        datetime.date(_MIN_YEAR, 1, 1)).days + 1
+    first_day = numpy.datetime64('%d-01-01' % _MIN_YEAR)
+
+    with open(csv_path, 'wb') as csv_file:
+        csv_file.write(_PHOTO_CSV_HEADER)
+        for block_start in range(0, n_photos, _PHOTOS_PER_BLOCK):
+            n_block = min(_PHOTOS_PER_BLOCK, n_photos - block_start)
+            clustered = rng.uniform(size=n_block) < skew
+            cluster_index = rng.randint(0, n_clusters, n_block)
+            lng = numpy.where(
+                clustered,
+                cluster_centers[cluster_index, 0] + rng.normal(
+                    size=n_block) * cluster_sigma[cluster_index],
+                rng.uniform(lng_min, lng_max, n_block))
+            lat = numpy.where(
+                clustered,
+                cluster_centers[cluster_index, 1] + rng.normal(
+                    size=n_block) * cluster_sigma[cluster_index],
+                rng.uniform(lat_min, lat_max, n_block))
+            lng = numpy.clip(lng, lng_min, lng_max)
+            lat = numpy.clip(lat, lat_min, lat_max)
+            date_array = (
+                first_day + rng.randint(0, n_days, n_block)).astype(str)
+            user_array = rng.randint(0, n_users, n_block)
+            second_array = rng.randint(0, 24 * 60 * 60, n_block)
+            csv_file.write(''.join([
+                '%d,%d@N00,%s %02d:%02d:%02d,%.6f,%.6f,16\n' % (
+                    block_start + index, user_id, date_string,
+                    seconds // 3600, seconds // 60 % 60, seconds % 60,
+                    lat_value, lng_value)
+                for index, (user_id, date_string, seconds, lat_value,
+                            lng_value) in enumerate(zip(
+                                user_array.tolist(), date_array.tolist(),
+                                second_array.tolist(), lat.tolist(),
+                                lng.tolist()))]).encode('ascii'))
+    return cluster_centers
+
+
+def build_aoi_archive(archive_path, n_polygons, center, aoi_width):
+    """Write a zipped grid of square AOI polygons in lat/lng.
+
+    Args:
+        archive_path (string): path to the zip archive to create.
+        n_polygons (int): number of polygons in the AOI.
+        center (tuple): (lng, lat) center of the AOI.
+        aoi_width (float): width and height in degrees of the square the
+            polygons are laid out in.
+
+    Returns:
+        None
+    """
+    n_side = int(math.ceil(math.sqrt(n_polygons)))
+    cell_size = aoi_width / n_side
+    lng_origin = center[0] - aoi_width / 2
+    lat_origin = center[1] - aoi_width / 2
+
+    aoi_dir = os.path.splitext(archive_path)[0]
+    os.makedirs(aoi_dir)
+    aoi_path = os.path.join(aoi_dir, 'aoi.shp')
+    lat_lng_ref = osr.SpatialReference()
+    lat_lng_ref.ImportFromEPSG(4326)
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    aoi_vector = driver.CreateDataSource(aoi_path)
+    aoi_layer = aoi_vector.CreateLayer('aoi', lat_lng_ref, ogr.wkbPolygon)
+    aoi_layer.StartTransaction()
+    for poly_index in range(n_polygons):
+        row_index, col_index = divmod(poly_index, n_side)
+        x_min = lng_origin + col_index * cell_size
+        y_min = lat_origin + row_index * cell_size
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x_coord, y_coord in [
+                (x_min, y_min), (x_min + cell_size, y_min),
+                (x_min + cell_size, y_min + cell_size),
+                (x_min, y_min + cell_size), (x_min, y_min)]:
+            ring.AddPoint_2D(x_coord, y_coord)
+        polygon = ogr.Geometry(ogr.wkbPolygon)
+        polygon.AddGeometry(ring)
+        feature = ogr.Feature(aoi_layer.GetLayerDefn())
+        feature.SetGeometry(polygon)
+        aoi_layer.CreateFeature(feature)
+        feature = None
+    aoi_layer.CommitTransaction()
+    aoi_layer = None
+    aoi_vector = None
+
+    with zipfile.ZipFile(archive_path, 'w') as aoi_zip:
+        for filename in os.listdir(aoi_dir):
+            aoi_zip.write(os.path.join(aoi_dir, filename), filename)
+    shutil.rmtree(aoi_dir)
+
+
+class PeakMemoryMonitor(object):
+    """Sample the resident memory of this process and its children."""
+
+    def __init__(self, interval=0.1):
+        """Start sampling every ``interval`` seconds in a thread."""
+        self.interval = interval
+        self.peak_rss = 0
+        self._process = psutil.Process()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sample(self):
+        """Record the largest total resident memory seen."""
+        while not self._stop_event.is_set():
+            total_rss = 0
+            for process in [self._process] + self._process.children(
+                    recursive=True):
+                try:
+                    total_rss += process.memory_info().rss
+                except psutil.Error:
+                    # the process exited between listing and sampling it
+                    pass
+            self.peak_rss = max(self.peak_rss, total_rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the peak resident memory in bytes."""
+        self._stop_event.set()
+        self._thread.join()
+        return self.peak_rss
+
+
+def run_request(server_uri, aoi_archive_path, date_range):
+    """Send one AOI to the server and wait for its result.
+
+    Args:
+        server_uri (string): Pyro URI of the RecModel.
+        aoi_archive_path (string): path to the zipped AOI.
+        date_range (tuple): inclusive start and end dates as 'YYYY-MM-DD'.
+
+    Returns:
+        dictionary of the request's 'latency', 'upload_seconds',
+        'download_seconds' and the server's 'phase_seconds'.
+    """
+    recmodel_server_proxy = Pyro4.Proxy(server_uri)
+    start_time = time.time()
+    session_id = recmodel_client._upload_aoi(
+        recmodel_server_proxy, aoi_archive_path)
+    upload_time = time.time()
+    job_id = recmodel_server_proxy.submit_job(
+        session_id, date_range, 'pud_results.shp')
+    while True:
+        job_status = recmodel_server_proxy.get_job_status(job_id)
+        if job_status['phase'] == 'done':
+            break
+        if job_status['phase'] == 'failed':
+            raise RuntimeError(
+                'job %s failed: %s' % (job_id, job_status['error']))
+        time.sleep(_POLL_INTERVAL)
+    done_time = time.time()
+    n_bytes = 0
+    for chunk_binary in recmodel_client._iter_result_chunks(
+            recmodel_server_proxy, job_id, job_status['result_size']):
+        n_bytes += len(chunk_binary)
+    end_time = time.time()
+    recmodel_server_proxy._pyroRelease()
+    return {
+        'latency': end_time - start_time,
+        'upload_seconds': upload_time - start_time,
+        'download_seconds': end_time - done_time,
+        'phase_seconds': job_status['phase_seconds'],
+    }
+
+
+def _summarize(value_list):
+    """Return the mean, median, 90th percentile and max of values."""
+    value_array = numpy.array(value_list, dtype=numpy.float64)
+    return {
+        'mean': float(numpy.mean(value_array)),
+        'p50': float(numpy.percentile(value_array, 50)),
+        'p90': float(numpy.percentile(value_array, 90)),
+        'max': float(numpy.max(value_array)),
+    }
+
+
+def _directory_size(dir_path):
+    """Return the total size in bytes of the files under a directory."""
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _, filename_list in os.walk(dir_path)
+        for filename in filename_list)
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--workspace', required=True,
+        help='directory for the photo CSV, quadtree and request workspaces')
+    parser.add_argument(
+        '--n-photos', type=int, default=1000000,
+        help='number of synthetic photos')
+    parser.add_argument(
+        '--skew', type=float, default=0.8,
+        help='fraction of photos in clusters rather than uniform')
+    parser.add_argument(
+        '--n-clusters', type=int, default=50,
+        help='number of photo clusters')
+    parser.add_argument(
+        '--n-users', type=int, default=100000,
+        help='number of distinct photo owners')
+    parser.add_argument(
+        '--bounding-box', type=float, nargs=4,
+        default=[-125.0, 25.0, -65.0, 50.0],
+        metavar=('LNG_MIN', 'LAT_MIN', 'LNG_MAX', 'LAT_MAX'),
+        help='lat/lng box the photos are placed in')
+    parser.add_argument(
+        '--seed', type=int, default=1, help='seed of the random generator')
+    parser.add_argument(
+        '--polygon-counts', type=int, nargs='+', default=[1, 10, 100, 1000],
+        help='AOI polygon counts to replay requests with')
+    parser.add_argument(
+        '--n-clients', type=int, default=4,
+        help='number of clients sending requests at once')
+    parser.add_argument(
+        '--n-requests', type=int, default=8,
+        help='requests to send for each polygon count')
+    parser.add_argument(
+        '--n-polytest-workers', type=int, default=None,
+        help="size of the server's polygon test pool, defaults to the CPUs")
+    parser.add_argument(
+        '--max-concurrent-requests', type=int,
+        default=recmodel_server.MAX_CONCURRENT_REQUESTS,
+        help='requests the server aggregates at once')
+    parser.add_argument(
+        '--max-points-per-node', type=int,
+        default=recmodel_server.GLOBAL_MAX_POINTS_PER_NODE,
+        help='maximum points per node of the global quadtree')
+    parser.add_argument(
+        '--report-path', help='path to write the JSON report to')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.workspace):
+        os.makedirs(args.workspace)
+    memory_monitor = PeakMemoryMonitor()
+    report = {'args': vars(args), 'n_cpus': multiprocessing.cpu_count()}
+
+    csv_path = os.path.join(args.workspace, 'photos.csv')
+    LOGGER.info('generating %d photos in %s', args.n_photos, csv_path)
+    start_time = time.time()
+    cluster_centers = generate_photo_csv(
+        csv_path, args.n_photos, args.bounding_box, args.skew,
+        args.n_clusters, args.n_users, args.seed)
+    report['csv_seconds'] = time.time() - start_time
+    report['csv_bytes'] = os.path.getsize(csv_path)
+
+    cache_dir = os.path.join(args.workspace, 'server_cache')
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+    LOGGER.info('building quadtree')
+    start_time = time.time()
+    _, qt_index_path = recmodel_server.construct_userday_quadtree(
+        [-180, -90, 180, 90], csv_path, cache_dir, args.max_points_per_node)
+    report['build_seconds'] = time.time() - start_time
+    report['index_bytes'] = os.path.getsize(qt_index_path)
+    report['quadtree_bytes'] = _directory_size(cache_dir)
+    LOGGER.info(
+        'built quadtree in %.2fs, index is %d bytes',
+        report['build_seconds'], report['index_bytes'])
+
+    # the model finds the quadtree already built in the cache
+    rec_model = recmodel_server.RecModel(
+        csv_path, _MIN_YEAR, _MAX_YEAR, cache_dir,
+        max_points_per_node=args.max_points_per_node,
+        n_polytest_workers=args.n_polytest_workers,
+        max_concurrent_requests=args.max_concurrent_requests,
+        max_queued_jobs=args.n_clients * args.n_requests)
+    daemon = Pyro4.Daemon('localhost', 0)
+    server_uri = daemon.register(rec_model, 'natcap.invest.recreation')
+    daemon_thread = threading.Thread(target=daemon.requestLoop)
+    daemon_thread.daemon = True
+    daemon_thread.start()
+    LOGGER.info('serving %s', server_uri)
+
+    date_range = ('%d-01-01' % _MIN_YEAR, '%d-12-31' % _MAX_YEAR)
+    rng = numpy.random.RandomState(args.seed)
+    aoi_dir = os.path.join(args.workspace, 'aoi')
+    if os.path.exists(aoi_dir):
+        shutil.rmtree(aoi_dir)
+    os.makedirs(aoi_dir)
+    report['requests'] = {}
+    for n_polygons in args.polygon_counts:
+        # center each AOI near a different cluster so no request is answered
+        # from the result cache
+        aoi_archive_list = []
+        for request_index in range(args.n_requests):
+            center = cluster_centers[
+                rng.randint(len(cluster_centers))] + rng.uniform(
+                    -0.5, 0.5, 2)
+            aoi_archive_path = os.path.join(
+                aoi_dir, 'aoi_%d_%d.zip' % (n_polygons, request_index))
+            build_aoi_archive(
+                aoi_archive_path, n_polygons, center, _AOI_WIDTH)
+            aoi_archive_list.append(aoi_archive_path)
+
+        LOGGER.info(
+            'sending %d requests of %d polygons from %d clients',
+            args.n_requests, n_polygons, args.n_clients)
+        start_time = time.time()
+        with concurrent.futures.ThreadPoolExecutor(
+                args.n_clients) as executor:
+            result_list = list(executor.map(
+                lambda aoi_archive_path: run_request(
+                    server_uri, aoi_archive_path, date_range),
+                aoi_archive_list))
+        elapsed_time = time.time() - start_time
+
+        phase_set = set()
+        for result in result_list:
+            phase_set.update(result['phase_seconds'])
+        report['requests'][n_polygons] = {
+            'n_requests': len(result_list),
+            'requests_per_second': len(result_list) / elapsed_time,
+            'latency': _summarize(
+                [result['latency'] for result in result_list]),
+            'upload_seconds': _summarize(
+                [result['upload_seconds'] for result in result_list]),
+            'download_seconds': _summarize(
+                [result['download_seconds'] for result in result_list]),
+            'phase_seconds': dict(
+                (phase, _summarize([
+                    result['phase_seconds'].get(phase, 0.0)
+                    for result in result_list]))
+                for phase in sorted(phase_set)),
+        }
+        LOGGER.info(
+            '%d polygons: %.2f requests/s, latency p50 %.2fs p90 %.2fs',
+            n_polygons,
+            report['requests'][n_polygons]['requests_per_second'],
+            report['requests'][n_polygons]['latency']['p50'],
+            report['requests'][n_polygons]['latency']['p90'])
+        for phase, phase_summary in sorted(
+                report['requests'][n_polygons]['phase_seconds'].items()):
+            LOGGER.info(
+                '    %-24s mean %.3fs p90 %.3fs', phase,
+                phase_summary['mean'], phase_summary['p90'])
+
+    daemon.shutdown()
+    report['peak_rss_bytes'] = memory_monitor.stop()
+    LOGGER.info('peak resident memory %d bytes', report['peak_rss_bytes'])
+    if args.report_path:
+        with open(args.report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+        LOGGER.info('wrote report to %s', args.report_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -89,6 +89,13 @@ setup(
         'Topic :: Scientific/Engineering :: GIS'
     ],
     ext_modules=[
+        Extension(
+            name="natcap.invest.managed_raster",
+            sources=['src/natcap/invest/managed_raster.pyx'],
+            include_dirs=[numpy.get_include(), 'src/natcap/invest'],
+            extra_compile_args=compiler_and_linker_args,
+            extra_link_args=compiler_and_linker_args,
+            language="c++"),
         Extension(
             name="natcap.invest.delineateit.delineateit_core",
             sources=['src/natcap/invest/delineateit/delineateit_core.pyx'],
@@ -108,22 +115,21 @@ setup(
             name="natcap.invest.scenic_quality.viewshed",
             sources=[
                 'src/natcap/invest/scenic_quality/viewshed.pyx'],
-            include_dirs=[numpy.get_include(),
-                          'src/natcap/invest/scenic_quality'],
+            include_dirs=[numpy.get_include(), 'src/natcap/invest'],
             extra_compile_args=compiler_and_linker_args,
             extra_link_args=compiler_and_linker_args,
             language="c++"),
         Extension(
             name="natcap.invest.ndr.ndr_core",
             sources=['src/natcap/invest/ndr/ndr_core.pyx'],
-            include_dirs=[numpy.get_include()],
+            include_dirs=[numpy.get_include(), 'src/natcap/invest'],
             extra_compile_args=compiler_and_linker_args,
             extra_link_args=compiler_and_linker_args,
             language="c++"),
         Extension(
             name="natcap.invest.sdr.sdr_core",
             sources=['src/natcap/invest/sdr/sdr_core.pyx'],
-            include_dirs=[numpy.get_include()],
+            include_dirs=[numpy.get_include(), 'src/natcap/invest'],
             extra_compile_args=compiler_and_linker_args,
             extra_link_args=compiler_and_linker_args,
             language="c++"),
@@ -133,7 +139,7 @@ setup(
             sources=[
                 ("src/natcap/invest/seasonal_water_yield/"
                  "seasonal_water_yield_core.pyx")],
-            include_dirs=[numpy.get_include()],
+            include_dirs=[numpy.get_include(), 'src/natcap/invest'],
             extra_compile_args=compiler_and_linker_args,
             extra_link_args=compiler_and_linker_args,
             language="c++"),
@@ -15,6 +15,7 @@ import pygeoprocessing
 import pygeoprocessing.routing
 import taskgraph
 
+from .. import hydrology_cache
 from .. import utils
 from .. import validation
 from . import delineateit_core
@@ -202,7 +203,7 @@ def execute(args):
     graph = taskgraph.TaskGraph(work_token_dir, n_workers=n_workers)
 
     fill_pits_task = graph.add_task(
-        pygeoprocessing.routing.fill_pits,
+        hydrology_cache.fill_pits,
         args=((args['dem_path'], 1),
               file_registry['filled_dem']),
         kwargs={'working_dir': output_directory},
@@ -212,7 +213,7 @@ def execute(args):
         copy_duplicate_artifact=True)
 
     flow_dir_task = graph.add_task(
-        pygeoprocessing.routing.flow_dir_d8,
+        hydrology_cache.flow_dir_d8,
         args=((file_registry['filled_dem'], 1),
               file_registry['flow_dir_d8']),
         kwargs={'working_dir': output_directory},
@@ -254,7 +255,7 @@ def execute(args):
     delineation_dependent_tasks = [flow_dir_task, geometry_task]
     if 'snap_points' in args and args['snap_points']:
         flow_accumulation_task = graph.add_task(
-            pygeoprocessing.routing.flow_accumulation_d8,
+            hydrology_cache.flow_accumulation_d8,
             args=((file_registry['flow_dir_d8'], 1),
                   file_registry['flow_accumulation']),
             target_path_list=[file_registry['flow_accumulation']],
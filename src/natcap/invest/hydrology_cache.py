@@ -0,0 +1,457 @@
+"""Cache of routed hydrology products shared between models and runs.
+
+NDR, SDR, Seasonal Water Yield, RouteDEM and DelineateIt all fill the pits of
+a DEM and route it before doing anything model specific.  The functions here
+have the signatures of their ``pygeoprocessing.routing`` counterparts and can
+be used in their place.  When a cache directory is configured, each product
+is stored there under a key built from the pixel values and pixel grid of its
+input rasters, the operation that made it and the operation's parameters.  A
+later call with the same key copies the stored raster to its target instead
+of computing it again, no matter which model or workspace asks for it.
+
+The cache is configured with environment variables so that it also applies
+to taskgraph's worker processes:
+
+    * ``INVEST_HYDROLOGY_CACHE_DIR``: directory of the cache.  The cache is
+      off when this is not set.
+    * ``INVEST_HYDROLOGY_CACHE_MAX_BYTES``: size the cache is kept under.
+      When a new product takes the cache over this size, the least recently
+      used products are removed.  Defaults to 10 GiB.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import pygeoprocessing
+import pygeoprocessing.routing
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_DIR_ENV_VAR = 'INVEST_HYDROLOGY_CACHE_DIR'
+MAX_BYTES_ENV_VAR = 'INVEST_HYDROLOGY_CACHE_MAX_BYTES'
+DEFAULT_MAX_BYTES = 10 * 2**30
+# temporary files of an insert older than this were left by a process that
+# died and are removed when the cache is evicted
+_INCOMPLETE_MAX_AGE = 60 * 60.0
+
+# raster path and band to the content key of the band, valid while the
+# file's modification time and size are unchanged
+_CONTENT_KEYS = {}
+
+
+def set_cache_dir(cache_dir, max_bytes=None):
+    """Turn the hydrology cache on or off for this process and its children.
+
+    Args:
+        cache_dir (string): directory to keep the cache in, created if it
+            doesn't exist.  If ``None``, the cache is turned off.
+        max_bytes (int): size to keep the cache under.  If ``None``,
+            ``DEFAULT_MAX_BYTES`` is used.
+
+    Returns:
+        None.
+    """
+    if cache_dir is None:
+        os.environ.pop(CACHE_DIR_ENV_VAR, None)
+    else:
+        os.environ[CACHE_DIR_ENV_VAR] = os.path.abspath(cache_dir)
+    if max_bytes is None:
+        os.environ.pop(MAX_BYTES_ENV_VAR, None)
+    else:
+        os.environ[MAX_BYTES_ENV_VAR] = str(int(max_bytes))
+
+
+def get_cache_dir():
+    """Return the cache directory, or ``None`` if the cache is off."""
+    return os.environ.get(CACHE_DIR_ENV_VAR) or None
+
+
+def get_max_bytes():
+    """Return the size in bytes the cache is kept under."""
+    max_bytes = os.environ.get(MAX_BYTES_ENV_VAR)
+    if not max_bytes:
+        return DEFAULT_MAX_BYTES
+    return int(max_bytes)
+
+
+def fill_pits(
+        dem_raster_path_band, target_filled_dem_raster_path,
+        working_dir=None, **kwargs):
+    """Cached ``pygeoprocessing.routing.fill_pits``.
+
+    Args:
+        dem_raster_path_band (tuple): path and band index of the DEM.
+        target_filled_dem_raster_path (string): path to the filled DEM
+            created by this call.
+        working_dir (string): directory for temporary files, passed on to
+            pygeoprocessing.
+        **kwargs: passed on to pygeoprocessing and made part of the key.
+
+    Returns:
+        None.
+    """
+    _cached_call(
+        'fill_pits', [dem_raster_path_band], kwargs,
+        target_filled_dem_raster_path,
+        lambda: pygeoprocessing.routing.fill_pits(
+            dem_raster_path_band, target_filled_dem_raster_path,
+            working_dir=working_dir, **kwargs))
+
+
+def flow_dir_mfd(
+        dem_raster_path_band, target_flow_dir_path, working_dir=None,
+        **kwargs):
+    """Cached ``pygeoprocessing.routing.flow_dir_mfd``.
+
+    Args:
+        dem_raster_path_band (tuple): path and band index of the filled DEM.
+        target_flow_dir_path (string): path to the MFD flow direction raster
+            created by this call.
+        working_dir (string): directory for temporary files, passed on to
+            pygeoprocessing.
+        **kwargs: passed on to pygeoprocessing and made part of the key.
+
+    Returns:
+        None.
+    """
+    _cached_call(
+        'flow_dir_mfd', [dem_raster_path_band], kwargs, target_flow_dir_path,
+        lambda: pygeoprocessing.routing.flow_dir_mfd(
+            dem_raster_path_band, target_flow_dir_path,
+            working_dir=working_dir, **kwargs))
+
+
+def flow_dir_d8(
+        dem_raster_path_band, target_flow_dir_path, working_dir=None,
+        **kwargs):
+    """Cached ``pygeoprocessing.routing.flow_dir_d8``.
+
+    Args:
+        dem_raster_path_band (tuple): path and band index of the filled DEM.
+        target_flow_dir_path (string): path to the D8 flow direction raster
+            created by this call.
+        working_dir (string): directory for temporary files, passed on to
+            pygeoprocessing.
+        **kwargs: passed on to pygeoprocessing and made part of the key.
+
+    Returns:
+        None.
+    """
+    _cached_call(
+        'flow_dir_d8', [dem_raster_path_band], kwargs, target_flow_dir_path,
+        lambda: pygeoprocessing.routing.flow_dir_d8(
+            dem_raster_path_band, target_flow_dir_path,
+            working_dir=working_dir, **kwargs))
+
+
+def flow_accumulation_mfd(
+        flow_dir_mfd_path_band, target_flow_accum_path,
+        weight_raster_path_band=None, **kwargs):
+    """Cached ``pygeoprocessing.routing.flow_accumulation_mfd``.
+
+    Args:
+        flow_dir_mfd_path_band (tuple): path and band index of the MFD flow
+            direction raster.
+        target_flow_accum_path (string): path to the flow accumulation
+            raster created by this call.
+        weight_raster_path_band (tuple): optional path and band index of a
+            raster of per pixel weights.
+        **kwargs: passed on to pygeoprocessing and made part of the key.
+
+    Returns:
+        None.
+    """
+    raster_path_band_list = [flow_dir_mfd_path_band]
+    if weight_raster_path_band is not None:
+        raster_path_band_list.append(weight_raster_path_band)
+    _cached_call(
+        'flow_accumulation_mfd', raster_path_band_list, kwargs,
+        target_flow_accum_path,
+        lambda: pygeoprocessing.routing.flow_accumulation_mfd(
+            flow_dir_mfd_path_band, target_flow_accum_path,
+            weight_raster_path_band=weight_raster_path_band, **kwargs))
+
+
+def flow_accumulation_d8(
+        flow_dir_raster_path_band, target_flow_accum_raster_path,
+        weight_raster_path_band=None, **kwargs):
+    """Cached ``pygeoprocessing.routing.flow_accumulation_d8``.
+
+    Args:
+        flow_dir_raster_path_band (tuple): path and band index of the D8
+            flow direction raster.
+        target_flow_accum_raster_path (string): path to the flow
+            accumulation raster created by this call.
+        weight_raster_path_band (tuple): optional path and band index of a
+            raster of per pixel weights.
+        **kwargs: passed on to pygeoprocessing and made part of the key.
+
+    Returns:
+        None.
+    """
+    raster_path_band_list = [flow_dir_raster_path_band]
+    if weight_raster_path_band is not None:
+        raster_path_band_list.append(weight_raster_path_band)
+    _cached_call(
+        'flow_accumulation_d8', raster_path_band_list, kwargs,
+        target_flow_accum_raster_path,
+        lambda: pygeoprocessing.routing.flow_accumulation_d8(
+            flow_dir_raster_path_band, target_flow_accum_raster_path,
+            weight_raster_path_band=weight_raster_path_band, **kwargs))
+
+
+def extract_streams_mfd(
+        flow_accum_raster_path_band, flow_dir_mfd_path_band, flow_threshold,
+        target_stream_raster_path, **kwargs):
+    """Cached ``pygeoprocessing.routing.extract_streams_mfd``.
+
+    Args:
+        flow_accum_raster_path_band (tuple): path and band index of the flow
+            accumulation raster.
+        flow_dir_mfd_path_band (tuple): path and band index of the MFD flow
+            direction raster.
+        flow_threshold (float): flow accumulation above which a pixel is a
+            stream.
+        target_stream_raster_path (string): path to the stream raster
+            created by this call.
+        **kwargs: passed on to pygeoprocessing and made part of the key,
+            such as ``trace_threshold_proportion``.
+
+    Returns:
+        None.
+    """
+    _cached_call(
+        'extract_streams_mfd',
+        [flow_accum_raster_path_band, flow_dir_mfd_path_band],
+        dict(kwargs, flow_threshold=flow_threshold),
+        target_stream_raster_path,
+        lambda: pygeoprocessing.routing.extract_streams_mfd(
+            flow_accum_raster_path_band, flow_dir_mfd_path_band,
+            flow_threshold, target_stream_raster_path, **kwargs))
+
+
+def _cached_call(
+        operation, raster_path_band_list, parameters, target_raster_path,
+        compute_func):
+    """Copy a product from the cache, or compute it and add it to the cache.
+
+    Args:
+        operation (string): name of the operation, part of the key.
+        raster_path_band_list (list): path and band tuples of the input
+            rasters.  Their pixel values and grids are part of the key.
+        parameters (dict): parameters of the operation that change its
+            output, part of the key.
+        target_raster_path (string): path to the product.
+        compute_func (callable): called with no arguments to create
+            ``target_raster_path`` when it isn't in the cache.
+
+    Returns:
+        None.
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        compute_func()
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    product_key = _product_key(operation, raster_path_band_list, parameters)
+    cached_raster_path = os.path.join(cache_dir, '%s.tif' % product_key)
+    cached_info_path = os.path.join(cache_dir, '%s.json' % product_key)
+
+    try:
+        with open(cached_info_path) as info_file:
+            content_key = json.load(info_file)['content_key']
+        shutil.copyfile(cached_raster_path, target_raster_path)
+    except (OSError, ValueError, KeyError):
+        # not in the cache, evicted by another process while we read it, or
+        # an entry left incomplete by a process that died
+        LOGGER.info(
+            '%s not in the hydrology cache, computing %s', operation,
+            target_raster_path)
+    else:
+        LOGGER.info(
+            'copied %s from the hydrology cache to %s', operation,
+            target_raster_path)
+        _touch(cached_raster_path, cached_info_path)
+        _remember_content_key(target_raster_path, 1, content_key)
+        return
+
+    compute_func()
+    content_key = _content_key((target_raster_path, 1))
+
+    # copy to a temporary name first so no other process can see a partial
+    # raster, and write the info file last since it marks a complete entry
+    temp_path_list = []
+    try:
+        temp_fd, temp_raster_path = tempfile.mkstemp(
+            suffix='.tif', prefix='incomplete_', dir=cache_dir)
+        temp_path_list.append(temp_raster_path)
+        os.close(temp_fd)
+        shutil.copyfile(target_raster_path, temp_raster_path)
+        os.replace(temp_raster_path, cached_raster_path)
+        temp_fd, temp_info_path = tempfile.mkstemp(
+            suffix='.json', prefix='incomplete_', dir=cache_dir)
+        temp_path_list.append(temp_info_path)
+        with os.fdopen(temp_fd, 'w') as info_file:
+            json.dump({
+                'operation': operation,
+                'parameters': _jsonable(parameters),
+                'content_key': content_key,
+                'created': time.time(),
+            }, info_file)
+        os.replace(temp_info_path, cached_info_path)
+    except OSError:
+        # on Windows a cached raster can't be replaced while another process
+        # copies it, the product is already computed so this is only a miss
+        LOGGER.warning(
+            'could not add %s to the hydrology cache', target_raster_path,
+            exc_info=True)
+        for temp_path in temp_path_list:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass  # already replaced the cached file
+    _evict(cache_dir, get_max_bytes())
+
+
+def _product_key(operation, raster_path_band_list, parameters):
+    """Return the cache key of a product.
+
+    Args:
+        operation (string): name of the operation that makes the product.
+        raster_path_band_list (list): path and band tuples of the input
+            rasters.
+        parameters (dict): parameters of the operation.
+
+    Returns:
+        A hex digest string.
+    """
+    key_source = json.dumps({
+        'operation': operation,
+        'inputs': [
+            _content_key(path_band) for path_band in raster_path_band_list],
+        'parameters': _jsonable(parameters),
+    }, sort_keys=True)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+def _content_key(raster_path_band):
+    """Return a hash of a raster band's pixel values and pixel grid.
+
+    Two bands have the same key when they have the same pixel values,
+    datatype, nodata value, size, geotransform and projection, even when
+    their files differ in format or metadata.
+
+    Args:
+        raster_path_band (tuple): path and band index of the raster.
+
+    Returns:
+        A hex digest string.
+    """
+    raster_path, band_index = raster_path_band
+    file_stat = os.stat(raster_path)
+    memo_key = (
+        os.path.abspath(raster_path), band_index, file_stat.st_mtime_ns,
+        file_stat.st_size)
+    if memo_key in _CONTENT_KEYS:
+        return _CONTENT_KEYS[memo_key]
+
+    raster_info = pygeoprocessing.get_raster_info(raster_path)
+    content_hash = hashlib.sha256()
+    content_hash.update(json.dumps({
+        'raster_size': raster_info['raster_size'],
+        'geotransform': raster_info['geotransform'],
+        'projection_wkt': raster_info['projection_wkt'],
+        'datatype': raster_info['datatype'],
+        'nodata': raster_info['nodata'][band_index-1],
+    }, sort_keys=True).encode('utf-8'))
+    for offset_dict, block in pygeoprocessing.iterblocks(raster_path_band):
+        content_hash.update(json.dumps(
+            offset_dict, sort_keys=True).encode('utf-8'))
+        content_hash.update(block.tobytes())
+    content_key = content_hash.hexdigest()
+    _CONTENT_KEYS[memo_key] = content_key
+    return content_key
+
+
+def _remember_content_key(raster_path, band_index, content_key):
+    """Record the content key of a raster copied from the cache."""
+    file_stat = os.stat(raster_path)
+    _CONTENT_KEYS[(
+        os.path.abspath(raster_path), band_index, file_stat.st_mtime_ns,
+        file_stat.st_size)] = content_key
+
+
+def _jsonable(value):
+    """Return ``value`` with tuples turned into lists, for hashing."""
+    if isinstance(value, dict):
+        return {str(key): _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def _touch(*path_list):
+    """Mark cache files as just used so they're evicted last."""
+    for path in path_list:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+def _evict(cache_dir, max_bytes):
+    """Remove the least recently used products until under ``max_bytes``.
+
+    Temporary files of inserts older than ``_INCOMPLETE_MAX_AGE`` are
+    removed too, they were left by processes that died.
+
+    Args:
+        cache_dir (string): directory of the cache.
+        max_bytes (int): size in bytes to keep the cache's rasters under.
+
+    Returns:
+        None.
+    """
+    entries = []
+    total_bytes = 0
+    for filename in os.listdir(cache_dir):
+        if filename.startswith('incomplete_'):
+            incomplete_path = os.path.join(cache_dir, filename)
+            try:
+                if (time.time() - os.path.getmtime(incomplete_path) >
+                        _INCOMPLETE_MAX_AGE):
+                    LOGGER.info('removing stale %s', incomplete_path)
+                    os.remove(incomplete_path)
+            except OSError:
+                pass  # replaced or removed by another process
+            continue
+        if not filename.endswith('.tif'):
+            continue
+        raster_path = os.path.join(cache_dir, filename)
+        try:
+            file_stat = os.stat(raster_path)
+        except OSError:
+            continue  # removed by another process
+        entries.append((file_stat.st_mtime, file_stat.st_size, raster_path))
+        total_bytes += file_stat.st_size
+
+    for _, size, raster_path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        LOGGER.info('evicting %s from the hydrology cache', raster_path)
+        # the info file goes first so the entry is never seen without its
+        # raster
+        for path in (os.path.splitext(raster_path)[0] + '.json',
+                     raster_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total_bytes -= size
@@ -0,0 +1,133 @@
+# cython: language_level=3
+from libcpp.list cimport list as clist
+from libcpp.pair cimport pair
+from libcpp.set cimport set as cset
+
+# this is a least recently used cache written in C++ in an external file,
+# exposing here so _ManagedRaster can use it
+cdef extern from "LRUCache.h" nogil:
+    cdef cppclass LRUCache[KEY_T, VAL_T]:
+        LRUCache(int)
+        void put(KEY_T&, VAL_T&, clist[pair[KEY_T,VAL_T]]&)
+        clist[pair[KEY_T,VAL_T]].iterator begin()
+        clist[pair[KEY_T,VAL_T]].iterator end()
+        bint exist(KEY_T &)
+        VAL_T* get(KEY_T &)
+
+# this ctype is used to store the block ID and the block buffer as one object
+# inside Managed Raster
+ctypedef pair[int, char*] BlockBufferPair
+
+
+# Block caching shared by the typed managed rasters below.  Blocks are held
+# in the pixel type of the subclass, so use the subclass that matches the
+# raster's datatype.
+cdef class _ManagedRasterBase:
+    cdef LRUCache[int, char*]* lru_cache
+    cdef cset[int] dirty_blocks
+    cdef int block_xsize
+    cdef int block_ysize
+    cdef int block_xmod
+    cdef int block_ymod
+    cdef int block_xbits
+    cdef int block_ybits
+    cdef long raster_x_size
+    cdef long raster_y_size
+    cdef int block_nx
+    cdef int block_ny
+    cdef int write_mode
+    cdef bytes raster_path
+    cdef int band_id
+    cdef int closed
+    cdef long long cache_bytes
+    cdef int pixel_bytes
+    cdef object numpy_type
+    cdef object raster
+    cdef object raster_band
+    cdef object block_io
+
+    cdef _block_window(self, int block_index)
+    cdef _block_array(self, int block_index, char* block_buffer)
+    cdef void _prefetch_neighbors(self, int block_index) except *
+    cdef char* _load_block(self, int block_index) except NULL
+    cdef void _write_block(
+            self, int block_index, char* block_buffer) except *
+
+    cdef inline int _block_index(self, long xi, long yi):
+        """Return the flat index of the block holding pixel `xi,yi`."""
+        return (
+            (yi >> self.block_ybits) * self.block_nx +
+            (xi >> self.block_xbits))
+
+    cdef inline long _pixel_index(self, long xi, long yi):
+        """Return the index of pixel `xi,yi` inside its cached block."""
+        return (
+            ((yi & (self.block_ymod))<<self.block_xbits) +
+            (xi & (self.block_xmod)))
+
+    cdef inline char* _block_buffer(self, int block_index) except NULL:
+        """Return the cached block `block_index`, loading it if needed."""
+        cdef char** block_buffer = self.lru_cache.get(block_index)
+        if block_buffer == NULL:
+            return self._load_block(block_index)
+        return block_buffer[0]
+
+
+cdef class _ManagedRaster(_ManagedRasterBase):
+    cdef inline void set(self, long xi, long yi, double value):
+        """Set the pixel at `xi,yi` to `value`."""
+        cdef int block_index = self._block_index(xi, yi)
+        (<double*>self._block_buffer(block_index))[
+            self._pixel_index(xi, yi)] = value
+        if self.write_mode:
+            self.dirty_blocks.insert(block_index)
+
+    cdef inline double get(self, long xi, long yi):
+        """Return the value of the pixel at `xi,yi`."""
+        return (<double*>self._block_buffer(self._block_index(xi, yi)))[
+            self._pixel_index(xi, yi)]
+
+
+cdef class _ManagedFloat32Raster(_ManagedRasterBase):
+    cdef inline void set(self, long xi, long yi, float value):
+        """Set the pixel at `xi,yi` to `value`."""
+        cdef int block_index = self._block_index(xi, yi)
+        (<float*>self._block_buffer(block_index))[
+            self._pixel_index(xi, yi)] = value
+        if self.write_mode:
+            self.dirty_blocks.insert(block_index)
+
+    cdef inline float get(self, long xi, long yi):
+        """Return the value of the pixel at `xi,yi`."""
+        return (<float*>self._block_buffer(self._block_index(xi, yi)))[
+            self._pixel_index(xi, yi)]
+
+
+cdef class _ManagedInt32Raster(_ManagedRasterBase):
+    cdef inline void set(self, long xi, long yi, int value):
+        """Set the pixel at `xi,yi` to `value`."""
+        cdef int block_index = self._block_index(xi, yi)
+        (<int*>self._block_buffer(block_index))[
+            self._pixel_index(xi, yi)] = value
+        if self.write_mode:
+            self.dirty_blocks.insert(block_index)
+
+    cdef inline int get(self, long xi, long yi):
+        """Return the value of the pixel at `xi,yi`."""
+        return (<int*>self._block_buffer(self._block_index(xi, yi)))[
+            self._pixel_index(xi, yi)]
+
+
+cdef class _ManagedByteRaster(_ManagedRasterBase):
+    cdef inline void set(self, long xi, long yi, unsigned char value):
+        """Set the pixel at `xi,yi` to `value`."""
+        cdef int block_index = self._block_index(xi, yi)
+        (<unsigned char*>self._block_buffer(block_index))[
+            self._pixel_index(xi, yi)] = value
+        if self.write_mode:
+            self.dirty_blocks.insert(block_index)
+
+    cdef inline unsigned char get(self, long xi, long yi):
+        """Return the value of the pixel at `xi,yi`."""
+        return (<unsigned char*>self._block_buffer(
+            self._block_index(xi, yi)))[self._pixel_index(xi, yi)]
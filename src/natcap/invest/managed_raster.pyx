@@ -0,0 +1,592 @@
+# cython: profile=False
+# cython: language_level=3
+"""Fast random per-pixel access to rasters shared by the routing cores.
+
+``_ManagedRaster`` caches whole raster blocks in a least recently used cache
+so pixels can be read and written in any order.  It's cimported by the
+compiled cores of SDR, NDR, Seasonal Water Yield and Scenic Quality::
+
+    from natcap.invest.managed_raster cimport _ManagedRaster
+
+``_ManagedRaster`` holds pixels as float64.  ``_ManagedFloat32Raster``,
+``_ManagedInt32Raster`` and ``_ManagedByteRaster`` hold them in their own
+type, so rasters of those types take less memory per cached block.
+
+The memory each managed raster may use for cached blocks is
+``get_cache_bytes()`` unless it's constructed with its own ``cache_bytes``.
+"""
+import collections
+import logging
+import threading
+
+import numpy
+import pygeoprocessing
+cimport numpy
+from osgeo import gdal
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cython.operator cimport dereference as deref
+from cython.operator cimport preincrement as inc
+
+numpy.import_array()
+
+LOGGER = logging.getLogger(__name__)
+
+# Default bytes of blocks to hold in memory at once per Managed Raster, this
+# is 2**6 float64 blocks of 256x256 pixels.
+cdef long long _CACHE_BYTES = 2**25
+
+# Whether managed rasters read and write blocks on a background thread by
+# default.
+_ASYNC_IO = False
+# Most evicted dirty blocks waiting to be written, and most blocks read ahead,
+# held by the background I/O of one managed raster.  These are in addition to
+# the blocks in its cache.
+_MAX_PENDING_WRITES = 8
+_MAX_PREFETCHED_BLOCKS = 16
+
+
+def get_cache_bytes():
+    """Return the default cache size in bytes of each managed raster."""
+    return _CACHE_BYTES
+
+
+def set_cache_bytes(cache_bytes):
+    """Set the default cache size in bytes of managed rasters.
+
+    Managed rasters made after this call cache as many whole blocks as fit
+    in `cache_bytes`, and always at least one.
+
+    Args:
+        cache_bytes (int): number of bytes of raster blocks each managed
+            raster may hold in memory.
+
+    Returns:
+        None.
+    """
+    global _CACHE_BYTES
+    if cache_bytes <= 0:
+        raise ValueError(
+            "cache_bytes must be positive, got %s" % cache_bytes)
+    _CACHE_BYTES = cache_bytes
+
+
+def get_async_io():
+    """Return whether managed rasters do block I/O on a background thread."""
+    return _ASYNC_IO
+
+
+def set_async_io(async_io):
+    """Set whether managed rasters do block I/O on a background thread.
+
+    With background I/O on, evicted dirty blocks are written behind the
+    traversal and the blocks next to each newly loaded block are read ahead
+    of it.  Results are the same either way.
+
+    Args:
+        async_io (bool): the default of managed rasters made after this call.
+
+    Returns:
+        None.
+    """
+    global _ASYNC_IO
+    _ASYNC_IO = bool(async_io)
+
+
+class _BlockIO(object):
+    """Reads and writes the blocks of one raster band on a background thread.
+
+    Every GDAL call on the band is made holding ``gdal_lock``, since a GDAL
+    dataset can't be used from two threads at once.  A block is never read
+    while a write of it is queued, so reads always see the latest data.
+    """
+
+    def __init__(
+            self, raster_band, numpy_type, max_pending_writes,
+            max_prefetched):
+        """Start the I/O thread.
+
+        Args:
+            raster_band (gdal.Band): the band to read and write.
+            numpy_type (numpy.dtype): pixel type blocks are read as.
+            max_pending_writes (int): most blocks waiting to be written,
+                ``write`` blocks until there's room.
+            max_prefetched (int): most blocks read ahead and not yet taken
+                by ``read``.
+
+        Returns:
+            None.
+        """
+        self.raster_band = raster_band
+        self.numpy_type = numpy_type
+        self.max_pending_writes = max_pending_writes
+        self.max_prefetched = max_prefetched
+        self.gdal_lock = threading.Lock()
+        self.state = threading.Condition()
+        # (block index, window, array to write or None to read)
+        self.requests = collections.deque()
+        # block index to the array waiting to be written
+        self.pending_writes = {}
+        # block index to the array read ahead, or None while it's queued
+        self.prefetched = collections.OrderedDict()
+        self.error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """Process requests in order until stopped and out of requests."""
+        while True:
+            with self.state:
+                while not self.requests and not self.stopping:
+                    self.state.wait()
+                if not self.requests:
+                    return
+                block_index, window, block_array = self.requests.popleft()
+            try:
+                with self.gdal_lock:
+                    if block_array is None:
+                        read_array = self._read_window(window)
+                    else:
+                        self.raster_band.WriteArray(
+                            block_array, xoff=window[0], yoff=window[1])
+            except Exception as error:
+                LOGGER.exception('error in background raster I/O')
+                with self.state:
+                    self.error = error
+                    self.requests.clear()
+                    self.state.notify_all()
+                return
+            with self.state:
+                if block_array is None:
+                    self.prefetched[block_index] = read_array
+                else:
+                    del self.pending_writes[block_index]
+                self.state.notify_all()
+
+    def _read_window(self, window, block_array=None):
+        """Read ``window`` into ``block_array`` or a new array."""
+        xoff, yoff, win_xsize, win_ysize = window
+        if block_array is None:
+            block_array = numpy.empty(
+                (win_ysize, win_xsize), dtype=self.numpy_type)
+        self.raster_band.ReadAsArray(
+            xoff=xoff, yoff=yoff, win_xsize=win_xsize, win_ysize=win_ysize,
+            buf_obj=block_array)
+        return block_array
+
+    def _raise_error(self):
+        """Raise the I/O thread's error, if any.  Hold ``state`` to call."""
+        if self.error is not None:
+            raise RuntimeError(
+                'background raster I/O failed: %s' % self.error)
+
+    def read(self, block_index, window, block_array):
+        """Read a block into ``block_array``.
+
+        The block is taken from the blocks read ahead if it's there or
+        queued, otherwise it's read now.
+
+        Args:
+            block_index (int): flat index of the block.
+            window (tuple): (xoff, yoff, win_xsize, win_ysize) of the block.
+            block_array (numpy.ndarray): array of the window's shape to read
+                the block into.
+
+        Returns:
+            None.
+        """
+        with self.state:
+            while self.error is None and (
+                    block_index in self.pending_writes or
+                    (block_index in self.prefetched and
+                     self.prefetched[block_index] is None)):
+                self.state.wait()
+            self._raise_error()
+            read_array = self.prefetched.pop(block_index, None)
+        if read_array is not None:
+            block_array[...] = read_array
+            return
+        with self.gdal_lock:
+            self._read_window(window, block_array)
+
+    def prefetch(self, block_index, window):
+        """Queue a read ahead of a block that isn't cached.
+
+        Args:
+            block_index (int): flat index of the block.
+            window (tuple): (xoff, yoff, win_xsize, win_ysize) of the block.
+
+        Returns:
+            None.
+        """
+        with self.state:
+            if (self.error is not None or
+                    block_index in self.pending_writes or
+                    block_index in self.prefetched):
+                return
+            if len(self.prefetched) >= self.max_prefetched:
+                # make room by dropping the oldest block that's been read
+                oldest_index, oldest_array = next(
+                    iter(self.prefetched.items()))
+                if oldest_array is None:
+                    return
+                del self.prefetched[oldest_index]
+            self.prefetched[block_index] = None
+            self.requests.append((block_index, window, None))
+            self.state.notify_all()
+
+    def write(self, block_index, window, block_array):
+        """Queue a block to be written.
+
+        Args:
+            block_index (int): flat index of the block.
+            window (tuple): (xoff, yoff, win_xsize, win_ysize) of the block.
+            block_array (numpy.ndarray): the block's pixels, owned by the
+                I/O thread from here on.
+
+        Returns:
+            None.
+        """
+        with self.state:
+            while (self.error is None and
+                   len(self.pending_writes) >= self.max_pending_writes):
+                self.state.wait()
+            self._raise_error()
+            self.pending_writes[block_index] = block_array
+            self.requests.append((block_index, window, block_array))
+            self.state.notify_all()
+
+    def close(self):
+        """Finish the queued writes, drop the queued reads and stop."""
+        with self.state:
+            self.requests = collections.deque(
+                request for request in self.requests
+                if request[2] is not None)
+            self.stopping = True
+            self.state.notify_all()
+        self.thread.join()
+        with self.state:
+            self._raise_error()
+
+
+# a class to allow fast random per-pixel access to a raster for both setting
+# and reading pixels.  Copied from src/pygeoprocessing/routing/routing.pyx,
+# revision 891288683889237cfd3a3d0a1f09483c23489fca.
+cdef class _ManagedRasterBase:
+
+    def __cinit__(
+            self, raster_path, band_id, write_mode, cache_bytes=None,
+            async_io=None):
+        """Create new instance of Managed Raster.
+
+        Args:
+            raster_path (char*): path to raster that has block sizes that are
+                powers of 2. If not, an exception is raised.
+            band_id (int): which band in `raster_path` to index. Uses GDAL
+                notation that starts at 1.
+            write_mode (boolean): if true, this raster is writable and dirty
+                memory blocks will be written back to the raster as blocks
+                are swapped out of the cache or when the object deconstructs.
+            cache_bytes (int): bytes of raster blocks to hold in memory at
+                once.  Defaults to ``get_cache_bytes()``.
+            async_io (bool): whether to write evicted blocks and read ahead
+                blocks on a background thread.  Defaults to
+                ``get_async_io()``.
+
+        Returns:
+            None.
+        """
+        # set first so a failed construction is already closed on dealloc
+        self.closed = 1
+        raster_info = pygeoprocessing.get_raster_info(raster_path)
+        self.raster_x_size, self.raster_y_size = raster_info['raster_size']
+        self.block_xsize, self.block_ysize = raster_info['block_size']
+        self.block_xmod = self.block_xsize-1
+        self.block_ymod = self.block_ysize-1
+
+        if not (1 <= band_id <= raster_info['n_bands']):
+            err_msg = (
+                "Error: band ID (%s) is not a valid band number. "
+                "This exception is happening in Cython, so it will cause a "
+                "hard seg-fault, but it's otherwise meant to be a "
+                "ValueError." % (band_id))
+            print(err_msg)
+            raise ValueError(err_msg)
+        self.band_id = band_id
+
+        if (self.block_xsize & (self.block_xsize - 1) != 0) or (
+                self.block_ysize & (self.block_ysize - 1) != 0):
+            # If inputs are not a power of two, this will at least print
+            # an error message. Unfortunately with Cython, the exception will
+            # present itself as a hard seg-fault, but I'm leaving the
+            # ValueError in here at least for readability.
+            err_msg = (
+                "Error: Block size is not a power of two: "
+                "block_xsize: %d, %d, %s. This exception is happening"
+                "in Cython, so it will cause a hard seg-fault, but it's"
+                "otherwise meant to be a ValueError." % (
+                    self.block_xsize, self.block_ysize, raster_path))
+            print(err_msg)
+            raise ValueError(err_msg)
+
+        self.block_xbits = numpy.log2(self.block_xsize)
+        self.block_ybits = numpy.log2(self.block_ysize)
+        self.block_nx = (
+            self.raster_x_size + (self.block_xsize) - 1) // self.block_xsize
+        self.block_ny = (
+            self.raster_y_size + (self.block_ysize) - 1) // self.block_ysize
+
+        # blocks are cached in the pixel type of the subclass
+        self.numpy_type = numpy.dtype(type(self)._numpy_type)
+        self.pixel_bytes = self.numpy_type.itemsize
+
+        if cache_bytes is None:
+            cache_bytes = _CACHE_BYTES
+        self.cache_bytes = cache_bytes
+        cdef long long block_bytes = (
+            self.pixel_bytes * self.block_xsize * self.block_ysize)
+        self.lru_cache = new LRUCache[int, char*](
+            max(1, self.cache_bytes // block_bytes))
+        self.raster_path = <bytes> raster_path
+        self.write_mode = write_mode
+
+        # the dataset stays open until the raster is closed rather than
+        # being reopened for every block
+        if self.write_mode:
+            self.raster = gdal.OpenEx(
+                self.raster_path, gdal.GA_Update | gdal.OF_RASTER)
+        else:
+            self.raster = gdal.OpenEx(self.raster_path, gdal.OF_RASTER)
+        self.raster_band = self.raster.GetRasterBand(self.band_id)
+        if async_io is None:
+            async_io = _ASYNC_IO
+        if async_io:
+            self.block_io = _BlockIO(
+                self.raster_band, self.numpy_type, _MAX_PENDING_WRITES,
+                _MAX_PREFETCHED_BLOCKS)
+        self.closed = 0
+
+    def __dealloc__(self):
+        """Deallocate _ManagedRaster.
+
+        This operation manually frees memory from the LRUCache and writes any
+        dirty memory blocks back to the raster if `self.write_mode` is True.
+        """
+        self.close()
+        if self.lru_cache != NULL:
+            del self.lru_cache
+            self.lru_cache = NULL
+
+    def close(self):
+        """Close the _ManagedRaster and free up resources.
+
+            This call writes any dirty blocks to disk, frees up the memory
+            allocated as part of the cache, and frees all GDAL references.
+
+            Any subsequent calls to any other functions in _ManagedRaster will
+            have undefined behavior.
+        """
+        if self.closed:
+            return
+        self.closed = 1
+        cdef char *block_buffer
+        cdef int block_index
+        cdef cset[int].iterator dirty_itr
+
+        cdef clist[BlockBufferPair].iterator it = self.lru_cache.begin()
+        cdef clist[BlockBufferPair].iterator end = self.lru_cache.end()
+        try:
+            while it != end:
+                block_buffer = deref(it).second
+                block_index = deref(it).first
+                if self.write_mode:
+                    # write to disk if block is dirty
+                    dirty_itr = self.dirty_blocks.find(block_index)
+                    if dirty_itr != self.dirty_blocks.end():
+                        self.dirty_blocks.erase(dirty_itr)
+                        self._write_block(block_index, block_buffer)
+                PyMem_Free(block_buffer)
+                inc(it)
+        finally:
+            # wait for the queued writes so they're on the band before the
+            # flush below
+            if self.block_io is not None:
+                block_io = self.block_io
+                self.block_io = None
+                block_io.close()
+
+        if self.write_mode:
+            self.raster_band.FlushCache()
+        self.raster_band = None
+        self.raster = None
+
+    cdef _block_window(self, int block_index):
+        """Return the raster window covered by a block.
+
+        Args:
+            block_index (int): flat index of the block.
+
+        Returns:
+            a tuple of (xoff, yoff, win_xsize, win_ysize) of the block,
+            clipped to the raster's edge.
+        """
+        cdef int xoff = (block_index % self.block_nx) << self.block_xbits
+        cdef int yoff = (block_index // self.block_nx) << self.block_ybits
+
+        # initially the win size is the same as the block size unless
+        # we're at the edge of a raster
+        cdef int win_xsize = self.block_xsize
+        cdef int win_ysize = self.block_ysize
+        if xoff+win_xsize > self.raster_x_size:
+            win_xsize = win_xsize - (xoff+win_xsize - self.raster_x_size)
+        if yoff+win_ysize > self.raster_y_size:
+            win_ysize = win_ysize - (yoff+win_ysize - self.raster_y_size)
+        return xoff, yoff, win_xsize, win_ysize
+
+    cdef _block_array(self, int block_index, char* block_buffer):
+        """Wrap a cached block in an array over the raster window it covers.
+
+        Args:
+            block_index (int): flat index of the block.
+            block_buffer (char*): the cached block, rows are ``block_xsize``
+                pixels apart.
+
+        Returns:
+            a tuple of the block's window, as from ``_block_window``, and a
+            numpy array view of ``block_buffer`` over that window.
+        """
+        window = self._block_window(block_index)
+        cdef numpy.npy_intp dims[2]
+        dims[0] = window[3]
+        dims[1] = self.block_xsize
+        block_array = numpy.PyArray_SimpleNewFromData(
+            2, dims, self.numpy_type.num, block_buffer)
+        return window, block_array[:, :window[2]]
+
+    cdef void _prefetch_neighbors(self, int block_index) except *:
+        """Queue reads ahead of the uncached blocks sharing an edge with one.
+
+        Diagonal blocks are left out, flow rarely crosses a block's corner
+        and reading them ahead more than doubles the blocks read.
+
+        Args:
+            block_index (int): flat index of the block.
+
+        Returns:
+            None.
+        """
+        cdef int block_xi = block_index % self.block_nx
+        cdef int block_yi = block_index // self.block_nx
+        cdef int neighbor_xi, neighbor_yi, neighbor_index
+        for neighbor_yi in range(
+                max(0, block_yi-1), min(self.block_ny, block_yi+2)):
+            for neighbor_xi in range(
+                    max(0, block_xi-1), min(self.block_nx, block_xi+2)):
+                if neighbor_xi != block_xi and neighbor_yi != block_yi:
+                    continue
+                neighbor_index = neighbor_yi * self.block_nx + neighbor_xi
+                if not self.lru_cache.exist(neighbor_index):
+                    self.block_io.prefetch(
+                        neighbor_index, self._block_window(neighbor_index))
+
+    cdef char* _load_block(self, int block_index) except NULL:
+        """Read a block into the cache, evicting blocks if it's full.
+
+        Args:
+            block_index (int): flat index of the block to load.
+
+        Returns:
+            pointer to the cached block.
+        """
+        cdef int win_ysize = self.block_ysize
+        cdef int yoff = (block_index // self.block_nx) << self.block_ybits
+        if yoff+win_ysize > self.raster_y_size:
+            win_ysize = win_ysize - (yoff+win_ysize - self.raster_y_size)
+
+        cdef char *block_buffer
+        cdef char *removed_buffer
+        cdef int removed_block_index
+        cdef clist[BlockBufferPair] removed_value_list
+        cdef cset[int].iterator dirty_itr
+
+        block_buffer = <char*>PyMem_Malloc(
+            (self.pixel_bytes << self.block_xbits) * win_ysize)
+        if block_buffer == NULL:
+            raise MemoryError()
+        try:
+            # GDAL reads the window straight into the cached block,
+            # converting to its pixel type
+            window, block_array = self._block_array(
+                block_index, block_buffer)
+            if self.block_io is not None:
+                self.block_io.read(block_index, window, block_array)
+            else:
+                self.raster_band.ReadAsArray(
+                    xoff=window[0], yoff=window[1], win_xsize=window[2],
+                    win_ysize=window[3], buf_obj=block_array)
+        except:
+            PyMem_Free(block_buffer)
+            raise
+        self.lru_cache.put(
+            <int>block_index, <char*>block_buffer, removed_value_list)
+
+        while not removed_value_list.empty():
+            # write the changed value back if desired
+            removed_buffer = removed_value_list.front().second
+            if self.write_mode:
+                removed_block_index = removed_value_list.front().first
+                # write back the block if it's dirty
+                dirty_itr = self.dirty_blocks.find(removed_block_index)
+                if dirty_itr != self.dirty_blocks.end():
+                    self.dirty_blocks.erase(dirty_itr)
+                    self._write_block(removed_block_index, removed_buffer)
+            PyMem_Free(removed_buffer)
+            removed_value_list.pop_front()
+
+        if self.block_io is not None:
+            # the traversal is likely to step into a neighboring block next
+            self._prefetch_neighbors(block_index)
+        return block_buffer
+
+    cdef void _write_block(
+            self, int block_index, char* block_buffer) except *:
+        """Write a cached block back to the raster.
+
+        Args:
+            block_index (int): flat index of the block to write.
+            block_buffer (char*): the cached block, rows are
+                ``block_xsize`` pixels apart.
+
+        Returns:
+            None.
+        """
+        window, block_array = self._block_array(block_index, block_buffer)
+        if self.block_io is not None:
+            # the buffer is freed once it's evicted, so the I/O thread gets
+            # its own copy to write behind
+            self.block_io.write(block_index, window, block_array.copy())
+        else:
+            self.raster_band.WriteArray(
+                block_array, xoff=window[0], yoff=window[1])
+
+
+cdef class _ManagedRaster(_ManagedRasterBase):
+    """Managed raster caching pixels as float64."""
+    _numpy_type = numpy.float64
+
+
+cdef class _ManagedFloat32Raster(_ManagedRasterBase):
+    """Managed raster caching pixels as float32."""
+    _numpy_type = numpy.float32
+
+
+cdef class _ManagedInt32Raster(_ManagedRasterBase):
+    """Managed raster caching pixels as int32."""
+    _numpy_type = numpy.int32
+
+
+cdef class _ManagedByteRaster(_ManagedRasterBase):
+    """Managed raster caching pixels as uint8, GDAL's Byte type."""
+    _numpy_type = numpy.uint8
@@ -10,7 +10,7 @@ import pygeoprocessing.routing
 from osgeo import gdal, ogr
 import taskgraph
 
-from .. import utils, validation
+from .. import hydrology_cache, utils, validation
 from . import ndr_core
 
 LOGGER = logging.getLogger(__name__)
@@ -431,7 +431,7 @@ def execute(args):
         task_name='align rasters')
 
     fill_pits_task = task_graph.add_task(
-        func=pygeoprocessing.routing.fill_pits,
+        func=hydrology_cache.fill_pits,
         args=(
             (f_reg['aligned_dem_path'], 1), f_reg['filled_dem_path']),
         kwargs={'working_dir': cache_dir},
@@ -440,7 +440,7 @@ def execute(args):
         task_name='fill pits')
 
     flow_dir_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_dir_mfd,
+        func=hydrology_cache.flow_dir_mfd,
         args=(
             (f_reg['filled_dem_path'], 1), f_reg['flow_direction_path']),
         kwargs={'working_dir': cache_dir},
@@ -449,7 +449,7 @@ def execute(args):
         task_name='flow dir')
 
     flow_accum_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_accumulation_mfd,
+        func=hydrology_cache.flow_accumulation_mfd,
         args=(
             (f_reg['flow_direction_path'], 1),
             f_reg['flow_accumulation_path']),
@@ -458,7 +458,7 @@ def execute(args):
         task_name='flow accum')
 
     stream_extraction_task = task_graph.add_task(
-        func=pygeoprocessing.routing.extract_streams_mfd,
+        func=hydrology_cache.extract_streams_mfd,
         args=(
             (f_reg['flow_accumulation_path'], 1),
             (f_reg['flow_direction_path'], 1),
@@ -549,6 +549,47 @@ def execute(args):
         dependent_task_list=[d_dn_task, d_up_task],
         task_name='calc ic')
 
+    # the effective retention of every nutrient is routed in one walk of the
+    # flow direction graph
+    eff_ret_dependent_task_list = [stream_extraction_task]
+    for nutrient in nutrients_to_process:
+        eff_path = f_reg['eff_%s_path' % nutrient]
+        eff_task = task_graph.add_task(
+            func=_map_lulc_to_val_mask_stream,
+            args=(
+                f_reg['aligned_lulc_path'], f_reg['stream_path'],
+                lucode_to_parameters, 'eff_%s' % nutrient, eff_path),
+            target_path_list=[eff_path],
+            dependent_task_list=[align_raster_task, stream_extraction_task],
+            task_name='ret eff %s' % nutrient)
+
+        crit_len_path = f_reg['crit_len_%s_path' % nutrient]
+        crit_len_task = task_graph.add_task(
+            func=_map_lulc_to_val_mask_stream,
+            args=(
+                f_reg['aligned_lulc_path'], f_reg['stream_path'],
+                lucode_to_parameters, 'crit_len_%s' % nutrient, crit_len_path),
+            target_path_list=[crit_len_path],
+            dependent_task_list=[align_raster_task, stream_extraction_task],
+            task_name='ret eff %s' % nutrient)
+        eff_ret_dependent_task_list.extend([eff_task, crit_len_task])
+
+    effective_retention_path_list = [
+        f_reg['effective_retention_%s_path' % nutrient]
+        for nutrient in nutrients_to_process]
+    ndr_eff_task = task_graph.add_task(
+        func=ndr_core.ndr_eff_calculation_multi,
+        args=(
+            f_reg['flow_direction_path'], f_reg['stream_path'],
+            [f_reg['eff_%s_path' % nutrient]
+             for nutrient in nutrients_to_process],
+            [f_reg['crit_len_%s_path' % nutrient]
+             for nutrient in nutrients_to_process],
+            effective_retention_path_list),
+        target_path_list=effective_retention_path_list,
+        dependent_task_list=eff_ret_dependent_task_list,
+        task_name='eff ret %s' % ' '.join(nutrients_to_process))
+
     for nutrient in nutrients_to_process:
         load_path = f_reg['load_%s_path' % nutrient]
         modified_load_path = f_reg['modified_load_%s_path' % nutrient]
@@ -595,43 +636,12 @@ def execute(args):
             dependent_task_list=[modified_load_task, align_raster_task],
             task_name='map subsurface load %s' % nutrient)
 
-        eff_path = f_reg['eff_%s_path' % nutrient]
-        eff_task = task_graph.add_task(
-            func=_map_lulc_to_val_mask_stream,
-            args=(
-                f_reg['aligned_lulc_path'], f_reg['stream_path'],
-                lucode_to_parameters, 'eff_%s' % nutrient, eff_path),
-            target_path_list=[eff_path],
-            dependent_task_list=[align_raster_task, stream_extraction_task],
-            task_name='ret eff %s' % nutrient)
-
-        crit_len_path = f_reg['crit_len_%s_path' % nutrient]
-        crit_len_task = task_graph.add_task(
-            func=_map_lulc_to_val_mask_stream,
-            args=(
-                f_reg['aligned_lulc_path'], f_reg['stream_path'],
-                lucode_to_parameters, 'crit_len_%s' % nutrient, crit_len_path),
-            target_path_list=[crit_len_path],
-            dependent_task_list=[align_raster_task, stream_extraction_task],
-            task_name='ret eff %s' % nutrient)
-
-        effective_retention_path = (
-            f_reg['effective_retention_%s_path' % nutrient])
-        ndr_eff_task = task_graph.add_task(
-            func=ndr_core.ndr_eff_calculation,
-            args=(
-                f_reg['flow_direction_path'], f_reg['stream_path'], eff_path,
-                crit_len_path, effective_retention_path),
-            target_path_list=[effective_retention_path],
-            dependent_task_list=[
-                stream_extraction_task, eff_task, crit_len_task],
-            task_name='eff ret %s' % nutrient)
-
         ndr_path = f_reg['ndr_%s_path' % nutrient]
         ndr_task = task_graph.add_task(
             func=_calculate_ndr,
             args=(
-                effective_retention_path, f_reg['ic_factor_path'],
+                f_reg['effective_retention_%s_path' % nutrient],
+                f_reg['ic_factor_path'],
                 float(args['k_param']), ndr_path),
             target_path_list=[ndr_path],
             dependent_task_list=[ndr_eff_task, ic_task],
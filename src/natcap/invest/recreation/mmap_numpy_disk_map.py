@@ -0,0 +1,381 @@
+"""Append-only, memory-mapped node store module."""
+
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+import numpy
+
+from .. import utils
+from . import buffered_numpy_disk_map
+
+
+LOGGER = logging.getLogger(
+    'natcap.invest.recmodel_server.mmap_numpy_disk_map')
+
+_ARRAY_TUPLE_TYPE = (
+    buffered_numpy_disk_map.BufferedNumpyDiskMap._ARRAY_TUPLE_TYPE)
+
+# smallest extent, in records, reserved for a node on its first write
+_MIN_EXTENT_RECORDS = 2**6
+
+
+class MemoryMappedNumpyDiskMap(object):
+    """Persistent append-only map of keys to numpy arrays.
+
+    This object has the same append/read/delete/flush interface as
+    ``BufferedNumpyDiskMap`` but stores every node in a single extent file
+    rather than one ``.npy`` file per node.  Each node owns one contiguous
+    extent whose capacity is a power of two records.  Appends write only the
+    new records into the reserved space of the extent; when an extent is
+    full the node is moved to an extent of twice the capacity and the old
+    extent goes on a free list for reuse.  Because a node is always
+    contiguous, ``read`` returns a read-only view into a memory map of the
+    extent file rather than a copy.  A view is of the extent, not of the
+    node, so it goes stale once the extent is freed and reused: after a
+    ``delete`` of the node or any append that moves the node to a larger
+    extent.
+
+    The offset/length index is held in memory and persisted to a sqlite
+    database over a single connection on ``flush``.
+
+    While a reader such as a ``FlatQuadTree`` uses extents located by an
+    earlier ``get_extent``, the store can be modified safely by first
+    calling ``freeze_extents``.  Appends only write past the end a reader
+    knows about, and freed extents are then held back rather than reused
+    until ``release_frozen_extents`` is called.  Frozen extents are tagged
+    with the generation they were freed in, so a caller that writes
+    successive versions of an index can release only the extents no
+    version still being read refers to.
+    """
+
+    def __init__(
+            self, manager_filename, max_bytes_to_buffer,
+            array_dtype=_ARRAY_TUPLE_TYPE):
+        """Create file manager object.
+
+        Args:
+            manager_filename (string): path to store the extent index
+                database.  The extent file is created next to it with a
+                ``.extents`` suffix.
+            max_bytes_to_buffer (int): number of bytes to hold in memory at
+                one time.
+            array_dtype (numpy.dtype): dtype of the records stored in every
+                node.
+
+        Returns:
+            None
+        """
+        self.manager_filename = manager_filename
+        self.manager_directory = os.path.dirname(manager_filename)
+        utils.make_directories([self.manager_directory])
+        self.extent_filename = manager_filename + '.extents'
+        self.array_dtype = numpy.dtype(array_dtype)
+        self.max_bytes_to_buffer = max_bytes_to_buffer
+
+        self.array_cache = collections.defaultdict(collections.deque)
+        self.current_bytes_in_system = 0
+
+        # array_id -> [offset, length, capacity], offset in bytes and
+        # length/capacity in records
+        self.extent_index = {}
+        # capacity -> list of free byte offsets of that capacity
+        self.free_extents = collections.defaultdict(list)
+        # byte offset of the first unreserved byte in the extent file
+        self.extent_file_end = 0
+        # extents freed while frozen, as (generation, offset, capacity)
+        # tuples.  These are not persisted to the database so are leaked if
+        # the store is reopened from it before they're released.
+        self.frozen_extents = []
+        self.extents_frozen = False
+        self.frozen_generation = 0
+        self._dirty_array_ids = set()
+        self._deleted_array_ids = set()
+
+        self._db_connection = None
+        self._extent_file = None
+        self._extent_mmap = None
+        self._load_index()
+
+    def __getstate__(self):
+        """Drop open file handles and memory maps when pickling."""
+        state = self.__dict__.copy()
+        state['_db_connection'] = None
+        state['_extent_file'] = None
+        state['_extent_mmap'] = None
+        return state
+
+    def _connection(self):
+        """Return the persistent sqlite connection, opening if needed."""
+        if self._db_connection is None:
+            self._db_connection = sqlite3.connect(self.manager_filename)
+            self._db_connection.execute(
+                """CREATE TABLE IF NOT EXISTS extent_table
+                (array_id INTEGER PRIMARY KEY, offset INTEGER,
+                 length INTEGER, capacity INTEGER)""")
+            self._db_connection.execute(
+                """CREATE TABLE IF NOT EXISTS free_extent_table
+                (offset INTEGER PRIMARY KEY, capacity INTEGER)""")
+            self._db_connection.commit()
+        return self._db_connection
+
+    def _file(self):
+        """Return the unbuffered extent file handle, opening if needed."""
+        if self._extent_file is None:
+            if not os.path.exists(self.extent_filename):
+                open(self.extent_filename, 'wb').close()
+            # unbuffered so writes are immediately visible to the memory map
+            self._extent_file = open(
+                self.extent_filename, 'r+b', buffering=0)
+        return self._extent_file
+
+    def _load_index(self):
+        """Load the extent index from the database into memory."""
+        db_cursor = self._connection().cursor()
+        for array_id, offset, length, capacity in db_cursor.execute(
+                "SELECT array_id, offset, length, capacity "
+                "FROM extent_table"):
+            self.extent_index[array_id] = [offset, length, capacity]
+            self.extent_file_end = max(
+                self.extent_file_end,
+                offset + capacity * self.array_dtype.itemsize)
+        for offset, capacity in db_cursor.execute(
+                "SELECT offset, capacity FROM free_extent_table"):
+            self.free_extents[capacity].append(offset)
+            self.extent_file_end = max(
+                self.extent_file_end,
+                offset + capacity * self.array_dtype.itemsize)
+
+    def _allocate_extent(self, n_records):
+        """Reserve an extent large enough for `n_records` records.
+
+        Args:
+            n_records (int): minimum number of records the extent must hold.
+
+        Returns:
+            (offset, capacity) tuple of the reserved extent.
+        """
+        capacity = _MIN_EXTENT_RECORDS
+        while capacity < n_records:
+            capacity *= 2
+        if self.free_extents[capacity]:
+            return self.free_extents[capacity].pop(), capacity
+        offset = self.extent_file_end
+        self.extent_file_end += capacity * self.array_dtype.itemsize
+        return offset, capacity
+
+    def _free_extent(self, offset, capacity):
+        """Release an extent for reuse, or hold it if extents are frozen."""
+        if self.extents_frozen:
+            self.frozen_extents.append(
+                (self.frozen_generation, offset, capacity))
+        else:
+            self.free_extents[capacity].append(offset)
+
+    def freeze_extents(self, generation=0):
+        """Stop reusing extents freed from now on.
+
+        Extents located before this call keep their contents until
+        ``release_frozen_extents`` releases them.
+
+        Args:
+            generation (int): tag for the extents freed from now on, such as
+                the version of an index being written.  Extents freed while
+                writing generation N are referenced only by generations
+                before N.
+
+        Returns:
+            None
+        """
+        self.extents_frozen = True
+        self.frozen_generation = generation
+
+    def release_frozen_extents(self, oldest_generation_in_use=None):
+        """Make extents freed while frozen available for reuse.
+
+        Args:
+            oldest_generation_in_use (int): oldest generation that may still
+                be read.  Only extents freed in this generation or earlier
+                are released, the rest stay frozen and the store stays
+                frozen.  If None, every frozen extent is released and
+                freed extents are reused again from now on.
+
+        Returns:
+            None
+        """
+        frozen_extents = []
+        for generation, offset, capacity in self.frozen_extents:
+            if (oldest_generation_in_use is None or
+                    generation <= oldest_generation_in_use):
+                self.free_extents[capacity].append(offset)
+            else:
+                frozen_extents.append((generation, offset, capacity))
+        self.frozen_extents = frozen_extents
+        if oldest_generation_in_use is None:
+            self.extents_frozen = False
+
+    def _write_records(self, offset, array_data):
+        """Write `array_data` to the extent file at byte `offset`."""
+        extent_file = self._file()
+        extent_file.seek(offset)
+        extent_file.write(
+            numpy.ascontiguousarray(array_data, dtype=self.array_dtype))
+
+    def _view(self, offset, length):
+        """Return a read-only view of `length` records at byte `offset`."""
+        end = offset + length * self.array_dtype.itemsize
+        if self._extent_mmap is None or self._extent_mmap.size < end:
+            # the file has grown since it was last mapped, earlier views keep
+            # a reference to the previous map so remain valid
+            self._extent_mmap = numpy.memmap(
+                self.extent_filename, dtype=numpy.uint8, mode='r')
+        return self._extent_mmap[offset:end].view(self.array_dtype)
+
+    def _write_node(self, array_id, array_deque):
+        """Append the arrays in `array_deque` to the extent of `array_id`."""
+        new_length = sum(array.size for array in array_deque)
+        if array_id in self.extent_index:
+            offset, length, capacity = self.extent_index[array_id]
+        else:
+            offset, length, capacity = None, 0, 0
+
+        if length + new_length > capacity:
+            # move the node to a larger extent and release the old one
+            new_offset, capacity = self._allocate_extent(length + new_length)
+            if length > 0:
+                self._write_records(
+                    new_offset, numpy.array(self._view(offset, length)))
+            if offset is not None:
+                self._free_extent(offset, self.extent_index[array_id][2])
+            offset = new_offset
+
+        write_offset = offset + length * self.array_dtype.itemsize
+        for array_data in array_deque:
+            self._write_records(write_offset, array_data)
+            write_offset += array_data.size * self.array_dtype.itemsize
+        self.extent_index[array_id] = [offset, length + new_length, capacity]
+        self._dirty_array_ids.add(array_id)
+        self._deleted_array_ids.discard(array_id)
+
+    def append(self, array_id, array_data):
+        """Append data to the node.
+
+        Args:
+            array_id (int): unique key to identify the array node
+            array_data (numpy.ndarray): data to append to node.
+
+        Returns:
+            None
+        """
+        self.array_cache[array_id].append(
+            numpy.array(array_data, dtype=self.array_dtype))
+        self.current_bytes_in_system += (
+            array_data.size * self.array_dtype.itemsize)
+        if self.current_bytes_in_system > self.max_bytes_to_buffer:
+            self.flush()
+
+    def flush(self):
+        """Write buffered data to the extent file and persist the index."""
+        start_time = time.time()
+        LOGGER.info(
+            'Flushing %d bytes in %d arrays', self.current_bytes_in_system,
+            len(self.array_cache))
+        while len(self.array_cache) > 0:
+            array_id = next(iter(self.array_cache.keys()))
+            self._write_node(array_id, self.array_cache.pop(array_id))
+        self.current_bytes_in_system = 0
+
+        db_connection = self._connection()
+        db_connection.executemany(
+            "DELETE FROM extent_table WHERE array_id=?",
+            [(array_id,) for array_id in self._deleted_array_ids])
+        db_connection.executemany(
+            """INSERT OR REPLACE INTO extent_table
+                (array_id, offset, length, capacity) VALUES (?,?,?,?)""",
+            [[array_id] + self.extent_index[array_id]
+             for array_id in self._dirty_array_ids])
+        db_connection.execute("DELETE FROM free_extent_table")
+        db_connection.executemany(
+            """INSERT INTO free_extent_table (offset, capacity)
+                VALUES (?,?)""",
+            [(offset, capacity)
+             for capacity, offset_list in self.free_extents.items()
+             for offset in offset_list])
+        db_connection.commit()
+        self._dirty_array_ids = set()
+        self._deleted_array_ids = set()
+        LOGGER.info('Completed flush in %.2fs', time.time() - start_time)
+
+    def read(self, array_id):
+        """Read the entirety of the node.
+
+        Any buffered data for the node is first written to its extent so the
+        result is always a single view into the extent file.  The view is
+        read-only and is only valid until the node's extent is freed, by a
+        ``delete`` of the node or by an append that grows the node past the
+        capacity of its extent.  Either may be followed by a write of another
+        node into the same extent, so callers that need to keep the data
+        across appends or modify it must copy it, or call ``freeze_extents``
+        first.
+
+        Args:
+            array_id (int): unique node id to read
+
+        Returns:
+            contents of node as a numpy.ndarray.
+        """
+        offset, length = self.get_extent(array_id)
+        if length == 0:
+            return numpy.empty(0, dtype=self.array_dtype)
+        return self._view(offset, length)
+
+    def get_extent(self, array_id):
+        """Return the location of a node in the extent file.
+
+        Any buffered data for the node is written to its extent first.
+
+        Args:
+            array_id (int): unique node id to locate
+
+        Returns:
+            (offset, length) tuple of the byte offset of the node in
+            ``self.extent_filename`` and its length in records, or (-1, 0)
+            if the node has no data.
+        """
+        if self.array_cache.get(array_id):
+            array_deque = self.array_cache.pop(array_id)
+            self.current_bytes_in_system -= (
+                sum(array.size for array in array_deque) *
+                self.array_dtype.itemsize)
+            self._write_node(array_id, array_deque)
+
+        if array_id not in self.extent_index:
+            return -1, 0
+        offset, length, _ = self.extent_index[array_id]
+        return offset, length
+
+    def delete(self, array_id):
+        """Delete node `array_id` from disk and cache."""
+        if array_id in self.extent_index:
+            offset, _, capacity = self.extent_index.pop(array_id)
+            self._free_extent(offset, capacity)
+            self._dirty_array_ids.discard(array_id)
+            self._deleted_array_ids.add(array_id)
+
+        if array_id in self.array_cache:
+            self.current_bytes_in_system -= (
+                sum(array.size for array in self.array_cache[array_id]) *
+                self.array_dtype.itemsize)
+            del self.array_cache[array_id]
+
+    def close(self):
+        """Flush and release the database connection and extent file."""
+        self.flush()
+        self._db_connection.close()
+        self._db_connection = None
+        if self._extent_file is not None:
+            self._extent_file.close()
+            self._extent_file = None
+        self._extent_mmap = None
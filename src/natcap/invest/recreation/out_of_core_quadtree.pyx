@@ -14,6 +14,8 @@ import traceback
 import bisect
 import operator
 import shapely.geometry
+import shapely.prepared
+import shapely.vectorized
 import numpy
 import logging
 
@@ -23,12 +25,30 @@ cimport numpy
 
 MAX_BYTES_TO_BUFFER = 2**27  # buffer a little over 128 megabytes
 import buffered_numpy_disk_map
+import mmap_numpy_disk_map
 _ARRAY_TUPLE_TYPE = (
     buffered_numpy_disk_map.BufferedNumpyDiskMap._ARRAY_TUPLE_TYPE)
 
 LOGGER = logging.getLogger(
     'natcap.invest.recmodel_server.out_of_core_quadtree')
 
+# The flat index file is a header of (magic, version, extent path length,
+# number of nodes), the path of the extent file relative to the index, then
+# padding to _FLAT_INDEX_ALIGNMENT bytes and the node records in preorder.
+_FLAT_INDEX_MAGIC = b'OOCQTIDX'
+_FLAT_INDEX_VERSION = 1
+_FLAT_INDEX_HEADER = struct.Struct('<8sIIq')
+_FLAT_INDEX_ALIGNMENT = 64
+# `subtree_end` is the index one past the last node under this node so a
+# whole subtree can be skipped or taken in one step; `offset` and `n_points`
+# locate a leaf's points in the node store's extent file.
+_FLAT_NODE_TYPE = numpy.dtype([
+    ('bounding_box', numpy.float64, (4,)),
+    ('subtree_end', numpy.int64),
+    ('is_leaf', numpy.bool_),
+    ('offset', numpy.int64),
+    ('n_points', numpy.int64)])
+
 
 class OutOfCoreQuadTree(object):
     """An out of core quad tree spatial indexing structure."""
@@ -49,10 +69,12 @@ class OutOfCoreQuadTree(object):
             quad_tree_storage_dir (string): path to a directory where the
                 quadtree files can be stored
             node_depth (int): depth of current node
-            node_data_manager (BufferedNumpyDiskMap): an object which is used
-                to store the node data across the entire quadtree
+            node_data_manager (MemoryMappedNumpyDiskMap): an object which is
+                used to store the node data across the entire quadtree
             pickle_filename (string): name of file on disk which to pickle the
-                tree to during a flush
+                tree to during a flush.  A flat index of the tree that can be
+                opened with ``FlatQuadTree`` is written next to it with a
+                ``.qtindex`` extension, see ``new_index_version``.
 
         Returns:
             None
@@ -67,22 +89,114 @@ class OutOfCoreQuadTree(object):
         self.quad_tree_storage_dir = quad_tree_storage_dir
         if node_data_manager is None:
             self.node_data_manager = (
-                buffered_numpy_disk_map.BufferedNumpyDiskMap(
+                mmap_numpy_disk_map.MemoryMappedNumpyDiskMap(
                     pickle_filename+'.db', MAX_BYTES_TO_BUFFER))
         else:
             self.node_data_manager = node_data_manager
 
         self.pickle_filename = pickle_filename
+        self.index_version = 0
+        self.index_filename = None
+        if pickle_filename is not None:
+            self.index_filename = (
+                os.path.splitext(pickle_filename)[0] + '.qtindex')
 
         # unique blob_id
         self.blob_id = OutOfCoreQuadTree.next_available_blob_id
         OutOfCoreQuadTree.next_available_blob_id += 1
 
+    def __setstate__(self, state):
+        """Restore a pickled node and reserve its blob id.
+
+        Nodes split after the tree is unpickled in a new process must not
+        reuse the blob ids of the nodes already in the node store.
+        """
+        self.__dict__.update(state)
+        if self.blob_id is not None:
+            OutOfCoreQuadTree.next_available_blob_id = max(
+                OutOfCoreQuadTree.next_available_blob_id, self.blob_id + 1)
+
     def flush(self):
         """Flush any cached data to disk."""
         self.node_data_manager.flush()
         if self.pickle_filename is not None:
-            pickle.dump(self, open(self.pickle_filename, 'wb'))
+            # replace the pickle in one step so it always matches an index
+            tmp_pickle_filename = self.pickle_filename + '.tmp'
+            with open(tmp_pickle_filename, 'wb') as pickle_file:
+                pickle.dump(self, pickle_file)
+            os.replace(tmp_pickle_filename, self.pickle_filename)
+            self.write_flat_index(self.index_filename)
+
+    def new_index_version(self):
+        """Direct the next flush to write a new version of the flat index.
+
+        Earlier versions of the index are left in place so they can keep
+        serving queries while the tree is modified, as long as the node
+        store's extents are frozen, see
+        ``MemoryMappedNumpyDiskMap.freeze_extents``.  Version 0 is
+        ``<pickle base>.qtindex`` and version N is
+        ``<pickle base>.vN.qtindex``.
+
+        Returns:
+            path to the new version of the index.
+        """
+        self.index_version += 1
+        self.index_filename = '%s.v%d.qtindex' % (
+            os.path.splitext(self.pickle_filename)[0], self.index_version)
+        return self.index_filename
+
+    def write_flat_index(self, index_path):
+        """Write the tree to a flat index that can open as a FlatQuadTree.
+
+        The node data is not copied, the index points into the extent file
+        of the node store so the store must be flushed before the index is
+        read.  The index is written to a temporary file and moved into place
+        so readers never see a partial index.
+
+        Args:
+            index_path (string): path to the index file to write.
+
+        Returns:
+            None
+        """
+        node_list = []
+        self._flatten(node_list)
+        node_array = numpy.array(node_list, dtype=_FLAT_NODE_TYPE)
+        extent_path = os.path.relpath(
+            self.node_data_manager.extent_filename,
+            os.path.dirname(os.path.abspath(index_path))).encode('utf-8')
+
+        header = _FLAT_INDEX_HEADER.pack(
+            _FLAT_INDEX_MAGIC, _FLAT_INDEX_VERSION, len(extent_path),
+            node_array.size) + extent_path
+        header += b'\0' * (_flat_index_header_size(len(extent_path)) -
+                           len(header))
+        tmp_index_path = index_path + '.tmp'
+        with open(tmp_index_path, 'wb') as index_file:
+            index_file.write(header)
+            index_file.write(node_array.tobytes())
+        os.replace(tmp_index_path, index_path)
+
+    def _flatten(self, node_list):
+        """Append this subtree's flat node records to a list in preorder.
+
+        Args:
+            node_list (list): list of tuples matching ``_FLAT_NODE_TYPE``.
+
+        Returns:
+            None
+        """
+        node_index = len(node_list)
+        if self.is_leaf:
+            offset, n_points = self.node_data_manager.get_extent(self.blob_id)
+            node_list.append(
+                (self.bounding_box, node_index+1, True, offset, n_points))
+            return
+        node_list.append(None)  # placeholder until the subtree end is known
+        for node_index_offset in xrange(4):
+            self.nodes[node_index_offset]._flatten(node_list)
+        node_list[node_index] = (
+            self.bounding_box, len(node_list), False, -1, 0)
 
     def build_node_shapes(self, ogr_polygon_layer):
         """Add features to an ogr.Layer to visualize quadtree segmentation.
@@ -126,7 +240,9 @@ class OutOfCoreQuadTree(object):
         Returns:
             list of (data, x_coord, y_coord)
         """
-        userday_tuples = self._get_points_from_node()
+        # copy because the node store returns a read-only view of an extent
+        # that is released by the delete below
+        userday_tuples = numpy.array(self._get_points_from_node())
 
         # delete the file because it's drained
         self.node_data_manager.delete(self.blob_id)
@@ -242,6 +358,177 @@ class OutOfCoreQuadTree(object):
             self.nodes[1].add_points(
                 point_list, right_y_split_index, right_bound)
 
+    def split_to_depth(self, partition_depth):
+        """Split an empty tree so all its leaves are `partition_depth` deep.
+
+        The leaves partition the tree's bounding box so each one can be
+        built independently of the others with ``add_points`` and then
+        replaced by the result with ``graft_subtree``.
+
+        Args:
+            partition_depth (int): depth of the partition leaves, must not
+                be more than the tree's ``max_node_depth``.
+
+        Returns:
+            list of the partition leaves in the order of the indexes
+            returned by ``partition_points``.
+        """
+        if self.n_points() > 0:
+            raise ValueError(
+                "Only an empty quadtree can be split into partitions, this "
+                "one has %d points" % self.n_points())
+        if partition_depth > self.max_node_depth:
+            raise ValueError(
+                "partition depth %d is deeper than the maximum node depth "
+                "%d" % (partition_depth, self.max_node_depth))
+        leaf_list = []
+        self._split_to_depth(partition_depth, leaf_list)
+        return leaf_list
+
+    def _split_to_depth(self, partition_depth, leaf_list):
+        """Split leaves above `partition_depth` and collect the partitions.
+
+        Args:
+            partition_depth (int): depth of the partition leaves.
+            leaf_list (list): the leaves at `partition_depth` are appended
+                to this list in preorder.
+
+        Returns:
+            None
+        """
+        if self.node_depth == partition_depth:
+            leaf_list.append(self)
+            return
+        if self.is_leaf:
+            self._split_node()
+        for node_index in xrange(4):
+            self.nodes[node_index]._split_to_depth(partition_depth, leaf_list)
+
+    def partition_points(self, point_list, partition_depth):
+        """Find the partition leaf that ``add_points`` would route points to.
+
+        Points are routed with the same single precision comparisons as
+        ``add_points`` so a partition built from its points is identical to
+        the same subtree built by adding every point to this tree.
+
+        Args:
+            point_list (numpy.ndarray): a numpy array of
+                (data, x_coord, y_coord) tuples.
+            partition_depth (int): depth the tree was split to with
+                ``split_to_depth``.
+
+        Returns:
+            numpy.ndarray of the index of each point's partition in the list
+            returned by ``split_to_depth``.
+        """
+        partition_index = numpy.zeros(point_list.size, dtype=numpy.int64)
+        self._route_to_partitions(
+            point_list['f2'], point_list['f3'],
+            numpy.arange(point_list.size), partition_depth, partition_index)
+        return partition_index
+
+    def _route_to_partitions(
+            self, x_coords, y_coords, point_index, partition_depth,
+            partition_index):
+        """Accumulate the partition index of points under this node.
+
+        Each level contributes one base 4 digit in the children's order so
+        the index of a partition is its position in a preorder traversal.
+
+        Args:
+            x_coords (numpy.ndarray): x coordinates of all the points.
+            y_coords (numpy.ndarray): y coordinates of all the points.
+            point_index (numpy.ndarray): indexes of the points in this node.
+            partition_depth (int): depth of the partition leaves.
+            partition_index (numpy.ndarray): array of the partition index of
+                every point, updated in place.
+
+        Returns:
+            None
+        """
+        if self.node_depth == partition_depth or point_index.size == 0:
+            return
+        # same midpoints as add_points, NaN coordinates go right and top
+        mid_x_coord = numpy.float32(self.nodes[0].bounding_box[2])
+        mid_y_coord = numpy.float32(self.nodes[0].bounding_box[1])
+        is_right = ~(x_coords[point_index] < mid_x_coord)
+        is_bottom = y_coords[point_index] < mid_y_coord
+        # quads indexed like this:
+        # 01
+        # 23
+        quad_index = 2 * is_bottom.astype(numpy.int64) + is_right
+        partition_index[point_index] += (
+            quad_index * 4 ** (partition_depth - self.node_depth - 1))
+        for node_index in xrange(4):
+            self.nodes[node_index]._route_to_partitions(
+                x_coords, y_coords, point_index[quad_index == node_index],
+                partition_depth, partition_index)
+
+    def graft_subtree(self, subtree):
+        """Replace an empty leaf with a subtree built in another node store.
+
+        The subtree's points are copied to this tree's node store under new
+        blob ids, so afterwards the subtree's own store can be deleted.
+
+        Args:
+            subtree (OutOfCoreQuadTree): root of a tree whose bounding box
+                and node depth are those of an empty leaf of this tree, such
+                as one returned by ``split_to_depth``.
+
+        Returns:
+            None
+        """
+        mid_x_coord = (subtree.bounding_box[0] + subtree.bounding_box[2]) / 2.
+        mid_y_coord = (subtree.bounding_box[1] + subtree.bounding_box[3]) / 2.
+        parent_node = None
+        node = self
+        while node.node_depth < subtree.node_depth and not node.is_leaf:
+            parent_node = node
+            node_index = (
+                2 * (mid_y_coord < node.nodes[0].bounding_box[1]) +
+                (mid_x_coord >= node.nodes[0].bounding_box[2]))
+            node = node.nodes[node_index]
+        if (parent_node is None or not node.is_leaf or
+                node.node_depth != subtree.node_depth or
+                node.bounding_box != subtree.bounding_box or
+                node.n_points_in_node > 0):
+            raise ValueError(
+                "No empty leaf at depth %d with bounding box %s to graft "
+                "the subtree to" % (
+                    subtree.node_depth, subtree.bounding_box))
+
+        subtree._move_node_data(
+            self.node_data_manager, self.quad_tree_storage_dir)
+        node.node_data_manager.delete(node.blob_id)
+        parent_node.nodes[node_index] = subtree
+
+    def _move_node_data(self, node_data_manager, quad_tree_storage_dir):
+        """Copy this subtree's points to another node store.
+
+        Args:
+            node_data_manager (MemoryMappedNumpyDiskMap): the node store to
+                copy the points to.
+            quad_tree_storage_dir (string): storage directory of the tree
+                that uses `node_data_manager`.
+
+        Returns:
+            None
+        """
+        if self.is_leaf:
+            point_list = self._get_points_from_node()
+            self.blob_id = OutOfCoreQuadTree.next_available_blob_id
+            OutOfCoreQuadTree.next_available_blob_id += 1
+            if point_list.size > 0:
+                node_data_manager.append(self.blob_id, point_list)
+        else:
+            for node_index in xrange(4):
+                self.nodes[node_index]._move_node_data(
+                    node_data_manager, quad_tree_storage_dir)
+        self.node_data_manager = node_data_manager
+        self.quad_tree_storage_dir = quad_tree_storage_dir
+        self.pickle_filename = None
+        self.index_filename = None
+
     def _bounding_box_intersect(self, bb):
         """Test if this node's bounding intersects another.
 
@@ -270,49 +557,76 @@ class OutOfCoreQuadTree(object):
         return sum([self.nodes[index].n_points() for index in xrange(4)])
 
     def get_intersecting_points_in_polygon(self, shapely_polygon):
-        """Return the points contained in `shapely_prepared_polygon`.
+        """Return the points contained in `shapely_polygon`.
 
         This function is a high performance test routine to return the points
-        contained in the shapely_prepared_polygon that are stored in `self`'s
-        representation of a quadtree.
+        contained in the shapely_polygon that are stored in `self`'s
+        representation of a quadtree.  The polygon is prepared once per
+        query and the points of leaves that straddle its boundary are tested
+        in bulk as coordinate arrays.
 
         Args:
-            shapely_polygon (ogr.DataSource): a polygon datasource to bound
+            shapely_polygon (shapely.geometry.Polygon): a polygon to bound
                 against
 
         Returns:
-            deque of (data, x_coord, y_coord) of nodes that are contained
-                in `shapely_prepared_polygon`.
+            numpy.ndarray of (data, x_coord, y_coord) of points that are
+                contained in `shapely_polygon`.
         """
+        if shapely_polygon.is_empty:
+            # an empty polygon has no bounds to cull against
+            return numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
+        shapely_prepared_polygon = shapely.prepared.prep(shapely_polygon)
+        point_array_list = []
+        self._collect_points_in_polygon(
+            shapely_prepared_polygon, shapely_polygon.bounds,
+            point_array_list)
+        if len(point_array_list) == 0:
+            return numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
+        return numpy.concatenate(point_array_list)
+
+    def _collect_points_in_polygon(
+            self, shapely_prepared_polygon, polygon_bounds,
+            point_array_list):
+        """Append arrays of points in a prepared polygon to a list.
+
+        Args:
+            shapely_prepared_polygon (shapely.prepared.PreparedGeometry): a
+                prepared polygon to bound against
+            polygon_bounds (tuple): bounding box of the polygon of the form
+                (xmin, ymin, xmax, ymax)
+            point_array_list (list): list to append structured arrays of
+                (data, x_coord, y_coord) to for every leaf that contains
+                points in the polygon
+
+        Returns:
+            None
+        """
+        if not self._bounding_box_intersect(polygon_bounds):
+            return
         bounding_polygon = shapely.geometry.box(*self.bounding_box)
+        if not shapely_prepared_polygon.intersects(bounding_polygon):
+            return
 
-        if self.is_leaf:
-            if shapely_polygon.contains(bounding_polygon):
-                # trivial, all points are in the poly
-                return self._get_points_from_node()
-            elif shapely_polygon.intersects(bounding_polygon):
-                # tricky, some points might be in poly
-                result_deque = collections.deque()
-                shapely_prepared_polygon = shapely.prepared.prep(
-                    shapely_polygon)
-                polygon_box = shapely.geometry.box(
-                    *shapely_polygon.bounds)
-                for point in self._get_points_from_node():
-                    shapely_point = shapely.geometry.Point(point[2], point[3])
-                    if (polygon_box.contains(shapely_point) and
-                            shapely_prepared_polygon.contains(shapely_point)):
-                        result_deque.append(point)
-                return result_deque
-        elif shapely_polygon.intersects(bounding_polygon):
+        if not self.is_leaf:
             # combine results of children
-            result_deque = collections.deque()
             for node_index in xrange(4):
-                result_deque.extend(
-                    self.nodes[node_index].get_intersecting_points_in_polygon(
-                        shapely_polygon))
-            return result_deque
+                self.nodes[node_index]._collect_points_in_polygon(
+                    shapely_prepared_polygon, polygon_bounds,
+                    point_array_list)
+            return
+
+        point_array = self._get_points_from_node()
+        if point_array.size == 0:
+            return
+        if shapely_prepared_polygon.contains(bounding_polygon):
+            # trivial, all points are in the poly
+            point_array_list.append(point_array)
+            return
 
-        return collections.deque()  # empty
+        # tricky, some points might be in poly
+        point_array_list.append(_points_in_prepared_polygon(
+            point_array, shapely_prepared_polygon, polygon_bounds))
 
     def get_intersecting_points_in_bounding_box(self, bounding_box):
         """Get list of data that is contained by bounding_box.
@@ -328,23 +642,326 @@ class OutOfCoreQuadTree(object):
             numpy.ndarray array of (data, x_coord, lng) of nodes that
             intersect the bounding box.
         """
+        leaf_point_list = []
+        self._collect_leaves_in_bounding_box(
+            bounding_box, self.bounding_box, leaf_point_list)
+        return _gather_points_in_bounding_box(leaf_point_list, bounding_box)
+
+    def _collect_leaves_in_bounding_box(
+            self, bounding_box, root_bounding_box, leaf_point_list):
+        """Append the points of leaves that intersect bounding_box to a list.
+
+        Args:
+            bounding_box (list): of the form [xmin, ymin, xmax, ymax]
+            root_bounding_box (list): bounding box of the root of the tree
+            leaf_point_list (list): list to append (point_array,
+                fully_inside) tuples to for every leaf with points that
+                intersects `bounding_box`
+
+        Returns:
+            None
+        """
         if not self._bounding_box_intersect(bounding_box):
+            return
+        if self.is_leaf:
+            point_array = self._get_points_from_node()
+            if point_array.size > 0:
+                leaf_point_list.append((
+                    point_array, _leaf_in_bounding_box(
+                        self.bounding_box, root_bounding_box,
+                        bounding_box)))
+            return
+        for node_index in xrange(4):
+            self.nodes[node_index]._collect_leaves_in_bounding_box(
+                bounding_box, root_bounding_box, leaf_point_list)
+
+
+class FlatQuadTree(object):
+    """A read-only quadtree opened from a flat index file.
+
+    The index is memory-mapped so opening is O(1) and node points are read
+    lazily from the node store's extent file.  Processes that open the same
+    index share its pages through the OS rather than each holding a copy of
+    the tree.  Pickling only stores the index path.
+    """
+
+    def __init__(self, index_path):
+        """Open a flat index written by ``OutOfCoreQuadTree.flush``.
+
+        Args:
+            index_path (string): path to a ``.qtindex`` file.
+
+        Returns:
+            None
+        """
+        self.index_path = index_path
+        with open(index_path, 'rb') as index_file:
+            magic, version, extent_path_len, n_nodes = (
+                _FLAT_INDEX_HEADER.unpack(
+                    index_file.read(_FLAT_INDEX_HEADER.size)))
+            if magic != _FLAT_INDEX_MAGIC or version != _FLAT_INDEX_VERSION:
+                raise ValueError(
+                    '%s is not a version %d quadtree index' % (
+                        index_path, _FLAT_INDEX_VERSION))
+            extent_path = index_file.read(extent_path_len).decode('utf-8')
+        self.extent_filename = os.path.join(
+            os.path.dirname(os.path.abspath(index_path)), extent_path)
+        self.node_array = numpy.memmap(
+            index_path, dtype=_FLAT_NODE_TYPE, mode='r',
+            offset=_flat_index_header_size(extent_path_len),
+            shape=(n_nodes,))
+        self._extent_mmap = None
+
+    def __getstate__(self):
+        """Pickle only the path to the index."""
+        return {'index_path': self.index_path}
+
+    def __setstate__(self, state):
+        """Reopen the index on unpickling."""
+        self.__init__(state['index_path'])
+
+    def n_nodes(self):
+        """Return the number of nodes in the quadtree"""
+        return self.node_array.size
+
+    def n_points(self):
+        """Return the number of points in the quadtree"""
+        return int(self.node_array['n_points'].sum())
+
+    def _get_points_from_node(self, node_index):
+        """Return a read-only view of the points in a leaf node.
+
+        Args:
+            node_index (int): index of a leaf in ``self.node_array``.
+
+        Returns:
+            numpy.ndarray of the form [(data, x_coord, y_coord), ...]
+        """
+        n_points = self.node_array['n_points'][node_index]
+        if n_points == 0:
             return numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
+        if self._extent_mmap is None:
+            self._extent_mmap = numpy.memmap(
+                self.extent_filename, dtype=numpy.uint8, mode='r')
+        offset = self.node_array['offset'][node_index]
+        return self._extent_mmap[
+            offset:offset+n_points*_ARRAY_TUPLE_TYPE.itemsize].view(
+                _ARRAY_TUPLE_TYPE)
 
-        if self.is_leaf:
-            # drain the node into a list, filter to current bounding box
-            point_list = numpy.array([
-                point for point in self._get_points_from_node() if _in_box(
-                    bounding_box, point[2], point[3])],
-                dtype=_ARRAY_TUPLE_TYPE)
-            return point_list
+    def get_intersecting_points_in_polygon(self, shapely_polygon):
+        """Return the points contained in `shapely_polygon`.
+
+        Args:
+            shapely_polygon (shapely.geometry.Polygon): a polygon to bound
+                against
+
+        Returns:
+            numpy.ndarray of (data, x_coord, y_coord) of points that are
+                contained in `shapely_polygon`.
+        """
+        if shapely_polygon.is_empty:
+            # an empty polygon has no bounds to cull against
+            return numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
+        shapely_prepared_polygon = shapely.prepared.prep(shapely_polygon)
+        polygon_bounds = shapely_polygon.bounds
+        bounding_box_array = self.node_array['bounding_box']
+        subtree_end_array = self.node_array['subtree_end']
+        leaf_array = self.node_array['is_leaf']
+
+        point_array_list = []
+        node_index = 0
+        while node_index < self.node_array.size:
+            bounding_box = bounding_box_array[node_index]
+            if not _bounding_box_intersect(bounding_box, polygon_bounds):
+                node_index = subtree_end_array[node_index]
+                continue
+            bounding_polygon = shapely.geometry.box(*bounding_box)
+            if not shapely_prepared_polygon.intersects(bounding_polygon):
+                node_index = subtree_end_array[node_index]
+                continue
+            if shapely_prepared_polygon.contains(bounding_polygon):
+                # trivial, every point under this node is in the poly
+                for leaf_index in xrange(
+                        node_index, subtree_end_array[node_index]):
+                    if leaf_array[leaf_index]:
+                        point_array_list.append(
+                            self._get_points_from_node(leaf_index))
+                node_index = subtree_end_array[node_index]
+                continue
+            if leaf_array[node_index]:
+                # tricky, some points might be in poly
+                point_array_list.append(_points_in_prepared_polygon(
+                    self._get_points_from_node(node_index),
+                    shapely_prepared_polygon, polygon_bounds))
+            node_index += 1
+
+        if len(point_array_list) == 0:
+            return numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
+        return numpy.concatenate(point_array_list)
+
+    def get_intersecting_points_in_bounding_box(self, bounding_box):
+        """Get list of data that is contained by bounding_box.
+
+        Args:
+            bounding_box (list): of the form [xmin, ymin, xmax, ymax]
+
+        Returns:
+            numpy.ndarray array of (data, x_coord, y_coord) of points in
+            `bounding_box`.
+        """
+        bounding_box_array = self.node_array['bounding_box'].T
+        leaf_index_array = numpy.flatnonzero(
+            self.node_array['is_leaf'] &
+            (self.node_array['n_points'] > 0) &
+            _bounding_box_intersect(bounding_box_array, bounding_box))
+        fully_inside_array = _leaf_in_bounding_box(
+            bounding_box_array[:, leaf_index_array], bounding_box_array[:, 0],
+            bounding_box)
+        return _gather_points_in_bounding_box(
+            [(self._get_points_from_node(leaf_index), fully_inside)
+             for leaf_index, fully_inside in zip(
+                 leaf_index_array, fully_inside_array)],
+            bounding_box)
+
+
+def _flat_index_header_size(extent_path_len):
+    """Return the padded size of a flat index header in bytes."""
+    header_size = _FLAT_INDEX_HEADER.size + extent_path_len
+    return -(-header_size // _FLAT_INDEX_ALIGNMENT) * _FLAT_INDEX_ALIGNMENT
+
+
+def _bounding_box_intersect(bounding_box, other_bounding_box):
+    """Test if two bounding boxes intersect.
+
+    Args:
+        bounding_box (sequence): bounding box of form [xmin, ymin, xmax,
+            ymax], the elements may be numpy arrays to test many boxes at once
+        other_bounding_box (sequence): bounding box of form [xmin, ymin,
+            xmax, ymax]
+
+    Returns:
+        True (or a boolean array) where the boxes intersect.
+    """
+    return ~(
+        (bounding_box[0] > other_bounding_box[2]) |
+        (bounding_box[2] < other_bounding_box[0]) |
+        (bounding_box[1] > other_bounding_box[3]) |
+        (bounding_box[3] < other_bounding_box[1]))
+
+
+def _leaf_in_bounding_box(
+        leaf_bounding_box, root_bounding_box, bounding_box):
+    """Test if every point in a leaf is guaranteed to be in bounding_box.
+
+    Points are split between quads by comparing their float32 coordinates to
+    a float32 midpoint, so the leaf edges are compared at float32 precision.
+    Leaves on the edge of the root can hold points that lie outside of the
+    tree's bounding box so are never considered fully inside.
+
+    Args:
+        leaf_bounding_box (sequence): bounding box of the leaf of the form
+            [xmin, ymin, xmax, ymax], the elements may be numpy arrays to
+            test many leaves at once
+        root_bounding_box (sequence): bounding box of the root of the tree
+        bounding_box (sequence): query bounding box, points are inside if
+            xmin <= x < xmax and ymin <= y < ymax
+
+    Returns:
+        True (or a boolean array) where all the points of the leaf are in
+        `bounding_box`.
+    """
+    leaf_bounding_box_f32 = numpy.asarray(
+        leaf_bounding_box, dtype=numpy.float32)
+    return (
+        (leaf_bounding_box[0] > root_bounding_box[0]) &
+        (leaf_bounding_box[1] > root_bounding_box[1]) &
+        (leaf_bounding_box[2] < root_bounding_box[2]) &
+        (leaf_bounding_box[3] < root_bounding_box[3]) &
+        (leaf_bounding_box_f32[0] >= bounding_box[0]) &
+        (leaf_bounding_box_f32[1] >= bounding_box[1]) &
+        (leaf_bounding_box_f32[2] <= bounding_box[2]) &
+        (leaf_bounding_box_f32[3] <= bounding_box[3]))
+
+
+def _gather_points_in_bounding_box(leaf_point_list, bounding_box):
+    """Gather the points of many leaves in bounding_box into one array.
+
+    Leaves that are fully inside the bounding box are copied without a
+    filter, the rest are filtered with a boolean mask.  The output is
+    allocated once and every leaf is copied directly into its slice.
+
+    Args:
+        leaf_point_list (list): list of (point_array, fully_inside) tuples
+            where `point_array` is a structured array of
+            (data, x_coord, y_coord) points
+        bounding_box (list): of the form [xmin, ymin, xmax, ymax]
+
+    Returns:
+        numpy.ndarray of the (data, x_coord, y_coord) points in
+        `bounding_box`.
+    """
+    leaf_mask_list = []
+    n_points = 0
+    for point_array, fully_inside in leaf_point_list:
+        if fully_inside:
+            leaf_mask_list.append((point_array, None, point_array.size))
+            n_points += point_array.size
+            continue
+        in_box_mask = (
+            (point_array['f2'] >= bounding_box[0]) &
+            (point_array['f3'] >= bounding_box[1]) &
+            (point_array['f2'] < bounding_box[2]) &
+            (point_array['f3'] < bounding_box[3]))
+        n_points_in_box = numpy.count_nonzero(in_box_mask)
+        leaf_mask_list.append((point_array, in_box_mask, n_points_in_box))
+        n_points += n_points_in_box
+
+    result_array = numpy.empty(n_points, dtype=_ARRAY_TUPLE_TYPE)
+    result_index = 0
+    for point_array, in_box_mask, n_points_in_box in leaf_mask_list:
+        result_slice = result_array[
+            result_index:result_index+n_points_in_box]
+        if in_box_mask is None:
+            result_slice[:] = point_array
         else:
-            point_list = numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
-            for node_index in xrange(4):
-                point_list = numpy.concatenate((
-                    self.nodes[node_index].get_intersecting_points_in_bounding_box(
-                        bounding_box), point_list))
-            return point_list
+            numpy.compress(in_box_mask, point_array, out=result_slice)
+        result_index += n_points_in_box
+    return result_array
+
+
+def _points_in_prepared_polygon(
+        point_array, shapely_prepared_polygon, polygon_bounds):
+    """Return the points in an array that are inside a prepared polygon.
+
+    Points are first culled to the interior of the polygon's bounding box
+    and the rest are tested in one vectorized call.
+
+    Args:
+        point_array (numpy.ndarray): structured array of
+            (data, x_coord, y_coord) points.
+        shapely_prepared_polygon (shapely.prepared.PreparedGeometry): a
+            prepared polygon to bound against
+        polygon_bounds (tuple): bounding box of the polygon of the form
+            (xmin, ymin, xmax, ymax)
+
+    Returns:
+        numpy.ndarray of the points in `point_array` contained in the polygon.
+    """
+    if shapely_prepared_polygon.context.is_empty:
+        return point_array[:0]
+    x_coords = point_array['f2'].astype(numpy.float64)
+    y_coords = point_array['f3'].astype(numpy.float64)
+    in_box_index = numpy.flatnonzero(
+        (x_coords > polygon_bounds[0]) &
+        (y_coords > polygon_bounds[1]) &
+        (x_coords < polygon_bounds[2]) &
+        (y_coords < polygon_bounds[3]))
+    if in_box_index.size == 0:
+        return point_array[in_box_index]
+    in_polygon_mask = shapely.vectorized.contains(
+        shapely_prepared_polygon, x_coords[in_box_index],
+        y_coords[in_box_index])
+    return point_array[in_box_index[in_polygon_mask]]
 
 
 cdef _sort_list_to_quads(
@@ -397,19 +1014,3 @@ cdef _sort_list_to_quads(
     right_y_split_index[0] = sub_array['f3'].searchsorted(
         mid_y_coord) + x_split_index[0]
 
-
-def _in_box(bounding_box, x_coord, y_coord):
-    """Test if coordinate is contained in the bounding box.
-
-    Args:
-        bounding_box (list): of form [xmin, ymin, xmax, ymax]
-        x_coord, y_coord (int): x and y coordinate to test.
-
-    Returns:
-        True if (x_coord, y_coord) bound in bounding_box, False otherwise.
-    """
-    return (
-        x_coord >= bounding_box[0] and  # xmin
-        y_coord >= bounding_box[1] and  # ymin
-        x_coord < bounding_box[2] and  # xmax
-        y_coord < bounding_box[3])  # ymax
@@ -0,0 +1,166 @@
+"""Columnar parser for blocks of the recreation photo CSV."""
+
+import hashlib
+
+import numpy
+
+from . import buffered_numpy_disk_map
+
+
+_ARRAY_TUPLE_TYPE = (
+    buffered_numpy_disk_map.BufferedNumpyDiskMap._ARRAY_TUPLE_TYPE)
+
+# user ids are truncated to this many bytes before they're hashed
+_USER_ID_BYTES = 40
+# length of the "YYYY-MM-DD " prefix of the date/time field
+_DATE_PREFIX_BYTES = 11
+
+_NEWLINE = ord('\n')
+_COMMA = ord(',')
+
+
+def parse_photo_block(block_bytes):
+    """Parse lines of the photo CSV to (date, user hash, lng, lat) points.
+
+    Lines have the form::
+
+        8568090486,48344648@N00,2013-03-17 16:27:27,42.383841,-71.138378,16
+
+    Rather than matching each line with a regular expression, the positions
+    of every newline and comma in the block are found with one vectorized
+    scan and the fields of all lines are sliced out of the block together.
+    Lines with fewer than six fields, an empty field, or a date/time that
+    doesn't start with a valid 20xx calendar date are skipped.
+
+    User ids are truncated to 40 bytes and hashed to the last four bytes of
+    their md5 digest.  Each distinct user id in the block is hashed once.
+
+    Args:
+        block_bytes (bytes): whole lines of the photo CSV.
+
+    Returns:
+        numpy structured array of (datetime64[D], user hash, lng, lat)
+        points, one for each valid line.
+    """
+    block_array = numpy.frombuffer(block_bytes, dtype=numpy.uint8)
+    if block_array.size == 0:
+        return numpy.empty(0, dtype=_ARRAY_TUPLE_TYPE)
+    line_end = numpy.flatnonzero(block_array == _NEWLINE)
+    if block_array.size > 0 and block_array[-1] != _NEWLINE:
+        line_end = numpy.append(line_end, block_array.size)
+    line_start = numpy.concatenate(([0], line_end[:-1] + 1))
+
+    # the first five commas at or after each line start, the padding is past
+    # the end of every line so lines without five commas are invalid
+    comma_index = numpy.append(
+        numpy.flatnonzero(block_array == _COMMA),
+        numpy.full(5, block_array.size + 1))
+    first_comma = numpy.searchsorted(comma_index, line_start)
+    field_end = comma_index[first_comma[:, None] + numpy.arange(5)]
+    field_start = numpy.concatenate(
+        (line_start[:, None], field_end[:, :4] + 1), axis=1)
+
+    # the sixth field must be nonempty and the date/time field must hold at
+    # least a date, a space, and a time
+    valid_mask = (
+        (field_end[:, 4] + 1 < line_end) &
+        numpy.all(field_end > field_start, axis=1) &
+        (field_end[:, 2] - field_start[:, 2] > _DATE_PREFIX_BYTES))
+    field_start = field_start[valid_mask]
+    field_end = field_end[valid_mask]
+
+    date_bytes = _gather_fields(
+        block_array, field_start[:, 2], field_start[:, 2] +
+        _DATE_PREFIX_BYTES, _DATE_PREFIX_BYTES).astype(numpy.int32)
+    date_digits = date_bytes - ord('0')
+    digit_columns = [2, 3, 5, 6, 8, 9]
+    year = 2000 + date_digits[:, 2] * 10 + date_digits[:, 3]
+    month = date_digits[:, 5] * 10 + date_digits[:, 6]
+    day = date_digits[:, 8] * 10 + date_digits[:, 9]
+    valid_mask = (
+        (date_bytes[:, 0] == ord('2')) & (date_bytes[:, 1] == ord('0')) &
+        numpy.all(
+            (date_digits[:, digit_columns] >= 0) &
+            (date_digits[:, digit_columns] <= 9), axis=1) &
+        (date_bytes[:, 4] == ord('-')) & (date_bytes[:, 7] == ord('-')) &
+        (date_bytes[:, 10] == ord(' ')) &
+        (month >= 1) & (month <= 12) & (day >= 1))
+    month_start = numpy.where(
+        valid_mask, (year - 1970) * 12 + month - 1, 0).astype(
+            'datetime64[M]')
+    days_in_month = (
+        (month_start + 1).astype('datetime64[D]') -
+        month_start.astype('datetime64[D]')).astype(numpy.int32)
+    valid_mask &= day <= days_in_month
+
+    field_start = field_start[valid_mask]
+    field_end = field_end[valid_mask]
+    point_array = numpy.empty(field_start.shape[0], dtype=_ARRAY_TUPLE_TYPE)
+    point_array['f0'] = (
+        month_start[valid_mask].astype('datetime64[D]') +
+        (day[valid_mask] - 1))
+
+    # fixed width user ids drop trailing nulls like any numpy bytes array
+    user_id_width = min(
+        _USER_ID_BYTES, int(numpy.max(field_end[:, 1] - field_start[:, 1],
+                                      initial=1)))
+    user_id_array = _gather_fields(
+        block_array, field_start[:, 1], field_end[:, 1],
+        user_id_width).view('S%d' % user_id_width)[:, 0]
+    unique_user_ids, user_index = numpy.unique(
+        user_id_array, return_inverse=True)
+    user_hashes = numpy.array(
+        [hashlib.md5(user_id).digest()[-4:] for user_id in unique_user_ids],
+        dtype='S4')
+    point_array['f1'] = user_hashes[user_index.ravel()]
+
+    # lat is the fourth field and lng the fifth
+    for field_id, field_index in [('f3', 3), ('f2', 4)]:
+        point_array[field_id] = _parse_float_field(
+            block_array, field_start[:, field_index],
+            field_end[:, field_index])
+    return point_array
+
+
+def _gather_fields(block_array, field_start, field_end, width):
+    """Copy fields of a byte array to rows of a fixed width array.
+
+    Args:
+        block_array (numpy.ndarray): uint8 array of the block.
+        field_start (numpy.ndarray): index of the first byte of each field.
+        field_end (numpy.ndarray): index one past the last byte of each
+            field.
+        width (int): number of bytes to copy per field, longer fields are
+            truncated and shorter ones padded with nulls.
+
+    Returns:
+        uint8 numpy.ndarray of shape (n fields, width).
+    """
+    # index whole rows of a sliding window view so each field is one copy
+    padded_block = numpy.concatenate(
+        (block_array, numpy.zeros(width, dtype=numpy.uint8)))
+    field_bytes = numpy.lib.stride_tricks.sliding_window_view(
+        padded_block, width)[field_start]
+    field_bytes *= (
+        numpy.arange(width) < (field_end - field_start)[:, None])
+    return field_bytes
+
+
+def _parse_float_field(block_array, field_start, field_end):
+    """Parse numeric fields of a byte array to float32.
+
+    Args:
+        block_array (numpy.ndarray): uint8 array of the block.
+        field_start (numpy.ndarray): index of the first byte of each field.
+        field_end (numpy.ndarray): index one past the last byte of each
+            field.
+
+    Returns:
+        float32 numpy.ndarray of the parsed fields.
+    """
+    if field_start.size == 0:
+        return numpy.empty(0, dtype=numpy.float32)
+    width = int(numpy.max(field_end - field_start))
+    field_array = _gather_fields(
+        block_array, field_start, field_end, width).view('S%d' % width)
+    return field_array[:, 0].astype(numpy.float32)
@@ -9,6 +9,8 @@ import pickle
 import urllib.request
 import tempfile
 import shutil
+import struct
+import zlib
 
 import rtree
 import Pyro4
@@ -19,10 +21,12 @@ import shapely
 import shapely.geometry
 import shapely.wkt
 import shapely.prepared
+import shapely.vectorized
 import pygeoprocessing
 import numpy
 import numpy.linalg
 import pandas
+import scipy.spatial
 import shapely.speedups
 import taskgraph
 
@@ -33,6 +37,7 @@ if shapely.speedups.available:
 # installed and we import the global version of it rather than the local
 from .. import utils
 from .. import validation
+from . import vector_field_writer
 
 LOGGER = logging.getLogger(__name__)
 
@@ -179,6 +184,30 @@ _ESRI_SHAPEFILE_EXTENSIONS = ['.prj', '.shp', '.shx', '.dbf', '.sbn', '.sbx']
 # Have 5.0 seconds between timed progress outputs
 LOGGER_TIME_DELAY = 5.0
 
+# Nodata of the rasterized response polygon FIDs
+_RESPONSE_FID_NODATA = -1
+
+# Size of the chunks the AOI and results are sent to and from the server in
+_TRANSFER_CHUNK_SIZE = 2 ** 22
+# Times to reconnect and resume an interrupted upload or download
+_MAX_TRANSFER_RETRIES = 5
+# Fixed size part of a zip member's local file header
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+_ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# Seconds between polls of a job's status, doubling up to the maximum
+_JOB_POLL_MIN_DELAY = 1.0
+_JOB_POLL_MAX_DELAY = 30.0
+
+# Most blocks per side of the coarse mask used to cull grid cells
+_GRID_MASK_MAX_SIZE = 256
+# Grid cells written per transaction
+_GRID_TRANSACTION_SIZE = 10000
+# Features per block when reading the fields of a regression or scenario
+_FIELD_BLOCK_SIZE = 2 ** 16
+
+# Points nearest a polygon's center that bound its nearest point distance
+_NEAREST_POINT_CANDIDATES = 8
+
 # For now, this is the field name we use to mark the photo user "days"
 RESPONSE_ID = 'PUD_YR_AVG'
 SCENARIO_RESPONSE_ID = 'PUD_EST'
@@ -491,27 +520,26 @@ def _retrieve_photo_user_days(
                 LOGGER.info('archiving %s', filename)
                 aoizip.write(filename, os.path.basename(filename))
 
-    # convert shapefile to binary string for serialization
-    zip_file_binary = open(compressed_aoi_path, 'rb').read()
-
-    # transfer zipped file to server
+    # transfer zipped file to server in chunks
     start_time = time.time()
+    session_id = _upload_aoi(recmodel_server, compressed_aoi_path)
     LOGGER.info('Please wait for server to calculate PUD...')
 
-    result_zip_file_binary, workspace_id = (
-        recmodel_server.calc_photo_user_days_in_aoi(
-            zip_file_binary, date_range,
-            pud_results_filename))
+    workspace_id = recmodel_server.submit_job(
+        session_id, date_range, pud_results_filename)
+    result_size = _wait_for_job(recmodel_server, workspace_id)
     LOGGER.info(
-        'received result, took %f seconds, workspace_id: %s',
+        'calculated result, took %f seconds, workspace_id: %s',
         time.time() - start_time, workspace_id)
 
-    # unpack result
-    open(compressed_pud_path, 'wb').write(
-        result_zip_file_binary)
+    # unpack result while it downloads
     temporary_output_dir = tempfile.mkdtemp(dir=output_dir)
-    zipfile.ZipFile(compressed_pud_path, 'r').extractall(
-        temporary_output_dir)
+    _extract_zip_stream(
+        _iter_result_chunks(recmodel_server, workspace_id, result_size),
+        compressed_pud_path, temporary_output_dir)
+    LOGGER.info(
+        'received %d byte result, took %f seconds', result_size,
+        time.time() - start_time)
 
     for filename in os.listdir(temporary_output_dir):
         shutil.copy(os.path.join(temporary_output_dir, filename), output_dir)
@@ -525,6 +553,240 @@ def _retrieve_photo_user_days(
     recmodel_server._pyroRelease()
 
 
+def _upload_aoi(recmodel_server, compressed_aoi_path):
+    """Upload a zipped AOI to the server in chunks.
+
+    If the connection drops the proxy reconnects and the upload resumes
+    from the last byte the server received.
+
+    Args:
+        recmodel_server (Pyro4.Proxy): proxy of the recreation server.
+        compressed_aoi_path (string): path to the zipped AOI.
+
+    Returns:
+        session ID of the upload to pass to ``submit_job``.
+
+    """
+    session_id = recmodel_server.start_aoi_upload()
+    aoi_size = os.path.getsize(compressed_aoi_path)
+    offset = 0
+    n_retries = 0
+    resuming = False
+    with open(compressed_aoi_path, 'rb') as aoi_file:
+        while offset < aoi_size:
+            try:
+                if resuming:
+                    # reconnecting and asking for the offset can fail too,
+                    # they're retried like a chunk
+                    recmodel_server._pyroReconnect()
+                    offset = recmodel_server.get_upload_offset(session_id)
+                    resuming = False
+                    continue
+                aoi_file.seek(offset)
+                chunk_binary = aoi_file.read(_TRANSFER_CHUNK_SIZE)
+                offset = recmodel_server.upload_aoi_chunk(
+                    session_id, offset, chunk_binary)
+            except Pyro4.errors.CommunicationError:
+                n_retries += 1
+                if n_retries > _MAX_TRANSFER_RETRIES:
+                    raise
+                LOGGER.warning(
+                    'AOI upload interrupted at %d of %d bytes, resuming',
+                    offset, aoi_size)
+                resuming = True
+    return session_id
+
+
+def _wait_for_job(recmodel_server, job_id):
+    """Poll the status of a job on the server until it's done.
+
+    The delay between polls doubles from ``_JOB_POLL_MIN_DELAY`` up to
+    ``_JOB_POLL_MAX_DELAY`` and the connection is released while waiting so
+    long jobs don't hold one of the server's connections.
+
+    Args:
+        recmodel_server (Pyro4.Proxy): proxy of the recreation server.
+        job_id (string): ID returned by the server's ``submit_job``.
+
+    Returns:
+        size in bytes of the job's result archive.
+
+    Raises:
+        RuntimeError if the job failed on the server.
+
+    """
+    poll_delay = _JOB_POLL_MIN_DELAY
+    n_retries = 0
+    last_phase = None
+    last_log_time = time.time()
+    while True:
+        try:
+            job_status = recmodel_server.get_job_status(job_id)
+        except Pyro4.errors.CommunicationError:
+            n_retries += 1
+            if n_retries > _MAX_TRANSFER_RETRIES:
+                raise
+            LOGGER.warning('lost connection polling job %s, retrying', job_id)
+            job_status = None
+        else:
+            n_retries = 0
+
+        if job_status is not None:
+            if job_status['phase'] == 'done':
+                return job_status['result_size']
+            if job_status['phase'] == 'failed':
+                raise RuntimeError(
+                    "server failed to calculate PUD: %s" %
+                    job_status['error'])
+            if (job_status['phase'] != last_phase or
+                    time.time() - last_log_time > LOGGER_TIME_DELAY):
+                LOGGER.info(
+                    'server job is %s, %.2f%% complete',
+                    job_status['phase'], job_status['percent_complete'])
+                last_phase = job_status['phase']
+                last_log_time = time.time()
+
+        recmodel_server._pyroRelease()
+        time.sleep(poll_delay)
+        poll_delay = min(poll_delay * 2, _JOB_POLL_MAX_DELAY)
+
+
+def _iter_result_chunks(recmodel_server, workspace_id, result_size):
+    """Download the result archive of a workspace in chunks.
+
+    If the connection drops the proxy reconnects and the download resumes
+    from the last chunk received.
+
+    Args:
+        recmodel_server (Pyro4.Proxy): proxy of the recreation server.
+        workspace_id (string): ID of the workspace with the result.
+        result_size (int): size in bytes of the result archive.
+
+    Yields:
+        bytes chunks of the result archive in order.
+
+    """
+    offset = 0
+    n_retries = 0
+    while offset < result_size:
+        try:
+            chunk_binary = recmodel_server.download_result_chunk(
+                workspace_id, offset, _TRANSFER_CHUNK_SIZE)
+        except Pyro4.errors.CommunicationError:
+            n_retries += 1
+            if n_retries > _MAX_TRANSFER_RETRIES:
+                raise
+            LOGGER.warning(
+                'result download interrupted at %d of %d bytes, resuming',
+                offset, result_size)
+            recmodel_server._pyroReconnect()
+            continue
+        if not chunk_binary:
+            raise IOError(
+                "result ended after %d of %d bytes" % (offset, result_size))
+        offset += len(chunk_binary)
+        yield chunk_binary
+
+
+def _extract_zip_stream(chunk_iterator, archive_path, target_dir):
+    """Save a zip archive from chunks and extract it as the chunks arrive.
+
+    Each member is extracted as soon as its bytes arrive by following the
+    local file headers that precede the members, so the first files are
+    unpacked before the rest of the archive is received.  If a member can't
+    be streamed, such as one whose size isn't in its local header, it and
+    any members after it are extracted from the saved archive at the end.
+
+    Args:
+        chunk_iterator (iterable): bytes chunks of the archive in order.
+        archive_path (string): path to save the archive to.
+        target_dir (string): directory to extract the archive's files to.
+
+    Returns:
+        None
+
+    """
+    pending_bytes = bytearray()
+    extracted_name_set = set()
+    streaming = True
+    # the member being extracted is a list of its file, decompressor,
+    # compressed bytes left, running crc, expected crc and name
+    member = None
+    with open(archive_path, 'wb') as archive_file:
+        for chunk_binary in chunk_iterator:
+            archive_file.write(chunk_binary)
+            if not streaming:
+                continue
+            pending_bytes += chunk_binary
+            while streaming:
+                if member is None:
+                    if len(pending_bytes) < _ZIP_LOCAL_HEADER.size:
+                        break
+                    (signature, _, flags, compress_type, _, _, member_crc,
+                     compress_size, _, name_size, extra_size) = (
+                        _ZIP_LOCAL_HEADER.unpack_from(pending_bytes))
+                    if signature != _ZIP_LOCAL_HEADER_SIGNATURE:
+                        # the central directory follows the last member
+                        streaming = False
+                        break
+                    # encrypted, data descriptor, and zip64 members can't
+                    # be streamed
+                    if (flags & 0x09 or compress_size == 0xFFFFFFFF or
+                            compress_type not in (
+                                zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+                        streaming = False
+                        break
+                    header_size = (
+                        _ZIP_LOCAL_HEADER.size + name_size + extra_size)
+                    if len(pending_bytes) < header_size:
+                        break
+                    member_name = bytes(pending_bytes[
+                        _ZIP_LOCAL_HEADER.size:
+                        _ZIP_LOCAL_HEADER.size + name_size]).decode(
+                            'utf-8' if flags & 0x800 else 'cp437')
+                    del pending_bytes[:header_size]
+                    target_filename = os.path.basename(member_name)
+                    member = [
+                        open(os.path.join(target_dir, target_filename), 'wb')
+                        if target_filename else None,
+                        zlib.decompressobj(-zlib.MAX_WBITS)
+                        if compress_type == zipfile.ZIP_DEFLATED else None,
+                        compress_size, 0, member_crc, member_name]
+
+                (member_file, decompressor, compress_size, running_crc,
+                 member_crc, member_name) = member
+                member_bytes = bytes(pending_bytes[:compress_size])
+                del pending_bytes[:len(member_bytes)]
+                compress_size -= len(member_bytes)
+                if decompressor is not None:
+                    member_bytes = decompressor.decompress(member_bytes)
+                    if compress_size == 0:
+                        member_bytes += decompressor.flush()
+                running_crc = zlib.crc32(member_bytes, running_crc)
+                if member_file is not None:
+                    member_file.write(member_bytes)
+                if compress_size > 0:
+                    member[2:4] = [compress_size, running_crc]
+                    break
+                if member_file is not None:
+                    member_file.close()
+                if running_crc != member_crc:
+                    raise zipfile.BadZipFile(
+                        "Bad CRC-32 for file %r" % member_name)
+                extracted_name_set.add(member_name)
+                member = None
+    if member is not None and member[0] is not None:
+        member[0].close()
+
+    # the archive's central directory lists all of its members
+    with zipfile.ZipFile(archive_path, 'r') as archive:
+        unextracted_name_list = [
+            member_name for member_name in archive.namelist()
+            if member_name not in extracted_name_set]
+        if unextracted_name_list:
+            archive.extractall(target_dir, members=unextracted_name_list)
+
+
 def _grid_vector(vector_path, grid_type, cell_size, out_grid_vector_path):
     """Convert vector to a regular grid.
 
@@ -532,6 +794,12 @@ def _grid_vector(vector_path, grid_type, cell_size, out_grid_vector_path):
     original vector.  Cells that would intersect with the boundary are not
     produced.
 
+    The vertices of a whole row of cells are calculated at once.  Cells are
+    first checked against a coarse mask of the vector, which accepts cells
+    that lie inside mask blocks in the vector's interior and rejects cells
+    whose center is in a block outside the vector, so only cells near the
+    boundary are tested for containment one at a time.
+
     Args:
         vector_path (string): path to an OGR compatible polygon vector type
         grid_type (string): one of "square" or "hexagon"
@@ -585,54 +853,210 @@ def _grid_vector(vector_path, grid_type, cell_size, out_grid_vector_path):
         n_cols = int(math.floor(grid_width / (3 * delta_long_x)) + 1)
         n_rows = int(math.floor(grid_height / delta_y) + 1)
 
-        def _generate_polygon(col_index, row_index):
-            """Generate a points for a closed hexagon."""
+        def _generate_row(row_index):
+            """Generate the points of the closed hexagons in a row."""
+            col_array = numpy.arange(n_cols)
             if (row_index + 1) % 2:
-                centroid = (
-                    extent[0] + (delta_long_x * (1 + (3 * col_index))),
-                    extent[2] + (delta_y * (row_index + 1)))
+                x_coordinate = (
+                    extent[0] + (delta_long_x * (1 + (3 * col_array))))
             else:
-                centroid = (
-                    extent[0] + (delta_long_x * (2.5 + (3 * col_index))),
-                    extent[2] + (delta_y * (row_index + 1)))
-            x_coordinate, y_coordinate = centroid
-            hexagon = [(x_coordinate - delta_long_x, y_coordinate),
-                       (x_coordinate - delta_short_x, y_coordinate + delta_y),
-                       (x_coordinate + delta_short_x, y_coordinate + delta_y),
-                       (x_coordinate + delta_long_x, y_coordinate),
-                       (x_coordinate + delta_short_x, y_coordinate - delta_y),
-                       (x_coordinate - delta_short_x, y_coordinate - delta_y),
-                       (x_coordinate - delta_long_x, y_coordinate)]
-            return hexagon
+                x_coordinate = (
+                    extent[0] + (delta_long_x * (2.5 + (3 * col_array))))
+            y_coordinate = numpy.full(
+                n_cols, extent[2] + (delta_y * (row_index + 1)))
+            hexagon_x = [
+                x_coordinate - delta_long_x, x_coordinate - delta_short_x,
+                x_coordinate + delta_short_x, x_coordinate + delta_long_x,
+                x_coordinate + delta_short_x, x_coordinate - delta_short_x,
+                x_coordinate - delta_long_x]
+            hexagon_y = [
+                y_coordinate, y_coordinate + delta_y, y_coordinate + delta_y,
+                y_coordinate, y_coordinate - delta_y, y_coordinate - delta_y,
+                y_coordinate]
+            return numpy.stack(
+                [numpy.stack(hexagon_x, axis=1),
+                 numpy.stack(hexagon_y, axis=1)], axis=2)
+        mask_cell_size = 4 * cell_size
     elif grid_type == 'square':
-        def _generate_polygon(col_index, row_index):
-            """Generate points for a closed square."""
-            square = [
-                (extent[0] + col_index * cell_size + x,
-                 extent[2] + row_index * cell_size + y)
-                for x, y in [
+        def _generate_row(row_index):
+            """Generate the points of the closed squares in a row."""
+            col_array = numpy.arange(n_cols)
+            square_x = []
+            square_y = []
+            for x, y in [
                     (0, 0), (cell_size, 0), (cell_size, cell_size),
-                    (0, cell_size), (0, 0)]]
-            return square
+                    (0, cell_size), (0, 0)]:
+                square_x.append(extent[0] + col_array * cell_size + x)
+                square_y.append(numpy.full(
+                    n_cols, extent[2] + row_index * cell_size + y))
+            return numpy.stack(
+                [numpy.stack(square_x, axis=1),
+                 numpy.stack(square_y, axis=1)], axis=2)
         n_rows = int((extent[3] - extent[2]) / cell_size)
         n_cols = int((extent[1] - extent[0]) / cell_size)
+        mask_cell_size = 4 * cell_size
     else:
         raise ValueError('Unknown polygon type: %s' % grid_type)
 
+    # coordinates can move by rounding when a cell is tested as WKT, so the
+    # mask blocks and the cell bounds are padded by much more than that
+    margin = 1e-9 * max(max(abs(value) for value in extent), cell_size)
+    mask_cell_size = max(
+        mask_cell_size,
+        max(extent[1] - extent[0], extent[3] - extent[2]) /
+        _GRID_MASK_MAX_SIZE)
+    interior_table, exterior_mask = _grid_containment_mask(
+        original_polygon, extent, mask_cell_size, margin)
+    mask_n_rows, mask_n_cols = exterior_mask.shape
+
+    def _mask_index(coordinate, origin, n_mask):
+        """Index of the mask block of coordinates, -1 or n_mask if off it."""
+        return numpy.clip(
+            numpy.floor((coordinate - origin) / mask_cell_size),
+            -1, n_mask).astype(numpy.int64)
+
+    n_cells = 0
+    n_exact_tests = 0
+    last_time = time.time()
+    grid_layer.StartTransaction()
     for row_index in range(n_rows):
-        for col_index in range(n_cols):
-            polygon_points = _generate_polygon(col_index, row_index)
-            ring = ogr.Geometry(ogr.wkbLinearRing)
-            for xoff, yoff in polygon_points:
-                ring.AddPoint(xoff, yoff)
-            poly = ogr.Geometry(ogr.wkbPolygon)
-            poly.AddGeometry(ring)
+        if time.time() - last_time > LOGGER_TIME_DELAY:
+            LOGGER.info(
+                'gridding aoi: %.2f%% complete',
+                100.0 * row_index / n_rows)
+            last_time = time.time()
+        row_points = _generate_row(row_index)
+        min_x = row_points[:, :, 0].min(axis=1)
+        max_x = row_points[:, :, 0].max(axis=1)
+        min_y = row_points[:, :, 1].min(axis=1)
+        max_y = row_points[:, :, 1].max(axis=1)
+
+        # accept cells whose padded bounds only cover interior blocks
+        col_start = _mask_index(min_x - margin, extent[0], mask_n_cols)
+        col_end = _mask_index(max_x + margin, extent[0], mask_n_cols) + 1
+        row_start = _mask_index(min_y - margin, extent[2], mask_n_rows)
+        row_end = _mask_index(max_y + margin, extent[2], mask_n_rows) + 1
+        on_mask = (
+            (col_start >= 0) & (col_end <= mask_n_cols) &
+            (row_start >= 0) & (row_end <= mask_n_rows))
+        col_start, col_end, row_start, row_end = [
+            numpy.clip(index_array, 0, n_mask) for index_array, n_mask in [
+                (col_start, mask_n_cols), (col_end, mask_n_cols),
+                (row_start, mask_n_rows), (row_end, mask_n_rows)]]
+        n_non_interior = (
+            interior_table[row_end, col_end] -
+            interior_table[row_start, col_end] -
+            interior_table[row_end, col_start] +
+            interior_table[row_start, col_start])
+        interior_cells = on_mask & (n_non_interior == 0)
+
+        # reject cells whose center is in a block outside the polygon
+        center_col = _mask_index(
+            (min_x + max_x) / 2, extent[0], mask_n_cols)
+        center_row = _mask_index(
+            (min_y + max_y) / 2, extent[2], mask_n_rows)
+        center_on_mask = (
+            (center_col >= 0) & (center_col < mask_n_cols) &
+            (center_row >= 0) & (center_row < mask_n_rows))
+        exterior_cells = center_on_mask & exterior_mask[
+            numpy.clip(center_row, 0, mask_n_rows - 1),
+            numpy.clip(center_col, 0, mask_n_cols - 1)]
+
+        row_wkb_array = numpy.empty(
+            n_cols, dtype=_polygon_wkb_dtype(row_points.shape[1]))
+        row_wkb_array['byte_order'] = 1
+        row_wkb_array['geometry_type'] = ogr.wkbPolygon
+        row_wkb_array['n_rings'] = 1
+        row_wkb_array['n_points'] = row_points.shape[1]
+        row_wkb_array['points'] = row_points
+        for col_index in numpy.flatnonzero(~exterior_cells):
+            poly = ogr.CreateGeometryFromWkb(
+                row_wkb_array[col_index].tobytes())
+            if not interior_cells[col_index]:
+                n_exact_tests += 1
+                if not original_polygon.contains(
+                        shapely.wkt.loads(poly.ExportToWkt())):
+                    continue
+            poly_feature = ogr.Feature(grid_layer_defn)
+            poly_feature.SetGeometry(poly)
+            grid_layer.CreateFeature(poly_feature)
+            n_cells += 1
+            if n_cells % _GRID_TRANSACTION_SIZE == 0:
+                grid_layer.CommitTransaction()
+                grid_layer.StartTransaction()
+    grid_layer.CommitTransaction()
+    LOGGER.info(
+        'gridded aoi to %d cells, %d of %d tested exactly', n_cells,
+        n_exact_tests, n_rows * n_cols)
 
-            if original_polygon.contains(
-                    shapely.wkt.loads(poly.ExportToWkt())):
-                poly_feature = ogr.Feature(grid_layer_defn)
-                poly_feature.SetGeometry(poly)
-                grid_layer.CreateFeature(poly_feature)
+    grid_layer = None
+    out_grid_vector = None
+    vector_layer = None
+    vector = None
+
+
+def _grid_containment_mask(prepared_polygon, extent, mask_cell_size, margin):
+    """Classify blocks of an extent as inside or outside a polygon.
+
+    Args:
+        prepared_polygon (shapely.prepared.PreparedGeometry): polygon to
+            test the blocks against.
+        extent (tuple): (minx, maxx, miny, maxy) of the mask.
+        mask_cell_size (float): side length of the mask's square blocks,
+            the first block's lower left corner is the extent's.
+        margin (float): distance the blocks are padded by before they are
+            tested.
+
+    Returns:
+        (interior_table, exterior_mask) where ``exterior_mask`` is a boolean
+        array of the blocks, indexed by row from the bottom and column from
+        the left, whose padded block is disjoint from the polygon and
+        ``interior_table`` is the summed area table of the blocks whose
+        padded block is not contained by the polygon, with an extra leading
+        row and column of zeros.
+
+    """
+    mask_n_cols = max(
+        1, int(math.ceil((extent[1] - extent[0]) / mask_cell_size)))
+    mask_n_rows = max(
+        1, int(math.ceil((extent[3] - extent[2]) / mask_cell_size)))
+    interior_mask = numpy.zeros((mask_n_rows, mask_n_cols), dtype=bool)
+    exterior_mask = numpy.zeros((mask_n_rows, mask_n_cols), dtype=bool)
+    for mask_row in range(mask_n_rows):
+        for mask_col in range(mask_n_cols):
+            block = shapely.geometry.box(
+                extent[0] + mask_col * mask_cell_size - margin,
+                extent[2] + mask_row * mask_cell_size - margin,
+                extent[0] + (mask_col + 1) * mask_cell_size + margin,
+                extent[2] + (mask_row + 1) * mask_cell_size + margin)
+            if not prepared_polygon.intersects(block):
+                exterior_mask[mask_row, mask_col] = True
+            elif prepared_polygon.contains(block):
+                interior_mask[mask_row, mask_col] = True
+
+    interior_table = numpy.zeros(
+        (mask_n_rows + 1, mask_n_cols + 1), dtype=numpy.int64)
+    interior_table[1:, 1:] = numpy.cumsum(
+        numpy.cumsum(~interior_mask, axis=0), axis=1)
+    return interior_table, exterior_mask
+
+
+def _polygon_wkb_dtype(n_points):
+    """Numpy dtype of a little endian WKB polygon with one ring.
+
+    Args:
+        n_points (int): number of points in the ring.
+
+    Returns:
+        numpy.dtype whose items are the polygon's WKB.
+
+    """
+    return numpy.dtype([
+        ('byte_order', 'u1'),
+        ('geometry_type', '<u4'),
+        ('n_rings', '<u4'),
+        ('n_points', '<u4'),
+        ('points', '<f8', (n_points, 2))])
 
 
 def _schedule_predictor_data_processing(
@@ -644,7 +1068,11 @@ def _schedule_predictor_data_processing(
 
     Build a shapefile with geometry from the response vector, and tabular
     data from aggregate metrics of spatial predictor datasets in
-    ``predictor_table_path``.
+    ``predictor_table_path``.  The vector predictors of each type are
+    evaluated by one task that loads the response polygons once, and the
+    raster predictors that share a grid are summarized by one task that
+    rasterizes the response polygons once.  Tasks for different types and
+    grids run in parallel.
 
     Args:
         response_vector_path (string): path to a single layer polygon vector.
@@ -683,19 +1111,14 @@ def _schedule_predictor_data_processing(
     """
     LOGGER.info('Processing predictor datasets')
 
-    # lookup functions for response types
-    # polygon predictor types are a special case because the polygon_area
-    # function requires a 'mode' argument that these fucntions do not.
-    predictor_functions = {
-        'point_count': _point_count,
-        'point_nearest_distance': _point_nearest_distance,
-        'line_intersect_length': _line_intersect_length,
-        }
-
     predictor_table = utils.build_lookup_from_csv(
         predictor_table_path, 'id')
     predictor_task_list = []
     predictor_json_list = []  # tracks predictor files to add to shp
+    # maps the type of vector predictors to the predictors of that type
+    vector_predictor_lookup = {}
+    # maps the grid of raster predictors to the predictors on that grid
+    raster_predictor_lookup = {}
 
     for predictor_id in predictor_table:
         LOGGER.info("Building predictor %s", predictor_id)
@@ -703,42 +1126,45 @@ def _schedule_predictor_data_processing(
         predictor_path = _sanitize_path(
             predictor_table_path, predictor_table[predictor_id]['path'])
         predictor_type = predictor_table[predictor_id]['type'].strip()
+        predictor_target_path = os.path.join(
+            working_dir, predictor_id + '.json')
+        predictor_json_list.append(predictor_target_path)
         if predictor_type.startswith('raster'):
             # type must be one of raster_sum or raster_mean
             raster_op_mode = predictor_type.split('_')[1]
-            predictor_target_path = os.path.join(
-                working_dir, predictor_id + '.json')
-            predictor_json_list.append(predictor_target_path)
-            predictor_task_list.append(task_graph.add_task(
-                func=_raster_sum_mean,
-                args=(predictor_path, raster_op_mode, response_vector_path,
-                      predictor_target_path),
-                target_path_list=[predictor_target_path],
-                task_name='predictor %s' % predictor_id))
-        # polygon types are a special case because the polygon_area
-        # function requires an additional 'mode' argument.
-        elif predictor_type.startswith('polygon'):
-            predictor_target_path = os.path.join(
-                working_dir, predictor_id + '.json')
-            predictor_json_list.append(predictor_target_path)
-            predictor_task_list.append(task_graph.add_task(
-                func=_polygon_area,
-                args=(predictor_type, response_polygons_pickle_path,
-                      predictor_path, predictor_target_path),
-                target_path_list=[predictor_target_path],
-                dependent_task_list=[prepare_response_polygons_task],
-                task_name='predictor %s' % predictor_id))
+            raster_info = pygeoprocessing.get_raster_info(predictor_path)
+            grid_key = (
+                raster_info['projection_wkt'],
+                tuple(raster_info['geotransform']),
+                tuple(raster_info['raster_size']))
+            raster_predictor_lookup.setdefault(grid_key, []).append(
+                (predictor_path, raster_op_mode, predictor_target_path))
         else:
-            predictor_target_path = os.path.join(
-                working_dir, predictor_id + '.json')
-            predictor_json_list.append(predictor_target_path)
-            predictor_task_list.append(task_graph.add_task(
-                func=predictor_functions[predictor_type],
-                args=(response_polygons_pickle_path, predictor_path,
-                      predictor_target_path),
-                target_path_list=[predictor_target_path],
-                dependent_task_list=[prepare_response_polygons_task],
-                task_name='predictor %s' % predictor_id))
+            vector_predictor_lookup.setdefault(predictor_type, []).append(
+                (predictor_type, predictor_path, predictor_target_path))
+
+    # vector predictors of the same type share one load of the response
+    # polygons
+    for predictor_type, vector_predictor_list in (
+            vector_predictor_lookup.items()):
+        predictor_task_list.append(task_graph.add_task(
+            func=_vector_predictors,
+            args=(response_polygons_pickle_path, vector_predictor_list),
+            target_path_list=[
+                predictor_target_path for _, _, predictor_target_path in
+                vector_predictor_list],
+            dependent_task_list=[prepare_response_polygons_task],
+            task_name='%s predictors' % predictor_type))
+    # raster predictors on the same grid share one rasterized response
+    for grid_index, raster_predictor_list in enumerate(
+            raster_predictor_lookup.values()):
+        predictor_task_list.append(task_graph.add_task(
+            func=_raster_predictors,
+            args=(response_vector_path, raster_predictor_list),
+            target_path_list=[
+                predictor_target_path for _, _, predictor_target_path in
+                raster_predictor_list],
+            task_name='raster predictors on grid %d' % grid_index))
 
     assemble_predictor_data_task = task_graph.add_task(
         func=_json_to_shp_table,
@@ -775,9 +1201,9 @@ def _json_to_shp_table(
     Args:
         response_vector_path (string): Path to the response vector polygon
             shapefile.
-        predictor_vector_path (string): a copy of ``response_vector_path``.
-            One field will be added for each json file, and all other
-            fields will be deleted.
+        predictor_vector_path (string): a copy of ``response_vector_path``
+            with one field for each json file and none of its other fields.
+            Written as a GeoPackage if the extension is ``.gpkg``.
         predictor_json_list (list): list of json filenames, one for each
             predictor dataset. A json file will look like this,
             {0: 0.0, 1: 0.0}
@@ -787,54 +1213,29 @@ def _json_to_shp_table(
         None
 
     """
-    driver = gdal.GetDriverByName('ESRI Shapefile')
-    if os.path.exists(predictor_vector_path):
-        driver.Delete(predictor_vector_path)
-    response_vector = gdal.OpenEx(response_vector_path, gdal.OF_VECTOR | gdal.GA_Update)
-    predictor_vector = driver.CreateCopy(
-        predictor_vector_path, response_vector)
-    response_vector = None
-
-    layer = predictor_vector.GetLayer()
-    layer_defn = layer.GetLayerDefn()
-
-    predictor_id_list = []
+    fid_set = set()
+    predictor_results_list = []
     for json_filename in predictor_json_list:
+        with open(json_filename, 'r') as file:
+            predictor_results = {
+                int(feature_id): value
+                for feature_id, value in json.load(file).items()}
+        fid_set.update(predictor_results)
+        predictor_results_list.append(predictor_results)
+
+    # one column per predictor, features without a value are left unset
+    fid_array = numpy.array(sorted(fid_set), dtype=numpy.int64)
+    field_list = []
+    for json_filename, predictor_results in zip(
+            predictor_json_list, predictor_results_list):
         predictor_id = os.path.basename(os.path.splitext(json_filename)[0])
-        predictor_id_list.append(predictor_id)
-        # Create a new field for the predictor
-        # Delete the field first if it already exists
-        field_index = layer.FindFieldIndex(
-            str(predictor_id), 1)
-        if field_index >= 0:
-            layer.DeleteField(field_index)
-        predictor_field = ogr.FieldDefn(str(predictor_id), ogr.OFTReal)
-        predictor_field.SetWidth(24)
-        predictor_field.SetPrecision(11)
-        layer.CreateField(predictor_field)
+        field_list.append((str(predictor_id), numpy.array([
+            predictor_results.get(feature_id, numpy.nan)
+            for feature_id in fid_array.tolist()], dtype=numpy.float64)))
 
-        with open(json_filename, 'r') as file:
-            predictor_results = json.load(file)
-        for feature_id, value in predictor_results.items():
-            feature = layer.GetFeature(int(feature_id))
-            feature.SetField(str(predictor_id), value)
-            layer.SetFeature(feature)
-
-    # Get all the fieldnames. If they are not in the predictor_id_list,
-    # get their index and delete
-    n_fields = layer_defn.GetFieldCount()
-    fieldnames = []
-    for idx in range(n_fields):
-        field_defn = layer_defn.GetFieldDefn(idx)
-        fieldnames.append(field_defn.GetName())
-    for field_name in fieldnames:
-        if field_name not in predictor_id_list:
-            idx = layer.FindFieldIndex(field_name, 1)
-            layer.DeleteField(idx)
-    layer_defn = None
-    layer = None
-    predictor_vector.FlushCache()
-    predictor_vector = None
+    vector_field_writer.write_vector_fields(
+        response_vector_path, predictor_vector_path, fid_array, field_list,
+        keep_base_fields=False)
 
 
 def _raster_sum_mean(
@@ -854,39 +1255,295 @@ def _raster_sum_mean(
         None
 
     """
-    aggregate_results = pygeoprocessing.zonal_statistics(
-        (raster_path, 1), response_vector_path,
-        polygons_might_overlap=False)
-    # remove results for a feature when the pixel count is 0.
-    # we don't have non-nodata predictor values for those features.
-    aggregate_results = {
-        str(fid): stats for fid, stats in aggregate_results.items()
-        if stats['count'] != 0}
-    if not aggregate_results:
-        LOGGER.warning('raster predictor does not intersect with vector AOI')
-        # Create an empty file so that Taskgraph has its target file.
+    _raster_predictors(
+        response_vector_path,
+        [(raster_path, op_mode, predictor_target_path)])
+
+
+def _raster_predictors(response_vector_path, raster_predictor_list):
+    """Sum or mean of each raster on a shared grid under each polygon.
+
+    The response polygons are rasterized onto the grid once and every
+    raster is summarized against that rasterization in the same pass over
+    its blocks.  As in ``pygeoprocessing.zonal_statistics``, a polygon
+    covers the pixels whose centers it contains and a polygon too small to
+    contain a pixel center covers the pixels under its bounding box.
+    Nodata pixels are ignored.
+
+    Args:
+        response_vector_path (string): path to response polygons.
+        raster_predictor_list (list): list of (raster_path, op_mode,
+            predictor_target_path) tuples.  Every raster must have the same
+            projection, geotransform and size.  ``op_mode`` is either
+            'mean' or 'sum' and ``predictor_target_path`` is a path to a
+            json file to store the result, which is a dictionary mapping
+            feature IDs from ``response_vector_path`` to values of the
+            raster under the polygon.
+
+    Returns:
+        None
+
+    """
+    raster_info = pygeoprocessing.get_raster_info(
+        raster_predictor_list[0][0])
+    geotransform = raster_info['geotransform']
+    # keep the datasets referenced so their bands stay valid
+    raster_list = [
+        gdal.OpenEx(raster_path, gdal.OF_RASTER)
+        for raster_path, _, _ in raster_predictor_list]
+    band_list = [raster.GetRasterBand(1) for raster in raster_list]
+    nodata_list = [band.GetNoDataValue() for band in band_list]
+
+    response_vector = gdal.OpenEx(response_vector_path, gdal.OF_VECTOR)
+    response_layer = response_vector.GetLayer()
+    fid_list = [feature.GetFID() for feature in response_layer]
+    n_fids = max(fid_list) + 1 if fid_list else 0
+    sum_array = numpy.zeros((len(raster_list), n_fids))
+    count_array = numpy.zeros((len(raster_list), n_fids), dtype=numpy.int64)
+    pixel_count_array = numpy.zeros(n_fids, dtype=numpy.int64)
+
+    def _accumulate_values(
+            raster_index, fid_array, xoff, yoff, win_xsize, win_ysize,
+            value_mask=None):
+        """Add the valid values in a raster window to their polygons."""
+        value_array = band_list[raster_index].ReadAsArray(
+            xoff=xoff, yoff=yoff, win_xsize=win_xsize, win_ysize=win_ysize)
+        if value_mask is not None:
+            value_array = value_array[value_mask]
+        value_array = value_array.ravel()
+        if nodata_list[raster_index] is not None:
+            valid_mask = ~numpy.isclose(
+                value_array, nodata_list[raster_index])
+            value_array = value_array[valid_mask]
+            fid_array = fid_array[valid_mask]
+        sum_array[raster_index] += numpy.bincount(
+            fid_array, weights=value_array, minlength=n_fids)
+        count_array[raster_index] += numpy.bincount(
+            fid_array, minlength=n_fids)
+
+    response_window = _bounding_box_window(
+        geotransform, raster_info['raster_size'],
+        pygeoprocessing.get_vector_info(
+            response_vector_path)['bounding_box'])
+    if fid_list and response_window[2] > 0 and response_window[3] > 0:
+        working_dir = tempfile.mkdtemp(
+            dir=os.path.dirname(raster_predictor_list[0][2]))
+        fid_raster_path = os.path.join(working_dir, 'response_fid.tif')
+        try:
+            _rasterize_response_fids(
+                response_layer, raster_info, response_window,
+                fid_raster_path)
+
+            window_xoff, window_yoff, _, _ = response_window
+            for offset_dict, fid_block in pygeoprocessing.iterblocks(
+                    (fid_raster_path, 1)):
+                fid_mask = fid_block != _RESPONSE_FID_NODATA
+                if not fid_mask.any():
+                    continue
+                block_fids = fid_block[fid_mask]
+                pixel_count_array += numpy.bincount(
+                    block_fids, minlength=n_fids)
+                for raster_index in range(len(raster_list)):
+                    _accumulate_values(
+                        raster_index, block_fids,
+                        window_xoff + offset_dict['xoff'],
+                        window_yoff + offset_dict['yoff'],
+                        offset_dict['win_xsize'], offset_dict['win_ysize'],
+                        value_mask=fid_mask)
+        finally:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+        # polygons that contain no pixel centers use their bounding box
+        for fid in fid_list:
+            if pixel_count_array[fid] > 0:
+                continue
+            response_geometry = response_layer.GetFeature(
+                fid).GetGeometryRef()
+            if response_geometry is None:
+                continue
+            x_min, x_max, y_min, y_max = response_geometry.GetEnvelope()
+            fid_window = _bounding_box_window(
+                geotransform, raster_info['raster_size'],
+                [x_min, y_min, x_max, y_max])
+            if fid_window[2] <= 0 or fid_window[3] <= 0:
+                continue
+            fid_array = numpy.full(
+                fid_window[2] * fid_window[3], fid, dtype=numpy.int64)
+            for raster_index in range(len(raster_list)):
+                _accumulate_values(raster_index, fid_array, *fid_window)
+    response_layer = None
+    response_vector = None
+
+    for raster_index, (raster_path, op_mode, predictor_target_path) in (
+            enumerate(raster_predictor_list)):
+        # we don't have non-nodata predictor values for features where the
+        # pixel count is 0.
         predictor_results = {}
+        for fid in fid_list:
+            if count_array[raster_index, fid] == 0:
+                continue
+            if op_mode == 'mean':
+                predictor_results[str(fid)] = (
+                    sum_array[raster_index, fid] /
+                    count_array[raster_index, fid])
+            else:
+                predictor_results[str(fid)] = sum_array[raster_index, fid]
+        if not predictor_results:
+            LOGGER.warning(
+                'raster predictor %s does not intersect with vector AOI',
+                os.path.basename(raster_path))
+        # an empty file is still written so that Taskgraph has its target
         with open(predictor_target_path, 'w') as jsonfile:
             json.dump(predictor_results, jsonfile)
-        return None
 
-    fid_raster_values = {
-        'fid': aggregate_results.keys(),
-        'sum': [fid['sum'] for fid in aggregate_results.values()],
-        'count': [fid['count'] for fid in aggregate_results.values()],
-        }
 
-    if op_mode == 'mean':
-        mean_results = (
-            numpy.array(fid_raster_values['sum']) /
-            numpy.array(fid_raster_values['count']))
-        predictor_results = dict(
-            zip(fid_raster_values['fid'], mean_results))
-    else:
-        predictor_results = dict(
-            zip(fid_raster_values['fid'], fid_raster_values['sum']))
-    with open(predictor_target_path, 'w') as jsonfile:
-        json.dump(predictor_results, jsonfile)
+def _bounding_box_window(geotransform, raster_size, bounding_box):
+    """Find the window of a grid's pixels that intersect a bounding box.
+
+    Args:
+        geotransform (list): geotransform of the grid.
+        raster_size (tuple): (n_cols, n_rows) of the grid.
+        bounding_box (list): [minx, miny, maxx, maxy] in the grid's
+            projection.
+
+    Returns:
+        (xoff, yoff, win_xsize, win_ysize) tuple clipped to the grid.  The
+        sizes are not positive if the bounding box misses the grid.
+
+    """
+    x_min, y_min, x_max, y_max = bounding_box
+    col_min, col_max = sorted([
+        (x_min - geotransform[0]) / geotransform[1],
+        (x_max - geotransform[0]) / geotransform[1]])
+    row_min, row_max = sorted([
+        (y_min - geotransform[3]) / geotransform[5],
+        (y_max - geotransform[3]) / geotransform[5]])
+    xoff = max(0, int(math.floor(col_min)))
+    yoff = max(0, int(math.floor(row_min)))
+    win_xsize = min(raster_size[0], int(math.ceil(col_max))) - xoff
+    win_ysize = min(raster_size[1], int(math.ceil(row_max))) - yoff
+    return xoff, yoff, win_xsize, win_ysize
+
+
+def _rasterize_response_fids(
+        response_layer, raster_info, window, target_fid_raster_path):
+    """Rasterize the FIDs of response polygons onto a window of a grid.
+
+    Args:
+        response_layer (ogr.Layer): layer of response polygons.
+        raster_info (dict): ``pygeoprocessing.get_raster_info`` of a raster
+            on the grid.
+        window (tuple): (xoff, yoff, win_xsize, win_ysize) window of the
+            grid to rasterize onto.
+        target_fid_raster_path (string): path to the int32 GeoTIFF to
+            create.  Pixels whose centers are in a polygon are set to its
+            FID and all others to ``_RESPONSE_FID_NODATA``.
+
+    Returns:
+        None
+
+    """
+    xoff, yoff, win_xsize, win_ysize = window
+    geotransform = raster_info['geotransform']
+    gtiff_driver = gdal.GetDriverByName('GTiff')
+    fid_raster = gtiff_driver.Create(
+        target_fid_raster_path, win_xsize, win_ysize, 1, gdal.GDT_Int32,
+        options=[
+            'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=LZW',
+            'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+    fid_raster.SetProjection(raster_info['projection_wkt'])
+    fid_raster.SetGeoTransform([
+        geotransform[0] + xoff * geotransform[1], geotransform[1],
+        geotransform[2], geotransform[3] + yoff * geotransform[5],
+        geotransform[4], geotransform[5]])
+    fid_band = fid_raster.GetRasterBand(1)
+    fid_band.SetNoDataValue(_RESPONSE_FID_NODATA)
+    fid_band.Fill(_RESPONSE_FID_NODATA)
+
+    # copy the polygons to a layer with their FID as an attribute to burn
+    fid_vector = ogr.GetDriverByName('MEMORY').CreateDataSource('fid_vector')
+    fid_layer = fid_vector.CreateLayer(
+        'fid_layer', response_layer.GetSpatialRef(), ogr.wkbUnknown)
+    fid_layer.CreateField(ogr.FieldDefn('response_fid', ogr.OFTInteger))
+    fid_layer_defn = fid_layer.GetLayerDefn()
+    fid_layer.StartTransaction()
+    response_layer.ResetReading()
+    for response_feature in response_layer:
+        response_geometry = response_feature.GetGeometryRef()
+        if response_geometry is None:
+            continue
+        fid_feature = ogr.Feature(fid_layer_defn)
+        fid_feature.SetGeometry(response_geometry.Clone())
+        fid_feature.SetField('response_fid', response_feature.GetFID())
+        fid_layer.CreateFeature(fid_feature)
+        fid_feature = None
+    fid_layer.CommitTransaction()
+
+    gdal.RasterizeLayer(
+        fid_raster, [1], fid_layer,
+        options=['ALL_TOUCHED=FALSE', 'ATTRIBUTE=response_fid'])
+    fid_layer = None
+    fid_vector = None
+    fid_band = None
+    fid_raster = None
+
+
+def _vector_predictors(response_polygons_pickle_path, predictor_list):
+    """Summarize vector predictors by response polygon in one sweep.
+
+    The response polygons are unpickled, prepared and indexed once and
+    every predictor is evaluated against them, rather than each predictor
+    loading and indexing the response polygons again.
+
+    Args:
+        response_polygons_pickle_path (string): path to pickle that stores a
+            dictionary which maps FIDs to shapely geometry.
+        predictor_list (list): list of (predictor_type, predictor_path,
+            predictor_target_path) tuples.  ``predictor_type`` is one of
+            'point_count', 'point_nearest_distance', 'line_intersect_length',
+            'polygon_area_coverage' or 'polygon_percent_coverage'.
+            ``predictor_target_path`` is a path to json file to store the
+            result, which is a dictionary mapping feature IDs to the
+            predictor's value for that response polygon.
+
+    Returns:
+        None
+
+    """
+    with open(response_polygons_pickle_path, 'rb') as pickle_file:
+        response_polygons_lookup = pickle.load(pickle_file)
+    prepared_polygons_lookup = {
+        feature_id: shapely.prepared.prep(geometry)
+        for feature_id, geometry in response_polygons_lookup.items()}
+    response_spatial_index = rtree.index.Index()
+    if response_polygons_lookup:
+        # bulk loading builds a better packed tree than inserting
+        response_spatial_index = rtree.index.Index(
+            (feature_id, geometry.bounds, None)
+            for feature_id, geometry in response_polygons_lookup.items())
+
+    for predictor_type, predictor_path, predictor_target_path in (
+            predictor_list):
+        LOGGER.info(
+            "Evaluating %s predictor %s", predictor_type,
+            os.path.basename(predictor_path))
+        if predictor_type == 'point_count':
+            predictor_results = _point_count_lookup(
+                response_polygons_lookup, predictor_path)
+        elif predictor_type == 'point_nearest_distance':
+            predictor_results = _point_nearest_distance_lookup(
+                response_polygons_lookup, predictor_path)
+        elif predictor_type == 'line_intersect_length':
+            predictor_results = _line_intersect_length_lookup(
+                response_polygons_lookup, prepared_polygons_lookup,
+                response_spatial_index, predictor_path)
+        else:
+            predictor_results = _polygon_area_lookup(
+                predictor_type, response_polygons_lookup,
+                prepared_polygons_lookup, response_spatial_index,
+                predictor_path)
+        with open(predictor_target_path, 'w') as jsonfile:
+            json.dump(predictor_results, jsonfile)
 
 
 def _polygon_area(
@@ -914,45 +1571,69 @@ def _polygon_area(
         None
 
     """
-    start_time = time.time()
-    with open(response_polygons_pickle_path, 'rb') as pickle_file:
-        response_polygons_lookup = pickle.load(pickle_file)
+    _vector_predictors(
+        response_polygons_pickle_path,
+        [(mode, polygon_vector_path, predictor_target_path)])
+
+
+def _polygon_area_lookup(
+        mode, response_polygons_lookup, prepared_polygons_lookup,
+        response_spatial_index, polygon_vector_path):
+    """Calculate polygon area overlap of each response polygon.
+
+    Each predictor polygon is tested against the response polygons whose
+    bounding boxes it intersects in ``response_spatial_index``.
+
+    Args:
+        mode (string): one of 'polygon_area_coverage' or
+            'polygon_percent_coverage', see ``_polygon_area``.
+        response_polygons_lookup (dictionary): maps feature ID to
+            shapely.Polygon.
+        prepared_polygons_lookup (dictionary): maps feature ID to the
+            prepared response polygon.
+        response_spatial_index (rtree.index.Index): index of the response
+            polygon bounding boxes by feature ID.
+        polygon_vector_path (string): path to a single layer polygon vector
+            object.
+
+    Returns:
+        dictionary mapping feature IDs from ``response_polygons_lookup`` to
+        polygon area coverage.
+
+    """
+    last_time = time.time()
     polygons = _ogr_to_geometry_list(polygon_vector_path)
-    prepped_polygons = [shapely.prepared.prep(polygon) for polygon in polygons]
-    polygon_spatial_index = rtree.index.Index()
-    for polygon_index, polygon in enumerate(polygons):
-        polygon_spatial_index.insert(polygon_index, polygon.bounds)
-    polygon_coverage_lookup = {}  # map FID to point count
+    polygon_area_lookup = {
+        feature_id: 0 for feature_id in response_polygons_lookup}
 
-    for index, (feature_id, geometry) in enumerate(
-            response_polygons_lookup.items()):
-        if time.time() - start_time > 5.0:
-            LOGGER.info(
+    polygon_index = None
+    for polygon_index, polygon in enumerate(polygons):
+        last_time = delay_op(
+            last_time, LOGGER_TIME_DELAY, lambda: LOGGER.info(
                 "%s polygon area: %.2f%% complete",
                 os.path.basename(polygon_vector_path),
-                (100.0*index)/len(response_polygons_lookup))
-            start_time = time.time()
-
-        potential_intersecting_poly_ids = polygon_spatial_index.intersection(
-            geometry.bounds)
-        intersecting_polygons = [
-            polygons[polygon_index]
-            for polygon_index in potential_intersecting_poly_ids
-            if prepped_polygons[polygon_index].intersects(geometry)]
-        polygon_area_coverage = sum([
-            (geometry.intersection(polygon)).area
-            for polygon in intersecting_polygons])
+                (100.0*polygon_index)/len(polygons)))
+        if polygon.is_empty:
+            continue
+        for feature_id in response_spatial_index.intersection(
+                polygon.bounds):
+            if prepared_polygons_lookup[feature_id].intersects(polygon):
+                polygon_area_lookup[feature_id] += (
+                    response_polygons_lookup[feature_id].intersection(
+                        polygon)).area
+    LOGGER.info(
+        "%s polygon area: 100.00%% complete",
+        os.path.basename(polygon_vector_path))
 
+    polygon_coverage_lookup = {}  # map FID to polygon coverage
+    for feature_id, geometry in response_polygons_lookup.items():
+        polygon_area_coverage = polygon_area_lookup[feature_id]
         if mode == 'polygon_area_coverage':
             polygon_coverage_lookup[feature_id] = polygon_area_coverage
         elif mode == 'polygon_percent_coverage':
             polygon_coverage_lookup[str(feature_id)] = (
                 polygon_area_coverage / geometry.area * 100.0)
-    LOGGER.info(
-        "%s polygon area: 100.00%% complete",
-        os.path.basename(polygon_vector_path))
-    with open(predictor_target_path, 'w') as jsonfile:
-        json.dump(polygon_coverage_lookup, jsonfile)
+    return polygon_coverage_lookup
 
 
 def _line_intersect_length(
@@ -972,37 +1653,60 @@ def _line_intersect_length(
     Returns:
         None
 
+    """
+    _vector_predictors(
+        response_polygons_pickle_path,
+        [('line_intersect_length', line_vector_path, predictor_target_path)])
+
+
+def _line_intersect_length_lookup(
+        response_polygons_lookup, prepared_polygons_lookup,
+        response_spatial_index, line_vector_path):
+    """Calculate the length of the lines intersecting each response polygon.
+
+    Each line is tested against the response polygons whose bounding boxes
+    it intersects in ``response_spatial_index``.
+
+    Args:
+        response_polygons_lookup (dictionary): maps feature ID to
+            shapely.Polygon.
+        prepared_polygons_lookup (dictionary): maps feature ID to the
+            prepared response polygon.
+        response_spatial_index (rtree.index.Index): index of the response
+            polygon bounding boxes by feature ID.
+        line_vector_path (string): path to a single layer line vector
+            object.
+
+    Returns:
+        dictionary mapping feature IDs from ``response_polygons_lookup`` to
+        line intersect length.
+
     """
     last_time = time.time()
-    with open(response_polygons_pickle_path, 'rb') as pickle_file:
-        response_polygons_lookup = pickle.load(pickle_file)
     lines = _ogr_to_geometry_list(line_vector_path)
-    line_length_lookup = {}  # map FID to intersecting line length
+    line_length_lookup = {
+        feature_id: 0 for feature_id in response_polygons_lookup}
 
-    line_spatial_index = rtree.index.Index()
+    line_index = None
     for line_index, line in enumerate(lines):
-        line_spatial_index.insert(line_index, line.bounds)
-
-    feature_count = None
-    for feature_count, (feature_id, geometry) in enumerate(
-            response_polygons_lookup.items()):
         last_time = delay_op(
             last_time, LOGGER_TIME_DELAY, lambda: LOGGER.info(
                 "%s line intersect length: %.2f%% complete",
                 os.path.basename(line_vector_path),
-                (100.0 * feature_count)/len(response_polygons_lookup)))
-        potential_intersecting_lines = line_spatial_index.intersection(
-            geometry.bounds)
-        line_length = sum([
-            (lines[line_index].intersection(geometry)).length
-            for line_index in potential_intersecting_lines if
-            geometry.intersects(lines[line_index])])
-        line_length_lookup[str(feature_id)] = line_length
+                (100.0 * line_index)/len(lines)))
+        if line.is_empty:
+            continue
+        for feature_id in response_spatial_index.intersection(line.bounds):
+            if prepared_polygons_lookup[feature_id].intersects(line):
+                line_length_lookup[feature_id] += (
+                    line.intersection(
+                        response_polygons_lookup[feature_id])).length
     LOGGER.info(
         "%s line intersect length: 100.00%% complete",
         os.path.basename(line_vector_path))
-    with open(predictor_target_path, 'w') as jsonfile:
-        json.dump(line_length_lookup, jsonfile)
+    return {
+        str(feature_id): line_length
+        for feature_id, line_length in line_length_lookup.items()}
 
 
 def _point_nearest_distance(
@@ -1022,12 +1726,37 @@ def _point_nearest_distance(
     Returns:
         None
 
+    """
+    _vector_predictors(
+        response_polygons_pickle_path,
+        [('point_nearest_distance', point_vector_path,
+          predictor_target_path)])
+
+
+def _point_nearest_distance_lookup(
+        response_polygons_lookup, point_vector_path):
+    """Calculate distance to nearest point for all polygons.
+
+    The points are indexed in a KD-tree.  For each polygon the points
+    nearest the center of its bounding box give an upper bound on the
+    distance, then the exact distance is only calculated to the points
+    within that bound plus the bounding box's half diagonal of the center.
+
+    Args:
+        response_polygons_lookup (dictionary): maps feature ID to
+            shapely.Polygon.
+        point_vector_path (string): path to a single layer point vector
+            object.
+
+    Returns:
+        dictionary mapping feature IDs from ``response_polygons_lookup`` to
+        distance to nearest point.
+
     """
     last_time = time.time()
-    with open(response_polygons_pickle_path, 'rb') as pickle_file:
-        response_polygons_lookup = pickle.load(pickle_file)
-    points = _ogr_to_geometry_list(point_vector_path)
-    point_distance_lookup = {}  # map FID to point count
+    points, point_index_array, kd_tree, other_point_index_list = (
+        _index_points(point_vector_path))
+    point_distance_lookup = {}  # map FID to nearest point distance
 
     index = None
     for index, (feature_id, geometry) in enumerate(
@@ -1038,13 +1767,38 @@ def _point_nearest_distance(
                 os.path.basename(point_vector_path),
                 (100.0*index)/len(response_polygons_lookup)))
 
-        point_distance_lookup[str(feature_id)] = min([
-            geometry.distance(point) for point in points])
+        if geometry.is_empty:
+            # an empty polygon has no bounds to search around, shapely<2
+            # returns () for them
+            point_distance_lookup[str(feature_id)] = min([
+                geometry.distance(point) for point in points])
+            continue
+        distance_list = [
+            geometry.distance(points[point_index])
+            for point_index in other_point_index_list]
+        if kd_tree is not None:
+            x_min, y_min, x_max, y_max = geometry.bounds
+            center = ((x_min + x_max) / 2.0, (y_min + y_max) / 2.0)
+            half_diagonal = math.hypot(x_max - x_min, y_max - y_min) / 2.0
+            _, nearest_rows = kd_tree.query(
+                center, k=min(_NEAREST_POINT_CANDIDATES, kd_tree.n))
+            nearest_distance = min([
+                geometry.distance(points[point_index_array[row]])
+                for row in numpy.atleast_1d(nearest_rows)])
+            distance_list.append(nearest_distance)
+            if nearest_distance > 0:
+                # any point nearer the polygon is within this radius of the
+                # center, pad it so rounding can't drop a candidate
+                candidate_rows = kd_tree.query_ball_point(
+                    center, (nearest_distance + half_diagonal) * (1 + 1e-9))
+                distance_list.extend([
+                    geometry.distance(points[point_index_array[row]])
+                    for row in candidate_rows])
+        point_distance_lookup[str(feature_id)] = min(distance_list)
     LOGGER.info(
         "%s point distance: 100.00%% complete",
         os.path.basename(point_vector_path))
-    with open(predictor_target_path, 'w') as jsonfile:
-        json.dump(point_distance_lookup, jsonfile)
+    return point_distance_lookup
 
 
 def _point_count(
@@ -1064,11 +1818,33 @@ def _point_count(
     Returns:
         None
 
+    """
+    _vector_predictors(
+        response_polygons_pickle_path,
+        [('point_count', point_vector_path, predictor_target_path)])
+
+
+def _point_count_lookup(response_polygons_lookup, point_vector_path):
+    """Calculate number of points contained in each response polygon.
+
+    The points are indexed in a KD-tree.  The points in the square around
+    each polygon's bounding box are found with one query and tested for
+    containment together with ``shapely.vectorized.contains``.
+
+    Args:
+        response_polygons_lookup (dictionary): maps feature ID to
+            shapely.Polygon.
+        point_vector_path (string): path to a single layer point vector
+            object.
+
+    Returns:
+        dictionary mapping feature IDs from ``response_polygons_lookup`` to
+        number of points in that polygon.
+
     """
     last_time = time.time()
-    with open(response_polygons_pickle_path, 'rb') as pickle_file:
-        response_polygons_lookup = pickle.load(pickle_file)
-    points = _ogr_to_geometry_list(point_vector_path)
+    points, point_index_array, kd_tree, other_point_index_list = (
+        _index_points(point_vector_path))
     point_count_lookup = {}  # map FID to point count
 
     index = None
@@ -1080,13 +1856,64 @@ def _point_count(
                 os.path.basename(point_vector_path),
                 (100.0*index)/len(response_polygons_lookup)))
         point_count = len([
-            point for point in points if geometry.contains(point)])
+            point_index for point_index in other_point_index_list
+            if geometry.contains(points[point_index])])
+        # an empty polygon contains no points and has no bounds to search
+        if kd_tree is not None and not geometry.is_empty:
+            x_min, y_min, x_max, y_max = geometry.bounds
+            # the max norm ball is the square that covers the bounding box
+            candidate_rows = numpy.array(kd_tree.query_ball_point(
+                ((x_min + x_max) / 2.0, (y_min + y_max) / 2.0),
+                max(x_max - x_min, y_max - y_min) / 2.0 * (1 + 1e-9),
+                p=numpy.inf), dtype=numpy.int64)
+            if candidate_rows.size > 0:
+                candidate_coords = kd_tree.data[candidate_rows]
+                point_count += int(numpy.count_nonzero(
+                    shapely.vectorized.contains(
+                        geometry, candidate_coords[:, 0],
+                        candidate_coords[:, 1])))
         point_count_lookup[str(feature_id)] = point_count
     LOGGER.info(
         "%s point count: 100.00%% complete",
         os.path.basename(point_vector_path))
-    with open(predictor_target_path, 'w') as jsonfile:
-        json.dump(point_count_lookup, jsonfile)
+    return point_count_lookup
+
+
+def _index_points(point_vector_path):
+    """Load the geometry of a point vector and index its points.
+
+    Args:
+        point_vector_path (string): path to a single layer point vector
+            object.
+
+    Returns:
+        (points, point_index_array, kd_tree, other_point_index_list) where
+        ``points`` is the list of shapely geometry of the features,
+        ``kd_tree`` is a ``scipy.spatial.cKDTree`` of the coordinates of
+        the single point features or None if there are none,
+        ``point_index_array`` maps the rows of ``kd_tree`` to indexes in
+        ``points`` and ``other_point_index_list`` lists the indexes of any
+        other geometry, such as multipoints, that must be tested one at a
+        time.
+
+    """
+    points = _ogr_to_geometry_list(point_vector_path)
+    point_index_list = []
+    other_point_index_list = []
+    for point_index, point in enumerate(points):
+        if point.geom_type == 'Point' and not point.is_empty:
+            point_index_list.append(point_index)
+        else:
+            other_point_index_list.append(point_index)
+    point_index_array = numpy.array(point_index_list, dtype=numpy.int64)
+
+    kd_tree = None
+    if point_index_array.size > 0:
+        point_coords = numpy.array(
+            [(points[point_index].x, points[point_index].y)
+             for point_index in point_index_list], dtype=numpy.float64)
+        kd_tree = scipy.spatial.cKDTree(point_coords)
+    return points, point_index_array, kd_tree, other_point_index_list
 
 
 def _ogr_to_geometry_list(vector_path):
@@ -1199,6 +2026,11 @@ def _build_regression(
     ``predictor_vector_path`` and are not transformed. Features with incomplete
     data are dropped prior to computing the regression.
 
+    The fields are read in blocks of ``_FIELD_BLOCK_SIZE`` features and the
+    least-squares problem is reduced block by block to the triangular factor
+    of its normal equations, so memory use doesn't grow with the number of
+    features.
+
     Args:
         response_vector_path (string): path to polygon vector with PUD
             results, in particular a field named with the ``response_id``.
@@ -1237,52 +2069,80 @@ def _build_regression(
     # we sure want to know about it.
     assert(n_features == response_layer.GetFeatureCount())
 
-    # Response data matrix
-    response_array = numpy.empty((n_features, 1))
-    for row_index, feature in enumerate(response_layer):
-        response_array[row_index, :] = feature.GetField(str(response_id))
-    response_array = numpy.log1p(response_array)
-
-    # Y-Intercept data matrix
-    intercept_array = numpy.ones_like(response_array)
-
-    # Predictor data matrix
-    n_predictors = predictor_layer_defn.GetFieldCount()
-    predictor_matrix = numpy.empty((n_features, n_predictors))
     predictor_names = []
-    for idx in range(n_predictors):
+    for idx in range(predictor_layer_defn.GetFieldCount()):
         field_defn = predictor_layer_defn.GetFieldDefn(idx)
         field_name = field_defn.GetName()
         predictor_names.append(field_name)
-    for row_index, feature in enumerate(predictor_layer):
-        predictor_matrix[row_index, :] = numpy.array(
-            [feature.GetField(str(key)) for key in predictor_names])
+    response_layer = None
+    response_vector = None
+    predictor_layer = None
+    predictor_vector = None
+    # every field is read and the valid ones selected by a mask, since
+    # ``predictor_names`` is narrowed to the valid predictors below
+    predictor_field_names = list(predictor_names)
+
+    def _iter_data_blocks(predictor_mask):
+        """Yield complete rows of (response, predictors, intercept)."""
+        for (_, response_block), (_, predictor_block) in zip(
+                _iter_field_blocks(response_vector_path, [str(response_id)]),
+                _iter_field_blocks(
+                    predictor_vector_path, predictor_field_names)):
+            data_block = numpy.concatenate(
+                (numpy.log1p(response_block),
+                 predictor_block[:, predictor_mask],
+                 numpy.ones((response_block.shape[0], 1))), axis=1)
+            # if any variable is missing data for some feature, drop that
+            # feature
+            yield data_block[~numpy.isnan(data_block).any(axis=1)]
 
     # If some predictor has no data across all features, drop that predictor:
-    valid_pred = ~numpy.isnan(predictor_matrix).all(axis=0)
-    predictor_matrix = predictor_matrix[:, valid_pred]
+    valid_pred = numpy.zeros(len(predictor_names), dtype=bool)
+    for _, predictor_block in _iter_field_blocks(
+            predictor_vector_path, predictor_field_names):
+        valid_pred |= ~numpy.isnan(predictor_block).all(axis=0)
     predictor_names = [
         pred for (pred, valid) in zip(predictor_names, valid_pred)
         if valid]
-    n_predictors = predictor_matrix.shape[1]
-
-    # add columns for response variable and y-intercept
-    data_matrix = numpy.concatenate(
-        (response_array, predictor_matrix, intercept_array), axis=1)
+    n_predictors = len(predictor_names)
     predictor_names.append('(Intercept)')
 
-    # if any variable is missing data for some feature, drop that feature:
-    data_matrix = data_matrix[~numpy.isnan(data_matrix).any(axis=1)]
-    n_features = data_matrix.shape[0]
-    y_factors = data_matrix[:, 0]  # useful to have this as a 1-D array
+    # Reduce [X | y] to the triangular factor of its QR decomposition one
+    # block at a time.  R^T R is X^T X and the last column holds Q^T y, so
+    # solving the triangular system gives the same least-squares solution
+    # without ever holding all of X.
+    n_columns = n_predictors + 1
+    r_factor = numpy.empty((0, n_columns + 1))
+    normal_matrix = numpy.zeros((n_columns, n_columns))
+    n_features = 0
+    response_sum = 0.0
+    for data_block in _iter_data_blocks(valid_pred):
+        if data_block.shape[0] == 0:
+            # no complete rows, older numpy can't factor an empty matrix
+            continue
+        block_matrix = data_block[:, 1:]
+        r_factor = numpy.linalg.qr(numpy.concatenate(
+            (r_factor, numpy.concatenate(
+                (block_matrix, data_block[:, :1]), axis=1))), mode='r')
+        normal_matrix += numpy.dot(block_matrix.T, block_matrix)
+        n_features += data_block.shape[0]
+        response_sum += numpy.sum(data_block[:, 0])
+    r_factor = numpy.concatenate((r_factor, numpy.zeros(
+        (n_columns + 1 - r_factor.shape[0], n_columns + 1))))
     coefficients, _, _, _ = numpy.linalg.lstsq(
-        data_matrix[:, 1:], y_factors, rcond=-1)
-
-    ssres = numpy.sum((
-        y_factors -
-        numpy.sum(data_matrix[:, 1:] * coefficients, axis=1)) ** 2)
-    sstot = numpy.sum((
-        numpy.average(y_factors) - y_factors) ** 2)
+        r_factor[:n_columns, :n_columns], r_factor[:n_columns, n_columns],
+        rcond=-1)
+
+    ssres = 0.0
+    sstot = 0.0
+    response_mean = response_sum / max(n_features, 1)
+    for data_block in _iter_data_blocks(valid_pred):
+        y_factors = data_block[:, 0]  # useful to have this as a 1-D array
+        ssres += numpy.sum((
+            y_factors -
+            numpy.sum(data_block[:, 1:] * coefficients, axis=1)) ** 2)
+        sstot += numpy.sum((response_mean - y_factors) ** 2)
+    ssres = numpy.float64(ssres)
     dof = n_features - n_predictors - 1
     if sstot == 0.0 or dof <= 0.0:
         # this can happen if there is only one sample
@@ -1294,20 +2154,71 @@ def _build_regression(
 
     if dof > 0:
         std_err = numpy.sqrt(ssres / dof)
-        sigma2 = numpy.sum((
-            y_factors - numpy.sum(
-                data_matrix[:, 1:] * coefficients, axis=1)) ** 2) / dof
-        var_est = sigma2 * numpy.diag(numpy.linalg.pinv(
-            numpy.dot(
-                data_matrix[:, 1:].T, data_matrix[:, 1:])))
+        sigma2 = ssres / dof
+        var_est = sigma2 * numpy.diag(numpy.linalg.pinv(normal_matrix))
         se_est = numpy.sqrt(var_est)
     else:
         LOGGER.warning("Linear model is under constrained with DOF=%d", dof)
         std_err = sigma2 = numpy.nan
-        se_est = var_est = [numpy.nan] * data_matrix.shape[1]
+        se_est = var_est = [numpy.nan] * (n_columns + 1)
     return predictor_names, coefficients, ssres, r_sq, r_sq_adj, std_err, dof, se_est
 
 
+def _iter_field_blocks(vector_path, field_name_list, block_size=None):
+    """Read numeric fields of a vector in blocks of features.
+
+    The geometry and every other field are ignored while reading so only
+    the requested values are fetched from the vector.
+
+    Args:
+        vector_path (string): path to a single layer vector.
+        field_name_list (list): names of the numeric fields to read.
+        block_size (int): number of features per block, the last block may
+            be shorter.  Defaults to ``_FIELD_BLOCK_SIZE``.
+
+    Yields:
+        (fid_array, value_array) for each block of features in the order of
+        the layer, where ``value_array`` has one column per field and
+        unset or null values are NaN.
+
+    """
+    if block_size is None:
+        block_size = _FIELD_BLOCK_SIZE
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    layer_defn = layer.GetLayerDefn()
+    field_index_list = []
+    for field_name in field_name_list:
+        field_index = layer_defn.GetFieldIndex(str(field_name))
+        if field_index < 0:
+            raise ValueError(
+                "field %s not found in %s" % (field_name, vector_path))
+        field_index_list.append(field_index)
+    requested_index_set = set(field_index_list)
+    layer.SetIgnoredFields(['OGR_GEOMETRY', 'OGR_STYLE'] + [
+        layer_defn.GetFieldDefn(field_index).GetName()
+        for field_index in range(layer_defn.GetFieldCount())
+        if field_index not in requested_index_set])
+
+    fid_block = numpy.empty(block_size, dtype=numpy.int64)
+    value_block = numpy.empty((block_size, len(field_index_list)))
+    n_rows = 0
+    for feature in layer:
+        fid_block[n_rows] = feature.GetFID()
+        value_block[n_rows] = [
+            feature.GetField(field_index) if
+            feature.IsFieldSetAndNotNull(field_index) else numpy.nan
+            for field_index in field_index_list]
+        n_rows += 1
+        if n_rows == block_size:
+            yield fid_block.copy(), value_block.copy()
+            n_rows = 0
+    if n_rows:
+        yield fid_block[:n_rows].copy(), value_block[:n_rows].copy()
+    layer = None
+    vector = None
+
+
 def _calculate_scenario(
         scenario_results_path, response_id, coefficient_json_path):
     """Estimate the PUD of a scenario given an existing regression equation.
@@ -1315,6 +2226,10 @@ def _calculate_scenario(
     It is expected that the predictor coefficients have been derived from a
     log normal distribution.
 
+    The predictor fields are read in blocks, the estimates of a whole block
+    are calculated at once, and the estimates are written in one pass over
+    the features.
+
     Args:
         scenario_results_path (string): path to desired output scenario
             vector result which will be geometrically a copy of the input
@@ -1332,6 +2247,37 @@ def _calculate_scenario(
     """
     LOGGER.info("Calculating scenario results")
 
+    # Load the pre-existing predictor coefficients to build the regression
+    # equation.
+    with open(coefficient_json_path, 'r') as json_file:
+        predictor_estimates = json.load(json_file)
+
+    y_intercept = predictor_estimates.pop("(Intercept)")
+    predictor_id_list = [
+        str(predictor_id) for predictor_id in predictor_estimates]
+
+    response_lookup = {}
+    n_incomplete = 0
+    for fid_block, predictor_block in _iter_field_blocks(
+            scenario_results_path, predictor_id_list):
+        # add the terms in the same order as summing them feature by feature
+        response_block = numpy.zeros(fid_block.shape[0])
+        for predictor_index, coefficient in enumerate(
+                predictor_estimates.values()):
+            response_block += (
+                coefficient * predictor_block[:, predictor_index])
+        response_block += y_intercept
+        complete_mask = ~numpy.isnan(response_block)
+        n_incomplete += numpy.count_nonzero(~complete_mask)
+        # recall the coefficients are log normal, so expm1 inverses it
+        response_lookup.update(zip(
+            fid_block[complete_mask].tolist(),
+            numpy.expm1(response_block[complete_mask]).tolist()))
+    if n_incomplete:
+        LOGGER.warning(
+            'incomplete predictor data for %d features, not estimating '
+            '%s for them', n_incomplete, response_id)
+
     # Open for writing
     scenario_coefficient_vector = gdal.OpenEx(
         scenario_results_path, gdal.OF_VECTOR | gdal.GA_Update)
@@ -1347,34 +2293,16 @@ def _calculate_scenario(
     response_field.SetWidth(24)
     response_field.SetPrecision(11)
     scenario_coefficient_layer.CreateField(response_field)
+    response_index = scenario_coefficient_layer.FindFieldIndex(response_id, 1)
 
-    # Load the pre-existing predictor coefficients to build the regression
-    # equation.
-    with open(coefficient_json_path, 'r') as json_file:
-        predictor_estimates = json.load(json_file)
-
-    y_intercept = predictor_estimates.pop("(Intercept)")
-
-    for feature_id in range(scenario_coefficient_layer.GetFeatureCount()):
-        feature = scenario_coefficient_layer.GetFeature(feature_id)
-        response_value = 0.0
-        try:
-            for predictor_id, coefficient in predictor_estimates.items():
-                response_value += (
-                    coefficient *
-                    feature.GetField(str(predictor_id)))
-        except TypeError as e:
-            # TypeError will happen if GetField returned None
-            LOGGER.warning(
-                'incomplete predictor data for feature_id %d, \
-                not estimating PUD_EST' % feature_id)
-            feature = None
+    scenario_coefficient_layer.StartTransaction()
+    for feature in scenario_coefficient_layer:
+        response_value = response_lookup.get(feature.GetFID())
+        if response_value is None:
             continue  # without writing to the feature
-        response_value += y_intercept
-        # recall the coefficients are log normal, so expm1 inverses it
-        feature.SetField(response_id, numpy.expm1(response_value))
+        feature.SetField(response_index, response_value)
         scenario_coefficient_layer.SetFeature(feature)
-        feature = None
+    scenario_coefficient_layer.CommitTransaction()
 
     scenario_coefficient_layer = None
     scenario_coefficient_vector.FlushCache()
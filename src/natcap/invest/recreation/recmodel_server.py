@@ -1,19 +1,22 @@
 """InVEST Recreation Server."""
 
 import subprocess
+import collections
+import contextlib
 import os
 import multiprocessing
 import uuid
 import zipfile
 import glob
 import hashlib
-import pickle
 import time
 import threading
-import collections
 import logging
+import pickle
 import queue
-from io import BytesIO, StringIO
+import shutil
+import tempfile
+from io import BytesIO
 
 import Pyro4
 import numpy
@@ -29,16 +32,31 @@ from ... import invest
 from .. import utils
 from natcap.invest.recreation import out_of_core_quadtree
 from . import recmodel_client
+from . import photo_csv_parser
+from . import result_cache
+from . import vector_field_writer
 
 
 BLOCKSIZE = 2 ** 21
 GLOBAL_MAX_POINTS_PER_NODE = 10000  # Default max points in quadtree to split
 POINTS_TO_ADD_PER_STEP = 2 ** 8
+GLOBAL_PARTITION_DEPTH = 2  # depth of the quads built in parallel
+PARTITION_POINTS_PER_ADD = 2 ** 20  # points added to a partition at a time
 GLOBAL_DEPTH = 10
 LOCAL_MAX_POINTS_PER_NODE = 50
 LOCAL_DEPTH = 8
 CSV_ROWS_PER_PARSE = 2 ** 10
 LOGGER_TIME_DELAY = 5.0
+RESULT_CACHE_MAX_BYTES = 2 ** 30  # default size of cached result archives
+RESULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60.0  # default max age in seconds
+MAX_CONCURRENT_REQUESTS = 4  # default requests to aggregate at once
+MAX_TRANSFER_CHUNK_SIZE = 2 ** 24  # largest chunk sent in one download call
+MAX_QUEUED_JOBS = 100  # default jobs that can wait for a job worker
+JOB_STATUS_MAX_AGE = 24 * 60 * 60.0  # seconds finished job statuses are kept
+_AOI_UPLOAD_FILENAME = 'server_in.zip.part'
+_AOI_ARCHIVE_FILENAME = 'server_in.zip'
+_RESULT_ARCHIVE_FILENAME = 'aoi_pud_result.zip'
+_QUEUE_POLL_SECONDS = 0.5  # how often a blocked producer checks to stop
 
 Pyro4.config.SERIALIZER = 'marshal'  # lets us pass null bytes in strings
 
@@ -97,6 +115,11 @@ def _try_except_wrapper(mesg):
     return try_except_decorator
 
 
+def _ignore_progress(phase, percent_complete):
+    """Progress callback that ignores the progress."""
+    pass
+
+
 @Pyro4.expose
 class RecModel(object):
     """Class that manages RPCs for calculating photo user days."""
@@ -104,7 +127,12 @@ class RecModel(object):
     @_try_except_wrapper("RecModel construction exited while multiprocessing.")
     def __init__(
             self, raw_csv_filename, min_year, max_year, cache_workspace,
-            max_points_per_node=GLOBAL_MAX_POINTS_PER_NODE):
+            max_points_per_node=GLOBAL_MAX_POINTS_PER_NODE,
+            result_cache_max_bytes=RESULT_CACHE_MAX_BYTES,
+            result_cache_max_age=RESULT_CACHE_MAX_AGE,
+            n_polytest_workers=None,
+            max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+            max_queued_jobs=MAX_QUEUED_JOBS, n_build_workers=None):
         """Initialize RecModel object.
 
         Args:
@@ -122,6 +150,24 @@ class RecModel(object):
                 object can write quadtree data to disk and search for
                 pre-computed quadtrees based on the hash of the file at
                 `raw_csv_filename`
+            max_points_per_node (int): maximum number of points to allow per
+                node of the global quadtree.
+            result_cache_max_bytes (int): maximum total size in bytes of the
+                cached result archives kept under `cache_workspace`.
+            result_cache_max_age (float): maximum age in seconds of a cached
+                request or polygon result.
+            n_polytest_workers (int): number of processes in the pool that
+                tests AOI polygons for every request.  Defaults to the
+                number of CPUs.
+            max_concurrent_requests (int): maximum number of requests that
+                aggregate points at once, further requests wait for one of
+                these to finish.  Also the number of threads that run
+                submitted jobs.
+            max_queued_jobs (int): maximum number of submitted jobs that can
+                wait for a job thread, ``submit_job`` fails when it's full.
+            n_build_workers (int): number of processes that build the
+                global quadtree if it isn't already in `cache_workspace`.
+                Defaults to the number of CPUs.
 
         Returns:
             None
@@ -132,13 +178,47 @@ class RecModel(object):
             raise ValueError(
                 "max_year is less than min_year, must be greater or "
                 "equal to")
-        self.qt_pickle_filename = construct_userday_quadtree(
-            initial_bounding_box, raw_csv_filename, cache_workspace,
-            max_points_per_node)
+        self.qt_pickle_filename, self.qt_index_filename = (
+            construct_userday_quadtree(
+                initial_bounding_box, raw_csv_filename, cache_workspace,
+                max_points_per_node, n_build_workers=n_build_workers))
+        # the flat index is memory-mapped so it's opened once and shared by
+        # every request
+        self.global_qt = out_of_core_quadtree.FlatQuadTree(
+            self.qt_index_filename)
+        self._ingest_lock = threading.Lock()
+        # number of requests reading each version of the global quadtree,
+        # an ingest only reuses extents no version being read refers to
+        self._global_qt_lock = threading.Lock()
+        self._global_qt_reader_count = collections.Counter()
         self.cache_workspace = cache_workspace
+        self.result_cache = result_cache.ResultCache(
+            os.path.join(cache_workspace, 'result_cache'),
+            result_cache_max_bytes, result_cache_max_age)
         self.min_year = min_year
         self.max_year = max_year
 
+        if n_polytest_workers is None:
+            n_polytest_workers = multiprocessing.cpu_count()
+        self.n_polytest_workers = n_polytest_workers
+        self._request_semaphore = threading.BoundedSemaphore(
+            max_concurrent_requests)
+        # the pool is started on the first request that needs it
+        self._polytest_pool_lock = threading.Lock()
+        self._polytest_job_queue = None
+        self._polytest_result_queue_map = {}
+        # maps the path of each unfinished upload to the lock that orders
+        # its chunk writes, uploads of different sessions don't wait on
+        # each other
+        self._upload_lock = threading.Lock()
+        self._upload_lock_map = {}
+        self.n_job_workers = max_concurrent_requests
+        self._job_queue = queue.Queue(max_queued_jobs)
+        # maps job ID to its status, the job threads start on the first job
+        self._job_lock = threading.Lock()
+        self._job_status_map = {}
+        self._job_workers_started = False
+
     def get_valid_year_range(self):
         """Return the min and max year queriable.
 
@@ -155,7 +235,146 @@ class RecModel(object):
         This string can be used to uniquely identify the PUD database and
         algorithm for publication in terms of reproducibility.
         """
-        return '%s:%s' % (invest.__version__, self.qt_pickle_filename)
+        return _quadtree_version(self.global_qt)
+
+    def _ingest_photo_csv(self, raw_csv_filename, start_offset=0):
+        """Add new photo records to the global quadtree and swap to it.
+
+        Requests keep querying the previous version of the global quadtree
+        until the new version is complete.  This is underscore-private so
+        Pyro doesn't expose it to clients.
+
+        Args:
+            raw_csv_filename (string): path to a csv file of new photo
+                records in the same format as the one the server started
+                with.
+            start_offset (int): byte offset of the first line to add from
+                `raw_csv_filename`, see ``ingest_userday_quadtree``.
+
+        Returns:
+            None
+        """
+        with self._ingest_lock:
+            with self._global_qt_lock:
+                oldest_version_in_use = min(
+                    [_index_version(self.global_qt.index_path)] + [
+                        version for version, reader_count in
+                        self._global_qt_reader_count.items()
+                        if reader_count > 0])
+            qt_index_filename = ingest_userday_quadtree(
+                self.qt_pickle_filename, raw_csv_filename, start_offset,
+                oldest_version_in_use=oldest_version_in_use)
+            # requests hold the tree they started with, see
+            # _hold_global_qt
+            global_qt = out_of_core_quadtree.FlatQuadTree(qt_index_filename)
+            with self._global_qt_lock:
+                self.global_qt = global_qt
+                self.qt_index_filename = qt_index_filename
+        LOGGER.info('now serving %s', qt_index_filename)
+
+    @contextlib.contextmanager
+    def _hold_global_qt(self):
+        """Hold the served version of the global quadtree while it's read.
+
+        An ingest doesn't reuse the node store extents of a version that's
+        held, so a request can keep reading the version it started with
+        after a newer one is swapped in.
+
+        Yields:
+            the held ``out_of_core_quadtree.FlatQuadTree``.
+        """
+        with self._global_qt_lock:
+            global_qt = self.global_qt
+            version = _index_version(global_qt.index_path)
+            self._global_qt_reader_count[version] += 1
+        try:
+            yield global_qt
+        finally:
+            with self._global_qt_lock:
+                self._global_qt_reader_count[version] -= 1
+                if not self._global_qt_reader_count[version]:
+                    del self._global_qt_reader_count[version]
+
+    def _start_polytest_workers(self):
+        """Start the pool of polygon test processes if it isn't running.
+
+        Returns:
+            None
+        """
+        with self._polytest_pool_lock:
+            if self._polytest_job_queue is not None:
+                return
+            LOGGER.info(
+                'starting %d polygon test processes', self.n_polytest_workers)
+            polytest_job_queue = multiprocessing.Queue()
+            polytest_result_queue = multiprocessing.Queue()
+            for _ in range(self.n_polytest_workers):
+                polytest_process = multiprocessing.Process(
+                    target=_calc_poly_pud, args=(
+                        polytest_job_queue, polytest_result_queue))
+                polytest_process.daemon = True
+                polytest_process.start()
+            route_thread = threading.Thread(
+                target=self._route_polytest_results,
+                args=(polytest_result_queue,))
+            route_thread.daemon = True
+            route_thread.start()
+            self._polytest_job_queue = polytest_job_queue
+
+    def _route_polytest_results(self, polytest_result_queue):
+        """Pass polygon test results to the queue of their request.
+
+        Args:
+            polytest_result_queue (multiprocessing.Queue): queue of
+                (request_id, poly_id, result) tuples from the pool.
+
+        Returns:
+            Never returns
+        """
+        while True:
+            request_id, poly_id, pud_result = polytest_result_queue.get()
+            with self._polytest_pool_lock:
+                request_result_queue = self._polytest_result_queue_map.get(
+                    request_id)
+            if request_result_queue is not None:
+                request_result_queue.put((poly_id, pud_result))
+
+    def _submit_polytest_jobs(
+            self, local_qt_index_path, aoi_path, date_range, poly_id_list):
+        """Queue a request's polygons to be tested by the worker pool.
+
+        The caller must pass the returned request id to
+        ``_finish_polytest_jobs`` when done with the results.
+
+        Args:
+            local_qt_index_path (string): path to the flat index of the
+                request's local quadtree.
+            aoi_path (string): path to the AOI that contains the polygons.
+            date_range (tuple): numpy.datetime64 tuple indicating inclusive
+                start and stop dates
+            poly_id_list (list): FIDs of the polygons to test.
+
+        Returns:
+            (request_id, result_queue) where ``result_queue`` receives a
+            (poly_id, result) tuple for each polygon in `poly_id_list`, see
+            ``_calc_poly_pud`` for the result.
+        """
+        self._start_polytest_workers()
+        request_id = uuid.uuid4().hex
+        request_result_queue = queue.Queue()
+        with self._polytest_pool_lock:
+            self._polytest_result_queue_map[request_id] = (
+                request_result_queue)
+        for poly_id in poly_id_list:
+            self._polytest_job_queue.put(
+                (request_id, local_qt_index_path, aoi_path, date_range,
+                 poly_id))
+        return request_id, request_result_queue
+
+    def _finish_polytest_jobs(self, request_id):
+        """Stop routing the results of a request submitted to the pool."""
+        with self._polytest_pool_lock:
+            del self._polytest_result_queue_map[request_id]
 
     # not static so it can register in Pyro object
     @_try_except_wrapper("exception in fetch_workspace_aoi")
@@ -178,6 +397,301 @@ class RecModel(object):
             workspace_path, str('server_in')+'.zip')
         return open(out_zip_file_path, 'rb').read()
 
+    def _session_workspace(self, session_id):
+        """Return the workspace path of a session, rejecting bad IDs.
+
+        Session IDs are generated UUIDs, so anything else could point
+        outside the cache workspace.
+        """
+        return os.path.join(self.cache_workspace, str(uuid.UUID(session_id)))
+
+    @_try_except_wrapper("exception in start_aoi_upload")
+    def start_aoi_upload(self):
+        """Start a chunked upload of a zipped AOI.
+
+        The zipped AOI is sent in pieces with ``upload_aoi_chunk`` and the
+        upload is finished by ``calc_photo_user_days_in_session``.  An
+        interrupted upload resumes from ``get_upload_offset``.
+
+        Returns:
+            session ID of the upload, which is also the ID of the workspace
+            the request runs in.
+
+        """
+        session_id = str(uuid.uuid4())
+        workspace_path = self._session_workspace(session_id)
+        os.makedirs(workspace_path)
+        open(os.path.join(workspace_path, _AOI_UPLOAD_FILENAME), 'wb').close()
+        return session_id
+
+    @_try_except_wrapper("exception in upload_aoi_chunk")
+    def upload_aoi_chunk(self, session_id, offset, chunk_binary):
+        """Write a chunk of a zipped AOI upload.
+
+        A chunk may be sent again, but may not leave a gap after the bytes
+        already received.
+
+        Args:
+            session_id (string): ID returned by ``start_aoi_upload``.
+            offset (int): byte offset of the chunk in the zipped AOI.
+            chunk_binary (bytes): the chunk.
+
+        Returns:
+            number of bytes of the upload received so far.
+
+        """
+        upload_path = os.path.join(
+            self._session_workspace(session_id), _AOI_UPLOAD_FILENAME)
+        with self._upload_path_lock(upload_path):
+            upload_size = os.path.getsize(upload_path)
+            if offset > upload_size:
+                raise ValueError(
+                    "chunk at offset %d leaves a gap after the %d bytes "
+                    "received" % (offset, upload_size))
+            with open(upload_path, 'r+b') as upload_file:
+                upload_file.seek(offset)
+                upload_file.write(chunk_binary)
+            return max(upload_size, offset + len(chunk_binary))
+
+    def _upload_path_lock(self, upload_path):
+        """Return the lock that orders the chunk writes of an upload."""
+        with self._upload_lock:
+            return self._upload_lock_map.setdefault(
+                upload_path, threading.Lock())
+
+    def _finish_upload(self, workspace_path):
+        """Rename a finished upload to the AOI archive of its workspace."""
+        upload_path = os.path.join(workspace_path, _AOI_UPLOAD_FILENAME)
+        with self._upload_path_lock(upload_path):
+            os.replace(
+                upload_path,
+                os.path.join(workspace_path, _AOI_ARCHIVE_FILENAME))
+        with self._upload_lock:
+            del self._upload_lock_map[upload_path]
+
+    @_try_except_wrapper("exception in get_upload_offset")
+    def get_upload_offset(self, session_id):
+        """Return the number of bytes received by an unfinished upload.
+
+        Args:
+            session_id (string): ID returned by ``start_aoi_upload``.
+
+        Returns:
+            offset to resume the upload from.
+
+        """
+        return os.path.getsize(os.path.join(
+            self._session_workspace(session_id), _AOI_UPLOAD_FILENAME))
+
+    @_try_except_wrapper("exception in calc_photo_user_days_in_session")
+    def calc_photo_user_days_in_session(
+            self, session_id, date_range, out_vector_filename):
+        """Calculate photo user days in an AOI sent with a chunked upload.
+
+        Like ``calc_photo_user_days_in_aoi`` except the result archive stays
+        on the server to be fetched with ``download_result_chunk``.
+
+        Args:
+            session_id (string): ID returned by ``start_aoi_upload`` after
+                all of the zipped AOI is uploaded.
+            date_range (string 2-tuple): a tuple that contains the inclusive
+                start and end date formatted as 'YYYY-MM-DD'
+            out_vector_filename (string): base filename of output vector
+
+        Returns:
+            (workspace_id, result_size) where ``result_size`` is the size in
+            bytes of the result archive.
+
+        """
+        workspace_path = self._session_workspace(session_id)
+        self._finish_upload(workspace_path)
+        result_archive_path = self._calc_photo_user_days_in_workspace(
+            workspace_path, date_range, out_vector_filename)
+        return session_id, os.path.getsize(result_archive_path)
+
+    @_try_except_wrapper("exception in submit_job")
+    def submit_job(self, session_id, date_range, out_vector_filename):
+        """Queue a photo user days calculation on an uploaded AOI.
+
+        Returns at once.  The job's progress is reported by
+        ``get_job_status`` and its result archive can be fetched with
+        ``download_result_chunk`` once the job is done.
+
+        Args:
+            session_id (string): ID returned by ``start_aoi_upload`` after
+                all of the zipped AOI is uploaded.
+            date_range (string 2-tuple): a tuple that contains the inclusive
+                start and end date formatted as 'YYYY-MM-DD'
+            out_vector_filename (string): base filename of output vector
+
+        Returns:
+            job ID, which is also the ID of the job's workspace.
+
+        Raises:
+            ValueError if a job was already submitted for the session.
+            RuntimeError if the job queue is full.
+
+        """
+        workspace_path = self._session_workspace(session_id)
+        self._start_job_workers()
+        with self._job_lock:
+            if session_id in self._job_status_map:
+                raise ValueError("job %s was already submitted" % session_id)
+            self._expire_job_statuses()
+            try:
+                self._job_queue.put_nowait(
+                    (session_id, tuple(date_range), out_vector_filename))
+            except queue.Full:
+                raise RuntimeError(
+                    "the server's queue of %d jobs is full, try again "
+                    "later" % self._job_queue.maxsize)
+            self._job_status_map[session_id] = {
+                'phase': 'queued',
+                'percent_complete': 0.0,
+                'result_size': None,
+                'error': None,
+                'phase_seconds': {},
+                'update_time': time.time(),
+                'phase_start_time': time.time(),
+            }
+        LOGGER.info('queued job %s on %s', session_id, workspace_path)
+        return session_id
+
+    @_try_except_wrapper("exception in get_job_status")
+    def get_job_status(self, job_id):
+        """Return the progress of a submitted job.
+
+        Args:
+            job_id (string): ID returned by ``submit_job``.
+
+        Returns:
+            dictionary with the job's 'phase', one of 'queued', 'preparing',
+            'querying quadtree', 'building local quadtree', 'testing
+            polygons', 'writing results', 'zipping results', 'done' or
+            'failed', its 'percent_complete', the 'result_size' in bytes of
+            its result archive once done, the 'error' message if it failed,
+            and 'phase_seconds' which maps each finished phase to the seconds
+            it took.
+
+        """
+        with self._job_lock:
+            job_status = self._job_status_map.get(job_id)
+            if job_status is None:
+                raise ValueError("unknown job %s" % job_id)
+            return {
+                key: (dict(value) if key == 'phase_seconds' else value)
+                for key, value in job_status.items()
+                if key not in ('update_time', 'phase_start_time')}
+
+    def _start_job_workers(self):
+        """Start the threads that run submitted jobs if they aren't running.
+
+        Returns:
+            None
+        """
+        with self._job_lock:
+            if self._job_workers_started:
+                return
+            LOGGER.info('starting %d job threads', self.n_job_workers)
+            for _ in range(self.n_job_workers):
+                job_thread = threading.Thread(target=self._run_jobs)
+                job_thread.daemon = True
+                job_thread.start()
+            self._job_workers_started = True
+
+    def _run_jobs(self):
+        """Run jobs from the job queue.
+
+        Returns:
+            Never returns
+        """
+        while True:
+            job_id, date_range, out_vector_filename = self._job_queue.get()
+
+            def _report_progress(phase, percent_complete):
+                """Record the phase and percent complete of the job."""
+                self._update_job_status(
+                    job_id, phase, percent_complete=percent_complete)
+
+            _report_progress('preparing', 0.0)
+            try:
+                workspace_path = self._session_workspace(job_id)
+                self._finish_upload(workspace_path)
+                result_archive_path = self._calc_photo_user_days_in_workspace(
+                    workspace_path, date_range, out_vector_filename,
+                    progress_callback=_report_progress)
+                result_size = os.path.getsize(result_archive_path)
+                self._update_job_status(
+                    job_id, 'done', percent_complete=100.0,
+                    result_size=result_size)
+                LOGGER.info('job %s done', job_id)
+            except Exception as exc_obj:
+                LOGGER.exception('job %s failed', job_id)
+                self._update_job_status(job_id, 'failed', error=str(exc_obj))
+
+    def _update_job_status(self, job_id, phase, **status_kwargs):
+        """Set the phase of a job and time the phase it finished.
+
+        Args:
+            job_id (string): ID of a submitted job.
+            phase (string): the job's current phase.
+            status_kwargs: other items of the job's status to set.
+
+        Returns:
+            None
+        """
+        with self._job_lock:
+            job_status = self._job_status_map[job_id]
+            update_time = time.time()
+            if phase != job_status['phase']:
+                phase_seconds = job_status['phase_seconds']
+                phase_seconds[job_status['phase']] = (
+                    phase_seconds.get(job_status['phase'], 0.0) +
+                    update_time - job_status['phase_start_time'])
+                job_status['phase_start_time'] = update_time
+            job_status.update(
+                phase=phase, update_time=update_time, **status_kwargs)
+
+    def _expire_job_statuses(self):
+        """Forget finished jobs older than ``JOB_STATUS_MAX_AGE``.
+
+        The caller must hold ``self._job_lock``.
+        """
+        min_update_time = time.time() - JOB_STATUS_MAX_AGE
+        for job_id, job_status in list(self._job_status_map.items()):
+            if (job_status['phase'] in ('done', 'failed') and
+                    job_status['update_time'] < min_update_time):
+                del self._job_status_map[job_id]
+
+    @_try_except_wrapper("exception in download_result_chunk")
+    def download_result_chunk(self, workspace_id, offset, chunk_size):
+        """Read a chunk of the result archive of a workspace.
+
+        Args:
+            workspace_id (string): ID of a workspace whose photo user days
+                have been calculated.
+            offset (int): byte offset of the chunk in the archive.
+            chunk_size (int): number of bytes to read, at most
+                ``MAX_TRANSFER_CHUNK_SIZE``.
+
+        Returns:
+            bytes of the chunk, empty past the end of the archive.
+
+        """
+        workspace_path = self._session_workspace(workspace_id)
+        with self._job_lock:
+            job_status = self._job_status_map.get(workspace_id)
+            if job_status is not None and job_status['phase'] != 'done':
+                raise ValueError(
+                    "job %s is %s, its result isn't ready" % (
+                        workspace_id, job_status['phase']))
+        result_archive_path = os.path.join(
+            workspace_path, _RESULT_ARCHIVE_FILENAME)
+        with open(result_archive_path, 'rb') as result_archive:
+            result_archive.seek(offset)
+            return result_archive.read(
+                min(chunk_size, MAX_TRANSFER_CHUNK_SIZE))
+
     @_try_except_wrapper("exception in calc_photo_user_days_in_aoi")
     def calc_photo_user_days_in_aoi(
             self, zip_file_binary, date_range, out_vector_filename):
@@ -203,46 +717,85 @@ class RecModel(object):
         workspace_path = os.path.join(self.cache_workspace, workspace_id)
         os.makedirs(workspace_path)
 
-        # decompress zip
-        out_zip_file_filename = os.path.join(
-            workspace_path, str('server_in')+'.zip')
+        with open(os.path.join(
+                workspace_path, _AOI_ARCHIVE_FILENAME), 'wb') as zip_file_disk:
+            zip_file_disk.write(zip_file_binary)
+        result_archive_path = self._calc_photo_user_days_in_workspace(
+            workspace_path, date_range, out_vector_filename)
+
+        # return the binary stream
+        LOGGER.info(
+            'calc user days complete sending binary back on %s',
+            workspace_path)
+        with open(result_archive_path, 'rb') as result_archive:
+            return result_archive.read(), workspace_id
+
+    def _calc_photo_user_days_in_workspace(
+            self, workspace_path, date_range, out_vector_filename,
+            progress_callback=_ignore_progress):
+        """Calculate photo user days in the zipped AOI of a workspace.
+
+        Args:
+            workspace_path (string): path to a request's workspace which
+                holds the zipped AOI as ``server_in.zip``.
+            date_range (string 2-tuple): a tuple that contains the inclusive
+                start and end date formatted as 'YYYY-MM-DD'
+            out_vector_filename (string): base filename of output vector
+            progress_callback (function): called with the name of the
+                current phase and its percent complete as the calculation
+                progresses.
 
+        Returns:
+            path to the zipped result in the workspace.
+
+        """
+        # decompress zip
         LOGGER.info('decompress zip file AOI')
-        with open(out_zip_file_filename, 'wb') as zip_file_disk:
-            zip_file_disk.write(zip_file_binary)
-        shapefile_archive = zipfile.ZipFile(out_zip_file_filename, 'r')
+        shapefile_archive = zipfile.ZipFile(
+            os.path.join(workspace_path, _AOI_ARCHIVE_FILENAME), 'r')
         shapefile_archive.extractall(workspace_path)
         shapefile_archive.close()
         shapefile_archive = None
         aoi_path = glob.glob(os.path.join(workspace_path, '*.shp'))[0]
 
-        LOGGER.info('running calc user days on %s', workspace_path)
+        aoi_pud_archive_path = os.path.join(
+            workspace_path, _RESULT_ARCHIVE_FILENAME)
         numpy_date_range = (
             numpy.datetime64(date_range[0]),
             numpy.datetime64(date_range[1]))
-        base_pud_aoi_path, monthly_table_path = (
-            self._calc_aggregated_points_in_aoi(
-                aoi_path, workspace_path, numpy_date_range,
-                out_vector_filename))
+        request_key = _hash_aoi_request(
+            aoi_path, numpy_date_range, out_vector_filename,
+            self.get_version())
+        if self.result_cache.copy_result(request_key, aoi_pud_archive_path):
+            LOGGER.info(
+                'returning cached result %s on %s', request_key,
+                workspace_path)
+            return aoi_pud_archive_path
+
+        LOGGER.info('running calc user days on %s', workspace_path)
+        # limit the requests in flight so load queues here rather than
+        # oversubscribing the host
+        with self._request_semaphore:
+            base_pud_aoi_path, monthly_table_path = (
+                self._calc_aggregated_points_in_aoi(
+                    aoi_path, workspace_path, numpy_date_range,
+                    out_vector_filename, progress_callback=progress_callback))
 
         # ZIP and stream the result back
         LOGGER.info('zipping result')
-        aoi_pud_archive_path = os.path.join(
-            workspace_path, 'aoi_pud_result.zip')
+        progress_callback('zipping results', 0.0)
         with zipfile.ZipFile(aoi_pud_archive_path, 'w') as myzip:
             for filename in glob.glob(
                     os.path.splitext(base_pud_aoi_path)[0] + '.*'):
                 myzip.write(filename, os.path.basename(filename))
             myzip.write(
                 monthly_table_path, os.path.basename(monthly_table_path))
-        # return the binary stream
-        LOGGER.info(
-            'calc user days complete sending binary back on %s',
-            workspace_path)
-        return open(aoi_pud_archive_path, 'rb').read(), workspace_id
+        self.result_cache.put_result(request_key, aoi_pud_archive_path)
+        return aoi_pud_archive_path
 
     def _calc_aggregated_points_in_aoi(
-            self, aoi_path, workspace_path, date_range, out_vector_filename):
+            self, aoi_path, workspace_path, date_range, out_vector_filename,
+            progress_callback=_ignore_progress):
         """Aggregate the PUD in the AOI.
 
         Args:
@@ -252,6 +805,9 @@ class RecModel(object):
             date_range (datetime 2-tuple): a tuple that contains the inclusive
                 start and end date
             out_vector_filename (string): base filename of output vector
+            progress_callback (function): called with the name of the
+                current phase and its percent complete as polygons are
+                tested.
 
         Returns:
             a path to an ESRI shapefile copy of `aoi_path` updated with a
@@ -262,14 +818,142 @@ class RecModel(object):
         # append a _pud to the aoi filename
         out_aoi_pud_path = os.path.join(workspace_path, out_vector_filename)
 
-        # start the workers now, because they have to load a quadtree and
-        # it will take some time
-        poly_test_queue = multiprocessing.Queue()
-        pud_poly_feature_queue = multiprocessing.Queue(4)
-        n_polytest_processes = multiprocessing.cpu_count()
-
-        global_qt = pickle.load(open(self.qt_pickle_filename, 'rb'))
         aoi_layer = aoi_vector.GetLayer()
+
+        # use one version of the global quadtree for the whole request even
+        # if an ingest swaps in a new one, it's held until the local
+        # quadtree is built so its extents aren't reused while it's read
+        with self._hold_global_qt() as global_qt:
+            # look up polygons that were tested in an earlier request
+            polygon_key_map = _hash_aoi_polygons(
+                aoi_layer, date_range, _quadtree_version(global_qt))
+            cached_polygon_results = self.result_cache.get_polygon_results(
+                list(set(polygon_key_map.values())))
+            uncached_poly_id_list = [
+                poly_feat.GetFID() for poly_feat in aoi_layer
+                if polygon_key_map.get(poly_feat.GetFID()) not in
+                cached_polygon_results]
+            aoi_layer.ResetReading()
+            LOGGER.info(
+                '%d polygons to test, %d found in the result cache',
+                len(uncached_poly_id_list),
+                aoi_layer.GetFeatureCount() - len(uncached_poly_id_list))
+
+            # the worker pool tests polygons while cached results are collected
+            request_id = None
+            if uncached_poly_id_list:
+                local_qt_index_path = self._build_local_quadtree(
+                    global_qt, aoi_layer, workspace_path,
+                    progress_callback=progress_callback)
+                LOGGER.info('testing polygons against quadtree')
+                request_id, polytest_result_queue = self._submit_polytest_jobs(
+                    local_qt_index_path, aoi_path, date_range,
+                    uncached_poly_id_list)
+
+        aoi_layer = None
+        aoi_vector = None
+
+        pud_id_suffix_list = [
+            'YR_AVG', 'JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG',
+            'SEP', 'OCT', 'NOV', 'DEC']
+
+        last_time = time.time()
+        n_poly_tested = 0
+
+        monthly_table_path = os.path.join(workspace_path, 'monthly_table.csv')
+        monthly_table = open(monthly_table_path, 'w')
+        date_range_year = [
+            date.tolist().timetuple().tm_year for date in date_range]
+        table_headers = [
+            '%s-%s' % (year, month) for year in range(
+                int(date_range_year[0]), int(date_range_year[1])+1)
+            for month in range(1, 13)]
+        monthly_table.write('poly_id,' + ','.join(table_headers) + '\n')
+
+        # the PUD fields are collected here and written in one pass at the end
+        pud_poly_id_list = []
+        pud_row_list = []
+
+        def _write_poly_result(poly_id, pud_list, pud_monthly_counts):
+            """Record a polygon's PUD and write it to the monthly table."""
+            pud_poly_id_list.append(poly_id)
+            pud_row_list.append(pud_list)
+
+            line = '%s,' % poly_id
+            line += (
+                ",".join(['%s' % pud_monthly_counts.get(header, 0)
+                          for header in table_headers]))
+            line += '\n'  # final newline
+            monthly_table.write(line)
+
+        for poly_id, polygon_key in polygon_key_map.items():
+            if polygon_key in cached_polygon_results:
+                _write_poly_result(
+                    poly_id, *cached_polygon_results[polygon_key])
+
+        new_polygon_result_list = []
+        try:
+            while n_poly_tested < len(uncached_poly_id_list):
+                poly_id, pud_result = polytest_result_queue.get()
+                n_poly_tested += 1
+                progress_callback(
+                    'testing polygons',
+                    100.0 * n_poly_tested / len(uncached_poly_id_list))
+                last_time = recmodel_client.delay_op(
+                    last_time, LOGGER_TIME_DELAY, lambda: LOGGER.info(
+                        '%.2f%% of polygons tested',
+                        100 * float(n_poly_tested) /
+                        len(uncached_poly_id_list)))
+                if isinstance(pud_result, Exception):
+                    raise pud_result
+                if pud_result is None:
+                    continue  # the polygon was skipped
+                pud_list, pud_monthly_counts = pud_result
+                _write_poly_result(poly_id, pud_list, pud_monthly_counts)
+                if poly_id in polygon_key_map:
+                    new_polygon_result_list.append(
+                        (polygon_key_map[poly_id], pud_list,
+                         pud_monthly_counts))
+        finally:
+            if request_id is not None:
+                self._finish_polytest_jobs(request_id)
+        self.result_cache.put_polygon_results(new_polygon_result_list)
+
+        monthly_table.close()
+
+        LOGGER.info('done with polygon test, writing %s', out_aoi_pud_path)
+        progress_callback('writing results', 0.0)
+        pud_array = numpy.array(
+            pud_row_list, dtype=numpy.float64).reshape(
+                -1, len(pud_id_suffix_list))
+        vector_field_writer.write_vector_fields(
+            aoi_path, out_aoi_pud_path,
+            numpy.array(pud_poly_id_list, dtype=numpy.int64),
+            [('PUD_%s' % pud_id, pud_array[:, pud_index])
+             for pud_index, pud_id in enumerate(pud_id_suffix_list)])
+
+        LOGGER.info('returning out shapefile path')
+        return out_aoi_pud_path, monthly_table_path
+
+    def _build_local_quadtree(
+            self, global_qt, aoi_layer, workspace_path,
+            progress_callback=_ignore_progress):
+        """Build a quadtree of the global points under an AOI.
+
+        Args:
+            global_qt (out_of_core_quadtree.FlatQuadTree): global quadtree
+                to query for points.
+            aoi_layer (ogr.Layer): layer of the AOI polygons.
+            workspace_path (string): path to a directory where the local
+                quadtree files can be created
+            progress_callback (function): called with the name of the
+                current phase and its percent complete.
+
+        Returns:
+            path to the flat index of the local quadtree, its points are
+            projected to the AOI's projection.
+
+        """
         aoi_extent = aoi_layer.GetExtent()
         aoi_ref = aoi_layer.GetSpatialRef()
 
@@ -319,9 +1003,11 @@ class RecModel(object):
 
         LOGGER.info(
             'querying global quadtree against %s', str(global_b_box))
+        progress_callback('querying quadtree', 0.0)
         local_points = global_qt.get_intersecting_points_in_bounding_box(
             global_b_box)
         LOGGER.info('found %d points', len(local_points))
+        progress_callback('building local quadtree', 0.0)
 
         local_qt_cache_dir = os.path.join(workspace_path, 'local_qt')
         local_qt_pickle_filename = os.path.join(
@@ -335,33 +1021,7 @@ class RecModel(object):
 
         LOGGER.info(
             'building local quadtree with %d points', len(local_points))
-        last_time = time.time()
-        time_elapsed = None
-        for point_list_slice_index in range(
-                0, len(local_points), POINTS_TO_ADD_PER_STEP):
-            time_elapsed = time.time() - last_time
-            last_time = recmodel_client.delay_op(
-                last_time, LOGGER_TIME_DELAY, lambda: LOGGER.info(
-                    '%d out of %d points added to local_qt so far, and '
-                    ' n_nodes in qt %d in %.2fs', local_qt.n_points(),
-                    len(local_points), local_qt.n_nodes(), time_elapsed))
-
-            projected_point_list = local_points[
-                point_list_slice_index:
-                point_list_slice_index+POINTS_TO_ADD_PER_STEP]
-            for point_index in range(
-                    min(len(projected_point_list), POINTS_TO_ADD_PER_STEP)):
-                current_point = projected_point_list[point_index]
-                # convert to python float types rather than numpy.float32
-                lng_coord = float(current_point[2])
-                lat_coord = float(current_point[3])
-                x_coord, y_coord, _ = from_lat_trans.TransformPoint(
-                    lng_coord, lat_coord)
-                projected_point_list[point_index] = (
-                    current_point[0], current_point[1], x_coord, y_coord)
-
-            local_qt.add_points(
-                projected_point_list, 0, len(projected_point_list))
+        _add_projected_points(local_qt, local_points, from_lat_trans)
         LOGGER.info('saving local qt to %s', local_qt_pickle_filename)
         local_qt.flush()
 
@@ -371,155 +1031,165 @@ class RecModel(object):
         build_quadtree_shape(
             local_quad_tree_shapefile_name, local_qt, aoi_ref)
 
-        # Start several testing processes
-        polytest_process_list = []
-        for _ in range(n_polytest_processes):
-            polytest_process = multiprocessing.Process(
-                target=_calc_poly_pud, args=(
-                    local_qt_pickle_filename, aoi_path, date_range,
-                    poly_test_queue, pud_poly_feature_queue))
-            polytest_process.daemon = True
-            polytest_process.start()
-            polytest_process_list.append(polytest_process)
-
-        # Copy the input shapefile into the designated output folder
-        LOGGER.info('Creating a copy of the input shapefile')
-        driver = gdal.GetDriverByName('ESRI Shapefile')
-        pud_aoi_vector = driver.CreateCopy(out_aoi_pud_path, aoi_vector)
-        pud_aoi_layer = pud_aoi_vector.GetLayer()
+        return local_qt.index_filename
 
-        aoi_layer = None
-        gdal.Dataset.__swig_destroy__(aoi_vector)
-        aoi_vector = None
 
-        pud_id_suffix_list = [
-            'YR_AVG', 'JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG',
-            'SEP', 'OCT', 'NOV', 'DEC']
-        for field_suffix in pud_id_suffix_list:
-            field_id = 'PUD_%s' % field_suffix
-            # delete the field if it already exists
-            field_index = pud_aoi_layer.FindFieldIndex(str(field_id), 1)
-            if field_index >= 0:
-                pud_aoi_layer.DeleteField(field_index)
-            field_defn = ogr.FieldDefn(field_id, ogr.OFTReal)
-            field_defn.SetWidth(24)
-            field_defn.SetPrecision(11)
-            pud_aoi_layer.CreateField(field_defn)
+def _quadtree_version(global_qt):
+    """Return the version string of the server with a global quadtree."""
+    return '%s:%s' % (invest.__version__, global_qt.index_path)
 
-        last_time = time.time()
-        LOGGER.info('testing polygons against quadtree')
 
-        # Load up the test queue with polygons
-        for poly_feat in pud_aoi_layer:
-            poly_test_queue.put(poly_feat.GetFID())
+def _index_version(index_path):
+    """Return the version number of a flat quadtree index path.
 
-        # Fill the queue with STOPs for each process
-        for _ in range(n_polytest_processes):
-            poly_test_queue.put('STOP')
+    Version 0 is ``<hash>.qtindex`` and version N is ``<hash>.vN.qtindex``,
+    see ``OutOfCoreQuadTree.new_index_version``.
+    """
+    version_suffix = os.path.splitext(
+        os.path.splitext(index_path)[0])[1]
+    if version_suffix.startswith('.v') and version_suffix[2:].isdigit():
+        return int(version_suffix[2:])
+    return 0
 
-        # Read the result until we've seen n_processes_alive
-        n_processes_alive = n_polytest_processes
-        n_poly_tested = 0
 
-        monthly_table_path = os.path.join(workspace_path, 'monthly_table.csv')
-        monthly_table = open(monthly_table_path, 'w')
-        date_range_year = [
-            date.tolist().timetuple().tm_year for date in date_range]
-        table_headers = [
-            '%s-%s' % (year, month) for year in range(
-                int(date_range_year[0]), int(date_range_year[1])+1)
-            for month in range(1, 13)]
-        monthly_table.write('poly_id,' + ','.join(table_headers) + '\n')
+def _add_projected_points(local_qt, point_array, coord_trans):
+    """Project lat/lng points and add them to a quadtree.
+
+    The next slice of points is projected in a thread while the current
+    slice is added to the quadtree.  If adding or projecting fails, the
+    projection thread is stopped before the error is raised so it doesn't
+    block forever on the queue holding a reference to the points.
 
+    Args:
+        local_qt (out_of_core_quadtree.OutOfCoreQuadTree): quadtree to add
+            the projected points to.
+        point_array (numpy.ndarray): structured array of
+            (data, user hash, lng, lat) points, projected in place.
+        coord_trans (osr.CoordinateTransformation): transformation from
+            lat/lng to the projection of ``local_qt``.
+
+    Returns:
+        None
+    """
+    projected_slice_queue = queue.Queue(2)
+    stop_event = threading.Event()
+    projection_thread = threading.Thread(
+        target=_project_point_slices, args=(
+            point_array, coord_trans, POINTS_TO_ADD_PER_STEP,
+            projected_slice_queue, stop_event),
+        name='project_point_slices')
+    projection_thread.daemon = True
+    projection_thread.start()
+
+    last_time = time.time()
+    time_elapsed = None
+    try:
         while True:
-            result_tuple = pud_poly_feature_queue.get()
-            n_poly_tested += 1
-            if result_tuple == 'STOP':
-                n_processes_alive -= 1
-                if n_processes_alive == 0:
-                    break
-                continue
+            projected_point_list = projected_slice_queue.get()
+            # test the type since comparing an array to 'STOP' is elementwise
+            if isinstance(projected_point_list, str):
+                break
+            if isinstance(projected_point_list, Exception):
+                raise projected_point_list
+            time_elapsed = time.time() - last_time
             last_time = recmodel_client.delay_op(
                 last_time, LOGGER_TIME_DELAY, lambda: LOGGER.info(
-                    '%.2f%% of polygons tested', 100 * float(n_poly_tested) /
-                    pud_aoi_layer.GetFeatureCount()))
-            poly_id, pud_list, pud_monthly_set = result_tuple
-            poly_feat = pud_aoi_layer.GetFeature(poly_id)
-            for pud_index, pud_id in enumerate(pud_id_suffix_list):
-                poly_feat.SetField('PUD_%s' % pud_id, pud_list[pud_index])
-            pud_aoi_layer.SetFeature(poly_feat)
+                    '%d out of %d points added to local_qt so far, and '
+                    ' n_nodes in qt %d in %.2fs', local_qt.n_points(),
+                    len(point_array), local_qt.n_nodes(), time_elapsed))
 
-            line = '%s,' % poly_id
-            line += (
-                ",".join(['%s' % len(pud_monthly_set[header])
-                          for header in table_headers]))
-            line += '\n'  # final newline
-            monthly_table.write(line)
+            local_qt.add_points(
+                projected_point_list, 0, len(projected_point_list))
+    finally:
+        stop_event.set()
+        projection_thread.join()
 
-        LOGGER.info('done with polygon test, syncing to disk')
-        pud_aoi_layer = None
-        pud_aoi_vector.FlushCache()
-        gdal.Dataset.__swig_destroy__(pud_aoi_vector)
-        pud_aoi_vector = None
 
-        for polytest_process in polytest_process_list:
-            polytest_process.join()
+def _project_point_slices(
+        point_array, coord_trans, slice_size, projected_slice_queue,
+        stop_event):
+    """Project slices of a point array in place and queue them.
 
-        LOGGER.info('returning out shapefile path')
-        return out_aoi_pud_path, monthly_table_path
+    Each slice is projected with a single ``TransformPoints`` call and its
+    x/y columns are overwritten with the projected coordinates.
+
+    Args:
+        point_array (numpy.ndarray): structured array of
+            (data, user hash, lng, lat) points, modified in place.
+        coord_trans (osr.CoordinateTransformation): transformation from
+            lat/lng to the target projection.
+        slice_size (int): number of points to project per slice.
+        projected_slice_queue (queue.Queue): output queue that receives each
+            projected slice of ``point_array`` followed by 'STOP'.  If the
+            projection fails the exception is put on the queue instead.
+        stop_event (threading.Event): when set, projection stops without
+            queuing anything else, the consumer is no longer reading.
+
+    Returns:
+        None
+    """
+    def _put(item):
+        """Queue `item`, return False if stopped before it was queued."""
+        while not stop_event.is_set():
+            try:
+                projected_slice_queue.put(item, timeout=_QUEUE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for slice_index in range(0, len(point_array), slice_size):
+            point_slice = point_array[slice_index:slice_index+slice_size]
+            # convert to python float types rather than numpy.float32
+            projected_coords = numpy.array(coord_trans.TransformPoints(
+                numpy.column_stack((
+                    point_slice['f2'], point_slice['f3'])).astype(
+                        numpy.float64).tolist()))
+            point_slice['f2'] = projected_coords[:, 0]
+            point_slice['f3'] = projected_coords[:, 1]
+            if not _put(point_slice):
+                return
+    except Exception as error:
+        LOGGER.exception('error projecting points')
+        _put(error)
+        return
+    _put('STOP')
 
 
 def _parse_input_csv(
-        block_offset_size_queue, csv_filepath, numpy_array_queue):
-    """Parse CSV file lines to (datetime64[d], userhash, lat, lng) tuples.
+        block_offset_size_queue, csv_filepath, numpy_array_queue, block_dir):
+    """Parse CSV file lines to (datetime64[d], userhash, lng, lat) tuples.
+
+    Each block is parsed with ``photo_csv_parser.parse_photo_block`` and
+    saved to a ``.npy`` file so the parsed points are handed back through
+    the file system cache rather than pickled through the queue.
 
     Args:
 
         block_offset_size_queue (multiprocessing.Queue): contains tuples of
             the form (offset, chunk size) to direct where the file should be
             read from
+        csv_filepath (string): path to csv file to parse from
         numpy_array_queue (multiprocessing.Queue): output queue will have
             paths to files that can be opened with numpy.load and contain
-            structured arrays of (datetime, userid, lat, lng) parsed from the
-            raw CSV file
-        csv_filepath (string): path to csv file to parse from
+            structured arrays of (datetime, userhash, lng, lat) parsed from
+            the raw CSV file, followed by 'STOP'
+        block_dir (string): path to a directory to write the parsed blocks
+            to.
 
     Returns:
         None
     """
     for file_offset, chunk_size in iter(block_offset_size_queue.get, 'STOP'):
-        csv_file = open(csv_filepath, 'r')
-        csv_file.seek(file_offset, 0)
-        chunk_string = csv_file.read(chunk_size)
-        csv_file.close()
-
-        # sample line:
-        # 8568090486,48344648@N00,2013-03-17 16:27:27,42.383841,-71.138378,16
-        # this pattern matches the above style of line and only parses valid
-        # dates to handle some cases where there are weird dates in the input
-        pattern = r"[^,]+,([^,]+),(19|20\d\d-(?:0[1-9]|1[012])-(?:0[1-9]|[12][0-9]|3[01])) [^,]+,([^,]+),([^,]+),[^\n]"  # pylint: disable=line-too-long
-        result = numpy.fromregex(
-            StringIO(chunk_string), pattern,
-            [('user', 'S40'), ('date', 'datetime64[D]'), ('lat', 'f4'),
-             ('lng', 'f4')])
-
-        def md5hash(user_string):
-            """md5hash userid."""
-            return hashlib.md5(user_string).digest()[-4:]
-
-        md5hash_v = numpy.vectorize(md5hash, otypes=['S4'])
-        hashes = md5hash_v(result['user'])
-
-        user_day_lng_lat = numpy.empty(
-            hashes.size, dtype='datetime64[D],a4,f4,f4')
-        user_day_lng_lat['f0'] = result['date']
-        user_day_lng_lat['f1'] = hashes
-        user_day_lng_lat['f2'] = result['lng']
-        user_day_lng_lat['f3'] = result['lat']
-        # multiprocessing.Queue pickles the array. Pickling isn't perfect and
-        # it modifies the `datetime64` dtype metadata, causing a warning later.
-        # To avoid this we dump the array to a string before adding to queue.
-        numpy_array_queue.put(_numpy_dumps(user_day_lng_lat))
+        with open(csv_filepath, 'rb') as csv_file:
+            csv_file.seek(file_offset, 0)
+            chunk_bytes = csv_file.read(chunk_size)
+
+        user_day_lng_lat = photo_csv_parser.parse_photo_block(chunk_bytes)
+        block_path = os.path.join(block_dir, '%d.npy' % file_offset)
+        numpy.save(block_path, user_day_lng_lat)
+        numpy_array_queue.put(block_path)
     numpy_array_queue.put('STOP')
 
 
@@ -542,7 +1212,7 @@ def _file_len(file_path):
 
 def construct_userday_quadtree(
         initial_bounding_box, raw_photo_csv_table, cache_dir,
-        max_points_per_node):
+        max_points_per_node, n_build_workers=None):
     """Construct a spatial quadtree for fast querying of userday points.
 
     Args:
@@ -553,9 +1223,15 @@ def construct_userday_quadtree(
         max_points_per_node(int): maximum number of points to allow per node
             of the quadree.  A larger amount will cause the quadtree to
             subdivide.
+        n_build_workers (int): number of processes that build the quads at
+            ``GLOBAL_PARTITION_DEPTH`` of the quadtree in parallel.  If 1
+            the points are added to a single tree in this process.  Defaults
+            to the number of CPUs.
 
     Returns:
-        None
+        (pickle path, index path) tuple of the pickled quadtree and the
+        latest version of its flat index which can be opened with
+        ``out_of_core_quadtree.FlatQuadTree``.
     """
     LOGGER.info('hashing input file')
     start_time = time.time()
@@ -563,89 +1239,33 @@ def construct_userday_quadtree(
     csv_hash = _hashfile(raw_photo_csv_table, fast_hash=True)
 
     ooc_qt_picklefilename = os.path.join(cache_dir, csv_hash + '.pickle')
-    if os.path.isfile(ooc_qt_picklefilename):
-        return ooc_qt_picklefilename
+    ooc_qt_index_filename = os.path.join(cache_dir, csv_hash + '.qtindex')
+    if os.path.isfile(ooc_qt_index_filename):
+        # serve the newest version written by an incremental ingest
+        index_version_list = [
+            (_index_version(index_path), index_path)
+            for index_path in glob.glob(
+                os.path.join(cache_dir, csv_hash + '.v*.qtindex'))]
+        if index_version_list:
+            ooc_qt_index_filename = max(index_version_list)[1]
+        return ooc_qt_picklefilename, ooc_qt_index_filename
     else:
         LOGGER.info(
-            '%s not found, constructing quadtree', ooc_qt_picklefilename)
-        LOGGER.info('counting lines in input file')
-        total_lines = _file_len(raw_photo_csv_table)
-        LOGGER.info('%d lines', total_lines)
+            '%s not found, constructing quadtree', ooc_qt_index_filename)
         ooc_qt = out_of_core_quadtree.OutOfCoreQuadTree(
             initial_bounding_box, max_points_per_node, GLOBAL_DEPTH,
             cache_dir, pickle_filename=ooc_qt_picklefilename)
-
-        n_parse_processes = multiprocessing.cpu_count() - 1
-        if n_parse_processes < 1:
-            n_parse_processes = 1
-
-        block_offset_size_queue = multiprocessing.Queue(n_parse_processes * 2)
-        numpy_array_queue = multiprocessing.Queue(n_parse_processes * 2)
-
-        LOGGER.info('starting parsing processes')
-        for _ in range(n_parse_processes):
-            parse_input_csv_process = multiprocessing.Process(
-                target=_parse_input_csv, args=(
-                    block_offset_size_queue, raw_photo_csv_table,
-                    numpy_array_queue))
-            parse_input_csv_process.deamon = True
-            parse_input_csv_process.start()
-
-        # rush through file and determine reasonable offsets and blocks
-        def _populate_offset_queue(block_offset_size_queue):
-            csv_file = open(raw_photo_csv_table, 'rb')
-            csv_file.readline()  # skip the csv header
-            while True:
-                start = csv_file.tell()
-                csv_file.seek(BLOCKSIZE, 1)
-                line = csv_file.readline()  # skip to end of line
-                bounds = (start, csv_file.tell() - start)
-                block_offset_size_queue.put(bounds)
-                if not line:
-                    break
-            csv_file.close()
-            for _ in range(n_parse_processes):
-                block_offset_size_queue.put('STOP')
-
-        LOGGER.info('starting offset queue population thread')
-        populate_thread = threading.Thread(
-            target=_populate_offset_queue, args=(block_offset_size_queue,))
-        populate_thread.start()
-
-        LOGGER.info("add points to the quadtree as they are ready")
-        last_time = time.time()
-        start_time = last_time
-        n_points = 0
-
-        while True:
-            payload = numpy_array_queue.get()
-            # if the item is a 'STOP' sentinel, don't load as an array
-            if payload == 'STOP':
-                n_parse_processes -= 1
-                if n_parse_processes == 0:
-                    break
-                continue
-            else:
-                point_array = _numpy_loads(payload)
-
-            n_points += len(point_array)
-            ooc_qt.add_points(point_array, 0, point_array.size)
-            current_time = time.time()
-            time_elapsed = current_time - last_time
-            if time_elapsed > 5.0:
-                LOGGER.info(
-                    '%.2f%% complete, %d points skipped, %d nodes in qt in '
-                    'only %.2fs', n_points * 100.0 / total_lines,
-                    n_points - ooc_qt.n_points(), ooc_qt.n_nodes(),
-                    current_time-start_time)
-                last_time = time.time()
+        if n_build_workers is None:
+            n_build_workers = multiprocessing.cpu_count()
+        if n_build_workers > 1:
+            _build_partitioned_quadtree(
+                ooc_qt, raw_photo_csv_table, GLOBAL_PARTITION_DEPTH,
+                n_build_workers)
+        else:
+            _add_csv_points_to_quadtree(ooc_qt, raw_photo_csv_table, 0)
 
         # save quadtree to disk
         ooc_qt.flush()
-        LOGGER.info(
-            '100.00%% complete, %d points skipped, %d nodes in qt in '
-            'only %.2fs', n_points - ooc_qt.n_points(), ooc_qt.n_nodes(),
-            time.time()-start_time)
 
         quad_tree_shapefile_name = os.path.join(
             cache_dir, 'quad_tree_shape.shp')
@@ -655,11 +1275,441 @@ def construct_userday_quadtree(
         LOGGER.info("building quadtree shapefile overview")
         build_quadtree_shape(quad_tree_shapefile_name, ooc_qt, lat_lng_ref)
 
+    LOGGER.info('took %f seconds', (time.time() - start_time))
+    return ooc_qt_picklefilename, ooc_qt_index_filename
+
+
+def ingest_userday_quadtree(
+        ooc_qt_picklefilename, raw_photo_csv_table, start_offset=0,
+        oldest_version_in_use=None):
+    """Add new photo records to an existing userday quadtree.
+
+    The tree is loaded from its pickle, the new rows are parsed and added,
+    splitting nodes as needed, and a new version of its flat index is
+    written next to the previous one.  Extents of the node store freed while
+    adding the points are frozen, so earlier versions of the index stay
+    valid and can keep serving queries.  They're released by a later ingest
+    once no version that refers to them is in use.
+
+    The byte range of the csv file that was added is recorded next to the
+    pickle with a hash of the file up to the end of that range.  A later
+    ingest of the same file, or of the same file with rows appended,
+    resumes after the recorded range rather than adding its rows again, so
+    a server restarted with the same ``ingest_csv_path`` doesn't count them
+    twice.
+
+    Args:
+        ooc_qt_picklefilename (string): path to the pickled quadtree from
+            ``construct_userday_quadtree``.
+        raw_photo_csv_table (string): path to a csv file of photo records in
+            the same format as the one the quadtree was built from.
+        start_offset (int): byte offset of the first line of
+            `raw_photo_csv_table` to add.  If 0 the first line is a header
+            and is skipped, otherwise this must be the start of a line such
+            as the size of the file when its rows were last added.  Rows
+            from here on that an earlier ingest recorded are skipped.
+        oldest_version_in_use (int): oldest version of the flat index that
+            may still be read while or after this ingest runs.  Extents
+            frozen by earlier ingests are only reused if no version from
+            this one on refers to them.  If None, no earlier version is in
+            use and every frozen extent is reused.
+
+    Returns:
+        path to the new version of the quadtree's flat index, or to the
+        current version if every row was already added.
+    """
+    start_time = time.time()
+    with open(ooc_qt_picklefilename, 'rb') as qt_pickle_file:
+        ooc_qt = pickle.load(qt_pickle_file)
+    ingest_record_path = _ingest_record_path(ooc_qt_picklefilename)
+    ingest_record_list = _load_ingest_records(ingest_record_path)
+    # a row still being appended is left for the next ingest
+    end_offset = _complete_lines_size(raw_photo_csv_table)
+    start_offset = _ingested_offset(
+        ingest_record_list, raw_photo_csv_table, start_offset)
+    if start_offset >= end_offset:
+        LOGGER.info(
+            '%s was already ingested into %s', raw_photo_csv_table,
+            ooc_qt_picklefilename)
+        return ooc_qt.index_filename
+    LOGGER.info(
+        'ingesting %s from byte %d to %d into %s', raw_photo_csv_table,
+        start_offset, end_offset, ooc_qt_picklefilename)
+    # extents freed while writing version N are referenced only by versions
+    # before N
+    ooc_qt.node_data_manager.release_frozen_extents(oldest_version_in_use)
+    ooc_qt.node_data_manager.freeze_extents(ooc_qt.index_version + 1)
+    _add_csv_points_to_quadtree(
+        ooc_qt, raw_photo_csv_table, start_offset, end_offset=end_offset)
+    ooc_qt.new_index_version()
+    ooc_qt.flush()
+    ingest_record_list.append((
+        _hash_file_prefix(raw_photo_csv_table, end_offset), start_offset,
+        end_offset))
+    _save_ingest_records(ingest_record_path, ingest_record_list)
+    LOGGER.info(
+        'wrote %s in %.2fs', ooc_qt.index_filename, time.time() - start_time)
+    return ooc_qt.index_filename
+
+
+def _ingest_record_path(ooc_qt_picklefilename):
+    """Return the path of the record of csv rows ingested into a quadtree."""
+    return os.path.splitext(ooc_qt_picklefilename)[0] + '.ingested'
+
+
+def _load_ingest_records(ingest_record_path):
+    """Load the (csv hash, start offset, end offset) records of a quadtree.
+
+    Args:
+        ingest_record_path (string): path from ``_ingest_record_path``.
+
+    Returns:
+        list of records, empty if nothing was ingested yet.
+    """
+    if not os.path.exists(ingest_record_path):
+        return []
+    with open(ingest_record_path, 'rb') as ingest_record_file:
+        return pickle.load(ingest_record_file)
+
+
+def _save_ingest_records(ingest_record_path, ingest_record_list):
+    """Replace the ingest records of a quadtree in one step.
+
+    Args:
+        ingest_record_path (string): path from ``_ingest_record_path``.
+        ingest_record_list (list): (csv hash, start offset, end offset)
+            records to save.
+
+    Returns:
+        None
+    """
+    temp_record_path = ingest_record_path + '.tmp'
+    with open(temp_record_path, 'wb') as ingest_record_file:
+        pickle.dump(ingest_record_list, ingest_record_file)
+    os.replace(temp_record_path, ingest_record_path)
+
+
+def _ingested_offset(ingest_record_list, raw_photo_csv_table, start_offset):
+    """Return where to start adding the rows of a csv file.
+
+    Args:
+        ingest_record_list (list): (csv hash, start offset, end offset)
+            records of earlier ingests.
+        raw_photo_csv_table (string): path to the csv file to ingest.
+        start_offset (int): requested byte offset of the first row to add.
+
+    Returns:
+        `start_offset` moved past every recorded range that covers it whose
+        hash matches the file up to the end of the range.
+    """
+    file_size = os.path.getsize(raw_photo_csv_table)
+    prefix_hash_map = {}
+    for csv_hash, record_start, record_end in sorted(
+            ingest_record_list, key=lambda record: record[1]):
+        if (not record_start <= start_offset < record_end or
+                record_end > file_size):
+            continue
+        if record_end not in prefix_hash_map:
+            prefix_hash_map[record_end] = _hash_file_prefix(
+                raw_photo_csv_table, record_end)
+        if prefix_hash_map[record_end] == csv_hash:
+            start_offset = record_end
+    return start_offset
+
+
+def _hash_file_prefix(file_path, n_bytes, blocksize=2**20):
+    """Return the sha1 hex digest of the first `n_bytes` of a file."""
+    hasher = hashlib.sha1()
+    with open(file_path, 'rb') as file_to_hash:
+        while n_bytes > 0:
+            buf = file_to_hash.read(min(blocksize, n_bytes))
+            if not buf:
+                break
+            hasher.update(buf)
+            n_bytes -= len(buf)
+    return hasher.hexdigest()
+
+
+def _complete_lines_size(file_path, blocksize=2**16):
+    """Return the byte offset just past the last newline of a file."""
+    with open(file_path, 'rb') as csv_file:
+        csv_file.seek(0, os.SEEK_END)
+        block_end = csv_file.tell()
+        while block_end > 0:
+            block_start = max(0, block_end - blocksize)
+            csv_file.seek(block_start)
+            newline_index = csv_file.read(block_end - block_start).rfind(
+                b'\n')
+            if newline_index >= 0:
+                return block_start + newline_index + 1
+            block_end = block_start
+    return 0
+
+
+def _add_csv_points_to_quadtree(
+        ooc_qt, raw_photo_csv_table, start_offset, end_offset=None):
+    """Parse photo records from a csv file and add them to a quadtree.
+
+    Args:
+        ooc_qt (out_of_core_quadtree.OutOfCoreQuadTree): quadtree to add the
+            points to.
+        raw_photo_csv_table (string): path to a csv file of photo records.
+        start_offset (int): byte offset of the first line to parse, if 0 the
+            first line is a header and is skipped.
+        end_offset (int): byte offset of the end of the last line to parse,
+            if None the file is parsed to its end.
+
+    Returns:
+        None
+    """
+    LOGGER.info('counting lines in input file')
+    total_lines = _file_len(raw_photo_csv_table)
+    LOGGER.info('%d lines', total_lines)
+    n_points_in_qt = ooc_qt.n_points()
+
+    LOGGER.info("add points to the quadtree as they are ready")
+    last_time = time.time()
+    start_time = last_time
+    n_points = 0
+
+    for point_array in _iter_csv_point_blocks(
+            raw_photo_csv_table, start_offset, ooc_qt.quad_tree_storage_dir,
+            end_offset=end_offset):
+        n_points += len(point_array)
+        ooc_qt.add_points(point_array, 0, point_array.size)
+        current_time = time.time()
+        time_elapsed = current_time - last_time
+        if time_elapsed > 5.0:
+            LOGGER.info(
+                '%.2f%% complete, %d points skipped, %d nodes in qt in '
+                'only %.2fs', n_points * 100.0 / total_lines,
+                n_points_in_qt + n_points - ooc_qt.n_points(),
+                ooc_qt.n_nodes(), current_time-start_time)
+            last_time = time.time()
+
+    LOGGER.info(
+        '100.00%% complete, %d points skipped, %d nodes in qt in '
+        'only %.2fs', n_points_in_qt + n_points - ooc_qt.n_points(),
+        ooc_qt.n_nodes(), time.time()-start_time)
+
+
+def _iter_csv_point_blocks(
+        raw_photo_csv_table, start_offset, work_dir, end_offset=None):
+    """Parse photo records from a csv file in parallel blocks.
+
+    Args:
+        raw_photo_csv_table (string): path to a csv file of photo records.
+        start_offset (int): byte offset of the first line to parse, if 0 the
+            first line is a header and is skipped.
+        work_dir (string): path to a directory where the parsed blocks can
+            be temporarily stored.
+        end_offset (int): byte offset to stop parsing at, it must be the
+            end of a line.  If None the file is parsed to its end.
+
+    Yields:
+        structured arrays of (datetime, userhash, lng, lat) points in the
+        order they're parsed.  Each array is a copy-on-write map of a block
+        file that is removed once the block after it has been handed out,
+        so it can be sorted in place but must be copied to keep it.
+    """
+    n_parse_processes = multiprocessing.cpu_count() - 1
+    if n_parse_processes < 1:
+        n_parse_processes = 1
+
+    block_offset_size_queue = multiprocessing.Queue(n_parse_processes * 2)
+    numpy_array_queue = multiprocessing.Queue(n_parse_processes * 2)
+    block_dir = tempfile.mkdtemp(dir=work_dir)
+
+    LOGGER.info('starting parsing processes')
+    for _ in range(n_parse_processes):
+        parse_input_csv_process = multiprocessing.Process(
+            target=_parse_input_csv, args=(
+                block_offset_size_queue, raw_photo_csv_table,
+                numpy_array_queue, block_dir))
+        parse_input_csv_process.deamon = True
+        parse_input_csv_process.start()
+
+    # rush through file and determine reasonable offsets and blocks
+    def _populate_offset_queue(block_offset_size_queue):
+        csv_file = open(raw_photo_csv_table, 'rb')
+        if start_offset == 0:
+            csv_file.readline()  # skip the csv header
+        else:
+            csv_file.seek(start_offset)
+        while True:
+            start = csv_file.tell()
+            csv_file.seek(BLOCKSIZE, 1)
+            line = csv_file.readline()  # skip to end of line
+            end = csv_file.tell()
+            if end_offset is not None and end >= end_offset:
+                # rows appended after end_offset are left for a later ingest
+                end = end_offset
+                line = None
+            block_offset_size_queue.put((start, end - start))
+            if not line:
+                break
+        csv_file.close()
+        for _ in range(n_parse_processes):
+            block_offset_size_queue.put('STOP')
+
+    LOGGER.info('starting offset queue population thread')
+    populate_thread = threading.Thread(
+        target=_populate_offset_queue, args=(block_offset_size_queue,))
+    populate_thread.start()
+
+    previous_payload = None
+    while True:
+        payload = numpy_array_queue.get()
+        # if the item is a 'STOP' sentinel, don't load as an array
+        if payload == 'STOP':
+            n_parse_processes -= 1
+            if n_parse_processes == 0:
+                break
+            continue
+        # copy-on-write since add_points sorts the points in place
+        yield numpy.load(payload, mmap_mode='c')
+        # the caller has let go of the previous block's map by now
+        if previous_payload is not None:
+            os.remove(previous_payload)
+        previous_payload = payload
+
     populate_thread.join()
     parse_input_csv_process.join()
+    shutil.rmtree(block_dir, ignore_errors=True)
 
-    LOGGER.info('took %f seconds', (time.time() - start_time))
-    return ooc_qt_picklefilename
+
+def _build_partitioned_quadtree(
+        ooc_qt, raw_photo_csv_table, partition_depth, n_build_workers):
+    """Build a quadtree from a csv file by building partitions in parallel.
+
+    The tree is split into the ``4**partition_depth`` quads at
+    `partition_depth`, the parsed points are bucketed to a file per quad,
+    then each quad's subtree is built from its file in a pool of processes
+    with a node store of its own.  The subtrees are grafted back into the
+    tree, which ends up with the same leaves as if every point were added
+    to it directly, except that it's always split to `partition_depth`.
+
+    Args:
+        ooc_qt (out_of_core_quadtree.OutOfCoreQuadTree): an empty quadtree
+            to add the points to.
+        raw_photo_csv_table (string): path to a csv file of photo records.
+        partition_depth (int): depth of the quads to build in parallel.
+        n_build_workers (int): number of processes that build partitions.
+
+    Returns:
+        None
+    """
+    start_time = time.time()
+    partition_list = ooc_qt.split_to_depth(partition_depth)
+    partition_dir = tempfile.mkdtemp(dir=ooc_qt.quad_tree_storage_dir)
+    partition_path_list = [
+        os.path.join(partition_dir, '%d.points' % partition_index)
+        for partition_index in range(len(partition_list))]
+    partition_size_list = [0] * len(partition_list)
+
+    LOGGER.info(
+        'bucketing points into %d partitions', len(partition_list))
+    partition_file_list = [
+        open(partition_path, 'wb') for partition_path in partition_path_list]
+    try:
+        for point_array in _iter_csv_point_blocks(
+                raw_photo_csv_table, 0, partition_dir):
+            point_partition_index = ooc_qt.partition_points(
+                point_array, partition_depth)
+            sort_index = numpy.argsort(point_partition_index, kind='stable')
+            block_partition_sizes = numpy.bincount(
+                point_partition_index, minlength=len(partition_list))
+            sorted_point_array = point_array[sort_index]
+            block_offset = 0
+            for partition_index, block_partition_size in enumerate(
+                    block_partition_sizes):
+                if block_partition_size == 0:
+                    continue
+                sorted_point_array[
+                    block_offset:block_offset+block_partition_size].tofile(
+                        partition_file_list[partition_index])
+                block_offset += block_partition_size
+                partition_size_list[partition_index] += int(
+                    block_partition_size)
+    finally:
+        for partition_file in partition_file_list:
+            partition_file.close()
+    LOGGER.info(
+        'bucketed %d points in %.2fs', sum(partition_size_list),
+        time.time() - start_time)
+
+    # the largest partitions are started first so they don't finish last
+    build_args_list = []
+    for partition_index in sorted(
+            range(len(partition_list)),
+            key=lambda index: -partition_size_list[index]):
+        if partition_size_list[partition_index] == 0:
+            continue
+        partition = partition_list[partition_index]
+        build_args_list.append((
+            partition.bounding_box, ooc_qt.max_points_per_node,
+            ooc_qt.max_node_depth, partition.node_depth,
+            partition_path_list[partition_index],
+            os.path.join(partition_dir, '%d.pickle' % partition_index)))
+
+    build_pool = multiprocessing.Pool(
+        max(1, min(n_build_workers, len(build_args_list))))
+    try:
+        for subtree_pickle_path in build_pool.imap_unordered(
+                _build_partition_subtree, build_args_list):
+            with open(subtree_pickle_path, 'rb') as subtree_pickle_file:
+                subtree = pickle.load(subtree_pickle_file)
+            # grafting points the subtree at the tree's node store, its own
+            # store is closed so its files can be removed with the
+            # partitions
+            subtree_data_manager = subtree.node_data_manager
+            ooc_qt.graft_subtree(subtree)
+            subtree_data_manager.close()
+            subtree = None
+            subtree_data_manager = None
+            LOGGER.info(
+                'grafted %s, %d points in qt in %.2fs',
+                os.path.basename(subtree_pickle_path), ooc_qt.n_points(),
+                time.time() - start_time)
+    finally:
+        build_pool.close()
+        build_pool.join()
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    LOGGER.info(
+        '%d points in %d nodes in qt in %.2fs', ooc_qt.n_points(),
+        ooc_qt.n_nodes(), time.time() - start_time)
+
+
+def _build_partition_subtree(build_args):
+    """Build and pickle the subtree of one partition of a quadtree.
+
+    Args:
+        build_args (tuple): (bounding box, max points per node, max node
+            depth, node depth, points path, pickle path) tuple where points
+            path is a file of the partition's points as raw
+            ``out_of_core_quadtree._ARRAY_TUPLE_TYPE`` records and the
+            subtree and its node store are written next to pickle path.
+
+    Returns:
+        path to the pickled subtree.
+    """
+    (bounding_box, max_points_per_node, max_node_depth, node_depth,
+     points_path, subtree_pickle_path) = build_args
+    subtree = out_of_core_quadtree.OutOfCoreQuadTree(
+        bounding_box, max_points_per_node, max_node_depth,
+        os.path.dirname(subtree_pickle_path), node_depth=node_depth,
+        pickle_filename=subtree_pickle_path)
+    point_dtype = out_of_core_quadtree._ARRAY_TUPLE_TYPE
+    n_points = os.path.getsize(points_path) // point_dtype.itemsize
+    for block_offset in range(0, n_points, PARTITION_POINTS_PER_ADD):
+        point_array = numpy.fromfile(
+            points_path, dtype=point_dtype,
+            count=min(PARTITION_POINTS_PER_ADD, n_points - block_offset),
+            offset=block_offset * point_dtype.itemsize)
+        subtree.add_points(point_array, 0, point_array.size)
+    os.remove(points_path)
+    subtree.flush()
+    return subtree_pickle_path
 
 
 def build_quadtree_shape(
@@ -692,84 +1742,215 @@ def build_quadtree_shape(
     quadtree.build_node_shapes(polygon_layer)
 
 
-def _calc_poly_pud(
-        local_qt_pickle_path, aoi_path, date_range, poly_test_queue,
-        pud_poly_feature_queue):
-    """Load a pre-calculated quadtree and test incoming polygons against it.
+def _calc_poly_pud(polytest_job_queue, polytest_result_queue):
+    """Test incoming polygons against pre-calculated quadtrees.
+
+    This is the loop of a long-lived worker process that serves every
+    request.  The jobs of one request usually arrive together, so the local
+    quadtree and AOI of the last job are kept open for the next.
+
+    Args:
+        polytest_job_queue (multiprocessing.Queue): queue of incoming
+            (request_id, local_qt_index_path, aoi_path, date_range, poly_id)
+            jobs where ``local_qt_index_path`` is the path to the flat index
+            of a local quadtree, ``aoi_path`` is the path to the AOI that
+            contains polygon ``poly_id``, and ``date_range`` is a
+            numpy.datetime64 tuple of inclusive start and stop dates.  The
+            worker exits on 'STOP'.
+        polytest_result_queue (multiprocessing.Queue): queue to put outgoing
+            (request_id, poly_id, result) tuples, one per job.  ``result``
+            is a (pud averages, monthly pud counts) tuple, None if the
+            polygon couldn't be read, or a RuntimeError describing an
+            exception raised by the test.
 
-    Updates polygons with a PUD and send back out on the queue.
+    Returns:
+        None
+    """
+    open_job_paths = None
+    local_qt = None
+    aoi_vector = None
+    aoi_layer = None
+    for (request_id, local_qt_index_path, aoi_path, date_range,
+         poly_id) in iter(polytest_job_queue.get, 'STOP'):
+        try:
+            if open_job_paths != (local_qt_index_path, aoi_path):
+                LOGGER.info(
+                    'in a _calc_poly_process, opening %s',
+                    local_qt_index_path)
+                local_qt = out_of_core_quadtree.FlatQuadTree(
+                    local_qt_index_path)
+                aoi_layer = None
+                aoi_vector = gdal.OpenEx(aoi_path, gdal.OF_VECTOR)
+                if aoi_vector:
+                    aoi_layer = aoi_vector.GetLayer()
+                open_job_paths = (local_qt_index_path, aoi_path)
+            pud_result = _calc_single_poly_pud(
+                local_qt, aoi_layer, poly_id, date_range)
+        except Exception as error:  # pylint: disable=broad-except
+            LOGGER.exception('error testing polygon %s', poly_id)
+            # not every exception pickles, so pass a description back
+            pud_result = RuntimeError(
+                'testing polygon %s raised %r' % (poly_id, error))
+        polytest_result_queue.put((request_id, poly_id, pud_result))
+
+
+def _calc_single_poly_pud(local_qt, aoi_layer, poly_id, date_range):
+    """Calculate the PUD of one AOI polygon.
 
     Args:
-        local_qt_pickle_path (string): path to pickled local quadtree
-        aoi_path (string): path to AOI that contains polygon features
+        local_qt (out_of_core_quadtree.FlatQuadTree): quadtree of the points
+            under the AOI.
+        aoi_layer (ogr.Layer): layer of the AOI polygons, None if the AOI
+            couldn't be opened.
+        poly_id (int): FID of the polygon in `aoi_layer`.
         date_range (tuple): numpy.datetime64 tuple indicating inclusive start
             and stop dates
-        poly_test_queue (multiprocessing.Queue): queue with incoming
-            ogr.Features
-        pud_poly_feature_queue (multiprocessing.Queue): queue to put outgoing
-            (fid, pud) tuple
 
     Returns:
-        None
+        (pud averages, monthly pud counts) tuple from ``_calc_pud_counts``
+        or None if the polygon couldn't be read.
     """
-    start_time = time.time()
-    LOGGER.info('in a _calc_poly_process, loading %s', local_qt_pickle_path)
-    local_qt = pickle.load(open(local_qt_pickle_path, 'rb'))
-    LOGGER.info('local qt load took %.2fs', time.time() - start_time)
+    try:
+        poly_feat = aoi_layer.GetFeature(poly_id)
+        poly_geom = poly_feat.GetGeometryRef()
+        poly_wkt = poly_geom.ExportToWkt()
+    except AttributeError as error:
+        LOGGER.warning('skipping feature that raised: %s', str(error))
+        return None
+    try:
+        shapely_polygon = shapely.wkt.loads(poly_wkt)
+    except Exception:  # pylint: disable=broad-except
+        # We often get weird corrupt data, this lets us tolerate it
+        LOGGER.warning('error parsing poly, skipping')
+        return None
 
-    aoi_vector = gdal.OpenEx(aoi_path, gdal.OF_VECTOR)
-    if aoi_vector:
-        aoi_layer = aoi_vector.GetLayer()
+    poly_points = local_qt.get_intersecting_points_in_polygon(
+        shapely_polygon)
+    return _calc_pud_counts(poly_points, date_range)
 
-        for poly_id in iter(poly_test_queue.get, 'STOP'):
-            try:
-                poly_feat = aoi_layer.GetFeature(poly_id)
-                poly_geom = poly_feat.GetGeometryRef()
-                poly_wkt = poly_geom.ExportToWkt()
-            except AttributeError as error:
-                LOGGER.warning('skipping feature that raised: %s', str(error))
-                continue
-            try:
-                shapely_polygon = shapely.wkt.loads(poly_wkt)
-            except Exception:  # pylint: disable=broad-except
-                # We often get weird corrupt data, this lets us tolerate it
-                LOGGER.warning('error parsing poly, skipping')
-                continue
-
-            poly_points = local_qt.get_intersecting_points_in_polygon(
-                shapely_polygon)
-            pud_set = set()
-            pud_monthly_set = collections.defaultdict(set)
-
-            for point_datetime, user_hash, _, _ in poly_points:
-                if date_range[0] <= point_datetime <= date_range[1]:
-                    timetuple = point_datetime.tolist().timetuple()
-
-                    year = str(timetuple.tm_year)
-                    month = str(timetuple.tm_mon)
-                    day = str(timetuple.tm_mday)
-                    pud_hash = str(user_hash) + '%s-%s-%s' % (year, month, day)
-                    pud_set.add(pud_hash)
-                    pud_monthly_set[month].add(pud_hash)
-                    pud_monthly_set["%s-%s" % (year, month)].add(pud_hash)
-
-            # calculate the number of years and months between the max/min dates
-            # index 0 is annual and 1-12 are the months
-            pud_averages = [0.0] * 13
-            n_years = (
-                date_range[1].tolist().timetuple().tm_year -
-                date_range[0].tolist().timetuple().tm_year + 1)
-            pud_averages[0] = len(pud_set) / float(n_years)
-            for month_id in range(1, 13):
-                monthly_pud_set = pud_monthly_set[str(month_id)]
-                pud_averages[month_id] = (
-                    len(monthly_pud_set) / float(n_years))
-
-            pud_poly_feature_queue.put((poly_id, pud_averages, pud_monthly_set))
-    pud_poly_feature_queue.put('STOP')
+
+def _calc_pud_counts(point_array, date_range):
+    """Count the distinct user days of points in a date range.
+
+    A user day is a unique (user hash, day) pair.  These are packed into
+    single uint64 keys so the distinct counts can be taken with one
+    ``numpy.unique`` rather than by building sets of strings per point.
+
+    Args:
+        point_array (numpy.ndarray): structured array of
+            (datetime64[D], user hash, x_coord, y_coord) points.
+        date_range (tuple): numpy.datetime64 tuple indicating inclusive start
+            and stop dates
+
+    Returns:
+        (pud_averages, pud_monthly_counts) where ``pud_averages`` is a list
+        whose index 0 is the annual average PUD and indexes 1-12 are the
+        average PUD of each calendar month, and ``pud_monthly_counts`` is a
+        dict mapping "year-month" strings to the PUD in that month.
+    """
+    date_mask = (
+        (point_array['f0'] >= date_range[0]) &
+        (point_array['f0'] <= date_range[1]))
+    user_hash_array = numpy.ascontiguousarray(
+        point_array['f1'][date_mask]).view(numpy.uint32)
+    day_offset_array = (
+        point_array['f0'][date_mask] - date_range[0]).astype(numpy.uint64)
+    user_day_keys = numpy.unique(
+        (user_hash_array.astype(numpy.uint64) << numpy.uint64(32)) |
+        day_offset_array)
+
+    # recover the day of each distinct user day and count it per month
+    user_days = date_range[0] + (
+        user_day_keys & numpy.uint64(0xffffffff)).astype(numpy.int64)
+    months_since_epoch = user_days.astype('datetime64[M]').astype(numpy.int64)
+    month_counts = numpy.bincount(months_since_epoch % 12 + 1, minlength=13)
+
+    # calculate the number of years and months between the max/min dates
+    # index 0 is annual and 1-12 are the months
+    n_years = (
+        date_range[1].tolist().timetuple().tm_year -
+        date_range[0].tolist().timetuple().tm_year + 1)
+    pud_averages = [0.0] * 13
+    pud_averages[0] = user_day_keys.size / float(n_years)
+    for month_id in range(1, 13):
+        pud_averages[month_id] = month_counts[month_id] / float(n_years)
+
+    unique_months, unique_month_counts = numpy.unique(
+        months_since_epoch, return_counts=True)
+    pud_monthly_counts = dict(
+        ('%d-%d' % (month // 12 + 1970, month % 12 + 1), int(count))
+        for month, count in zip(unique_months, unique_month_counts))
+    return pud_averages, pud_monthly_counts
+
+
+def _hash_aoi_request(aoi_path, date_range, out_vector_filename, version):
+    """Hash the parts of an AOI request that determine its result archive.
+
+    The geometry and attributes of every feature are hashed rather than the
+    uploaded archive so a re-zipped but otherwise identical AOI is still a
+    cache hit.
+
+    Args:
+        aoi_path (string): path to the AOI vector.
+        date_range (tuple): numpy.datetime64 tuple indicating inclusive start
+            and stop dates
+        out_vector_filename (string): base filename of the output vector.
+        version (string): version string of the server and its point data.
+
+    Returns:
+        sha1 hex digest identifying the request.
+    """
+    hasher = hashlib.sha1()
+    for request_part in (version, out_vector_filename) + tuple(
+            str(date) for date in date_range):
+        hasher.update(request_part.encode('utf-8') + b'\0')
+    aoi_vector = gdal.OpenEx(aoi_path, gdal.OF_VECTOR)
+    aoi_layer = aoi_vector.GetLayer()
+    aoi_ref = aoi_layer.GetSpatialRef()
+    if aoi_ref is not None:
+        hasher.update(aoi_ref.ExportToWkt().encode('utf-8'))
+    for poly_feat in aoi_layer:
+        hasher.update(str(poly_feat.GetFID()).encode('utf-8'))
+        hasher.update(repr(sorted(poly_feat.items().items())).encode('utf-8'))
+        poly_geom = poly_feat.GetGeometryRef()
+        if poly_geom is not None:
+            hasher.update(poly_geom.ExportToWkb())
     aoi_layer = None
-    gdal.Dataset.__swig_destroy__(aoi_vector)
     aoi_vector = None
+    return hasher.hexdigest()
+
+
+def _hash_aoi_polygons(aoi_layer, date_range, version):
+    """Hash each polygon of an AOI by the parts that determine its PUD.
+
+    Args:
+        aoi_layer (ogr.Layer): layer of the AOI polygons, its reading is
+            reset after hashing.
+        date_range (tuple): numpy.datetime64 tuple indicating inclusive start
+            and stop dates
+        version (string): version string of the server and its point data.
+
+    Returns:
+        dict mapping the FID of each feature with a geometry to the sha1 hex
+        digest identifying its result.
+    """
+    base_hasher = hashlib.sha1()
+    for request_part in (version,) + tuple(str(date) for date in date_range):
+        base_hasher.update(request_part.encode('utf-8') + b'\0')
+    aoi_ref = aoi_layer.GetSpatialRef()
+    if aoi_ref is not None:
+        base_hasher.update(aoi_ref.ExportToWkt().encode('utf-8'))
+
+    polygon_key_map = {}
+    for poly_feat in aoi_layer:
+        poly_geom = poly_feat.GetGeometryRef()
+        if poly_geom is None:
+            continue
+        hasher = base_hasher.copy()
+        hasher.update(poly_geom.ExportToWkb())
+        polygon_key_map[poly_feat.GetFID()] = hasher.hexdigest()
+    aoi_layer.ResetReading()
+    return polygon_key_map
 
 
 def execute(args):
@@ -802,6 +1983,26 @@ def execute(args):
         args['max_year'] (int): maximum year allowed to be queries by user
         args['min_year'] (int): minimum valid year allowed to be queried by
             user
+        args['result_cache_max_bytes'] (int): (optional) maximum total size
+            in bytes of cached result archives.
+        args['result_cache_max_age'] (float): (optional) maximum age in
+            seconds of a cached result.
+        args['n_polytest_workers'] (int): (optional) number of processes
+            that test AOI polygons, defaults to the number of CPUs.
+        args['max_concurrent_requests'] (int): (optional) maximum number of
+            requests to aggregate points for at once.
+        args['max_queued_jobs'] (int): (optional) maximum number of
+            submitted jobs that can wait to run.
+        args['n_build_workers'] (int): (optional) number of processes that
+            build the global quadtree, defaults to the number of CPUs.
+        args['ingest_csv_path'] (string): (optional) path to a csv file of
+            new photo records to add to the global quadtree.  They're added
+            in the background while the server answers requests from the
+            existing quadtree.
+        args['ingest_start_offset'] (int): (optional) byte offset of the
+            first line to add from `args['ingest_csv_path']`, defaults to 0
+            which skips the file's header.  Rows an earlier start already
+            added are skipped, see ``ingest_userday_quadtree``.
 
     Returns:
         Never returns
@@ -810,13 +2011,42 @@ def execute(args):
     max_points_per_node = GLOBAL_MAX_POINTS_PER_NODE
     if 'max_points_per_node' in args:
         max_points_per_node = args['max_points_per_node']
-
-    uri = daemon.register(
-        RecModel(args['raw_csv_point_data_path'], args['min_year'],
-                 args['max_year'], args['cache_workspace'],
-                 max_points_per_node=max_points_per_node),
-        'natcap.invest.recreation')
+    result_cache_max_bytes = RESULT_CACHE_MAX_BYTES
+    if 'result_cache_max_bytes' in args:
+        result_cache_max_bytes = int(args['result_cache_max_bytes'])
+    result_cache_max_age = RESULT_CACHE_MAX_AGE
+    if 'result_cache_max_age' in args:
+        result_cache_max_age = float(args['result_cache_max_age'])
+    n_polytest_workers = None
+    if 'n_polytest_workers' in args:
+        n_polytest_workers = int(args['n_polytest_workers'])
+    max_concurrent_requests = MAX_CONCURRENT_REQUESTS
+    if 'max_concurrent_requests' in args:
+        max_concurrent_requests = int(args['max_concurrent_requests'])
+    max_queued_jobs = MAX_QUEUED_JOBS
+    if 'max_queued_jobs' in args:
+        max_queued_jobs = int(args['max_queued_jobs'])
+    n_build_workers = None
+    if 'n_build_workers' in args:
+        n_build_workers = int(args['n_build_workers'])
+
+    rec_model = RecModel(
+        args['raw_csv_point_data_path'], args['min_year'], args['max_year'],
+        args['cache_workspace'], max_points_per_node=max_points_per_node,
+        result_cache_max_bytes=result_cache_max_bytes,
+        result_cache_max_age=result_cache_max_age,
+        n_polytest_workers=n_polytest_workers,
+        max_concurrent_requests=max_concurrent_requests,
+        max_queued_jobs=max_queued_jobs, n_build_workers=n_build_workers)
+    uri = daemon.register(rec_model, 'natcap.invest.recreation')
     LOGGER.info("natcap.invest.recreation ready. Object uri = %s", uri)
+    if 'ingest_csv_path' in args:
+        ingest_thread = threading.Thread(
+            target=rec_model._ingest_photo_csv, args=(
+                args['ingest_csv_path'],
+                int(args.get('ingest_start_offset', 0))))
+        ingest_thread.daemon = True
+        ingest_thread.start()
     daemon.requestLoop()
 
 
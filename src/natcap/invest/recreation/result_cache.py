@@ -0,0 +1,209 @@
+"""Recreation server result cache module."""
+
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from .. import utils
+
+
+LOGGER = logging.getLogger('natcap.invest.recmodel_server.result_cache')
+
+
+class ResultCache(object):
+    """Disk cache of recreation server results.
+
+    Two levels are cached.  Whole request results are stored as the zipped
+    result archive keyed by a hash of the request, so a repeated request can
+    return the archive immediately.  Individual polygon results are stored
+    as rows in a sqlite database keyed by a hash of the polygon so
+    overlapping AOIs can reuse earlier polygon counts.
+
+    Entries older than ``max_age`` seconds are evicted, and the oldest
+    archives are evicted once their total size exceeds ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir, max_bytes, max_age):
+        """Create a result cache.
+
+        Args:
+            cache_dir (string): path to a directory to store cached results
+                in.  Created if it does not exist.
+            max_bytes (int): maximum total size in bytes of the cached
+                result archives.
+            max_age (float): maximum age in seconds of any cached result.
+
+        Returns:
+            None
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.polygon_db_path = os.path.join(cache_dir, 'polygon_cache.db')
+        utils.make_directories([cache_dir])
+        # Pyro serves requests on several threads, this guards the archives
+        self._lock = threading.Lock()
+        db_connection = self._connect()
+        with db_connection:
+            db_connection.execute(
+                """CREATE TABLE IF NOT EXISTS polygon_table
+                (polygon_key TEXT PRIMARY KEY, pud_averages TEXT,
+                 pud_monthly_counts TEXT, create_time REAL)""")
+        db_connection.close()
+
+    def _connect(self):
+        """Return a new connection to the polygon database.
+
+        A connection is made per call because sqlite connections can't be
+        shared across the server's request threads.
+        """
+        return sqlite3.connect(self.polygon_db_path)
+
+    def _result_path(self, result_key):
+        """Return the path of the cached archive for `result_key`."""
+        return os.path.join(self.cache_dir, '%s.zip' % result_key)
+
+    def get_result(self, result_key):
+        """Return the cached archive for a request.
+
+        Args:
+            result_key (string): hash that identifies the request.
+
+        Returns:
+            bytes of the cached result archive or None if not cached.
+        """
+        result_path = self._result_path(result_key)
+        with self._lock:
+            if not os.path.isfile(result_path):
+                return None
+            if time.time() - os.path.getmtime(result_path) > self.max_age:
+                os.remove(result_path)
+                return None
+            with open(result_path, 'rb') as result_file:
+                return result_file.read()
+
+    def copy_result(self, result_key, target_path):
+        """Copy the cached archive for a request to a file.
+
+        Args:
+            result_key (string): hash that identifies the request.
+            target_path (string): path to copy the archive to.
+
+        Returns:
+            True if the result was cached and copied, False otherwise.
+        """
+        result_path = self._result_path(result_key)
+        with self._lock:
+            if not os.path.isfile(result_path):
+                return False
+            if time.time() - os.path.getmtime(result_path) > self.max_age:
+                os.remove(result_path)
+                return False
+            shutil.copyfile(result_path, target_path)
+            return True
+
+    def put_result(self, result_key, result_archive_path):
+        """Store the result archive of a request.
+
+        Args:
+            result_key (string): hash that identifies the request.
+            result_archive_path (string): path to the result archive, it is
+                copied into the cache.
+
+        Returns:
+            None
+        """
+        result_path = self._result_path(result_key)
+        tmp_result_path = result_path + '.tmp%d' % threading.get_ident()
+        shutil.copyfile(result_archive_path, tmp_result_path)
+        with self._lock:
+            os.replace(tmp_result_path, result_path)
+            self._evict()
+
+    def get_polygon_results(self, polygon_key_list):
+        """Return the cached results of polygons.
+
+        Args:
+            polygon_key_list (list): list of polygon hashes to look up.
+
+        Returns:
+            dict mapping the keys in `polygon_key_list` that are cached to
+            (pud_averages, pud_monthly_counts) tuples.
+        """
+        min_create_time = time.time() - self.max_age
+        polygon_results = {}
+        db_connection = self._connect()
+        with db_connection:
+            # look up in batches to stay under sqlite's variable limit
+            for index in range(0, len(polygon_key_list), 500):
+                key_batch = polygon_key_list[index:index+500]
+                for polygon_key, pud_averages, pud_monthly_counts in (
+                        db_connection.execute(
+                            """SELECT polygon_key, pud_averages,
+                                pud_monthly_counts FROM polygon_table
+                            WHERE create_time >= ? AND polygon_key IN (%s)
+                            """ % ','.join(['?'] * len(key_batch)),
+                            [min_create_time] + key_batch)):
+                    polygon_results[polygon_key] = (
+                        json.loads(pud_averages),
+                        json.loads(pud_monthly_counts))
+        db_connection.close()
+        return polygon_results
+
+    def put_polygon_results(self, polygon_result_list):
+        """Store the results of polygons.
+
+        Args:
+            polygon_result_list (list): list of (polygon_key, pud_averages,
+                pud_monthly_counts) tuples.
+
+        Returns:
+            None
+        """
+        create_time = time.time()
+        db_connection = self._connect()
+        with db_connection:
+            db_connection.executemany(
+                """INSERT OR REPLACE INTO polygon_table
+                    (polygon_key, pud_averages, pud_monthly_counts,
+                     create_time)
+                VALUES (?,?,?,?)""",
+                [(polygon_key, json.dumps(pud_averages),
+                  json.dumps(pud_monthly_counts), create_time)
+                 for polygon_key, pud_averages, pud_monthly_counts in
+                 polygon_result_list])
+        db_connection.close()
+
+    def _evict(self):
+        """Remove expired entries and the oldest archives over max_bytes."""
+        min_create_time = time.time() - self.max_age
+        db_connection = self._connect()
+        with db_connection:
+            db_connection.execute(
+                "DELETE FROM polygon_table WHERE create_time < ?",
+                [min_create_time])
+        db_connection.close()
+
+        result_list = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.zip'):
+                continue
+            result_path = os.path.join(self.cache_dir, filename)
+            result_stat = os.stat(result_path)
+            if result_stat.st_mtime < min_create_time:
+                os.remove(result_path)
+                continue
+            result_list.append(
+                (result_stat.st_mtime, result_stat.st_size, result_path))
+
+        total_bytes = sum(result_size for _, result_size, _ in result_list)
+        for _, result_size, result_path in sorted(result_list):
+            if total_bytes <= self.max_bytes:
+                break
+            LOGGER.info('evicting %s from result cache', result_path)
+            os.remove(result_path)
+            total_bytes -= result_size
@@ -0,0 +1,127 @@
+"""Bulk writer of attribute columns to recreation result vectors."""
+
+import logging
+import math
+import os
+
+import numpy
+from osgeo import gdal
+from osgeo import ogr
+
+
+LOGGER = logging.getLogger(
+    'natcap.invest.recreation.vector_field_writer')
+
+# vector formats that can be written, by file extension
+_DRIVER_NAME_LOOKUP = {
+    '.gpkg': 'GPKG',
+    '.shp': 'ESRI Shapefile',
+}
+
+
+def write_vector_fields(
+        base_vector_path, target_vector_path, fid_array, field_list,
+        keep_base_fields=True):
+    """Copy a vector and add columns of values as fields.
+
+    The target is created in a single pass over the base features inside
+    one transaction rather than copying the vector and then looking up and
+    rewriting each feature once per field.
+
+    Args:
+        base_vector_path (string): path to a single layer vector to copy.
+        target_vector_path (string): path to the vector to create, it is
+            overwritten if it exists.  Written as a GeoPackage if the
+            extension is ``.gpkg`` and as an ESRI Shapefile otherwise.
+        fid_array (numpy.ndarray): FIDs of base features, one for each
+            row of the columns in ``field_list``.  Features not in this
+            array are copied with the new fields unset.
+        field_list (list): list of (field_name, value_array) tuples in the
+            order the fields are created.  Each ``value_array`` is parallel
+            to ``fid_array`` and is written as a real field.  NaN values
+            leave the field unset.
+        keep_base_fields (bool): if True the fields of the base vector are
+            copied, except for those with the same name as a new field.
+            Otherwise the target has only the new fields.
+
+    Returns:
+        None
+
+    """
+    driver_name = _DRIVER_NAME_LOOKUP.get(
+        os.path.splitext(target_vector_path)[1].lower(), 'ESRI Shapefile')
+    driver = gdal.GetDriverByName(driver_name)
+    if os.path.exists(target_vector_path):
+        driver.Delete(target_vector_path)
+
+    base_vector = gdal.OpenEx(base_vector_path, gdal.OF_VECTOR)
+    base_layer = base_vector.GetLayer()
+    base_layer_defn = base_layer.GetLayerDefn()
+
+    target_vector = driver.Create(
+        target_vector_path, 0, 0, 0, gdal.GDT_Unknown)
+    target_layer = target_vector.CreateLayer(
+        os.path.splitext(os.path.basename(target_vector_path))[0],
+        base_layer.GetSpatialRef(), base_layer.GetGeomType())
+
+    # map each base field to its index in the target, -1 to drop it
+    new_field_name_set = set(
+        [field_name.lower() for field_name, _ in field_list])
+    base_field_map = []
+    for base_field_index in range(base_layer_defn.GetFieldCount()):
+        base_field_defn = base_layer_defn.GetFieldDefn(base_field_index)
+        if (keep_base_fields and base_field_defn.GetName().lower() not in
+                new_field_name_set):
+            target_layer.CreateField(base_field_defn)
+            base_field_map.append(
+                target_layer.GetLayerDefn().GetFieldCount() - 1)
+        else:
+            base_field_map.append(-1)
+
+    new_field_index_list = []
+    for field_name, _ in field_list:
+        field_defn = ogr.FieldDefn(str(field_name), ogr.OFTReal)
+        field_defn.SetWidth(24)
+        field_defn.SetPrecision(11)
+        target_layer.CreateField(field_defn)
+        new_field_index_list.append(
+            target_layer.GetLayerDefn().GetFieldCount() - 1)
+    target_layer_defn = target_layer.GetLayerDefn()
+
+    # look up each feature's row once instead of once per field
+    row_lookup = dict(zip(
+        numpy.asarray(fid_array, dtype=numpy.int64).tolist(),
+        range(len(fid_array))))
+    if field_list:
+        value_rows = numpy.column_stack([
+            numpy.asarray(value_array, dtype=numpy.float64)
+            for _, value_array in field_list]).tolist()
+    else:
+        value_rows = [[]] * len(fid_array)
+    # a GeoPackage numbers features from 1, so keep the base FIDs explicitly
+    preserve_fid = driver_name != 'ESRI Shapefile'
+
+    LOGGER.info(
+        'writing %d fields to %s', len(field_list),
+        os.path.basename(target_vector_path))
+    target_layer.StartTransaction()
+    for base_feature in base_layer:
+        target_feature = ogr.Feature(target_layer_defn)
+        target_feature.SetFromWithMap(base_feature, True, base_field_map)
+        if preserve_fid:
+            target_feature.SetFID(base_feature.GetFID())
+        row_index = row_lookup.get(base_feature.GetFID())
+        if row_index is not None:
+            for field_index, value in zip(
+                    new_field_index_list, value_rows[row_index]):
+                if not math.isnan(value):
+                    target_feature.SetField(field_index, value)
+        target_layer.CreateFeature(target_feature)
+        target_feature = None
+    target_layer.CommitTransaction()
+
+    target_layer = None
+    target_vector.FlushCache()
+    target_vector = None
+    base_layer = None
+    base_vector = None
@@ -8,6 +8,7 @@ import pygeoprocessing.routing
 import taskgraph
 import numpy
 
+from . import hydrology_cache
 from . import utils
 from . import validation
 
@@ -112,15 +113,15 @@ _DOWNSTREAM_DISTANCE_FILE_PATTERN = 'downstream_distance%s.tif'
 
 _ROUTING_FUNCS = {
     'D8': {
-        'flow_accumulation': pygeoprocessing.routing.flow_accumulation_d8,
-        'flow_direction': pygeoprocessing.routing.flow_dir_d8,
+        'flow_accumulation': hydrology_cache.flow_accumulation_d8,
+        'flow_direction': hydrology_cache.flow_dir_d8,
         'threshold_flow': None,  # Defined in source code as _threshold_flow
         'distance_to_channel': pygeoprocessing.routing.distance_to_channel_d8,
     },
     'MFD': {
-        'flow_accumulation': pygeoprocessing.routing.flow_accumulation_mfd,
-        'flow_direction': pygeoprocessing.routing.flow_dir_mfd,
-        'threshold_flow': pygeoprocessing.routing.extract_streams_mfd,
+        'flow_accumulation': hydrology_cache.flow_accumulation_mfd,
+        'flow_direction': hydrology_cache.flow_dir_mfd,
+        'threshold_flow': hydrology_cache.extract_streams_mfd,
         'distance_to_channel': pygeoprocessing.routing.distance_to_channel_mfd,
     }
 }
@@ -256,7 +257,7 @@ def execute(args):
         args['workspace_dir'],
         _TARGET_FILLED_PITS_FILED_PATTERN % file_suffix)
     filled_pits_task = graph.add_task(
-        pygeoprocessing.routing.fill_pits,
+        hydrology_cache.fill_pits,
         args=(dem_raster_path_band,
               dem_filled_pits_path,
               args['workspace_dir']),
@@ -17,6 +17,7 @@ import numpy
 import pygeoprocessing
 import pygeoprocessing.routing
 import taskgraph
+from .. import hydrology_cache
 from .. import utils
 from .. import validation
 from . import sdr_core
@@ -346,7 +347,7 @@ def execute(args):
         task_name='align input rasters')
 
     pit_fill_task = task_graph.add_task(
-        func=pygeoprocessing.routing.fill_pits,
+        func=hydrology_cache.fill_pits,
         args=(
             (f_reg['aligned_dem_path'], 1),
             f_reg['pit_filled_dem_path']),
@@ -377,7 +378,7 @@ def execute(args):
         task_name='threshold slope')
 
     flow_dir_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_dir_mfd,
+        func=hydrology_cache.flow_dir_mfd,
         args=(
             (f_reg['pit_filled_dem_path'], 1),
             f_reg['flow_direction_path']),
@@ -398,7 +399,7 @@ def execute(args):
         task_name='weighted average of multiple-flow aspects')
 
     flow_accumulation_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_accumulation_mfd,
+        func=hydrology_cache.flow_accumulation_mfd,
         args=(
             (f_reg['flow_direction_path'], 1),
             f_reg['flow_accumulation_path']),
@@ -424,7 +425,7 @@ def execute(args):
         task_name='ls factor calculation')
 
     stream_task = task_graph.add_task(
-        func=pygeoprocessing.routing.extract_streams_mfd,
+        func=hydrology_cache.extract_streams_mfd,
         args=(
             (f_reg['flow_accumulation_path'], 1),
             (f_reg['flow_direction_path'], 1),
@@ -616,6 +617,7 @@ def execute(args):
             f_reg['flow_direction_path'], f_reg['e_prime_path'],
             f_reg['f_path'], f_reg['sdr_path'],
             f_reg['sed_deposition_path']),
+        kwargs={'n_workers': n_workers},
         dependent_task_list=[e_prime_task, sdr_task, flow_dir_task],
         hash_algorithm='md5',
         copy_duplicate_artifact=True,
@@ -1,7 +1,10 @@
 # cython: profile=False
 # cython: language_level=3
+import concurrent.futures
 import logging
 import os
+import tempfile
+import threading
 
 import numpy
 import pygeoprocessing
@@ -9,14 +12,11 @@ cimport numpy
 cimport cython
 from osgeo import gdal
 
-from cpython.mem cimport PyMem_Malloc, PyMem_Free
-from cython.operator cimport dereference as deref
-from cython.operator cimport preincrement as inc
-from libcpp.pair cimport pair
-from libcpp.set cimport set as cset
-from libcpp.list cimport list as clist
 from libcpp.stack cimport stack
+from libcpp.vector cimport vector
 cimport libc.math as cmath
+from natcap.invest.managed_raster cimport _ManagedFloat32Raster
+from natcap.invest.managed_raster cimport _ManagedInt32Raster
 
 cdef extern from "time.h" nogil:
     ctypedef int time_t
@@ -31,8 +31,6 @@ cdef double SQRT2 = cmath.sqrt(2)
 cdef double PI = 3.141592653589793238462643383279502884
 # This module creates rasters with a memory xy block size of 2**BLOCK_BITS
 cdef int BLOCK_BITS = 8
-# Number of raster blocks to hold in memory at once per Managed Raster
-cdef int MANAGED_RASTER_N_BLOCKS = 2**6
 
 # These offsets are for the neighbor rows and columns according to the
 # ordering: 3 2 1
@@ -41,333 +39,44 @@ cdef int MANAGED_RASTER_N_BLOCKS = 2**6
 cdef int *ROW_OFFSETS = [0, -1, -1, -1,  0,  1, 1, 1]
 cdef int *COL_OFFSETS = [1,  1,  0, -1, -1, -1, 0, 1]
 
+# Largest window, in pixels, a drainage component is routed in memory in
+# when routing in parallel.  Larger components are routed through managed
+# rasters after the others are done.
+_MAX_WINDOW_PIXELS = 2**24
+# Bytes all threads' windows may hold at once, and about how many bytes a
+# window holds per pixel for the arrays it reads, routes and merges.  The
+# window size is lowered so n_workers windows fit in the budget.
+_WINDOW_MEMORY_BYTES = 2**31
+_WINDOW_BYTES_PER_PIXEL = 32
+# Small components are grouped while their window is under this many pixels
+_BATCH_WINDOW_PIXELS = 2**20
+
 
 cdef int is_close(double x, double y):
     return abs(x-y) <= (1e-8+1e-05*abs(y))
 
-# this is a least recently used cache written in C++ in an external file,
-# exposing here so _ManagedRaster can use it
-cdef extern from "LRUCache.h" nogil:
-    cdef cppclass LRUCache[KEY_T, VAL_T]:
-        LRUCache(int)
-        void put(KEY_T&, VAL_T&, clist[pair[KEY_T,VAL_T]]&)
-        clist[pair[KEY_T,VAL_T]].iterator begin()
-        clist[pair[KEY_T,VAL_T]].iterator end()
-        bint exist(KEY_T &)
-        VAL_T get(KEY_T &)
-
-# this ctype is used to store the block ID and the block buffer as one object
-# inside Managed Raster
-ctypedef pair[int, double*] BlockBufferPair
-
-# a class to allow fast random per-pixel access to a raster for both setting
-# and reading pixels.  Copied from src/pygeoprocessing/routing/routing.pyx,
-# revision 891288683889237cfd3a3d0a1f09483c23489fca.
-cdef class _ManagedRaster:
-    cdef LRUCache[int, double*]* lru_cache
-    cdef cset[int] dirty_blocks
-    cdef int block_xsize
-    cdef int block_ysize
-    cdef int block_xmod
-    cdef int block_ymod
-    cdef int block_xbits
-    cdef int block_ybits
-    cdef long raster_x_size
-    cdef long raster_y_size
-    cdef int block_nx
-    cdef int block_ny
-    cdef int write_mode
-    cdef bytes raster_path
-    cdef int band_id
-    cdef int closed
-
-    def __cinit__(self, raster_path, band_id, write_mode):
-        """Create new instance of Managed Raster.
-
-        Args:
-            raster_path (char*): path to raster that has block sizes that are
-                powers of 2. If not, an exception is raised.
-            band_id (int): which band in `raster_path` to index. Uses GDAL
-                notation that starts at 1.
-            write_mode (boolean): if true, this raster is writable and dirty
-                memory blocks will be written back to the raster as blocks
-                are swapped out of the cache or when the object deconstructs.
-
-        Returns:
-            None.
-        """
-        raster_info = pygeoprocessing.get_raster_info(raster_path)
-        self.raster_x_size, self.raster_y_size = raster_info['raster_size']
-        self.block_xsize, self.block_ysize = raster_info['block_size']
-        self.block_xmod = self.block_xsize-1
-        self.block_ymod = self.block_ysize-1
-
-        if not (1 <= band_id <= raster_info['n_bands']):
-            err_msg = (
-                "Error: band ID (%s) is not a valid band number. "
-                "This exception is happening in Cython, so it will cause a "
-                "hard seg-fault, but it's otherwise meant to be a "
-                "ValueError." % (band_id))
-            print(err_msg)
-            raise ValueError(err_msg)
-        self.band_id = band_id
-
-        if (self.block_xsize & (self.block_xsize - 1) != 0) or (
-                self.block_ysize & (self.block_ysize - 1) != 0):
-            # If inputs are not a power of two, this will at least print
-            # an error message. Unfortunately with Cython, the exception will
-            # present itself as a hard seg-fault, but I'm leaving the
-            # ValueError in here at least for readability.
-            err_msg = (
-                "Error: Block size is not a power of two: "
-                "block_xsize: %d, %d, %s. This exception is happening"
-                "in Cython, so it will cause a hard seg-fault, but it's"
-                "otherwise meant to be a ValueError." % (
-                    self.block_xsize, self.block_ysize, raster_path))
-            print(err_msg)
-            raise ValueError(err_msg)
-
-        self.block_xbits = numpy.log2(self.block_xsize)
-        self.block_ybits = numpy.log2(self.block_ysize)
-        self.block_nx = (
-            self.raster_x_size + (self.block_xsize) - 1) // self.block_xsize
-        self.block_ny = (
-            self.raster_y_size + (self.block_ysize) - 1) // self.block_ysize
-
-        self.lru_cache = new LRUCache[int, double*](MANAGED_RASTER_N_BLOCKS)
-        self.raster_path = <bytes> raster_path
-        self.write_mode = write_mode
-        self.closed = 0
-
-    def __dealloc__(self):
-        """Deallocate _ManagedRaster.
-
-        This operation manually frees memory from the LRUCache and writes any
-        dirty memory blocks back to the raster if `self.write_mode` is True.
-        """
-        self.close()
-
-    def close(self):
-        """Close the _ManagedRaster and free up resources.
-
-            This call writes any dirty blocks to disk, frees up the memory
-            allocated as part of the cache, and frees all GDAL references.
-
-            Any subsequent calls to any other functions in _ManagedRaster will
-            have undefined behavior.
-        """
-        if self.closed:
-            return
-        self.closed = 1
-        cdef int xi_copy, yi_copy
-        cdef numpy.ndarray[double, ndim=2] block_array = numpy.empty(
-            (self.block_ysize, self.block_xsize))
-        cdef double *double_buffer
-        cdef int block_xi
-        cdef int block_yi
-        # initially the win size is the same as the block size unless
-        # we're at the edge of a raster
-        cdef int win_xsize
-        cdef int win_ysize
-
-        # we need the offsets to subtract from global indexes for cached array
-        cdef int xoff
-        cdef int yoff
-
-        cdef clist[BlockBufferPair].iterator it = self.lru_cache.begin()
-        cdef clist[BlockBufferPair].iterator end = self.lru_cache.end()
-        if not self.write_mode:
-            while it != end:
-                # write the changed value back if desired
-                PyMem_Free(deref(it).second)
-                inc(it)
-            return
-
-        raster = gdal.OpenEx(
-            self.raster_path, gdal.GA_Update | gdal.OF_RASTER)
-        raster_band = raster.GetRasterBand(self.band_id)
-
-        # if we get here, we're in write_mode
-        cdef cset[int].iterator dirty_itr
-        while it != end:
-            double_buffer = deref(it).second
-            block_index = deref(it).first
-
-            # write to disk if block is dirty
-            dirty_itr = self.dirty_blocks.find(block_index)
-            if dirty_itr != self.dirty_blocks.end():
-                self.dirty_blocks.erase(dirty_itr)
-                block_xi = block_index % self.block_nx
-                block_yi = block_index / self.block_nx
-
-                # we need the offsets to subtract from global indexes for
-                # cached array
-                xoff = block_xi << self.block_xbits
-                yoff = block_yi << self.block_ybits
-
-                win_xsize = self.block_xsize
-                win_ysize = self.block_ysize
-
-                # clip window sizes if necessary
-                if xoff+win_xsize > self.raster_x_size:
-                    win_xsize = win_xsize - (
-                        xoff+win_xsize - self.raster_x_size)
-                if yoff+win_ysize > self.raster_y_size:
-                    win_ysize = win_ysize - (
-                        yoff+win_ysize - self.raster_y_size)
-
-                for xi_copy in xrange(win_xsize):
-                    for yi_copy in xrange(win_ysize):
-                        block_array[yi_copy, xi_copy] = (
-                            double_buffer[
-                                (yi_copy << self.block_xbits) + xi_copy])
-                raster_band.WriteArray(
-                    block_array[0:win_ysize, 0:win_xsize],
-                    xoff=xoff, yoff=yoff)
-            PyMem_Free(double_buffer)
-            inc(it)
-        raster_band.FlushCache()
-        raster_band = None
-        raster = None
-
-    cdef inline void set(self, long xi, long yi, double value):
-        """Set the pixel at `xi,yi` to `value`."""
-        cdef int block_xi = xi >> self.block_xbits
-        cdef int block_yi = yi >> self.block_ybits
-        # this is the flat index for the block
-        cdef int block_index = block_yi * self.block_nx + block_xi
-        if not self.lru_cache.exist(block_index):
-            self._load_block(block_index)
-        self.lru_cache.get(
-            block_index)[
-                ((yi & (self.block_ymod))<<self.block_xbits) +
-                (xi & (self.block_xmod))] = value
-        if self.write_mode:
-            dirty_itr = self.dirty_blocks.find(block_index)
-            if dirty_itr == self.dirty_blocks.end():
-                self.dirty_blocks.insert(block_index)
-
-    cdef inline double get(self, long xi, long yi):
-        """Return the value of the pixel at `xi,yi`."""
-        cdef int block_xi = xi >> self.block_xbits
-        cdef int block_yi = yi >> self.block_ybits
-        # this is the flat index for the block
-        cdef int block_index = block_yi * self.block_nx + block_xi
-        if not self.lru_cache.exist(block_index):
-            self._load_block(block_index)
-        return self.lru_cache.get(
-            block_index)[
-                ((yi & (self.block_ymod))<<self.block_xbits) +
-                (xi & (self.block_xmod))]
-
-    cdef void _load_block(self, int block_index) except *:
-        cdef int block_xi = block_index % self.block_nx
-        cdef int block_yi = block_index // self.block_nx
-
-        # we need the offsets to subtract from global indexes for cached array
-        cdef int xoff = block_xi << self.block_xbits
-        cdef int yoff = block_yi << self.block_ybits
-
-        cdef int xi_copy, yi_copy
-        cdef numpy.ndarray[double, ndim=2] block_array
-        cdef double *double_buffer
-        cdef clist[BlockBufferPair] removed_value_list
-
-        # determine the block aligned xoffset for read as array
-
-        # initially the win size is the same as the block size unless
-        # we're at the edge of a raster
-        cdef int win_xsize = self.block_xsize
-        cdef int win_ysize = self.block_ysize
-
-        # load a new block
-        if xoff+win_xsize > self.raster_x_size:
-            win_xsize = win_xsize - (xoff+win_xsize - self.raster_x_size)
-        if yoff+win_ysize > self.raster_y_size:
-            win_ysize = win_ysize - (yoff+win_ysize - self.raster_y_size)
-
-        raster = gdal.OpenEx(self.raster_path, gdal.OF_RASTER)
-        raster_band = raster.GetRasterBand(self.band_id)
-        block_array = raster_band.ReadAsArray(
-            xoff=xoff, yoff=yoff, win_xsize=win_xsize,
-            win_ysize=win_ysize).astype(
-            numpy.float64)
-        raster_band = None
-        raster = None
-        double_buffer = <double*>PyMem_Malloc(
-            (sizeof(double) << self.block_xbits) * win_ysize)
-        for xi_copy in xrange(win_xsize):
-            for yi_copy in xrange(win_ysize):
-                double_buffer[(yi_copy<<self.block_xbits)+xi_copy] = (
-                    block_array[yi_copy, xi_copy])
-        self.lru_cache.put(
-            <int>block_index, <double*>double_buffer, removed_value_list)
-
-        if self.write_mode:
-            raster = gdal.OpenEx(
-                self.raster_path, gdal.GA_Update | gdal.OF_RASTER)
-            raster_band = raster.GetRasterBand(self.band_id)
-
-        block_array = numpy.empty(
-            (self.block_ysize, self.block_xsize), dtype=numpy.double)
-        while not removed_value_list.empty():
-            # write the changed value back if desired
-            double_buffer = removed_value_list.front().second
-
-            if self.write_mode:
-                block_index = removed_value_list.front().first
-
-                # write back the block if it's dirty
-                dirty_itr = self.dirty_blocks.find(block_index)
-                if dirty_itr != self.dirty_blocks.end():
-                    self.dirty_blocks.erase(dirty_itr)
-
-                    block_xi = block_index % self.block_nx
-                    block_yi = block_index // self.block_nx
-
-                    xoff = block_xi << self.block_xbits
-                    yoff = block_yi << self.block_ybits
-
-                    win_xsize = self.block_xsize
-                    win_ysize = self.block_ysize
-
-                    if xoff+win_xsize > self.raster_x_size:
-                        win_xsize = win_xsize - (
-                            xoff+win_xsize - self.raster_x_size)
-                    if yoff+win_ysize > self.raster_y_size:
-                        win_ysize = win_ysize - (
-                            yoff+win_ysize - self.raster_y_size)
-
-                    for xi_copy in xrange(win_xsize):
-                        for yi_copy in xrange(win_ysize):
-                            block_array[yi_copy, xi_copy] = double_buffer[
-                                (yi_copy << self.block_xbits) + xi_copy]
-                    raster_band.WriteArray(
-                        block_array[0:win_ysize, 0:win_xsize],
-                        xoff=xoff, yoff=yoff)
-            PyMem_Free(double_buffer)
-            removed_value_list.pop_front()
-
-        if self.write_mode:
-            raster_band = None
-            raster = None
-
 
 def calculate_sediment_deposition(
         mfd_flow_direction_path, e_prime_path, f_path, sdr_path,
-        target_sediment_deposition_path):
+        target_sediment_deposition_path, n_workers=-1):
     """Calculate sediment deposition layer
 
         Args:
-            mfd_flow_direction_path (string): a path to a raster with
+            mfd_flow_direction_path (string): a path to an int32 raster with
                 pygeoprocessing.routing MFD flow direction values.
-            e_prime_path (string): path to a raster that shows sources of
-                sediment that wash off a pixel but do not reach the stream.
+            e_prime_path (string): path to a float32 raster that shows
+                sources of sediment that wash off a pixel but do not reach
+                the stream.
             f_path (string): path to a raster that shows the sediment flux
                 on a pixel for sediment that does not reach the stream.
-            sdr_path (string): path to Sediment Delivery Ratio raster.
+            sdr_path (string): path to float32 Sediment Delivery Ratio
+                raster.
             target_sediment_deposition_path (string): path to created that
                 shows where the E' sources end up across the landscape.
+            n_workers (int): if greater than 0, the number of threads that
+                route independent drainage basins at the same time.
+                Otherwise the whole raster is routed in one traversal.
+                Outputs are the same either way.
 
         Returns:
             None.
@@ -382,14 +91,51 @@ def calculate_sediment_deposition(
         mfd_flow_direction_path, f_path,
         gdal.GDT_Float32, [sediment_deposition_nodata])
 
-    cdef _ManagedRaster mfd_flow_direction_raster = _ManagedRaster(
+    if n_workers is not None and n_workers > 0:
+        components_left = _route_sediment_deposition_parallel(
+            mfd_flow_direction_path, e_prime_path, f_path, sdr_path,
+            target_sediment_deposition_path, n_workers)
+        if not components_left:
+            LOGGER.info('Sediment deposition 100% complete')
+            return
+    _route_sediment_deposition(
+        mfd_flow_direction_path, e_prime_path, f_path, sdr_path,
+        target_sediment_deposition_path)
+
+
+def _route_sediment_deposition(
+        mfd_flow_direction_path, e_prime_path, f_path, sdr_path,
+        target_sediment_deposition_path):
+    """Route sediment deposition over the pixels that aren't done yet.
+
+    Pixels whose sediment deposition isn't nodata are treated as done, so
+    this finishes the drainage basins the parallel pass left out.
+
+    Args:
+        mfd_flow_direction_path (string): a path to an int32 raster with
+            pygeoprocessing.routing MFD flow direction values.
+        e_prime_path (string): path to a float32 raster of E'.
+        f_path (string): path to an existing float32 raster of F, updated
+            by this call.
+        sdr_path (string): path to float32 Sediment Delivery Ratio raster.
+        target_sediment_deposition_path (string): path to an existing
+            float32 sediment deposition raster, updated by this call.
+
+    Returns:
+        None.
+
+    """
+    cdef float sediment_deposition_nodata = -1.0
+    cdef _ManagedInt32Raster mfd_flow_direction_raster = _ManagedInt32Raster(
         mfd_flow_direction_path, 1, False)
-    cdef _ManagedRaster e_prime_raster = _ManagedRaster(
+    cdef _ManagedFloat32Raster e_prime_raster = _ManagedFloat32Raster(
         e_prime_path, 1, False)
-    cdef _ManagedRaster sdr_raster = _ManagedRaster(sdr_path, 1, False)
-    cdef _ManagedRaster f_raster = _ManagedRaster(f_path, 1, True)
-    cdef _ManagedRaster sediment_deposition_raster = _ManagedRaster(
-        target_sediment_deposition_path, 1, True)
+    cdef _ManagedFloat32Raster sdr_raster = _ManagedFloat32Raster(
+        sdr_path, 1, False)
+    cdef _ManagedFloat32Raster f_raster = _ManagedFloat32Raster(
+        f_path, 1, True)
+    cdef _ManagedFloat32Raster sediment_deposition_raster = (
+        _ManagedFloat32Raster(target_sediment_deposition_path, 1, True))
 
     cdef int *inflow_offsets = [4, 5, 6, 7, 0, 1, 2, 3]
 
@@ -575,6 +321,491 @@ def calculate_sediment_deposition(
     sediment_deposition_raster.close()
 
 
+def _label_drainage_components(mfd_flow_direction_path, target_label_path):
+    """Label the independent drainage components of an MFD raster.
+
+    Two pixels are in the same component when flow passes from one to the
+    other, so no flow crosses between components and each can be routed on
+    its own.  Pixels that neither flow nor receive flow are never routed and
+    are left as 0.
+
+    Args:
+        mfd_flow_direction_path (string): a path to an int32 raster with
+            pygeoprocessing.routing MFD flow direction values.
+        target_label_path (string): path to an int32 raster created by this
+            call that holds the component label of each pixel, from 1.
+
+    Returns:
+        int64 numpy array of shape (n_components, 5) holding the xmin, ymin,
+        xmax, ymax and pixel count of each component.  Row ``i`` is the
+        component labelled ``i+1``.
+
+    """
+    pygeoprocessing.new_raster_from_base(
+        mfd_flow_direction_path, target_label_path, gdal.GDT_Int32, [-1],
+        fill_value_list=[0])
+
+    cdef _ManagedInt32Raster mfd_flow_direction_raster = _ManagedInt32Raster(
+        mfd_flow_direction_path, 1, False)
+    cdef _ManagedInt32Raster label_raster = _ManagedInt32Raster(
+        target_label_path, 1, True)
+
+    cdef int *inflow_offsets = [4, 5, 6, 7, 0, 1, 2, 3]
+    cdef int n_cols, n_rows
+    n_cols, n_rows = pygeoprocessing.get_raster_info(
+        mfd_flow_direction_path)['raster_size']
+
+    cdef stack[long] search_stack
+    cdef vector[long] component_bounds
+    cdef int label = 0
+    cdef int win_xsize, win_ysize, xoff, yoff, row_index, col_index
+    cdef int seed_col, seed_row, global_col, global_row, j
+    cdef int neighbor_col, neighbor_row, flow_val, neighbor_flow_val
+    cdef long flat_index, xmin, ymin, xmax, ymax, pixel_count
+
+    for offset_dict in pygeoprocessing.iterblocks(
+            (mfd_flow_direction_path, 1), offset_only=True, largest_block=0):
+        win_xsize = offset_dict['win_xsize']
+        win_ysize = offset_dict['win_ysize']
+        xoff = offset_dict['xoff']
+        yoff = offset_dict['yoff']
+        for row_index in range(win_ysize):
+            seed_row = yoff + row_index
+            for col_index in range(win_xsize):
+                seed_col = xoff + col_index
+                if label_raster.get(seed_col, seed_row) != 0:
+                    continue
+                if mfd_flow_direction_raster.get(seed_col, seed_row) == 0:
+                    # pixels that only receive flow are reached from the
+                    # pixels that flow into them
+                    continue
+
+                label += 1
+                label_raster.set(seed_col, seed_row, label)
+                search_stack.push(<long>seed_row * n_cols + seed_col)
+                xmin = xmax = seed_col
+                ymin = ymax = seed_row
+                pixel_count = 0
+                while search_stack.size() > 0:
+                    flat_index = search_stack.top()
+                    search_stack.pop()
+                    global_row = flat_index // n_cols
+                    global_col = flat_index % n_cols
+                    pixel_count += 1
+                    if global_col < xmin:
+                        xmin = global_col
+                    elif global_col > xmax:
+                        xmax = global_col
+                    if global_row < ymin:
+                        ymin = global_row
+                    elif global_row > ymax:
+                        ymax = global_row
+
+                    flow_val = mfd_flow_direction_raster.get(
+                        global_col, global_row)
+                    for j in range(8):
+                        neighbor_row = global_row + ROW_OFFSETS[j]
+                        if neighbor_row < 0 or neighbor_row >= n_rows:
+                            continue
+                        neighbor_col = global_col + COL_OFFSETS[j]
+                        if neighbor_col < 0 or neighbor_col >= n_cols:
+                            continue
+                        if label_raster.get(neighbor_col, neighbor_row) != 0:
+                            continue
+                        neighbor_flow_val = mfd_flow_direction_raster.get(
+                            neighbor_col, neighbor_row)
+                        # follow flow both out of and into this pixel
+                        if ((flow_val >> (j*4)) & 0xF) == 0 and (
+                                (neighbor_flow_val >> (
+                                    inflow_offsets[j]*4)) & 0xF) == 0:
+                            continue
+                        label_raster.set(neighbor_col, neighbor_row, label)
+                        search_stack.push(
+                            <long>neighbor_row * n_cols + neighbor_col)
+                component_bounds.push_back(xmin)
+                component_bounds.push_back(ymin)
+                component_bounds.push_back(xmax)
+                component_bounds.push_back(ymax)
+                component_bounds.push_back(pixel_count)
+
+    label_raster.close()
+    mfd_flow_direction_raster.close()
+    return numpy.array(component_bounds, dtype=numpy.int64).reshape((-1, 5))
+
+
+def _batch_components(component_array, max_window_pixels):
+    """Group drainage components into windows to route in parallel.
+
+    Components are grouped in raster order while the window around the
+    group stays under ``_BATCH_WINDOW_PIXELS``, or ``max_window_pixels`` if
+    that's smaller, so that small coastal basins aren't read one at a time.
+    Components whose own window is larger than ``max_window_pixels`` are
+    left out.
+
+    Args:
+        component_array (numpy.ndarray): the array returned by
+            ``_label_drainage_components``.
+        max_window_pixels (int): largest window, in pixels, of a batch.
+
+    Returns:
+        A tuple of a list of ``(window, labels)`` batches, largest window
+        first, where window is an ``(xoff, yoff, win_xsize, win_ysize)``
+        tuple and labels a numpy array of the labels in the batch, and the
+        number of components left out.
+
+    """
+    batch_list = []
+    n_left_out = 0
+    batch_window_pixels = min(_BATCH_WINDOW_PIXELS, max_window_pixels)
+    batch_bounds = None
+    batch_labels = []
+
+    def _add_batch():
+        xmin, ymin, xmax, ymax = batch_bounds
+        batch_list.append((
+            (xmin, ymin, xmax-xmin+1, ymax-ymin+1),
+            numpy.array(batch_labels, dtype=numpy.int32)))
+
+    order = numpy.lexsort((component_array[:, 0], component_array[:, 1]))
+    for component_index in order:
+        xmin, ymin, xmax, ymax, _ = component_array[component_index]
+        if (xmax-xmin+1) * (ymax-ymin+1) > max_window_pixels:
+            n_left_out += 1
+            continue
+        if batch_bounds is not None:
+            union_bounds = (
+                min(xmin, batch_bounds[0]), min(ymin, batch_bounds[1]),
+                max(xmax, batch_bounds[2]), max(ymax, batch_bounds[3]))
+            if ((union_bounds[2]-union_bounds[0]+1) *
+                    (union_bounds[3]-union_bounds[1]+1) <=
+                    batch_window_pixels):
+                batch_bounds = union_bounds
+                batch_labels.append(component_index+1)
+                continue
+            _add_batch()
+        batch_bounds = (xmin, ymin, xmax, ymax)
+        batch_labels = [component_index+1]
+    if batch_bounds is not None:
+        _add_batch()
+
+    batch_list.sort(key=lambda batch: batch[0][2]*batch[0][3], reverse=True)
+    return batch_list, n_left_out
+
+
+def _route_sediment_deposition_parallel(
+        mfd_flow_direction_path, e_prime_path, f_path, sdr_path,
+        target_sediment_deposition_path, n_workers):
+    """Route sediment deposition over drainage components on many threads.
+
+    The flow direction raster is split into components that no flow passes
+    between.  Batches of components are read into memory a window at a
+    time and routed with the GIL released, then merged into the F and
+    sediment deposition rasters.  Pixel values don't depend on the order
+    pixels are routed in, so the results are the same as routing the whole
+    raster in one traversal.  Each thread's window is kept small enough that
+    ``n_workers`` windows fit in ``_WINDOW_MEMORY_BYTES``.
+
+    Args:
+        mfd_flow_direction_path (string): a path to an int32 raster with
+            pygeoprocessing.routing MFD flow direction values.
+        e_prime_path (string): path to a float32 raster of E'.
+        f_path (string): path to an existing float32 raster of F, updated
+            by this call.
+        sdr_path (string): path to float32 Sediment Delivery Ratio raster.
+        target_sediment_deposition_path (string): path to an existing
+            float32 sediment deposition raster, updated by this call.
+        n_workers (int): number of threads to route components on.
+
+    Returns:
+        The number of components too large to route in memory.  They're
+        left for ``_route_sediment_deposition``.
+
+    """
+    fp, label_path = tempfile.mkstemp(
+        suffix='.tif', prefix='drainage_components',
+        dir=os.path.dirname(target_sediment_deposition_path))
+    os.close(fp)
+    LOGGER.info('Labelling drainage components')
+    component_array = _label_drainage_components(
+        mfd_flow_direction_path, label_path)
+    max_window_pixels = min(
+        _MAX_WINDOW_PIXELS,
+        _WINDOW_MEMORY_BYTES // (_WINDOW_BYTES_PER_PIXEL * n_workers))
+    if max_window_pixels < _MAX_WINDOW_PIXELS:
+        LOGGER.info(
+            'Limiting drainage component windows to %d pixels so %d '
+            'threads fit in %d bytes', max_window_pixels, n_workers,
+            _WINDOW_MEMORY_BYTES)
+    batch_list, n_left_out = _batch_components(
+        component_array, max_window_pixels)
+    if n_left_out == len(component_array):
+        # nothing fits in memory, the serial pass routes everything
+        LOGGER.info(
+            'No drainage component fits in a %d pixel window, routing '
+            'sediment deposition in one traversal', max_window_pixels)
+        os.remove(label_path)
+        return n_left_out
+    LOGGER.info(
+        'Routing sediment deposition over %d drainage components in %d '
+        'batches on %d threads', len(component_array) - n_left_out,
+        len(batch_list), n_workers)
+
+    cdef float sdr_nodata = pygeoprocessing.get_raster_info(
+        sdr_path)['nodata'][0]
+    cdef float e_prime_nodata = pygeoprocessing.get_raster_info(
+        e_prime_path)['nodata'][0]
+
+    # GDAL handles aren't thread safe, every read and write holds this lock
+    gdal_lock = threading.Lock()
+    raster_list = [
+        gdal.OpenEx(path, gdal.OF_RASTER) for path in (
+            mfd_flow_direction_path, e_prime_path, sdr_path, label_path)]
+    target_raster_list = [
+        gdal.OpenEx(path, gdal.OF_RASTER | gdal.GA_Update) for path in (
+            target_sediment_deposition_path, f_path)]
+    flow_dir_band, e_prime_band, sdr_band, label_band = [
+        raster.GetRasterBand(1) for raster in raster_list]
+    sediment_deposition_band, f_band = [
+        raster.GetRasterBand(1) for raster in target_raster_list]
+    n_total_pixels = max(1, int(component_array[:, 4].sum()))
+    progress = {'pixels': 0, 'last_log_time': time(NULL)}
+
+    def _route_batch(batch):
+        window, labels = batch
+        with gdal_lock:
+            flow_dir_array, e_prime_array, sdr_array, label_array = [
+                band.ReadAsArray(*window) for band in (
+                    flow_dir_band, e_prime_band, sdr_band, label_band)]
+        batch_mask = numpy.isin(label_array, labels)
+        # pixels of other components don't flow into or out of the batch,
+        # masking them keeps the window from routing them
+        flow_dir_array = numpy.where(batch_mask, flow_dir_array, 0).astype(
+            numpy.int32)
+        sediment_deposition_array = numpy.full(
+            flow_dir_array.shape, -1.0, dtype=numpy.float32)
+        f_array = numpy.full(
+            flow_dir_array.shape, -1.0, dtype=numpy.float32)
+        _route_sediment_deposition_window(
+            flow_dir_array,
+            numpy.ascontiguousarray(e_prime_array, dtype=numpy.float32),
+            numpy.ascontiguousarray(sdr_array, dtype=numpy.float32),
+            e_prime_nodata, sdr_nodata, sediment_deposition_array, f_array)
+        with gdal_lock:
+            for band, array in (
+                    (sediment_deposition_band, sediment_deposition_array),
+                    (f_band, f_array)):
+                # batches' windows can overlap, only write this batch's
+                # pixels
+                merged_array = band.ReadAsArray(*window)
+                merged_array[batch_mask] = array[batch_mask]
+                band.WriteArray(merged_array, window[0], window[1])
+            progress['pixels'] += int(numpy.count_nonzero(batch_mask))
+            if time(NULL) - progress['last_log_time'] > 5.0:
+                progress['last_log_time'] = time(NULL)
+                LOGGER.info('Sediment deposition %.2f%% complete', 100.0 * (
+                    progress['pixels'] / float(n_total_pixels)))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            for _ in executor.map(_route_batch, batch_list):
+                pass
+    finally:
+        for band in (sediment_deposition_band, f_band):
+            band.FlushCache()
+        flow_dir_band = e_prime_band = sdr_band = label_band = None
+        sediment_deposition_band = f_band = None
+        raster_list = target_raster_list = None
+        os.remove(label_path)
+    return n_left_out
+
+
+def _route_sediment_deposition_window(
+        int[:, ::1] flow_dir, float[:, ::1] e_prime, float[:, ::1] sdr,
+        float e_prime_nodata, float sdr_nodata,
+        float[:, ::1] sediment_deposition, float[:, ::1] f):
+    """Route sediment deposition over in-memory arrays without the GIL.
+
+    Args:
+        flow_dir (numpy.ndarray): int32 MFD flow direction.  Pixels off the
+            edge of the array are treated as off the edge of the raster, so
+            no flow may cross the array's edge.
+        e_prime (numpy.ndarray): float32 E'.
+        sdr (numpy.ndarray): float32 Sediment Delivery Ratio.
+        e_prime_nodata (float): nodata value of ``e_prime``.
+        sdr_nodata (float): nodata value of ``sdr``.
+        sediment_deposition (numpy.ndarray): float32 array filled with -1,
+            the sediment deposition of each routed pixel is set here.
+        f (numpy.ndarray): float32 array, the F of each routed pixel is set
+            here.
+
+    Returns:
+        None.
+
+    """
+    with nogil:
+        _route_window(
+            flow_dir, e_prime, sdr, e_prime_nodata, sdr_nodata,
+            sediment_deposition, f)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _route_window(
+        int[:, ::1] flow_dir, float[:, ::1] e_prime, float[:, ::1] sdr,
+        float e_prime_nodata, float sdr_nodata,
+        float[:, ::1] sediment_deposition, float[:, ::1] f) except -1 nogil:
+    """Route sediment deposition over arrays, as _route_sediment_deposition.
+
+    The arithmetic and its types match ``_route_sediment_deposition`` so
+    both give the same values bit for bit.
+    """
+    cdef float sediment_deposition_nodata = -1.0
+    cdef int *inflow_offsets = [4, 5, 6, 7, 0, 1, 2, 3]
+    cdef int n_rows = flow_dir.shape[0]
+    cdef int n_cols = flow_dir.shape[1]
+    cdef stack[long] processing_stack
+    cdef long flat_index
+    cdef int global_col, global_row, j, k
+    cdef int seed_col, seed_row, seed_pixel, upstream_neighbors_processed
+    cdef int neighbor_row, neighbor_col, ds_neighbor_row, ds_neighbor_col
+    cdef int flow_val, neighbor_flow_val, ds_neighbor_flow_val
+    cdef int flow_weight, neighbor_flow_weight
+    cdef float flow_sum, neighbor_flow_sum
+    cdef float downstream_sdr_weighted_sum, sdr_i, sdr_j
+    cdef float p_j, p_val, f_j, d_ri, sdr_denominator
+    cdef double f_j_weighted_sum, e_prime_i, r_i, f_i
+
+    for seed_row in range(n_rows):
+        for seed_col in range(n_cols):
+            if flow_dir[seed_row, seed_col] == 0:
+                continue
+            seed_pixel = 1
+            for j in range(8):
+                neighbor_row = seed_row + ROW_OFFSETS[j]
+                if neighbor_row < 0 or neighbor_row >= n_rows:
+                    continue
+                neighbor_col = seed_col + COL_OFFSETS[j]
+                if neighbor_col < 0 or neighbor_col >= n_cols:
+                    continue
+                neighbor_flow_val = flow_dir[neighbor_row, neighbor_col]
+                if neighbor_flow_val == 0:
+                    continue
+                neighbor_flow_weight = (
+                    neighbor_flow_val >> (inflow_offsets[j]*4)) & 0xF
+                if neighbor_flow_weight > 0:
+                    # neighbor flows in, not a seed
+                    seed_pixel = 0
+                    break
+            if seed_pixel and (
+                    sediment_deposition[seed_row, seed_col] ==
+                    sediment_deposition_nodata):
+                processing_stack.push(<long>seed_row * n_cols + seed_col)
+
+            while processing_stack.size() > 0:
+                # loop invariant: cell has all upstream neighbors processed
+                flat_index = processing_stack.top()
+                processing_stack.pop()
+                global_row = flat_index // n_cols
+                global_col = flat_index % n_cols
+
+                # calculate the upstream Fj contribution to this pixel
+                f_j_weighted_sum = 0
+                for j in range(8):
+                    neighbor_row = global_row + ROW_OFFSETS[j]
+                    if neighbor_row < 0 or neighbor_row >= n_rows:
+                        continue
+                    neighbor_col = global_col + COL_OFFSETS[j]
+                    if neighbor_col < 0 or neighbor_col >= n_cols:
+                        continue
+
+                    # see if there's an inflow
+                    neighbor_flow_val = flow_dir[neighbor_row, neighbor_col]
+                    neighbor_flow_weight = (
+                        neighbor_flow_val >> (inflow_offsets[j]*4)) & 0xF
+                    if neighbor_flow_weight > 0:
+                        f_j = f[neighbor_row, neighbor_col]
+                        neighbor_flow_sum = 0
+                        for k in range(8):
+                            neighbor_flow_sum += (
+                                neighbor_flow_val >> (k*4)) & 0xF
+                        p_val = neighbor_flow_weight / neighbor_flow_sum
+                        f_j_weighted_sum += p_val * f_j
+
+                # calculate the differential downstream change in sdr from
+                # this pixel
+                downstream_sdr_weighted_sum = 0.0
+                flow_val = flow_dir[global_row, global_col]
+                flow_sum = 0.0
+                for k in range(8):
+                    flow_sum += (flow_val >> (k*4)) & 0xF
+
+                for j in range(8):
+                    neighbor_row = global_row + ROW_OFFSETS[j]
+                    if neighbor_row < 0 or neighbor_row >= n_rows:
+                        continue
+                    neighbor_col = global_col + COL_OFFSETS[j]
+                    if neighbor_col < 0 or neighbor_col >= n_cols:
+                        continue
+                    # if this direction flows out, add to weighted sum
+                    flow_weight = (flow_val >> (j*4)) & 0xF
+                    if flow_weight > 0:
+                        sdr_j = sdr[neighbor_row, neighbor_col]
+                        if sdr_j == 0.0:
+                            # a stream, the last step to retain sediment on
+                            sdr_j = 1.0
+                        if sdr_j == sdr_nodata:
+                            sdr_j = 0.0
+                        p_j = flow_weight / flow_sum
+                        downstream_sdr_weighted_sum += sdr_j * p_j
+
+                        # push the downstream neighbor once all of its
+                        # other upstream neighbors are processed
+                        upstream_neighbors_processed = 1
+                        for k in range(8):
+                            if inflow_offsets[k] == j:
+                                continue
+                            ds_neighbor_row = neighbor_row + ROW_OFFSETS[k]
+                            if (ds_neighbor_row < 0 or
+                                    ds_neighbor_row >= n_rows):
+                                continue
+                            ds_neighbor_col = neighbor_col + COL_OFFSETS[k]
+                            if (ds_neighbor_col < 0 or
+                                    ds_neighbor_col >= n_cols):
+                                continue
+                            ds_neighbor_flow_val = flow_dir[
+                                ds_neighbor_row, ds_neighbor_col]
+                            if (ds_neighbor_flow_val >> (
+                                    inflow_offsets[k]*4)) & 0xF > 0:
+                                if sediment_deposition[
+                                        ds_neighbor_row, ds_neighbor_col] == (
+                                            sediment_deposition_nodata):
+                                    upstream_neighbors_processed = 0
+                                    break
+                        if upstream_neighbors_processed:
+                            processing_stack.push(
+                                <long>neighbor_row * n_cols + neighbor_col)
+
+                sdr_i = sdr[global_row, global_col]
+                if sdr_i == sdr_nodata:
+                    sdr_i = 0.0
+                e_prime_i = e_prime[global_row, global_col]
+                if e_prime_i == e_prime_nodata:
+                    e_prime_i = 0.0
+
+                if downstream_sdr_weighted_sum < sdr_i:
+                    downstream_sdr_weighted_sum = sdr_i
+                sdr_denominator = 1.0 - sdr_i
+                if sdr_denominator == 0:
+                    with gil:
+                        raise ZeroDivisionError('float division')
+                d_ri = (downstream_sdr_weighted_sum - sdr_i) / sdr_denominator
+                r_i = d_ri * (e_prime_i + f_j_weighted_sum)
+                f_i = (1-d_ri) * (e_prime_i + f_j_weighted_sum)
+                sediment_deposition[global_row, global_col] = <float>r_i
+                f[global_row, global_col] = <float>f_i
+    return 0
+
+
 def calculate_average_aspect(
     mfd_flow_direction_path, target_average_aspect_path):
     """Calculate the Weighted Average Aspect Ratio from MFD.
@@ -583,8 +814,8 @@ def calculate_average_aspect(
     direction.
 
     Args:
-        mfd_flow_direction_path (string): The path to an MFD flow direction
-            raster.
+        mfd_flow_direction_path (string): The path to an int32 MFD flow
+            direction raster.
         target_average_aspect_path (string): The path to where the calculated
             weighted average aspect raster should be written.
 
@@ -605,10 +836,10 @@ def calculate_average_aspect(
     cdef int n_cols, n_rows
     n_cols, n_rows = flow_direction_info['raster_size']
 
-    cdef _ManagedRaster mfd_flow_direction_raster = _ManagedRaster(
+    cdef _ManagedInt32Raster mfd_flow_direction_raster = _ManagedInt32Raster(
         mfd_flow_direction_path, 1, False)
 
-    cdef _ManagedRaster average_aspect_raster = _ManagedRaster(
+    cdef _ManagedFloat32Raster average_aspect_raster = _ManagedFloat32Raster(
         target_average_aspect_path, 1, True)
 
     cdef int seed_row = 0
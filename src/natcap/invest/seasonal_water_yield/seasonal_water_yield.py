@@ -13,6 +13,7 @@ import pygeoprocessing
 import pygeoprocessing.routing
 import taskgraph
 
+from .. import hydrology_cache
 from .. import utils
 from .. import validation
 
@@ -533,7 +534,7 @@ def _execute(args):
         task_name='align rasters')
 
     fill_pit_task = task_graph.add_task(
-        func=pygeoprocessing.routing.fill_pits,
+        func=hydrology_cache.fill_pits,
         args=(
             (file_registry['dem_aligned_path'], 1),
             file_registry['dem_pit_filled_path']),
@@ -543,7 +544,7 @@ def _execute(args):
         task_name='fill dem pits')
 
     flow_dir_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_dir_mfd,
+        func=hydrology_cache.flow_dir_mfd,
         args=(
             (file_registry['dem_pit_filled_path'], 1),
             file_registry['flow_dir_mfd_path']),
@@ -553,7 +554,7 @@ def _execute(args):
         task_name='flow dir mfd')
 
     flow_accum_task = task_graph.add_task(
-        func=pygeoprocessing.routing.flow_accumulation_mfd,
+        func=hydrology_cache.flow_accumulation_mfd,
         args=(
             (file_registry['flow_dir_mfd_path'], 1),
             file_registry['flow_accum_path']),
@@ -562,7 +563,7 @@ def _execute(args):
         task_name='flow accum task')
 
     stream_threshold_task = task_graph.add_task(
-        func=pygeoprocessing.routing.extract_streams_mfd,
+        func=hydrology_cache.extract_streams_mfd,
         args=(
             (file_registry['flow_accum_path'], 1),
             (file_registry['flow_dir_mfd_path'], 1),
@@ -13,16 +13,16 @@ cimport cython
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+from natcap.invest import managed_raster
 from cython.operator cimport dereference as deref
 
-from cpython.mem cimport PyMem_Malloc, PyMem_Free
-from cython.operator cimport dereference as deref
-from cython.operator cimport preincrement as inc
-from libcpp.list cimport list as clist
-from libcpp.set cimport set as cset
 from libcpp.pair cimport pair
 from libcpp.stack cimport stack
 from libcpp.queue cimport queue
+from natcap.invest.managed_raster cimport _ManagedByteRaster
+from natcap.invest.managed_raster cimport _ManagedFloat32Raster
+from natcap.invest.managed_raster cimport _ManagedInt32Raster
+from natcap.invest.managed_raster cimport _ManagedRaster
 
 from libc.time cimport time as ctime
 cdef extern from "time.h" nogil:
@@ -32,15 +32,6 @@ cdef extern from "time.h" nogil:
 cdef int is_close(double x, double y):
     return abs(x-y) <= (1e-8+1e-05*abs(y))
 
-cdef extern from "LRUCache.h":
-    cdef cppclass LRUCache[KEY_T, VAL_T]:
-        LRUCache(int)
-        void put(KEY_T&, VAL_T&, clist[pair[KEY_T,VAL_T]]&)
-        clist[pair[KEY_T,VAL_T]].iterator begin()
-        clist[pair[KEY_T,VAL_T]].iterator end()
-        bint exist(KEY_T &)
-        VAL_T get(KEY_T &)
-
 
 LOGGER = logging.getLogger(__name__)
 
@@ -69,305 +60,6 @@ cdef int* NEIGHBOR_OFFSET_ARRAY = [
 # cell.
 cdef int* FLOW_DIR_REVERSE_DIRECTION = [4, 5, 6, 7, 0, 1, 2, 3]
 
-# this ctype is used to store the block ID and the block buffer as one object
-# inside Managed Raster
-ctypedef pair[int, double*] BlockBufferPair
-
-# Number of raster blocks to hold in memory at once per Managed Raster
-cdef int MANAGED_RASTER_N_BLOCKS = 2**4
-
-# a class to allow fast random per-pixel access to a raster for both setting
-# and reading pixels.  Copied from src/pygeoprocessing/routing/routing.pyx,
-# revision 891288683889237cfd3a3d0a1f09483c23489fca.
-cdef class _ManagedRaster:
-    cdef LRUCache[int, double*]* lru_cache
-    cdef cset[int] dirty_blocks
-    cdef int block_xsize
-    cdef int block_ysize
-    cdef int block_xmod
-    cdef int block_ymod
-    cdef int block_xbits
-    cdef int block_ybits
-    cdef long raster_x_size
-    cdef long raster_y_size
-    cdef int block_nx
-    cdef int block_ny
-    cdef int write_mode
-    cdef bytes raster_path
-    cdef int band_id
-    cdef int closed
-
-    def __cinit__(self, raster_path, band_id, write_mode):
-        """Create new instance of Managed Raster.
-
-        Args:
-            raster_path (char*): path to raster that has block sizes that are
-                powers of 2. If not, an exception is raised.
-            band_id (int): which band in `raster_path` to index. Uses GDAL
-                notation that starts at 1.
-            write_mode (boolean): if true, this raster is writable and dirty
-                memory blocks will be written back to the raster as blocks
-                are swapped out of the cache or when the object deconstructs.
-
-        Returns:
-            None.
-        """
-        raster_info = pygeoprocessing.get_raster_info(raster_path)
-        self.raster_x_size, self.raster_y_size = raster_info['raster_size']
-        self.block_xsize, self.block_ysize = raster_info['block_size']
-        self.block_xmod = self.block_xsize-1
-        self.block_ymod = self.block_ysize-1
-
-        if not (1 <= band_id <= raster_info['n_bands']):
-            err_msg = (
-                "Error: band ID (%s) is not a valid band number. "
-                "This exception is happening in Cython, so it will cause a "
-                "hard seg-fault, but it's otherwise meant to be a "
-                "ValueError." % (band_id))
-            print(err_msg)
-            raise ValueError(err_msg)
-        self.band_id = band_id
-
-        if (self.block_xsize & (self.block_xsize - 1) != 0) or (
-                self.block_ysize & (self.block_ysize - 1) != 0):
-            # If inputs are not a power of two, this will at least print
-            # an error message. Unfortunately with Cython, the exception will
-            # present itself as a hard seg-fault, but I'm leaving the
-            # ValueError in here at least for readability.
-            err_msg = (
-                "Error: Block size is not a power of two: "
-                "block_xsize: %d, %d, %s. This exception is happening"
-                "in Cython, so it will cause a hard seg-fault, but it's"
-                "otherwise meant to be a ValueError." % (
-                    self.block_xsize, self.block_ysize, raster_path))
-            print(err_msg)
-            raise ValueError(err_msg)
-
-        self.block_xbits = numpy.log2(self.block_xsize)
-        self.block_ybits = numpy.log2(self.block_ysize)
-        self.block_nx = (
-            self.raster_x_size + (self.block_xsize) - 1) / self.block_xsize
-        self.block_ny = (
-            self.raster_y_size + (self.block_ysize) - 1) / self.block_ysize
-
-        self.lru_cache = new LRUCache[int, double*](MANAGED_RASTER_N_BLOCKS)
-        self.raster_path = <bytes> raster_path
-        self.write_mode = write_mode
-        self.closed = 0
-
-    def __dealloc__(self):
-        """Deallocate _ManagedRaster.
-
-        This operation manually frees memory from the LRUCache and writes any
-        dirty memory blocks back to the raster if `self.write_mode` is True.
-        """
-        self.close()
-
-    def close(self):
-        """Close the _ManagedRaster and free up resources.
-
-            This call writes any dirty blocks to disk, frees up the memory
-            allocated as part of the cache, and frees all GDAL references.
-
-            Any subsequent calls to any other functions in _ManagedRaster will
-            have undefined behavior.
-        """
-        if self.closed:
-            return
-        self.closed = 1
-        cdef int xi_copy, yi_copy
-        cdef numpy.ndarray[double, ndim=2] block_array = numpy.empty(
-            (self.block_ysize, self.block_xsize))
-        cdef double *double_buffer
-        cdef int block_xi
-        cdef int block_yi
-        # initially the win size is the same as the block size unless
-        # we're at the edge of a raster
-        cdef int win_xsize
-        cdef int win_ysize
-
-        # we need the offsets to subtract from global indexes for cached array
-        cdef int xoff
-        cdef int yoff
-
-        cdef clist[BlockBufferPair].iterator it = self.lru_cache.begin()
-        cdef clist[BlockBufferPair].iterator end = self.lru_cache.end()
-        if not self.write_mode:
-            while it != end:
-                # write the changed value back if desired
-                PyMem_Free(deref(it).second)
-                inc(it)
-            return
-
-        raster = gdal.OpenEx(
-            self.raster_path, gdal.GA_Update | gdal.OF_RASTER)
-        raster_band = raster.GetRasterBand(self.band_id)
-
-        # if we get here, we're in write_mode
-        cdef cset[int].iterator dirty_itr
-        while it != end:
-            double_buffer = deref(it).second
-            block_index = deref(it).first
-
-            # write to disk if block is dirty
-            dirty_itr = self.dirty_blocks.find(block_index)
-            if dirty_itr != self.dirty_blocks.end():
-                self.dirty_blocks.erase(dirty_itr)
-                block_xi = block_index % self.block_nx
-                block_yi = block_index / self.block_nx
-
-                # we need the offsets to subtract from global indexes for
-                # cached array
-                xoff = block_xi << self.block_xbits
-                yoff = block_yi << self.block_ybits
-
-                win_xsize = self.block_xsize
-                win_ysize = self.block_ysize
-
-                # clip window sizes if necessary
-                if xoff+win_xsize > self.raster_x_size:
-                    win_xsize = win_xsize - (
-                        xoff+win_xsize - self.raster_x_size)
-                if yoff+win_ysize > self.raster_y_size:
-                    win_ysize = win_ysize - (
-                        yoff+win_ysize - self.raster_y_size)
-
-                for xi_copy in xrange(win_xsize):
-                    for yi_copy in xrange(win_ysize):
-                        block_array[yi_copy, xi_copy] = (
-                            double_buffer[
-                                (yi_copy << self.block_xbits) + xi_copy])
-                raster_band.WriteArray(
-                    block_array[0:win_ysize, 0:win_xsize],
-                    xoff=xoff, yoff=yoff)
-            PyMem_Free(double_buffer)
-            inc(it)
-        raster_band.FlushCache()
-        raster_band = None
-        raster = None
-
-    cdef inline void set(self, long xi, long yi, double value):
-        """Set the pixel at `xi,yi` to `value`."""
-        cdef int block_xi = xi >> self.block_xbits
-        cdef int block_yi = yi >> self.block_ybits
-        # this is the flat index for the block
-        cdef int block_index = block_yi * self.block_nx + block_xi
-        if not self.lru_cache.exist(block_index):
-            self._load_block(block_index)
-        self.lru_cache.get(
-            block_index)[
-                ((yi & (self.block_ymod))<<self.block_xbits) +
-                (xi & (self.block_xmod))] = value
-        if self.write_mode:
-            dirty_itr = self.dirty_blocks.find(block_index)
-            if dirty_itr == self.dirty_blocks.end():
-                self.dirty_blocks.insert(block_index)
-
-    cdef inline double get(self, long xi, long yi):
-        """Return the value of the pixel at `xi,yi`."""
-        cdef int block_xi = xi >> self.block_xbits
-        cdef int block_yi = yi >> self.block_ybits
-        # this is the flat index for the block
-        cdef int block_index = block_yi * self.block_nx + block_xi
-        if not self.lru_cache.exist(block_index):
-            self._load_block(block_index)
-        return self.lru_cache.get(
-            block_index)[
-                ((yi & (self.block_ymod))<<self.block_xbits) +
-                (xi & (self.block_xmod))]
-
-    cdef void _load_block(self, int block_index) except *:
-        cdef int block_xi = block_index % self.block_nx
-        cdef int block_yi = block_index / self.block_nx
-
-        # we need the offsets to subtract from global indexes for cached array
-        cdef int xoff = block_xi << self.block_xbits
-        cdef int yoff = block_yi << self.block_ybits
-
-        cdef int xi_copy, yi_copy
-        cdef numpy.ndarray[double, ndim=2] block_array
-        cdef double *double_buffer
-        cdef clist[BlockBufferPair] removed_value_list
-
-        # determine the block aligned xoffset for read as array
-
-        # initially the win size is the same as the block size unless
-        # we're at the edge of a raster
-        cdef int win_xsize = self.block_xsize
-        cdef int win_ysize = self.block_ysize
-
-        # load a new block
-        if xoff+win_xsize > self.raster_x_size:
-            win_xsize = win_xsize - (xoff+win_xsize - self.raster_x_size)
-        if yoff+win_ysize > self.raster_y_size:
-            win_ysize = win_ysize - (yoff+win_ysize - self.raster_y_size)
-
-        raster = gdal.OpenEx(self.raster_path, gdal.OF_RASTER)
-        raster_band = raster.GetRasterBand(self.band_id)
-        block_array = raster_band.ReadAsArray(
-            xoff=xoff, yoff=yoff, win_xsize=win_xsize,
-            win_ysize=win_ysize).astype(
-            numpy.float64)
-        raster_band = None
-        raster = None
-        double_buffer = <double*>PyMem_Malloc(
-            (sizeof(double) << self.block_xbits) * win_ysize)
-        for xi_copy in xrange(win_xsize):
-            for yi_copy in xrange(win_ysize):
-                double_buffer[(yi_copy<<self.block_xbits)+xi_copy] = (
-                    block_array[yi_copy, xi_copy])
-        self.lru_cache.put(
-            <int>block_index, <double*>double_buffer, removed_value_list)
-
-        if self.write_mode:
-            raster = gdal.OpenEx(
-                self.raster_path, gdal.GA_Update | gdal.OF_RASTER)
-            raster_band = raster.GetRasterBand(self.band_id)
-
-        block_array = numpy.empty(
-            (self.block_ysize, self.block_xsize), dtype=numpy.double)
-        while not removed_value_list.empty():
-            # write the changed value back if desired
-            double_buffer = removed_value_list.front().second
-
-            if self.write_mode:
-                block_index = removed_value_list.front().first
-
-                # write back the block if it's dirty
-                dirty_itr = self.dirty_blocks.find(block_index)
-                if dirty_itr != self.dirty_blocks.end():
-                    self.dirty_blocks.erase(dirty_itr)
-
-                    block_xi = block_index % self.block_nx
-                    block_yi = block_index / self.block_nx
-
-                    xoff = block_xi << self.block_xbits
-                    yoff = block_yi << self.block_ybits
-
-                    win_xsize = self.block_xsize
-                    win_ysize = self.block_ysize
-
-                    if xoff+win_xsize > self.raster_x_size:
-                        win_xsize = win_xsize - (
-                            xoff+win_xsize - self.raster_x_size)
-                    if yoff+win_ysize > self.raster_y_size:
-                        win_ysize = win_ysize - (
-                            yoff+win_ysize - self.raster_y_size)
-
-                    for xi_copy in xrange(win_xsize):
-                        for yi_copy in xrange(win_ysize):
-                            block_array[yi_copy, xi_copy] = double_buffer[
-                                (yi_copy << self.block_xbits) + xi_copy]
-                    raster_band.WriteArray(
-                        block_array[0:win_ysize, 0:win_xsize],
-                        xoff=xoff, yoff=yoff)
-            PyMem_Free(double_buffer)
-            removed_value_list.pop_front()
-
-        if self.write_mode:
-            raster_band = None
-            raster = None
-
 
 cpdef calculate_local_recharge(
         precip_path_list, et0_path_list, qf_m_path_list, flow_dir_mfd_path,
@@ -384,10 +76,11 @@ cpdef calculate_local_recharge(
         precip_path_list (list): list of paths to monthly precipitation
             rasters. (model input)
         et0_path_list (list): path to monthly ET0 rasters. (model input)
-        qf_m_path_list (list): path to monthly quickflow rasters calculated by
-            Equation [1].
-        flow_dir_mfd_path (str): path to a PyGeoprocessing Multiple Flow
-            Direction raster indicating flow directions for this analysis.
+        qf_m_path_list (list): path to monthly float32 quickflow rasters
+            calculated by Equation [1].
+        flow_dir_mfd_path (str): path to a PyGeoprocessing int32 Multiple
+            Flow Direction raster indicating flow directions for this
+            analysis.
         alpha_month_map (dict): fraction of upslope annual available recharge
             that is available in month m (indexed from 1).
         beta_i (float):  fraction of the upgradient subsidy that is available
@@ -396,8 +89,8 @@ cpdef calculate_local_recharge(
             downgradient pixels.
         stream_path (str): path to the stream raster where 1 is a stream,
             0 is not, and nodata is outside of the DEM.
-        kc_path_list (str): list of rasters of the monthly crop factor for the
-            pixel.
+        kc_path_list (str): list of float32 rasters of the monthly crop factor
+            for the pixel.
         target_li_path (str): created by this call, path to local recharge
             derived from the annual water budget. (Equation 3).
         target_li_avail_path (str): created by this call, path to raster
@@ -424,7 +117,8 @@ cpdef calculate_local_recharge(
     cdef float mfd_direction_array[8]
 
     cdef queue[pair[int, int]] work_queue
-    cdef _ManagedRaster et0_m_raster, qf_m_raster, kc_m_raster
+    cdef _ManagedRaster et0_m_raster
+    cdef _ManagedFloat32Raster qf_m_raster, kc_m_raster
 
     cdef numpy.ndarray[numpy.npy_float32, ndim=1] alpha_month_array = (
         numpy.array(
@@ -439,7 +133,12 @@ cpdef calculate_local_recharge(
     flow_dir_raster_info = pygeoprocessing.get_raster_info(flow_dir_mfd_path)
     flow_dir_nodata = flow_dir_raster_info['nodata'][0]
     raster_x_size, raster_y_size = flow_dir_raster_info['raster_size']
-    cdef _ManagedRaster flow_raster = _ManagedRaster(flow_dir_mfd_path, 1, 0)
+    cdef _ManagedInt32Raster flow_raster = _ManagedInt32Raster(
+        flow_dir_mfd_path, 1, 0)
+
+    # a raster is open for every month of four inputs at once, so each of
+    # them gets a quarter of the default cache budget
+    monthly_cache_bytes = managed_raster.get_cache_bytes() // 4
 
     # make sure that user input nodata values are defined
     # set to -1 if not defined
@@ -448,7 +147,8 @@ cpdef calculate_local_recharge(
     et0_m_raster_list = []
     et0_m_nodata_list = []
     for et0_path in et0_path_list:
-        et0_m_raster_list.append(_ManagedRaster(et0_path, 1, 0))
+        et0_m_raster_list.append(_ManagedRaster(
+            et0_path, 1, 0, cache_bytes=monthly_cache_bytes))
         nodata = pygeoprocessing.get_raster_info(et0_path)['nodata'][0]
         if nodata is None:
             nodata = -1
@@ -457,7 +157,8 @@ cpdef calculate_local_recharge(
     precip_m_raster_list = []
     precip_m_nodata_list = []
     for precip_m_path in precip_path_list:
-        precip_m_raster_list.append(_ManagedRaster(precip_m_path, 1, 0))
+        precip_m_raster_list.append(_ManagedRaster(
+            precip_m_path, 1, 0, cache_bytes=monthly_cache_bytes))
         nodata = pygeoprocessing.get_raster_info(precip_m_path)['nodata'][0]
         if nodata is None:
             nodata = -1
@@ -466,14 +167,16 @@ cpdef calculate_local_recharge(
     qf_m_raster_list = []
     qf_m_nodata_list = []
     for qf_m_path in qf_m_path_list:
-        qf_m_raster_list.append(_ManagedRaster(qf_m_path, 1, 0))
+        qf_m_raster_list.append(_ManagedFloat32Raster(
+            qf_m_path, 1, 0, cache_bytes=monthly_cache_bytes))
         qf_m_nodata_list.append(
             pygeoprocessing.get_raster_info(qf_m_path)['nodata'][0])
 
     kc_m_raster_list = []
     kc_m_nodata_list = []
     for kc_m_path in kc_path_list:
-        kc_m_raster_list.append(_ManagedRaster(kc_m_path, 1, 0))
+        kc_m_raster_list.append(_ManagedFloat32Raster(
+            kc_m_path, 1, 0, cache_bytes=monthly_cache_bytes))
         kc_m_nodata_list.append(
             pygeoprocessing.get_raster_info(kc_m_path)['nodata'][0])
 
@@ -481,25 +184,25 @@ cpdef calculate_local_recharge(
     pygeoprocessing.new_raster_from_base(
         flow_dir_mfd_path, target_li_path, gdal.GDT_Float32, [target_nodata],
         fill_value_list=[target_nodata])
-    cdef _ManagedRaster target_li_raster = _ManagedRaster(
+    cdef _ManagedFloat32Raster target_li_raster = _ManagedFloat32Raster(
         target_li_path, 1, 1)
 
     pygeoprocessing.new_raster_from_base(
         flow_dir_mfd_path, target_li_avail_path, gdal.GDT_Float32,
         [target_nodata], fill_value_list=[target_nodata])
-    cdef _ManagedRaster target_li_avail_raster = _ManagedRaster(
-        target_li_avail_path, 1, 1)
+    cdef _ManagedFloat32Raster target_li_avail_raster = (
+        _ManagedFloat32Raster(target_li_avail_path, 1, 1))
 
     pygeoprocessing.new_raster_from_base(
         flow_dir_mfd_path, target_l_sum_avail_path, gdal.GDT_Float32,
         [target_nodata], fill_value_list=[target_nodata])
-    cdef _ManagedRaster target_l_sum_avail_raster = _ManagedRaster(
-        target_l_sum_avail_path, 1, 1)
+    cdef _ManagedFloat32Raster target_l_sum_avail_raster = (
+        _ManagedFloat32Raster(target_l_sum_avail_path, 1, 1))
 
     pygeoprocessing.new_raster_from_base(
         flow_dir_mfd_path, target_aet_path, gdal.GDT_Float32, [target_nodata],
         fill_value_list=[target_nodata])
-    cdef _ManagedRaster target_aet_raster = _ManagedRaster(
+    cdef _ManagedFloat32Raster target_aet_raster = _ManagedFloat32Raster(
         target_aet_path, 1, 1)
 
 
@@ -618,11 +321,11 @@ cpdef calculate_local_recharge(
                         precip_m_raster = (
                             <_ManagedRaster?>precip_m_raster_list[m_index])
                         qf_m_raster = (
-                            <_ManagedRaster?>qf_m_raster_list[m_index])
+                            <_ManagedFloat32Raster?>qf_m_raster_list[m_index])
                         et0_m_raster = (
                             <_ManagedRaster?>et0_m_raster_list[m_index])
                         kc_m_raster = (
-                            <_ManagedRaster?>kc_m_raster_list[m_index])
+                            <_ManagedFloat32Raster?>kc_m_raster_list[m_index])
 
                         et0_nodata = et0_m_nodata_list[m_index]
                         precip_nodata = precip_m_nodata_list[m_index]
@@ -684,14 +387,14 @@ def route_baseflow_sum(
     """Route Baseflow through MFD as described in Equation 11.
 
     Args:
-        flow_dir_mfd_path (string): path to a pygeoprocessing multiple flow
-            direction raster.
+        flow_dir_mfd_path (string): path to a pygeoprocessing int32 multiple
+            flow direction raster.
         l_path (string): path to local recharge raster.
-        l_avail_path (string): path to local recharge raster that shows
-            recharge available to the pixel.
+        l_avail_path (string): path to float32 local recharge raster that
+            shows recharge available to the pixel.
         l_sum_path (string): path to upstream sum of l_path.
-        stream_path (string): path to stream raster, 1 stream, 0 no stream,
-            and nodata.
+        stream_path (string): path to byte stream raster, 1 stream, 0 no
+            stream, and nodata.
         target_b_path (string): path to created raster for per-pixel baseflow.
         target_b_sum_path (string): path to created raster for per-pixel
             upstream sum of baseflow.
@@ -729,17 +432,21 @@ def route_baseflow_sum(
         flow_dir_mfd_path, target_b_path, gdal.GDT_Float32,
         [target_nodata], fill_value_list=[target_nodata])
 
-    cdef _ManagedRaster target_b_sum_raster = _ManagedRaster(
+    cdef _ManagedFloat32Raster target_b_sum_raster = _ManagedFloat32Raster(
         target_b_sum_path, 1, 1)
-    cdef _ManagedRaster target_b_raster = _ManagedRaster(
+    cdef _ManagedFloat32Raster target_b_raster = _ManagedFloat32Raster(
         target_b_path, 1, 1)
+    # l_path may be a user's local recharge raster of any type, and
+    # l_sum_path is the float64 flow accumulation of it
     cdef _ManagedRaster l_raster = _ManagedRaster(l_path, 1, 0)
-    cdef _ManagedRaster l_avail_raster = _ManagedRaster(l_avail_path, 1, 0)
+    cdef _ManagedFloat32Raster l_avail_raster = _ManagedFloat32Raster(
+        l_avail_path, 1, 0)
     cdef _ManagedRaster l_sum_raster = _ManagedRaster(l_sum_path, 1, 0)
-    cdef _ManagedRaster flow_dir_mfd_raster = _ManagedRaster(
+    cdef _ManagedInt32Raster flow_dir_mfd_raster = _ManagedInt32Raster(
         flow_dir_mfd_path, 1, 0)
 
-    cdef _ManagedRaster stream_raster = _ManagedRaster(stream_path, 1, 0)
+    cdef _ManagedByteRaster stream_raster = _ManagedByteRaster(
+        stream_path, 1, 0)
 
     current_pixel = 0
     for offset_dict in pygeoprocessing.iterblocks(
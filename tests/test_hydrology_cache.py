@@ -0,0 +1,177 @@
+"""Module for Testing the shared hydrology product cache."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy
+from osgeo import osr
+
+
+def _make_dem(target_path):
+    """Write a 20x20 DEM with a valley that drains to row 0."""
+    import pygeoprocessing
+    valley = numpy.abs(numpy.arange(20) - 10).astype(numpy.float32)
+    dem_array = numpy.tile(valley, (20, 1)) + numpy.arange(
+        20, dtype=numpy.float32).reshape((20, 1))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32731)  # WGS84 / UTM zone 31s
+    pygeoprocessing.numpy_array_to_raster(
+        dem_array, -1, (2, -2), (2, -2), srs.ExportToWkt(), target_path)
+
+
+class HydrologyCacheTests(unittest.TestCase):
+    """Tests for natcap.invest.hydrology_cache."""
+
+    def setUp(self):
+        """Create a temporary workspace and turn the cache on."""
+        from natcap.invest import hydrology_cache
+        self.workspace_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.workspace_dir, 'cache')
+        self.dem_path = os.path.join(self.workspace_dir, 'dem.tif')
+        _make_dem(self.dem_path)
+        hydrology_cache.set_cache_dir(self.cache_dir)
+
+    def tearDown(self):
+        """Turn the cache off and remove the workspace."""
+        from natcap.invest import hydrology_cache
+        hydrology_cache.set_cache_dir(None)
+        shutil.rmtree(self.workspace_dir)
+
+    def _route(self, run_dir, threshold=5):
+        """Route the DEM into ``run_dir`` and return the product paths."""
+        from natcap.invest import hydrology_cache
+        os.makedirs(run_dir, exist_ok=True)
+        paths = [os.path.join(run_dir, '%s.tif' % name) for name in (
+            'filled', 'flow_dir', 'flow_accum', 'streams')]
+        hydrology_cache.fill_pits(
+            (self.dem_path, 1), paths[0], working_dir=run_dir)
+        hydrology_cache.flow_dir_mfd(
+            (paths[0], 1), paths[1], working_dir=run_dir)
+        hydrology_cache.flow_accumulation_mfd((paths[1], 1), paths[2])
+        hydrology_cache.extract_streams_mfd(
+            (paths[2], 1), (paths[1], 1), threshold, paths[3],
+            trace_threshold_proportion=0.7)
+        return paths
+
+    def test_products_reused_across_workspaces(self):
+        """Hydrology cache: a second workspace copies every product."""
+        import pygeoprocessing
+        import pygeoprocessing.routing
+
+        first_paths = self._route(os.path.join(self.workspace_dir, 'first'))
+
+        routing_funcs = [
+            'fill_pits', 'flow_dir_mfd', 'flow_accumulation_mfd',
+            'extract_streams_mfd']
+        with mock.patch.multiple(
+                pygeoprocessing.routing,
+                **{name: mock.DEFAULT for name in routing_funcs}) as mocks:
+            second_paths = self._route(
+                os.path.join(self.workspace_dir, 'second'))
+        for name in routing_funcs:
+            mocks[name].assert_not_called()
+
+        for first_path, second_path in zip(first_paths, second_paths):
+            numpy.testing.assert_array_equal(
+                pygeoprocessing.raster_to_numpy_array(first_path),
+                pygeoprocessing.raster_to_numpy_array(second_path))
+
+    def test_parameters_in_key(self):
+        """Hydrology cache: a new stream threshold extracts new streams."""
+        import pygeoprocessing
+        import pygeoprocessing.routing
+
+        self._route(os.path.join(self.workspace_dir, 'first'), threshold=5)
+
+        other_dir = os.path.join(self.workspace_dir, 'other')
+        with mock.patch.object(
+                pygeoprocessing.routing, 'extract_streams_mfd',
+                wraps=pygeoprocessing.routing.extract_streams_mfd) as streams:
+            stream_path = self._route(other_dir, threshold=50)[3]
+        streams.assert_called_once()
+
+        expected_path = os.path.join(self.workspace_dir, 'expected.tif')
+        pygeoprocessing.routing.extract_streams_mfd(
+            (os.path.join(other_dir, 'flow_accum.tif'), 1),
+            (os.path.join(other_dir, 'flow_dir.tif'), 1), 50, expected_path,
+            trace_threshold_proportion=0.7)
+        numpy.testing.assert_array_equal(
+            pygeoprocessing.raster_to_numpy_array(expected_path),
+            pygeoprocessing.raster_to_numpy_array(stream_path))
+
+    def test_eviction(self):
+        """Hydrology cache: least recently used products are evicted."""
+        from natcap.invest import hydrology_cache
+
+        self._route(os.path.join(self.workspace_dir, 'first'))
+        cached_rasters = [
+            os.path.join(self.cache_dir, filename)
+            for filename in os.listdir(self.cache_dir)
+            if filename.endswith('.tif')]
+        self.assertEqual(len(cached_rasters), 4)
+
+        # set the access order by hand so the test doesn't depend on the
+        # resolution of the file system's timestamps
+        for access_time, raster_path in enumerate(cached_rasters):
+            os.utime(raster_path, (access_time, access_time))
+        newest_path = cached_rasters[-1]
+
+        # room for the newest product only
+        hydrology_cache._evict(
+            self.cache_dir, os.path.getsize(newest_path))
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            sorted([
+                os.path.basename(newest_path),
+                os.path.basename(newest_path).replace('.tif', '.json')]))
+
+    def test_cache_off(self):
+        """Hydrology cache: nothing is cached when no directory is set."""
+        from natcap.invest import hydrology_cache
+        hydrology_cache.set_cache_dir(None)
+
+        paths = self._route(os.path.join(self.workspace_dir, 'first'))
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_stale_incomplete_files_evicted(self):
+        """Hydrology cache: files left by dead inserts are removed."""
+        from natcap.invest import hydrology_cache
+        os.makedirs(self.cache_dir)
+        stale_path = os.path.join(self.cache_dir, 'incomplete_stale.tif')
+        fresh_path = os.path.join(self.cache_dir, 'incomplete_fresh.json')
+        for path in (stale_path, fresh_path):
+            with open(path, 'wb') as incomplete_file:
+                incomplete_file.write(b'\0' * 100)
+        stale_time = time.time() - 2 * hydrology_cache._INCOMPLETE_MAX_AGE
+        os.utime(stale_path, (stale_time, stale_time))
+
+        hydrology_cache._evict(self.cache_dir, 2**30)
+        self.assertEqual(
+            os.listdir(self.cache_dir), [os.path.basename(fresh_path)])
+
+    def test_failed_insert_is_miss(self):
+        """Hydrology cache: a product that can't be cached is still made."""
+        import pygeoprocessing
+        replace = os.replace
+
+        def _replace_outside_cache(source_path, target_path):
+            # like Windows when another process has the cached file open
+            if os.path.dirname(target_path) == self.cache_dir:
+                raise PermissionError(target_path)
+            replace(source_path, target_path)
+
+        with mock.patch('os.replace', _replace_outside_cache):
+            paths = self._route(os.path.join(self.workspace_dir, 'first'))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        expected_paths = self._route(
+            os.path.join(self.workspace_dir, 'second'))
+        for path, expected_path in zip(paths, expected_paths):
+            numpy.testing.assert_array_equal(
+                pygeoprocessing.raster_to_numpy_array(path),
+                pygeoprocessing.raster_to_numpy_array(expected_path))
@@ -7,8 +7,10 @@ import unittest
 
 import numpy
 import pygeoprocessing
+import pygeoprocessing.routing
 from osgeo import gdal
 from osgeo import ogr
+from osgeo import osr
 
 REGRESSION_DATA = os.path.join(
     os.path.dirname(__file__), '..', 'data', 'invest-test-data', 'ndr')
@@ -173,6 +175,106 @@ class NDRTests(unittest.TestCase):
             raise AssertionError(
                 "The following values are not equal: %s" % error_results)
 
+    def test_ndr_eff_calculation_multi(self):
+        """NDR joint effective retention matches stored per-nutrient output."""
+        from natcap.invest.ndr import ndr_core
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32731)  # WGS84 / UTM zone 31s
+        n_rows, n_cols = 7, 7
+        random_state = numpy.random.RandomState(5)
+        # a slope falling toward a stream along the bottom row
+        dem_array = (
+            10 * numpy.arange(n_rows, 0, -1)[:, numpy.newaxis] +
+            random_state.uniform(0, 5, (n_rows, n_cols)))
+
+        # pack MFD weights by hand, 4 bits per direction, so the expected
+        # values below don't depend on the routing implementation
+        row_offsets = [0, -1, -1, -1, 0, 1, 1, 1]
+        col_offsets = [1, 1, 0, -1, -1, -1, 0, 1]
+        flow_dir_array = numpy.empty((n_rows, n_cols), dtype=numpy.int32)
+        flow_dir_array[-1, :] = 0xF << (6 * 4)  # stream drains off the edge
+        for row in range(n_rows - 1):
+            for col in range(n_cols):
+                flow_dir = 0
+                for i in range(8):
+                    ds_row = row + row_offsets[i]
+                    ds_col = col + col_offsets[i]
+                    if (0 <= ds_row < n_rows and 0 <= ds_col < n_cols and
+                            dem_array[ds_row, ds_col] < dem_array[row, col]):
+                        drop = dem_array[row, col] - dem_array[ds_row, ds_col]
+                        flow_dir |= min(7, 1 + int(drop)) << (i * 4)
+                flow_dir_array[row, col] = flow_dir
+        stream_array = numpy.zeros((n_rows, n_cols), dtype=numpy.uint8)
+        stream_array[-1, :] = 1
+
+        def _path(name):
+            return os.path.join(self.workspace_dir, '%s.tif' % name)
+
+        def _write(array, name, nodata=-1):
+            pygeoprocessing.numpy_array_to_raster(
+                array, nodata, (30, -30), (0, 0), srs.ExportToWkt(),
+                _path(name))
+
+        _write(flow_dir_array, 'flow_dir', nodata=0)
+        _write(stream_array, 'stream', nodata=255)
+        eff_p_array = random_state.uniform(0, 0.8, (n_rows, n_cols))
+        eff_p_array[::3, ::2] = -1  # nodata in one nutrient only
+        _write(eff_p_array.astype(numpy.float32), 'eff_p')
+        for name in ('eff_n', 'crit_len_n', 'crit_len_p'):
+            high = 0.8 if name.startswith('eff') else 150
+            _write(
+                random_state.uniform(0, high, (n_rows, n_cols)).astype(
+                    numpy.float32), name)
+
+        # effective retention from the single nutrient kernel before it was
+        # rewritten on top of ndr_eff_calculation_multi
+        expected_n_array = numpy.array([
+            [0.5449483, 0.58095825, 0.7598667, 0.71437657,
+             0.72907555, 0.7310378, 0.71735096],
+            [0.55659074, 0.53330576, 0.57132185, 0.7257117,
+             0.760647, 0.70086795, 0.7318787],
+            [0.52766144, 0.52832925, 0.5384958, 0.6250848,
+             0.7133996, 0.7555672, 0.62477684],
+            [0.54819, 0.5067513, 0.5300464, 0.56777203,
+             0.77743596, 0.46995154, 0.5198647],
+            [0.19866379, 0.18987921, 0.27750736, 0.6004032,
+             0.2630754, 0.42945728, 0.6387938],
+            [0.21131195, 0.049628064, 0.16251361, 0.06412166,
+             0.4592667, 0.1212688, 0.1399867],
+            [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+        ], dtype=numpy.float32)
+        expected_p_array = numpy.array([
+            [-1.0, 0.64215064, -1.0, 0.39732784, -1.0, 0.5947987, -1.0],
+            [0.77193224, 0.5110845, 0.64391184, 0.43442094,
+             0.4876902, 0.6278795, 0.74105996],
+            [0.47020614, 0.482596, 0.3252572, 0.28859153,
+             0.30637562, 0.44005984, 0.4636679],
+            [-1.0, 0.45289594, -1.0, 0.57450956, -1.0, 0.4466476, -1.0],
+            [0.37720728, 0.47648433, 0.68105614, 0.75449544,
+             0.39636558, 0.6496237, 0.37854278],
+            [0.10410112, 0.3064995, 0.33904657, 0.67812157,
+             0.2681457, 0.0086478, 0.48026305],
+            [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+        ], dtype=numpy.float32)
+
+        ndr_core.ndr_eff_calculation_multi(
+            _path('flow_dir'), _path('stream'),
+            [_path('eff_n'), _path('eff_p')],
+            [_path('crit_len_n'), _path('crit_len_p')],
+            [_path('joint_n'), _path('joint_p')])
+        for nutrient, expected_array in (
+                ('n', expected_n_array), ('p', expected_p_array)):
+            ndr_core.ndr_eff_calculation(
+                _path('flow_dir'), _path('stream'), _path('eff_%s' % nutrient),
+                _path('crit_len_%s' % nutrient),
+                _path('single_%s' % nutrient))
+            for prefix in ('joint', 'single'):
+                numpy.testing.assert_array_equal(
+                    pygeoprocessing.raster_to_numpy_array(
+                        _path('%s_%s' % (prefix, nutrient))),
+                    expected_array)
+
     def test_missing_lucode(self):
         """NDR missing lucode in biophysical table should raise a KeyError."""
         from natcap.invest.ndr import ndr
@@ -1,16 +1,20 @@
 """InVEST Recreation model tests."""
 import datetime
 import glob
+import io
 import zipfile
 import socket
 import threading
+import uuid
 import unittest
+from unittest import mock
 import tempfile
 import shutil
 import os
 import functools
 import logging
 import json
+import pickle
 import queue
 import multiprocessing
 
@@ -20,6 +24,9 @@ import pandas
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+import shapely.geometry
+import shapely.ops
+import shapely.wkb
 import taskgraph
 import warnings
 
@@ -106,6 +113,13 @@ def _resample_csv(base_csv_path, base_dst_path, resample_factor):
                     write_table.write(line)
 
 
+def _read_csv_rows(csv_path):
+    """Return the bytes of a csv file after its header line."""
+    with open(csv_path, 'rb') as csv_file:
+        csv_file.readline()
+        return csv_file.read()
+
+
 class TestBufferedNumpyDiskMap(unittest.TestCase):
     """Tests for BufferedNumpyDiskMap."""
 
@@ -138,6 +152,392 @@ class TestBufferedNumpyDiskMap(unittest.TestCase):
             file_manager.read(1234)
 
 
+class TestMemoryMappedNumpyDiskMap(unittest.TestCase):
+    """Tests for MemoryMappedNumpyDiskMap."""
+
+    def setUp(self):
+        """Setup workspace."""
+        self.workspace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete workspace."""
+        shutil.rmtree(self.workspace_dir)
+
+    def test_basic_operation(self):
+        """Recreation test memory mapped node store basic ops w/ no buffer."""
+        from natcap.invest.recreation import mmap_numpy_disk_map
+        file_manager = mmap_numpy_disk_map.MemoryMappedNumpyDiskMap(
+            os.path.join(self.workspace_dir, 'test'), 0,
+            array_dtype=numpy.int64)
+
+        file_manager.append(1234, numpy.array([1, 2, 3, 4]))
+        file_manager.append(1234, numpy.array([1, 2, 3, 4]))
+        file_manager.append(4321, numpy.array([-4, -1, -2, 4]))
+
+        numpy.testing.assert_equal(
+            file_manager.read(1234), numpy.array([1, 2, 3, 4, 1, 2, 3, 4]))
+
+        numpy.testing.assert_equal(
+            file_manager.read(4321), numpy.array([-4, -1, -2, 4]))
+
+        # grow a node past several extent capacities
+        expected_array = numpy.arange(1000)
+        for index in range(0, 1000, 100):
+            file_manager.append(42, expected_array[index:index+100])
+        numpy.testing.assert_equal(file_manager.read(42), expected_array)
+
+        file_manager.delete(1234)
+        self.assertEqual(file_manager.read(1234).size, 0)
+
+    def test_persistence(self):
+        """Recreation test memory mapped node store reopened from disk."""
+        from natcap.invest.recreation import mmap_numpy_disk_map
+        manager_path = os.path.join(self.workspace_dir, 'test')
+        file_manager = mmap_numpy_disk_map.MemoryMappedNumpyDiskMap(
+            manager_path, 2**20)
+        point_array = numpy.empty(
+            3, dtype=mmap_numpy_disk_map._ARRAY_TUPLE_TYPE)
+        point_array['f0'] = numpy.datetime64('2013-03-16')
+        point_array['f1'] = b'abcd'
+        point_array['f2'] = [1.0, 2.0, 3.0]
+        point_array['f3'] = [-1.0, -2.0, -3.0]
+        file_manager.append(0, point_array)
+        file_manager.append(1, point_array[:1])
+        file_manager.delete(1)
+        file_manager.close()
+
+        file_manager = mmap_numpy_disk_map.MemoryMappedNumpyDiskMap(
+            manager_path, 2**20)
+        result = file_manager.read(0)
+        numpy.testing.assert_equal(result, point_array)
+        self.assertFalse(result.flags.writeable)
+        self.assertEqual(file_manager.read(1).size, 0)
+
+    def test_grow_reuses_extent(self):
+        """Recreation test memory mapped views across a node move."""
+        from natcap.invest.recreation import mmap_numpy_disk_map
+        file_manager = mmap_numpy_disk_map.MemoryMappedNumpyDiskMap(
+            os.path.join(self.workspace_dir, 'test'), 0,
+            array_dtype=numpy.int64)
+        n_records = mmap_numpy_disk_map._MIN_EXTENT_RECORDS
+        first_array = numpy.arange(n_records)
+        file_manager.append(0, first_array)
+        first_offset, _ = file_manager.get_extent(0)
+
+        # while frozen, a view read before the node moves keeps its data
+        file_manager.freeze_extents()
+        frozen_view = file_manager.read(0)
+        file_manager.append(0, numpy.array([-1]))
+        file_manager.append(1, -first_array)
+        self.assertNotEqual(file_manager.get_extent(1)[0], first_offset)
+        numpy.testing.assert_equal(frozen_view, first_array)
+        file_manager.release_frozen_extents()
+
+        # otherwise the old extent is reused by the next node that needs
+        # one, and views read before the move see that node's records
+        file_manager.append(2, -first_array)
+        self.assertEqual(file_manager.get_extent(2)[0], first_offset)
+        numpy.testing.assert_equal(frozen_view, -first_array)
+        numpy.testing.assert_equal(
+            file_manager.read(0), numpy.append(first_array, -1))
+        numpy.testing.assert_equal(file_manager.read(2), -first_array)
+
+
+class TestResultCache(unittest.TestCase):
+    """Tests for the recreation server ResultCache."""
+
+    def setUp(self):
+        """Setup workspace."""
+        self.workspace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete workspace."""
+        shutil.rmtree(self.workspace_dir)
+
+    def test_result_cache(self):
+        """Recreation test result cache put/get and size eviction."""
+        from natcap.invest.recreation import result_cache
+
+        cache = result_cache.ResultCache(
+            os.path.join(self.workspace_dir, 'cache'), 1500, 3600)
+        self.assertIsNone(cache.get_result('missing'))
+
+        archive_path = os.path.join(self.workspace_dir, 'archive.zip')
+        for index, result_key in enumerate(['a', 'b']):
+            with open(archive_path, 'wb') as archive_file:
+                archive_file.write(bytes([index]) * 1000)
+            cache.put_result(result_key, archive_path)
+            # age the archive so the modified times are distinct
+            result_path = os.path.join(
+                cache.cache_dir, '%s.zip' % result_key)
+            result_mtime = os.path.getmtime(result_path) - 10 * (2 - index)
+            os.utime(result_path, (result_mtime, result_mtime))
+        # 'a' is the oldest so is evicted to fit under max_bytes
+        self.assertIsNone(cache.get_result('a'))
+        self.assertEqual(cache.get_result('b'), bytes([1]) * 1000)
+
+        cache.put_polygon_results([
+            ('p0', [1.0] * 13, {'2005-1': 3}),
+            ('p1', [0.5] * 13, {})])
+        self.assertEqual(
+            cache.get_polygon_results(['p0', 'p1', 'p2']), {
+                'p0': ([1.0] * 13, {'2005-1': 3}),
+                'p1': ([0.5] * 13, {})})
+
+
+class TestVectorFieldWriter(unittest.TestCase):
+    """Tests for the recreation bulk vector field writer."""
+
+    def setUp(self):
+        """Setup workspace."""
+        self.workspace_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Delete workspace."""
+        shutil.rmtree(self.workspace_dir)
+
+    def test_write_vector_fields(self):
+        """Recreation test writing field columns to shapefile and gpkg."""
+        from natcap.invest.recreation import vector_field_writer
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32731)  # WGS84/UTM zone 31s
+        base_vector_path = os.path.join(self.workspace_dir, 'base.shp')
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        base_vector = driver.CreateDataSource(base_vector_path)
+        base_layer = base_vector.CreateLayer('base', srs, ogr.wkbPolygon)
+        base_layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+        base_layer.CreateField(ogr.FieldDefn('PUD_YR_AVG', ogr.OFTReal))
+        for index in range(3):
+            base_feature = ogr.Feature(base_layer.GetLayerDefn())
+            base_feature.SetGeometry(ogr.CreateGeometryFromWkt(
+                'POLYGON ((%d 0, %d 1, %d 1, %d 0, %d 0))' % (
+                    index, index, index+1, index+1, index)))
+            base_feature.SetField('name', 'poly_%d' % index)
+            base_feature.SetField('PUD_YR_AVG', -1.0)
+            base_layer.CreateFeature(base_feature)
+            base_feature = None
+        base_layer = None
+        base_vector = None
+
+        # feature 1 has no values and feature 2 has a NaN
+        fid_array = numpy.array([2, 0])
+        field_list = [
+            ('PUD_YR_AVG', numpy.array([numpy.nan, 1.5])),
+            ('PUD_JAN', numpy.array([4.0, 2.0]))]
+        for target_vector_path, keep_base_fields in [
+                (os.path.join(self.workspace_dir, 'target.shp'), True),
+                (os.path.join(self.workspace_dir, 'target.gpkg'), False)]:
+            vector_field_writer.write_vector_fields(
+                base_vector_path, target_vector_path, fid_array,
+                field_list, keep_base_fields=keep_base_fields)
+
+            target_vector = gdal.OpenEx(target_vector_path, gdal.OF_VECTOR)
+            target_layer = target_vector.GetLayer()
+            target_layer_defn = target_layer.GetLayerDefn()
+            field_names = [
+                target_layer_defn.GetFieldDefn(index).GetName()
+                for index in range(target_layer_defn.GetFieldCount())]
+            if keep_base_fields:
+                self.assertEqual(
+                    field_names, ['name', 'PUD_YR_AVG', 'PUD_JAN'])
+            else:
+                self.assertEqual(field_names, ['PUD_YR_AVG', 'PUD_JAN'])
+            self.assertEqual(target_layer.GetFeatureCount(), 3)
+            for fid, expected_values in [
+                    (0, (1.5, 2.0)), (1, (None, None)), (2, (None, 4.0))]:
+                target_feature = target_layer.GetFeature(fid)
+                self.assertEqual(
+                    (target_feature.GetField('PUD_YR_AVG'),
+                     target_feature.GetField('PUD_JAN')), expected_values)
+                if keep_base_fields:
+                    self.assertEqual(
+                        target_feature.GetField('name'), 'poly_%d' % fid)
+                self.assertAlmostEqual(
+                    target_feature.GetGeometryRef().GetEnvelope()[0], fid)
+            target_layer = None
+            target_vector = None
+
+
+class TestOutOfCoreQuadTree(unittest.TestCase):
+    """Tests for the OutOfCoreQuadTree spatial index."""
+
+    def setUp(self):
+        """Setup workspace and a quadtree of random points."""
+        from natcap.invest.recreation import out_of_core_quadtree
+        self.workspace_dir = tempfile.mkdtemp()
+        random_state = numpy.random.RandomState(0)
+        n_points = 10000
+        self.point_array = numpy.empty(
+            n_points, dtype=out_of_core_quadtree._ARRAY_TUPLE_TYPE)
+        self.point_array['f0'] = numpy.datetime64('2010-01-01')
+        self.point_array['f1'] = numpy.arange(n_points).astype('S4')
+        self.point_array['f2'] = random_state.uniform(0, 100, n_points)
+        self.point_array['f3'] = random_state.uniform(0, 100, n_points)
+
+        self.quadtree = out_of_core_quadtree.OutOfCoreQuadTree(
+            [0, 0, 100, 100], 50, 8, self.workspace_dir,
+            pickle_filename=os.path.join(self.workspace_dir, 'qt.pickle'))
+        point_array = self.point_array.copy()
+        self.quadtree.add_points(point_array, 0, point_array.size)
+
+    def tearDown(self):
+        """Delete workspace."""
+        shutil.rmtree(self.workspace_dir)
+
+    def test_points_in_polygon(self):
+        """Recreation test quadtree polygon query matches brute force."""
+        import shapely.geometry
+        shapely_polygon = shapely.geometry.Point(40, 60).buffer(25)
+        result = self.quadtree.get_intersecting_points_in_polygon(
+            shapely_polygon)
+        self.assertIsInstance(result, numpy.ndarray)
+
+        expected_ids = set(
+            point[1] for point in self.point_array
+            if shapely_polygon.contains(shapely.geometry.Point(
+                float(point[2]), float(point[3]))))
+        self.assertEqual(len(result), len(expected_ids))
+        self.assertEqual(set(result['f1']), expected_ids)
+
+    def test_points_in_empty_polygon(self):
+        """Recreation test quadtree query with an empty polygon."""
+        import shapely.geometry
+        result = self.quadtree.get_intersecting_points_in_polygon(
+            shapely.geometry.Polygon())
+        self.assertEqual(result.size, 0)
+        self.assertEqual(result.dtype, self.point_array.dtype)
+
+    def test_points_in_bounding_box(self):
+        """Recreation test quadtree bounding box query matches brute force."""
+        # the first box is aligned with quadtree node edges so it fully
+        # contains some leaves
+        for bounding_box in [[25, 50, 75, 100], [10.3, 20.7, 55.5, 70.1]]:
+            result = self.quadtree.get_intersecting_points_in_bounding_box(
+                bounding_box)
+            expected_mask = (
+                (self.point_array['f2'] >= bounding_box[0]) &
+                (self.point_array['f3'] >= bounding_box[1]) &
+                (self.point_array['f2'] < bounding_box[2]) &
+                (self.point_array['f3'] < bounding_box[3]))
+            self.assertEqual(len(result), numpy.count_nonzero(expected_mask))
+            self.assertEqual(
+                set(result['f1']), set(self.point_array['f1'][expected_mask]))
+
+    def test_flat_index(self):
+        """Recreation test flat quadtree index queries match the quadtree."""
+        import pickle
+        import shapely.geometry
+        from natcap.invest.recreation import out_of_core_quadtree
+
+        self.quadtree.flush()
+        flat_quadtree = out_of_core_quadtree.FlatQuadTree(
+            self.quadtree.index_filename)
+        self.assertEqual(flat_quadtree.n_nodes(), self.quadtree.n_nodes())
+        self.assertEqual(flat_quadtree.n_points(), self.quadtree.n_points())
+
+        # pickling only carries the path and reopens the index
+        flat_quadtree = pickle.loads(pickle.dumps(flat_quadtree))
+
+        shapely_polygon = shapely.geometry.Point(40, 60).buffer(25)
+        self.assertEqual(
+            set(flat_quadtree.get_intersecting_points_in_polygon(
+                shapely_polygon)['f1']),
+            set(self.quadtree.get_intersecting_points_in_polygon(
+                shapely_polygon)['f1']))
+
+        bounding_box = [10, 20, 55.5, 70]
+        self.assertEqual(
+            set(flat_quadtree.get_intersecting_points_in_bounding_box(
+                bounding_box)['f1']),
+            set(self.quadtree.get_intersecting_points_in_bounding_box(
+                bounding_box)['f1']))
+
+    def test_new_index_version(self):
+        """Recreation test old index version survives added points."""
+        import pickle
+        from natcap.invest.recreation import out_of_core_quadtree
+
+        self.quadtree.flush()
+        old_flat_quadtree = out_of_core_quadtree.FlatQuadTree(
+            self.quadtree.index_filename)
+        bounding_box = [10, 20, 55.5, 70]
+        old_result = numpy.sort(
+            old_flat_quadtree.get_intersecting_points_in_bounding_box(
+                bounding_box), order=['f2', 'f3'])
+
+        quadtree = pickle.load(open(self.quadtree.pickle_filename, 'rb'))
+        quadtree.node_data_manager.freeze_extents()
+        # enough points in the same area to move and split most nodes
+        new_point_array = self.point_array.copy()
+        new_point_array['f2'] = numpy.flipud(new_point_array['f2'])
+        quadtree.add_points(new_point_array, 0, new_point_array.size)
+        new_index_path = quadtree.new_index_version()
+        quadtree.flush()
+        self.assertNotEqual(new_index_path, self.quadtree.index_filename)
+
+        new_flat_quadtree = out_of_core_quadtree.FlatQuadTree(new_index_path)
+        self.assertEqual(
+            new_flat_quadtree.n_points(), 2 * self.point_array.size)
+        numpy.testing.assert_equal(
+            numpy.sort(
+                old_flat_quadtree.get_intersecting_points_in_bounding_box(
+                    bounding_box), order=['f2', 'f3']), old_result)
+        self.assertEqual(
+            new_flat_quadtree.get_intersecting_points_in_bounding_box(
+                [0, 0, 100, 100]).size, 2 * self.point_array.size)
+
+    def test_graft_partitions(self):
+        """Recreation test quadtree built from partitions matches serial."""
+        from natcap.invest.recreation import out_of_core_quadtree
+
+        partition_depth = 2
+        quadtree = out_of_core_quadtree.OutOfCoreQuadTree(
+            [0, 0, 100, 100], 50, 8, self.workspace_dir,
+            pickle_filename=os.path.join(
+                self.workspace_dir, 'partitioned.pickle'))
+        partition_list = quadtree.split_to_depth(partition_depth)
+        self.assertEqual(len(partition_list), 4 ** partition_depth)
+
+        # include points on the partition edges
+        point_array = self.point_array.copy()
+        point_array['f2'][:100] = 50
+        point_array['f3'][50:150] = 25
+        serial_quadtree = out_of_core_quadtree.OutOfCoreQuadTree(
+            [0, 0, 100, 100], 50, 8, self.workspace_dir,
+            pickle_filename=os.path.join(self.workspace_dir, 'serial.pickle'))
+        serial_quadtree.add_points(point_array.copy(), 0, point_array.size)
+
+        partition_index = quadtree.partition_points(
+            point_array, partition_depth)
+        for index, partition in enumerate(partition_list):
+            subtree_dir = os.path.join(self.workspace_dir, str(index))
+            subtree = out_of_core_quadtree.OutOfCoreQuadTree(
+                partition.bounding_box, 50, 8, subtree_dir,
+                node_depth=partition.node_depth,
+                pickle_filename=os.path.join(subtree_dir, 'subtree.pickle'))
+            partition_points = point_array[partition_index == index]
+            subtree.add_points(partition_points, 0, partition_points.size)
+            quadtree.graft_subtree(subtree)
+            shutil.rmtree(subtree_dir)
+
+        with self.assertRaises(ValueError):
+            quadtree.graft_subtree(subtree)
+        self.assertEqual(quadtree.n_points(), point_array.size)
+        self.assertEqual(quadtree.n_nodes(), serial_quadtree.n_nodes())
+        quadtree.flush()
+        flat_quadtree = out_of_core_quadtree.FlatQuadTree(
+            quadtree.index_filename)
+        for bounding_box in [[0, 0, 100, 100], [10, 20, 55.5, 70]]:
+            numpy.testing.assert_equal(
+                numpy.sort(
+                    flat_quadtree.get_intersecting_points_in_bounding_box(
+                        bounding_box), order=['f1', 'f2', 'f3']),
+                numpy.sort(
+                    serial_quadtree.get_intersecting_points_in_bounding_box(
+                        bounding_box), order=['f1', 'f2', 'f3']))
+
+
 class TestRecServer(unittest.TestCase):
     """Tests that set up local rec server on a port and call through."""
 
@@ -266,6 +666,207 @@ class TestRecServer(unittest.TestCase):
             aoi_path,
             os.path.join(out_workspace_dir, 'test_aoi_for_subset.shp'))
 
+    @_timeout(30.0)
+    def test_chunked_transfer(self):
+        """Recreation test chunked upload and download on a local server."""
+        from natcap.invest.recreation import recmodel_server
+        from natcap.invest.recreation import recmodel_client
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        sock = None
+
+        server_args = {
+            'hostname': 'localhost',
+            'port': port,
+            'raw_csv_point_data_path': self.resampled_data_path,
+            'cache_workspace': self.workspace_dir,
+            'min_year': 2004,
+            'max_year': 2015,
+        }
+        server_thread = threading.Thread(
+            target=recmodel_server.execute, args=(server_args,))
+        server_thread.daemon = True
+        server_thread.start()
+
+        recreation_server = Pyro4.Proxy(
+            "PYRO:natcap.invest.recreation@localhost:%s" % port)
+        aoi_path = os.path.join(SAMPLE_DATA, 'test_aoi_for_subset.shp')
+        aoi_archive_path = os.path.join(self.workspace_dir, 'aoi.zip')
+        with zipfile.ZipFile(aoi_archive_path, 'w') as myzip:
+            for filename in glob.glob(
+                    os.path.splitext(aoi_path)[0] + '.*'):
+                myzip.write(filename, os.path.basename(filename))
+        with open(aoi_archive_path, 'rb') as aoi_archive:
+            aoi_binary = aoi_archive.read()
+
+        # send part of the first chunk, then resume from where it stopped
+        session_id = recreation_server.start_aoi_upload()
+        recreation_server.upload_aoi_chunk(session_id, 0, aoi_binary[:100])
+        offset = recreation_server.get_upload_offset(session_id)
+        self.assertEqual(offset, 100)
+        with self.assertRaises(ValueError):
+            recreation_server.upload_aoi_chunk(
+                session_id, offset + 1, aoi_binary[offset+1:])
+        recreation_server.upload_aoi_chunk(
+            session_id, offset, aoi_binary[offset:])
+
+        date_range = (('2005-01-01'), ('2014-12-31'))
+        out_vector_filename = 'test_aoi_for_subset_pud.shp'
+        workspace_id, result_size = (
+            recreation_server.calc_photo_user_days_in_session(
+                session_id, date_range, out_vector_filename))
+        self.assertEqual(workspace_id, session_id)
+
+        # download in small chunks so the result is unpacked as it arrives
+        streamed_result_dir = os.path.join(self.workspace_dir, 'streamed')
+        os.makedirs(streamed_result_dir)
+        streamed_archive_path = os.path.join(
+            self.workspace_dir, 'streamed.zip')
+        recmodel_client._extract_zip_stream(
+            (recreation_server.download_result_chunk(
+                workspace_id, offset, 1024)
+             for offset in range(0, result_size, 1024)),
+            streamed_archive_path, streamed_result_dir)
+        self.assertEqual(os.path.getsize(streamed_archive_path), result_size)
+
+        result_binary, _ = recreation_server.calc_photo_user_days_in_aoi(
+            aoi_binary, date_range, out_vector_filename)
+        result_dir = os.path.join(self.workspace_dir, 'result')
+        with zipfile.ZipFile(io.BytesIO(result_binary), 'r') as result_zip:
+            result_zip.extractall(result_dir)
+        self.assertEqual(
+            sorted(os.listdir(streamed_result_dir)),
+            sorted(os.listdir(result_dir)))
+        utils._assert_vectors_equal(
+            os.path.join(result_dir, out_vector_filename),
+            os.path.join(streamed_result_dir, out_vector_filename))
+
+    def test_upload_aoi_retries(self):
+        """Recreation test AOI upload resumes after repeated failures."""
+        from natcap.invest.recreation import recmodel_client
+
+        class _FlakyServer(object):
+            """Stands in for a server proxy whose connection drops."""
+
+            def __init__(self):
+                self.received = b''
+                self.failures = {
+                    'upload_aoi_chunk': 1, 'get_upload_offset': 1}
+
+            def _fail(self, method_name):
+                if self.failures[method_name] > 0:
+                    self.failures[method_name] -= 1
+                    raise Pyro4.errors.CommunicationError('connection lost')
+
+            def start_aoi_upload(self):
+                return 'session'
+
+            def upload_aoi_chunk(self, session_id, offset, chunk_binary):
+                # the chunk arrives but the reply is lost
+                self.received = self.received[:offset] + chunk_binary
+                self._fail('upload_aoi_chunk')
+                return len(self.received)
+
+            def get_upload_offset(self, session_id):
+                self._fail('get_upload_offset')
+                return len(self.received)
+
+            def _pyroReconnect(self):
+                pass
+
+        aoi_archive_path = os.path.join(self.workspace_dir, 'aoi.zip')
+        aoi_binary = numpy.random.RandomState(1).bytes(1000)
+        with open(aoi_archive_path, 'wb') as aoi_archive:
+            aoi_archive.write(aoi_binary)
+        flaky_server = _FlakyServer()
+        with mock.patch.object(recmodel_client, '_TRANSFER_CHUNK_SIZE', 300):
+            self.assertEqual(
+                recmodel_client._upload_aoi(flaky_server, aoi_archive_path),
+                'session')
+        self.assertEqual(flaky_server.received, aoi_binary)
+        self.assertEqual(
+            flaky_server.failures,
+            {'upload_aoi_chunk': 0, 'get_upload_offset': 0})
+
+    @_timeout(30.0)
+    def test_job_queue(self):
+        """Recreation test submitting and polling jobs on a local server."""
+        from natcap.invest.recreation import recmodel_server
+        from natcap.invest.recreation import recmodel_client
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        sock = None
+
+        server_args = {
+            'hostname': 'localhost',
+            'port': port,
+            'raw_csv_point_data_path': self.resampled_data_path,
+            'cache_workspace': self.workspace_dir,
+            'min_year': 2004,
+            'max_year': 2015,
+            'max_concurrent_requests': 1,
+            'max_queued_jobs': 1,
+        }
+        server_thread = threading.Thread(
+            target=recmodel_server.execute, args=(server_args,))
+        server_thread.daemon = True
+        server_thread.start()
+
+        recreation_server = Pyro4.Proxy(
+            "PYRO:natcap.invest.recreation@localhost:%s" % port)
+        aoi_path = os.path.join(SAMPLE_DATA, 'test_aoi_for_subset.shp')
+        aoi_archive_path = os.path.join(self.workspace_dir, 'aoi.zip')
+        with zipfile.ZipFile(aoi_archive_path, 'w') as myzip:
+            for filename in glob.glob(
+                    os.path.splitext(aoi_path)[0] + '.*'):
+                myzip.write(filename, os.path.basename(filename))
+
+        date_range = (('2005-01-01'), ('2014-12-31'))
+        out_vector_filename = 'test_aoi_for_subset_pud.shp'
+        job_id = recreation_server.submit_job(
+            recmodel_client._upload_aoi(recreation_server, aoi_archive_path),
+            date_range, out_vector_filename)
+        job_status = recreation_server.get_job_status(job_id)
+        self.assertIn(
+            job_status['phase'],
+            ['queued', 'preparing', 'querying quadtree',
+             'building local quadtree', 'testing polygons',
+             'writing results', 'zipping results', 'done'])
+
+        with self.assertRaises(ValueError):
+            recreation_server.get_job_status(uuid.uuid4().hex)
+
+        result_size = recmodel_client._wait_for_job(recreation_server, job_id)
+        job_status = recreation_server.get_job_status(job_id)
+        self.assertEqual(job_status['phase'], 'done')
+        self.assertEqual(job_status['percent_complete'], 100.0)
+        self.assertEqual(job_status['result_size'], result_size)
+        self.assertIn('testing polygons', job_status['phase_seconds'])
+
+        result_dir = os.path.join(self.workspace_dir, 'result')
+        os.makedirs(result_dir)
+        recmodel_client._extract_zip_stream(
+            recmodel_client._iter_result_chunks(
+                recreation_server, job_id, result_size),
+            os.path.join(self.workspace_dir, 'result.zip'), result_dir)
+        self.assertTrue(
+            os.path.exists(os.path.join(result_dir, out_vector_filename)))
+        self.assertTrue(
+            os.path.exists(os.path.join(result_dir, 'monthly_table.csv')))
+
+        # a job with a missing upload fails rather than stalling the queue
+        failed_job_id = recreation_server.submit_job(
+            recreation_server.start_aoi_upload(), date_range,
+            out_vector_filename)
+        with self.assertRaises(RuntimeError):
+            recmodel_client._wait_for_job(recreation_server, failed_job_id)
+
     @_timeout(30.0)
     def test_empty_server(self):
         """Recreation test a client call to simple server."""
@@ -382,18 +983,19 @@ class TestRecServer(unittest.TestCase):
             numpy.datetime64('2005-01-01'),
             numpy.datetime64('2014-12-31'))
 
-        poly_test_queue = queue.Queue()
-        poly_test_queue.put(0)
-        poly_test_queue.put('STOP')
-        pud_poly_feature_queue = queue.Queue()
+        polytest_job_queue = queue.Queue()
+        polytest_job_queue.put(
+            ('request_id', recreation_server.qt_index_filename,
+             os.path.join(SAMPLE_DATA, 'test_aoi_for_subset.shp'),
+             date_range, 0))
+        polytest_job_queue.put('STOP')
+        polytest_result_queue = queue.Queue()
         recmodel_server._calc_poly_pud(
-            recreation_server.qt_pickle_filename,
-            os.path.join(SAMPLE_DATA, 'test_aoi_for_subset.shp'),
-            date_range, poly_test_queue, pud_poly_feature_queue)
+            polytest_job_queue, polytest_result_queue)
 
         # assert annual average PUD is the same as regression
         self.assertEqual(
-            83.2, pud_poly_feature_queue.get()[1][0])
+            83.2, polytest_result_queue.get()[2][0][0])
 
     def test_local_calc_poly_pud_bad_aoi(self):
         """Recreation test PUD calculation with missing AOI features."""
@@ -421,28 +1023,31 @@ class TestRecServer(unittest.TestCase):
             None,
             ogr.CreateGeometryFromWkt(
                 'POLYGON ((1 1, 1 0, 0 0, 0 1, 1 1))')]
-        poly_test_queue = queue.Queue()
-        poly_test_queue.put(1)  # gpkg FIDs start at 1
-        poly_test_queue.put(2)
         target_layer.StartTransaction()
         for geometry in input_geom_list:
             feature = ogr.Feature(target_layer.GetLayerDefn())
             feature.SetGeometry(geometry)
             target_layer.CreateFeature(feature)
         target_layer.CommitTransaction()
-        poly_test_queue.put('STOP')
         target_layer = None
         target_vector = None
 
-        pud_poly_feature_queue = queue.Queue()
+        polytest_job_queue = queue.Queue()
+        for poly_id in [1, 2]:  # gpkg FIDs start at 1
+            polytest_job_queue.put(
+                ('request_id', recreation_server.qt_index_filename,
+                 aoi_vector_path, date_range, poly_id))
+        polytest_job_queue.put('STOP')
+        polytest_result_queue = queue.Queue()
         recmodel_server._calc_poly_pud(
-            recreation_server.qt_pickle_filename,
-            aoi_vector_path, date_range, poly_test_queue,
-            pud_poly_feature_queue)
+            polytest_job_queue, polytest_result_queue)
 
-        # assert PUD was calculated for the one good AOI feature.
+        # assert the feature without a geometry was skipped and PUD was
+        # calculated for the one good AOI feature.
+        self.assertEqual(
+            ('request_id', 1, None), polytest_result_queue.get())
         self.assertEqual(
-            0.0, pud_poly_feature_queue.get()[1][0])
+            0.0, polytest_result_queue.get()[2][0][0])
 
     def test_local_calc_existing_cached(self):
         """Recreation local PUD calculation on existing quadtree."""
@@ -461,18 +1066,43 @@ class TestRecServer(unittest.TestCase):
             numpy.datetime64('2005-01-01'),
             numpy.datetime64('2014-12-31'))
 
-        poly_test_queue = queue.Queue()
-        poly_test_queue.put(0)
-        poly_test_queue.put('STOP')
-        pud_poly_feature_queue = queue.Queue()
+        polytest_job_queue = queue.Queue()
+        polytest_job_queue.put(
+            ('request_id', recreation_server.qt_index_filename,
+             os.path.join(SAMPLE_DATA, 'test_aoi_for_subset.shp'),
+             date_range, 0))
+        polytest_job_queue.put('STOP')
+        polytest_result_queue = queue.Queue()
         recmodel_server._calc_poly_pud(
-            recreation_server.qt_pickle_filename,
-            os.path.join(SAMPLE_DATA, 'test_aoi_for_subset.shp'),
-            date_range, poly_test_queue, pud_poly_feature_queue)
+            polytest_job_queue, polytest_result_queue)
 
         # assert annual average PUD is the same as regression
         self.assertEqual(
-            83.2, pud_poly_feature_queue.get()[1][0])
+            83.2, polytest_result_queue.get()[2][0][0])
+
+    def test_calc_pud_counts(self):
+        """Recreation test distinct user day counts of a point array."""
+        from natcap.invest.recreation import recmodel_server
+
+        point_array = numpy.empty(6, dtype='datetime64[D],a4,f4,f4')
+        point_array['f0'] = numpy.array([
+            '2005-01-01', '2005-01-01', '2005-01-02', '2006-01-01',
+            '2006-02-01', '2015-01-01'], dtype='datetime64[D]')
+        point_array['f1'] = [b'a', b'a', b'a', b'b', b'b', b'a']
+        date_range = (
+            numpy.datetime64('2005-01-01'),
+            numpy.datetime64('2014-12-31'))
+
+        pud_averages, pud_monthly_counts = recmodel_server._calc_pud_counts(
+            point_array, date_range)
+        # 4 user days in range over 10 years, the duplicate and 2015 point
+        # are not counted
+        self.assertEqual(pud_averages[0], 0.4)
+        self.assertEqual(pud_averages[1], 0.3)
+        self.assertEqual(pud_averages[2], 0.1)
+        self.assertEqual(pud_averages[3:], [0.0] * 10)
+        self.assertEqual(
+            pud_monthly_counts, {'2005-1': 2, '2006-1': 1, '2006-2': 1})
 
     def test_parse_input_csv(self):
         """Recreation test parsing raw CSV."""
@@ -484,10 +1114,38 @@ class TestRecServer(unittest.TestCase):
         numpy_array_queue = queue.Queue()
         recmodel_server._parse_input_csv(
             block_offset_size_queue, self.resampled_data_path,
-            numpy_array_queue)
-        val = recmodel_server._numpy_loads(numpy_array_queue.get())
+            numpy_array_queue, self.workspace_dir)
+        val = numpy.load(numpy_array_queue.get())
         # we know what the first date is
         self.assertEqual(val[0][0], datetime.date(2013, 3, 16))
+        self.assertEqual(numpy_array_queue.get(), 'STOP')
+
+    def test_parse_photo_block(self):
+        """Recreation test parsing photo CSV lines and skipping bad ones."""
+        import hashlib
+        from natcap.invest.recreation import photo_csv_parser
+
+        block_bytes = (
+            b'1,48344648@N00,2013-03-17 16:27:27,42.383841,-71.138378,16\n'
+            b'2,48344648@N00,2013-13-17 16:27:27,42.38,-71.13,16\n'
+            b'3,,2013-03-17 16:27:27,42.38,-71.13,16\n'
+            b'4,u4,2013-03-17 16:27:27,42.38,-71.13,\n'
+            b'5,u5,2013-02-30 16:27:27,42.38,-71.13,16\n'
+            b'6,u6,1999-03-31 16:27:27,42.38,-71.13,16\n'
+            b'7,u7,2013-03-31,42.38,-71.13,16\n'
+            b'8,u8,2012-02-29 16:27:27,-1.5,2.5,16')
+        point_array = photo_csv_parser.parse_photo_block(block_bytes)
+        self.assertEqual(point_array.size, 2)
+        numpy.testing.assert_equal(
+            point_array['f0'],
+            numpy.array(['2013-03-17', '2012-02-29'], dtype='datetime64[D]'))
+        self.assertEqual(
+            point_array['f1'][0],
+            hashlib.md5(b'48344648@N00').digest()[-4:].rstrip(b'\0'))
+        numpy.testing.assert_equal(
+            point_array['f2'], numpy.array([-71.138378, 2.5], numpy.float32))
+        numpy.testing.assert_equal(
+            point_array['f3'], numpy.array([42.383841, -1.5], numpy.float32))
 
     def test_numpy_pickling_queue(self):
         """Recreation test _numpy_dumps and _numpy_loads"""
@@ -512,6 +1170,117 @@ class TestRecServer(unittest.TestCase):
             # assert that no warning was raised
             self.assertTrue(len(ws) == 0)
 
+    def test_ingest_keeps_held_version(self):
+        """Recreation test ingests don't reuse a held version's extents."""
+        import pickle
+        from natcap.invest.recreation import recmodel_server
+
+        recreation_server = recmodel_server.RecModel(
+            self.resampled_data_path, 2005, 2014,
+            os.path.join(self.workspace_dir, 'server_cache'),
+            max_points_per_node=50, n_build_workers=1)
+        # every ingest adds the rows appended to a delta csv since the last
+        delta_csv_path = os.path.join(self.workspace_dir, 'delta.csv')
+        shutil.copyfile(self.resampled_data_path, delta_csv_path)
+        csv_rows = _read_csv_rows(self.resampled_data_path)
+        bounding_box = [-180, -90, 180, 90]
+        with recreation_server._hold_global_qt() as old_qt:
+            old_points = numpy.sort(
+                old_qt.get_intersecting_points_in_bounding_box(bounding_box))
+            # the second ingest would reuse the extents the first one froze
+            # if the held version weren't counted
+            recreation_server._ingest_photo_csv(delta_csv_path)
+            with open(delta_csv_path, 'ab') as delta_csv_file:
+                delta_csv_file.write(csv_rows)
+            recreation_server._ingest_photo_csv(delta_csv_path)
+            numpy.testing.assert_equal(
+                numpy.sort(old_qt.get_intersecting_points_in_bounding_box(
+                    bounding_box)), old_points)
+        self.assertEqual(
+            recreation_server.global_qt.n_points(), 3 * old_points.size)
+
+        # with nothing held, the next ingest releases every earlier extent
+        with open(delta_csv_path, 'ab') as delta_csv_file:
+            delta_csv_file.write(csv_rows)
+        recreation_server._ingest_photo_csv(delta_csv_path)
+        with open(recreation_server.qt_pickle_filename, 'rb') as qt_file:
+            node_data_manager = pickle.load(qt_file).node_data_manager
+        self.assertFalse([
+            generation for generation, _, _ in
+            node_data_manager.frozen_extents if generation < 3])
+
+    def test_ingest_resumes(self):
+        """Recreation test ingests don't add a csv's rows twice."""
+        from natcap.invest.recreation import recmodel_server
+
+        cache_dir = os.path.join(self.workspace_dir, 'server_cache')
+        recreation_server = recmodel_server.RecModel(
+            self.resampled_data_path, 2005, 2014, cache_dir,
+            max_points_per_node=50, n_build_workers=1)
+        n_points = recreation_server.global_qt.n_points()
+        delta_csv_path = os.path.join(self.workspace_dir, 'delta.csv')
+        shutil.copyfile(self.resampled_data_path, delta_csv_path)
+        recreation_server._ingest_photo_csv(delta_csv_path)
+        self.assertEqual(
+            recreation_server.global_qt.n_points(), 2 * n_points)
+
+        # a server restarted with the same ingest csv doesn't add it again
+        recreation_server = recmodel_server.RecModel(
+            self.resampled_data_path, 2005, 2014, cache_dir,
+            max_points_per_node=50, n_build_workers=1)
+        recreation_server._ingest_photo_csv(delta_csv_path)
+        self.assertEqual(
+            recreation_server.global_qt.n_points(), 2 * n_points)
+
+        # appended rows are added, a row still being written waits for the
+        # next ingest
+        csv_rows = _read_csv_rows(self.resampled_data_path)
+        first_row = csv_rows[:csv_rows.index(b'\n') + 1]
+        with open(delta_csv_path, 'ab') as delta_csv_file:
+            delta_csv_file.write(csv_rows + first_row[:5])
+        recreation_server._ingest_photo_csv(delta_csv_path)
+        self.assertEqual(
+            recreation_server.global_qt.n_points(), 3 * n_points)
+        with open(delta_csv_path, 'ab') as delta_csv_file:
+            delta_csv_file.write(first_row[5:])
+        recreation_server._ingest_photo_csv(delta_csv_path)
+        self.assertEqual(
+            recreation_server.global_qt.n_points(), 3 * n_points + 1)
+
+    def test_add_projected_points_failure(self):
+        """Recreation test projection thread stops when adding fails."""
+        from natcap.invest.recreation import recmodel_server
+        from natcap.invest.recreation import buffered_numpy_disk_map
+
+        def _projection_threads():
+            return [
+                thread for thread in threading.enumerate()
+                if thread.name == 'project_point_slices']
+
+        point_array = numpy.zeros(
+            recmodel_server.POINTS_TO_ADD_PER_STEP * 10,
+            dtype=buffered_numpy_disk_map.BufferedNumpyDiskMap
+            ._ARRAY_TUPLE_TYPE)
+        coord_trans = mock.Mock()
+        coord_trans.TransformPoints.side_effect = lambda points: points
+        local_qt = mock.Mock()
+        local_qt.add_points.side_effect = RuntimeError('add failed')
+        local_qt.n_points.return_value = 0
+        local_qt.n_nodes.return_value = 1
+        with self.assertRaises(RuntimeError):
+            recmodel_server._add_projected_points(
+                local_qt, point_array, coord_trans)
+        local_qt.add_points.assert_called_once()
+        self.assertEqual(_projection_threads(), [])
+
+        # a projection error is raised in the caller the same way
+        coord_trans.TransformPoints.side_effect = ValueError('bad point')
+        local_qt.add_points.side_effect = None
+        with self.assertRaises(ValueError):
+            recmodel_server._add_projected_points(
+                local_qt, point_array, coord_trans)
+        self.assertEqual(_projection_threads(), [])
+
     @_timeout(30.0)
     def test_regression_local_server(self):
         """Recreation base regression test on sample data on local server.
@@ -728,6 +1497,50 @@ class TestLocalRecServer(unittest.TestCase):
                 "Expected:\n%s\nGot:\n%s" % (expected_lines, output_lines))
 
 
+    def test_local_aoi_empty_polygon(self):
+        """Recreation test local AOI with an empty polygon feature."""
+        base_vector = gdal.OpenEx(
+            os.path.join(SAMPLE_DATA, 'test_local_aoi_for_subset.shp'),
+            gdal.OF_VECTOR)
+        base_layer = base_vector.GetLayer()
+        aoi_path = os.path.join(self.workspace_dir, 'aoi.gpkg')
+        gpkg_driver = gdal.GetDriverByName('GPKG')
+        target_vector = gpkg_driver.Create(
+            aoi_path, 0, 0, 0, gdal.GDT_Unknown)
+        target_layer = target_vector.CreateLayer(
+            'aoi', base_layer.GetSpatialRef(), ogr.wkbPolygon)
+        target_layer.StartTransaction()
+        for geometry in [
+                base_layer.GetFeature(0).GetGeometryRef(),
+                ogr.Geometry(ogr.wkbPolygon)]:
+            feature = ogr.Feature(target_layer.GetLayerDefn())
+            feature.SetGeometry(geometry)
+            target_layer.CreateFeature(feature)
+        target_layer.CommitTransaction()
+        target_layer = None
+        target_vector = None
+        base_layer = None
+        base_vector = None
+
+        date_range = (
+            numpy.datetime64('2010-01-01'),
+            numpy.datetime64('2014-12-31'))
+        out_vector_path, _ = (
+            self.recreation_server._calc_aggregated_points_in_aoi(
+                aoi_path, self.workspace_dir, date_range, 'pud.gpkg'))
+
+        # the empty polygon contains no points rather than failing the
+        # request
+        out_vector = gdal.OpenEx(out_vector_path, gdal.OF_VECTOR)
+        out_layer = out_vector.GetLayer()
+        pud_map = {
+            feature.GetFID(): feature.GetField('PUD_YR_AVG')
+            for feature in out_layer}
+        self.assertEqual(len(pud_map), 2)
+        self.assertEqual(pud_map[2], 0.0)  # gpkg FIDs start at 1
+        out_layer = None
+        out_vector = None
+
 class RecreationRegressionTests(unittest.TestCase):
     """Regression tests for InVEST Recreation model."""
 
@@ -834,6 +1647,129 @@ class RecreationRegressionTests(unittest.TestCase):
         # Assert that target file was written and it is an empty dictionary
         assert(len(predictor_results) == 0)
 
+    def test_raster_predictors_shared_grid(self):
+        """Recreation summarizes rasters on one grid in a single pass."""
+        from natcap.invest.recreation import recmodel_client
+        import pygeoprocessing
+        import shapely.geometry
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32731)  # WGS84/UTM zone 31s
+        projection_wkt = srs.ExportToWkt()
+
+        value_array = numpy.arange(100, dtype=numpy.float32).reshape(10, 10)
+        value_array[0, 0] = -1
+        value_raster_path = os.path.join(self.workspace_dir, 'value.tif')
+        pygeoprocessing.numpy_array_to_raster(
+            value_array, -1, (10, -10), (0, 100), projection_wkt,
+            value_raster_path)
+        ones_raster_path = os.path.join(self.workspace_dir, 'ones.tif')
+        pygeoprocessing.numpy_array_to_raster(
+            numpy.ones((10, 10), dtype=numpy.float32), None, (10, -10),
+            (0, 100), projection_wkt, ones_raster_path)
+
+        # the second polygon contains no pixel centers and the third is
+        # off the grid
+        response_vector_path = os.path.join(
+            self.workspace_dir, 'response.shp')
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        response_vector = driver.CreateDataSource(response_vector_path)
+        response_layer = response_vector.CreateLayer(
+            'response', srs, ogr.wkbPolygon)
+        for polygon in [
+                shapely.geometry.box(0, 50, 50, 100),
+                shapely.geometry.box(71, 21, 73, 23),
+                shapely.geometry.box(200, 200, 210, 210)]:
+            response_feature = ogr.Feature(response_layer.GetLayerDefn())
+            response_feature.SetGeometry(
+                ogr.CreateGeometryFromWkb(polygon.wkb))
+            response_layer.CreateFeature(response_feature)
+            response_feature = None
+        response_layer = None
+        response_vector = None
+
+        mean_path = os.path.join(self.workspace_dir, 'mean.json')
+        sum_path = os.path.join(self.workspace_dir, 'sum.json')
+        recmodel_client._raster_predictors(
+            response_vector_path,
+            [(value_raster_path, 'mean', mean_path),
+             (ones_raster_path, 'sum', sum_path)])
+
+        with open(mean_path, 'r') as mean_file:
+            mean_results = json.load(mean_file)
+        with open(sum_path, 'r') as sum_file:
+            sum_results = json.load(sum_file)
+        # the nodata pixel is left out of the mean of the first polygon
+        self.assertEqual(sorted(mean_results), ['0', '1'])
+        numpy.testing.assert_allclose(mean_results['0'], 550.0 / 24)
+        numpy.testing.assert_allclose(mean_results['1'], 77.0)
+        self.assertEqual(sum_results, {'0': 25.0, '1': 1.0})
+
+    def test_point_predictors(self):
+        """Recreation indexed point predictors match a brute force search."""
+        from natcap.invest.recreation import recmodel_client
+        import shapely.geometry
+
+        random_state = numpy.random.RandomState(11)
+        point_list = [
+            shapely.geometry.Point(x, y)
+            for x, y in random_state.uniform(0, 100, (500, 2))]
+        # points on polygon boundaries and a multipoint
+        point_list += [
+            shapely.geometry.Point(10, 10), shapely.geometry.Point(15, 20),
+            shapely.geometry.MultiPoint([(5, 5), (60, 60)])]
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32731)  # WGS84/UTM zone 31s
+        point_vector_path = os.path.join(self.workspace_dir, 'points.gpkg')
+        driver = ogr.GetDriverByName('GPKG')
+        point_vector = driver.CreateDataSource(point_vector_path)
+        point_layer = point_vector.CreateLayer(
+            'points', srs, ogr.wkbUnknown)
+        for point in point_list:
+            point_feature = ogr.Feature(point_layer.GetLayerDefn())
+            point_feature.SetGeometry(ogr.CreateGeometryFromWkb(point.wkb))
+            point_layer.CreateFeature(point_feature)
+            point_feature = None
+        point_layer = None
+        point_vector = None
+
+        response_polygons_lookup = {
+            index: shapely.geometry.Point(x, y).buffer(radius)
+            for index, (x, y, radius) in enumerate(zip(
+                random_state.uniform(-20, 120, 30),
+                random_state.uniform(-20, 120, 30),
+                random_state.uniform(0.5, 15, 30)))}
+        response_polygons_lookup[30] = shapely.geometry.box(10, 10, 20, 20)
+        response_polygons_lookup[31] = shapely.geometry.box(
+            200, 200, 201, 201)
+        response_polygons_lookup[32] = shapely.geometry.Polygon()
+        response_polygons_pickle_path = os.path.join(
+            self.workspace_dir, 'response_polygons.pickle')
+        with open(response_polygons_pickle_path, 'wb') as pickle_file:
+            pickle.dump(response_polygons_lookup, pickle_file)
+
+        count_path = os.path.join(self.workspace_dir, 'count.json')
+        recmodel_client._point_count(
+            response_polygons_pickle_path, point_vector_path, count_path)
+        distance_path = os.path.join(self.workspace_dir, 'distance.json')
+        recmodel_client._point_nearest_distance(
+            response_polygons_pickle_path, point_vector_path, distance_path)
+
+        with open(count_path, 'r') as count_file:
+            point_count_lookup = json.load(count_file)
+        with open(distance_path, 'r') as distance_file:
+            point_distance_lookup = json.load(distance_file)
+        for feature_id, polygon in response_polygons_lookup.items():
+            self.assertEqual(
+                point_count_lookup[str(feature_id)],
+                len([point for point in point_list
+                     if polygon.contains(point)]))
+            # the distance to an empty polygon is nan with shapely>=2
+            numpy.testing.assert_equal(
+                point_distance_lookup[str(feature_id)],
+                min([polygon.distance(point) for point in point_list]))
+
     def test_least_squares_regression(self):
         """Recreation regression test for the least-squares linear model."""
         from natcap.invest.recreation import recmodel_client
@@ -874,6 +1810,124 @@ class RecreationRegressionTests(unittest.TestCase):
         for key in expected_results:
             numpy.testing.assert_allclose(results[key], expected_results[key])
 
+    def test_least_squares_regression_blocks(self):
+        """Recreation regression is the same when read in small blocks."""
+        from natcap.invest.recreation import recmodel_client
+
+        coefficient_vector_path = os.path.join(
+            REGRESSION_DATA, 'predictor_data.shp')
+        response_vector_path = os.path.join(
+            REGRESSION_DATA, 'predictor_data_pud.shp')
+        response_id = 'PUD_YR_AVG'
+
+        expected_results = recmodel_client._build_regression(
+            response_vector_path, coefficient_vector_path, response_id)
+        with mock.patch.object(recmodel_client, '_FIELD_BLOCK_SIZE', 4):
+            results = recmodel_client._build_regression(
+                response_vector_path, coefficient_vector_path, response_id)
+
+        self.assertEqual(results[0], expected_results[0])
+        for result, expected_result in zip(
+                results[1:], expected_results[1:]):
+            numpy.testing.assert_allclose(result, expected_result)
+
+    def test_least_squares_regression_empty_block(self):
+        """Recreation regression skips blocks with no complete rows."""
+        from natcap.invest.recreation import recmodel_client
+
+        coefficient_vector_path = os.path.join(
+            REGRESSION_DATA, 'predictor_data.shp')
+        response_vector_path = os.path.join(
+            REGRESSION_DATA, 'predictor_data_pud.shp')
+        response_id = 'PUD_YR_AVG'
+
+        expected_results = recmodel_client._build_regression(
+            response_vector_path, coefficient_vector_path, response_id)
+
+        iter_field_blocks = recmodel_client._iter_field_blocks
+
+        def _iter_field_blocks_with_missing_block(
+                vector_path, field_name_list, block_size=None):
+            """Yield a block of missing values before the real blocks."""
+            yield (numpy.arange(2), numpy.full(
+                (2, len(field_name_list)), numpy.nan))
+            for field_block in iter_field_blocks(
+                    vector_path, field_name_list, block_size=block_size):
+                yield field_block
+
+        def _qr(matrix, *args, **kwargs):
+            # numpy before 1.16 raises on a matrix with no rows
+            self.assertGreater(matrix.shape[0], 0)
+            return numpy_qr(matrix, *args, **kwargs)
+
+        numpy_qr = numpy.linalg.qr
+        with mock.patch.object(
+                recmodel_client, '_iter_field_blocks',
+                _iter_field_blocks_with_missing_block), mock.patch.object(
+                    numpy.linalg, 'qr', _qr):
+            results = recmodel_client._build_regression(
+                response_vector_path, coefficient_vector_path, response_id)
+
+        self.assertEqual(results[0], expected_results[0])
+        for result, expected_result in zip(
+                results[1:], expected_results[1:]):
+            numpy.testing.assert_allclose(result, expected_result)
+
+    def test_calculate_scenario(self):
+        """Recreation scenario estimates match the regression equation."""
+        from natcap.invest.recreation import recmodel_client
+
+        scenario_results_path = os.path.join(
+            self.workspace_dir, 'scenario_results.shp')
+        gdal.VectorTranslate(
+            scenario_results_path,
+            os.path.join(REGRESSION_DATA, 'predictor_data.shp'))
+        scenario_vector = gdal.OpenEx(scenario_results_path, gdal.OF_VECTOR)
+        scenario_layer = scenario_vector.GetLayer()
+        scenario_layer_defn = scenario_layer.GetLayerDefn()
+        predictor_id_list = [
+            scenario_layer_defn.GetFieldDefn(field_index).GetName()
+            for field_index in range(scenario_layer_defn.GetFieldCount())]
+        scenario_layer = None
+        scenario_vector = None
+
+        # predictor id to coefficient, the intercept is added last
+        predictor_estimates = dict(
+            (predictor_id, 0.5 / (field_index + 1))
+            for field_index, predictor_id in enumerate(predictor_id_list))
+        predictor_estimates['(Intercept)'] = -0.25
+        coefficient_json_path = os.path.join(
+            self.workspace_dir, 'estimates.json')
+        with open(coefficient_json_path, 'w') as json_file:
+            json.dump(predictor_estimates, json_file)
+
+        with mock.patch.object(recmodel_client, '_FIELD_BLOCK_SIZE', 4):
+            recmodel_client._calculate_scenario(
+                scenario_results_path, 'PUD_EST', coefficient_json_path)
+
+        scenario_vector = gdal.OpenEx(scenario_results_path, gdal.OF_VECTOR)
+        scenario_layer = scenario_vector.GetLayer()
+        n_estimates = 0
+        for feature in scenario_layer:
+            predictor_value_list = [
+                feature.GetField(predictor_id)
+                for predictor_id in predictor_id_list]
+            if None in predictor_value_list:
+                self.assertIsNone(feature.GetField('PUD_EST'))
+                continue
+            response_value = 0.0
+            for predictor_id, predictor_value in zip(
+                    predictor_id_list, predictor_value_list):
+                response_value += (
+                    predictor_estimates[predictor_id] * predictor_value)
+            numpy.testing.assert_allclose(
+                feature.GetField('PUD_EST'),
+                numpy.expm1(response_value - 0.25), atol=1e-9)
+            n_estimates += 1
+        self.assertTrue(n_estimates > 0)
+        scenario_layer = None
+        scenario_vector = None
+
     @unittest.skip("skipping to avoid remote server call (issue #3753)")
     def test_base_regression(self):
         """Recreation base regression test on fast sample data.
@@ -939,6 +1993,48 @@ class RecreationRegressionTests(unittest.TestCase):
         utils._assert_vectors_equal(
             out_grid_vector_path, expected_grid_vector_path)
 
+    def test_fine_square_grid(self):
+        """Recreation fine square grid matches testing every cell."""
+        from natcap.invest.recreation import recmodel_client
+
+        aoi_path = os.path.join(SAMPLE_DATA, 'andros_aoi.shp')
+        out_grid_vector_path = os.path.join(
+            self.workspace_dir, 'fine_grid_vector_path.shp')
+        cell_size = 2000.0
+        recmodel_client._grid_vector(
+            aoi_path, 'square', cell_size, out_grid_vector_path)
+
+        aoi_vector = gdal.OpenEx(aoi_path, gdal.OF_VECTOR)
+        aoi_layer = aoi_vector.GetLayer()
+        aoi_polygon = shapely.ops.cascaded_union([
+            shapely.wkb.loads(bytes(feature.GetGeometryRef().ExportToWkb()))
+            for feature in aoi_layer])
+        extent = aoi_layer.GetExtent()
+        aoi_layer = None
+        aoi_vector = None
+
+        expected_cell_list = []
+        for row_index in range(int((extent[3] - extent[2]) / cell_size)):
+            for col_index in range(int((extent[1] - extent[0]) / cell_size)):
+                cell = shapely.geometry.box(
+                    extent[0] + col_index * cell_size,
+                    extent[2] + row_index * cell_size,
+                    extent[0] + col_index * cell_size + cell_size,
+                    extent[2] + row_index * cell_size + cell_size)
+                if aoi_polygon.contains(cell):
+                    expected_cell_list.append(cell.bounds)
+
+        grid_vector = gdal.OpenEx(out_grid_vector_path, gdal.OF_VECTOR)
+        grid_layer = grid_vector.GetLayer()
+        cell_list = [
+            shapely.wkb.loads(
+                bytes(feature.GetGeometryRef().ExportToWkb())).bounds
+            for feature in grid_layer]
+        grid_layer = None
+        grid_vector = None
+        self.assertTrue(len(expected_cell_list) > 0)
+        numpy.testing.assert_allclose(cell_list, expected_cell_list)
+
     @unittest.skip("skipping to avoid remote server call (issue #3753)")
     def test_no_grid_regression(self):
         """Recreation base regression on ungridded AOI."""
@@ -1,5 +1,6 @@
 """InVEST SDR model tests."""
 import unittest
+from unittest import mock
 import tempfile
 import shutil
 import os
@@ -293,6 +294,127 @@ class SDRTests(unittest.TestCase):
             args['workspace_dir'], 'watershed_results_sdr.shp')
         assert_expected_results_in_vector(expected_results, vector_path)
 
+    def test_sediment_deposition_async_io(self):
+        """SDR: background I/O gives the same sediment deposition."""
+        from natcap.invest import managed_raster
+        from natcap.invest.sdr import sdr_core
+        import pygeoprocessing.routing
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(26910)  # UTM Zone 10N
+        projection_wkt = srs.ExportToWkt()
+        rows, cols = numpy.mgrid[0:600, 0:600]
+        dem_array = (
+            rows * 0.5 + numpy.abs(cols - 300) * 0.3 +
+            numpy.random.RandomState(1).uniform(0, 2, rows.shape))
+        rng = numpy.random.RandomState(2)
+        input_arrays = {
+            'dem': dem_array.astype(numpy.float32),
+            'e_prime': rng.uniform(0, 5, rows.shape).astype(numpy.float32),
+            'sdr': numpy.clip(
+                1 - dem_array / dem_array.max(), 0.05, 0.95).astype(
+                    numpy.float32),
+        }
+        path_map = {}
+        for name, array in input_arrays.items():
+            path_map[name] = os.path.join(self.workspace_dir, name + '.tif')
+            pygeoprocessing.numpy_array_to_raster(
+                array, -1, (30, -30), (1180000, 690000), projection_wkt,
+                path_map[name])
+        flow_dir_path = os.path.join(self.workspace_dir, 'flow_dir.tif')
+        pygeoprocessing.routing.flow_dir_mfd(
+            (path_map['dem'], 1), flow_dir_path,
+            working_dir=self.workspace_dir)
+
+        # a one block cache so blocks are evicted and reloaded throughout
+        default_cache_bytes = managed_raster.get_cache_bytes()
+        managed_raster.set_cache_bytes(1)
+        deposition_arrays = []
+        try:
+            for async_io in (False, True):
+                managed_raster.set_async_io(async_io)
+                target_path = os.path.join(
+                    self.workspace_dir, 'deposition_%s.tif' % async_io)
+                sdr_core.calculate_sediment_deposition(
+                    flow_dir_path, path_map['e_prime'],
+                    os.path.join(self.workspace_dir, 'f_%s.tif' % async_io),
+                    path_map['sdr'], target_path)
+                deposition_arrays.append(
+                    pygeoprocessing.raster_to_numpy_array(target_path))
+        finally:
+            managed_raster.set_async_io(False)
+            managed_raster.set_cache_bytes(default_cache_bytes)
+        numpy.testing.assert_array_equal(
+            deposition_arrays[0], deposition_arrays[1])
+
+    def test_sediment_deposition_parallel(self):
+        """SDR: routing drainage components in parallel matches serial."""
+        from natcap.invest.sdr import sdr_core
+        import pygeoprocessing.routing
+
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(26910)  # UTM Zone 10N
+        projection_wkt = srs.ExportToWkt()
+        rows, cols = numpy.mgrid[0:300, 0:300]
+        # four round islands separated by nodata ocean, so each one drains
+        # on its own
+        dem_array = numpy.full(rows.shape, -1, dtype=numpy.float32)
+        for center_row, center_col in [
+                (70, 70), (70, 220), (220, 70), (220, 220)]:
+            distance = numpy.hypot(rows - center_row, cols - center_col)
+            island_mask = distance < 60
+            dem_array[island_mask] = 60 - distance[island_mask]
+        dem_array[dem_array >= 0] += numpy.random.RandomState(1).uniform(
+            0, 2, rows.shape)[dem_array >= 0]
+        rng = numpy.random.RandomState(2)
+        input_arrays = {
+            'dem': dem_array,
+            'e_prime': rng.uniform(0, 5, rows.shape).astype(numpy.float32),
+            'sdr': rng.uniform(0.05, 0.95, rows.shape).astype(numpy.float32),
+        }
+        path_map = {}
+        for name, array in input_arrays.items():
+            path_map[name] = os.path.join(self.workspace_dir, name + '.tif')
+            pygeoprocessing.numpy_array_to_raster(
+                array, -1, (30, -30), (1180000, 690000), projection_wkt,
+                path_map[name])
+        flow_dir_path = os.path.join(self.workspace_dir, 'flow_dir.tif')
+        pygeoprocessing.routing.flow_dir_mfd(
+            (path_map['dem'], 1), flow_dir_path,
+            working_dir=self.workspace_dir)
+
+        def _deposition(run_name, n_workers):
+            """Return the sediment deposition and F arrays of a run."""
+            target_path = os.path.join(
+                self.workspace_dir, 'deposition_%s.tif' % run_name)
+            f_path = os.path.join(self.workspace_dir, 'f_%s.tif' % run_name)
+            sdr_core.calculate_sediment_deposition(
+                flow_dir_path, path_map['e_prime'], f_path,
+                path_map['sdr'], target_path, n_workers=n_workers)
+            return [
+                pygeoprocessing.raster_to_numpy_array(path)
+                for path in (target_path, f_path)]
+
+        def _assert_same(expected_arrays, actual_arrays):
+            for expected_array, actual_array in zip(
+                    expected_arrays, actual_arrays):
+                numpy.testing.assert_array_equal(expected_array, actual_array)
+
+        serial_arrays = _deposition('serial', -1)
+        _assert_same(serial_arrays, _deposition('parallel', 2))
+        # a memory budget that leaves room for one island a thread
+        with mock.patch.object(
+                sdr_core, '_WINDOW_MEMORY_BYTES',
+                2 * 121 * 121 * sdr_core._WINDOW_BYTES_PER_PIXEL):
+            _assert_same(serial_arrays, _deposition('budget', 2))
+        # components too big for one window fall back to the serial pass,
+        # without starting threads when none of them fit
+        with mock.patch.object(sdr_core, '_MAX_WINDOW_PIXELS', 100):
+            with mock.patch(
+                    'concurrent.futures.ThreadPoolExecutor') as executor_mock:
+                _assert_same(serial_arrays, _deposition('fallback', 2))
+            executor_mock.assert_not_called()
+
     def test_drainage_regression(self):
         """SDR drainage layer regression test on sample data.
 